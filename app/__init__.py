@@ -32,6 +32,16 @@ def create_app(test_config=None):
             SECRET_KEY=os.environ.get('SECRET_KEY', 'dev'),
             SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URI', 'sqlite:///agriport.sqlite'),
             SQLALCHEMY_TRACK_MODIFICATIONS=False,
+            DISTANCE_MATRIX_PATH=os.environ.get(
+                'DISTANCE_MATRIX_PATH', os.path.join('data', 'distances.apdm')
+            ),
+            SCENARIO_CACHE_MAX_ENTRIES=int(os.environ.get('SCENARIO_CACHE_MAX_ENTRIES', 128)),
+            SCENARIO_CACHE_MAX_BYTES=int(os.environ.get('SCENARIO_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+            TILE_CACHE_MAX_ENTRIES=int(os.environ.get('TILE_CACHE_MAX_ENTRIES', 4096)),
+            TILE_CACHE_MAX_BYTES=int(os.environ.get('TILE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            TILE_PRERENDER_MAX_ZOOM=int(os.environ.get('TILE_PRERENDER_MAX_ZOOM', 6)),
+            JOB_WORKERS=int(os.environ.get('JOB_WORKERS', 2)),
+            JOB_RESULTS_DIR=os.environ.get('JOB_RESULTS_DIR'),
         )
     else:
         app.config.from_mapping(test_config)
@@ -46,6 +56,30 @@ def create_app(test_config=None):
     db.init_app(app)
     migrate.init_app(app, db)
     
+    # Memory-map the precomputed distance matrix once per worker
+    from .utils.matrix_store import open_distance_matrix
+    app.extensions['distance_matrix'] = open_distance_matrix(app.config.get('DISTANCE_MATRIX_PATH'))
+    
+    # Per-worker cache of evaluated cost scenarios
+    from .utils.scenario import ScenarioCache, DEFAULT_CACHE_MAX_ENTRIES, DEFAULT_CACHE_MAX_BYTES
+    app.extensions['scenario_cache'] = ScenarioCache(
+        max_entries=app.config.get('SCENARIO_CACHE_MAX_ENTRIES', DEFAULT_CACHE_MAX_ENTRIES),
+        max_bytes=app.config.get('SCENARIO_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES)
+    )
+    
+    # Per-worker cache of rendered map tiles, keyed by scenario and tile
+    from .utils.tiles import DEFAULT_TILE_CACHE_MAX_ENTRIES, DEFAULT_TILE_CACHE_MAX_BYTES, TilePrerenderer
+    app.extensions['tile_cache'] = ScenarioCache(
+        max_entries=app.config.get('TILE_CACHE_MAX_ENTRIES', DEFAULT_TILE_CACHE_MAX_ENTRIES),
+        max_bytes=app.config.get('TILE_CACHE_MAX_BYTES', DEFAULT_TILE_CACHE_MAX_BYTES)
+    )
+    app.extensions['tile_prerenderer'] = TilePrerenderer()
+    
+    # Background job queue; the process pool starts with the first request
+    # (or with `flask jobs-worker`)
+    from .utils.jobs import JobRunner, DEFAULT_JOB_WORKERS
+    app.extensions['job_runner'] = JobRunner(app, max_workers=app.config.get('JOB_WORKERS', DEFAULT_JOB_WORKERS))
+    
     # Enable CORS for development
     if app.debug:
         CORS(app)
@@ -54,6 +88,10 @@ def create_app(test_config=None):
     from .routes import main_bp
     app.register_blueprint(main_bp)
     
+    # Register CLI commands
+    from .cli import register_commands
+    register_commands(app)
+    
     # Simple route to check if app is running
     @app.route('/health')
     def health_check():
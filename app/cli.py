@@ -0,0 +1,246 @@
+"""
+Command line interface for AgriPort Optimizer (run with `flask <command>`)
+"""
+import json
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+def register_commands(app):
+    """
+    Register CLI commands with the Flask application
+    
+    Args:
+        app: Flask application instance
+    """
+    app.cli.add_command(refresh_distances)
+    app.cli.add_command(build_adaptive_grid)
+    app.cli.add_command(assign_points)
+    app.cli.add_command(jobs_worker)
+    app.cli.add_command(data)
+
+@click.command('refresh-distances')
+@click.option('--path', default=None, help='Distance matrix file (default: DISTANCE_MATRIX_PATH)')
+@click.option('--dry-run', is_flag=True, help='Only report which ports would be routed')
+@with_appcontext
+def refresh_distances(path, dry_run):
+    """Route only new or moved ports and mask deactivated ones in the stored distance matrix"""
+    from . import db
+    from .utils.distance_cache import DistanceCache
+    from .utils.matrix_store import refresh_from_database
+    from .utils.routing import create_router
+    
+    path = path or current_app.config['DISTANCE_MATRIX_PATH']
+    router = create_router(cache=DistanceCache())
+    try:
+        summary = refresh_from_database(path, db.session, router, dry_run=dry_run)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    click.echo(json.dumps(summary, indent=2))
+
+@click.command('build-adaptive-grid')
+@click.option('--scenario', 'scenario_path', required=True, type=click.Path(exists=True, dir_okay=False),
+              help='JSON file with fuel_price and optionally ports, as posted to /calculate')
+@click.option('--shapefile', default=None, type=click.Path(exists=True, dir_okay=False),
+              help='Boundary shapefile (default: data/boundaries/argentina.shp)')
+@click.option('--grid-size', type=int, default=100, help='Points per axis at the target resolution')
+@click.option('--cell-size-km', type=float, default=None, help='Grid spacing at the target resolution')
+@click.option('--levels', type=click.IntRange(0, 10), default=4, help='Quadtree levels above the target resolution')
+@click.option('--threshold', type=float, default=None, help='Relative cost gap refined around (default: 0.05)')
+@click.option('--path', default=None, help='Distance matrix file to write (default: DISTANCE_MATRIX_PATH)')
+@with_appcontext
+def build_adaptive_grid(scenario_path, shapefile, grid_size, cell_size_km, levels, threshold, path):
+    """Build the distance matrix on a grid refined only around the scenario's catchment boundaries"""
+    from . import db
+    from .models import Port
+    from .utils.adaptive import build_adaptive_matrix
+    from .utils.cost import DEFAULT_BOUNDARY_THRESHOLD
+    from .utils.distance_cache import DistanceCache
+    from .utils.gis import load_argentina_boundary, build_grid
+    from .utils.routing import create_router
+    
+    with open(scenario_path) as f:
+        scenario = json.load(f)
+    
+    try:
+        grid = build_grid(load_argentina_boundary(shapefile), grid_size=grid_size, cell_size_km=cell_size_km)
+    except (FileNotFoundError, ValueError) as e:
+        raise click.ClickException(str(e))
+    ports = [
+        {**port.to_dict(), 'updated_at': port.updated_at}
+        for port in db.session.query(Port).order_by(Port.id).all()
+    ]
+    
+    try:
+        summary = build_adaptive_matrix(
+            path or current_app.config['DISTANCE_MATRIX_PATH'], grid, ports, scenario,
+            create_router(cache=DistanceCache()), levels=levels,
+            threshold=DEFAULT_BOUNDARY_THRESHOLD if threshold is None else threshold
+        )
+    except (RuntimeError, ValueError) as e:
+        raise click.ClickException(str(e))
+    
+    click.echo(json.dumps(summary, indent=2))
+
+@click.command('assign-points')
+@click.argument('input_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_path', type=click.Path(dir_okay=False))
+@click.option('--scenario', 'scenario_path', required=True, type=click.Path(exists=True, dir_okay=False),
+              help='JSON file with fuel_price and ports, as posted to /calculate')
+@click.option('--id-column', default='id', help='Column passed through as point id')
+@click.option('--osrm', is_flag=True, help='Route points outside the grid with OSRM')
+@with_appcontext
+def assign_points(input_path, output_path, scenario_path, id_column, osrm):
+    """Assign a CSV or Parquet of farm coordinates to their optimal ports"""
+    from .routes import get_distance_matrix, get_raster_cell_rows, get_bulk_router
+    from .utils.bulk import BULK_FORMATS, iter_point_chunks, assign_stream
+    from .utils.scenario import ScenarioError, parse_scenario
+    
+    def file_format(path):
+        extension = path.lower().rsplit('.', 1)[-1]
+        return {'pq': 'parquet', 'arrows': 'arrow'}.get(extension, extension)
+    
+    input_format, output_format = file_format(input_path), file_format(output_path)
+    if input_format not in ('csv', 'parquet'):
+        raise click.ClickException("Input must be a .csv or .parquet file")
+    if output_format not in BULK_FORMATS:
+        raise click.ClickException(f"Output must be one of: {', '.join(BULK_FORMATS)}")
+    
+    store = get_distance_matrix()
+    if store is None:
+        raise click.ClickException("Distance matrix not available")
+    
+    with open(scenario_path) as f:
+        try:
+            scenario = parse_scenario(json.load(f), store)
+        except (ScenarioError, ValueError) as e:
+            raise click.ClickException(f"Invalid scenario: {e}")
+    
+    router, ports_latlon = get_bulk_router(scenario, store) if osrm else (None, None)
+    raster, cell_rows = get_raster_cell_rows(store)
+    
+    stats = {}
+    chunks = iter_point_chunks(input_path, input_format, id_column)
+    with open(output_path, 'wb') as out:
+        for part in assign_stream(scenario, store, raster, cell_rows, chunks, output_format,
+                                  router=router, ports_latlon=ports_latlon, stats=stats):
+            out.write(part)
+    
+    click.echo(json.dumps({'output': output_path, **stats}, indent=2))
+
+@click.command('jobs-worker')
+@click.option('--workers', type=int, default=None, help='Pool processes (default: JOB_WORKERS)')
+@with_appcontext
+def jobs_worker(workers):
+    """Run queued background jobs until interrupted (set JOB_WORKERS=0 on the web workers)"""
+    import time
+    from .utils.jobs import JobRunner
+    
+    runner = JobRunner(current_app._get_current_object(),
+                       max_workers=workers if workers is not None else current_app.config.get('JOB_WORKERS', 2))
+    if runner.max_workers <= 0:
+        raise click.ClickException("At least one worker is required")
+    
+    runner.start()
+    click.echo(f"Running jobs with {runner.max_workers} workers, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        click.echo("Stopping; running jobs will be requeued by the next runner")
+        runner.shutdown(wait=False)
+
+@click.group('data')
+def data():
+    """Bulk load grid points and distances into the database"""
+
+@data.command('seed-grid')
+@click.option('--shapefile', default=None, type=click.Path(exists=True, dir_okay=False),
+              help='Build the grid inside this boundary instead of using the distance matrix grid')
+@click.option('--grid-size', type=int, default=100, help='Points per axis when building a grid')
+@click.option('--cell-size-km', type=float, default=None, help='Grid spacing when building a grid')
+@click.option('--csv', 'csv_path', default=None, type=click.Path(exists=True, dir_okay=False),
+              help='CSV with grid_point_id, lat and lon columns (e.g. a build_grid job result)')
+@click.option('--replace', is_flag=True, help='Delete existing grid points and distances first')
+@with_appcontext
+def seed_grid(shapefile, grid_size, cell_size_km, csv_path, replace):
+    """Load grid points; by default the grid of the stored distance matrix"""
+    from . import db
+    from .routes import get_distance_matrix
+    from .utils.grid import Grid
+    from .utils.seed import seed_grid as load_grid
+    
+    if shapefile and csv_path:
+        raise click.ClickException("Use either --shapefile or --csv")
+    
+    ids = None
+    if csv_path:
+        import pandas as pd
+        
+        points = pd.read_csv(csv_path, usecols=['grid_point_id', 'lat', 'lon'])
+        try:
+            grid = Grid.from_coordinates(points['lat'].to_numpy(), points['lon'].to_numpy())
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        # The inferred raster need not be the one the ids were numbered on, so
+        # the file's ids are loaded as they are and kept out of the Grid
+        ids = points['grid_point_id'].to_numpy()
+    elif shapefile:
+        from .utils.gis import load_argentina_boundary, build_grid
+        
+        grid = build_grid(load_argentina_boundary(shapefile), grid_size=grid_size, cell_size_km=cell_size_km)
+    else:
+        store = get_distance_matrix()
+        if store is None or 'raster' not in store.metadata:
+            raise click.ClickException("No raster distance matrix available; use --shapefile or --csv")
+        grid = Grid.from_ids(store.grid_ids, store.metadata['raster'])
+    
+    try:
+        summary = load_grid(db.session, grid, replace=replace, ids=ids)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    click.echo(json.dumps(summary, indent=2))
+
+@data.command('seed-distances')
+@click.option('--path', default=None, help='Distance matrix file (default: DISTANCE_MATRIX_PATH)')
+@click.option('--port', 'port_ids', type=int, multiple=True, help='Only load these ports (repeatable)')
+@with_appcontext
+def seed_distances(path, port_ids):
+    """Load the stored distance matrix into the distances table, replacing its ports' rows"""
+    from . import db
+    from .utils.matrix_store import open_distance_matrix
+    from .utils.seed import seed_distances as load_distances
+    
+    store = open_distance_matrix(path or current_app.config['DISTANCE_MATRIX_PATH'])
+    if store is None:
+        raise click.ClickException("Distance matrix not available")
+    
+    try:
+        summary = load_distances(db.session, store, port_ids=port_ids or None)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    click.echo(json.dumps(summary, indent=2))
+
+@data.command('verify')
+@click.option('--path', default=None, help='Distance matrix file to compare with (default: DISTANCE_MATRIX_PATH)')
+@click.option('--no-matrix', is_flag=True, help='Only check the database')
+@with_appcontext
+def verify(path, no_matrix):
+    """Check row counts, orphaned distances and indexes of the loaded data"""
+    from . import db
+    from .utils.matrix_store import open_distance_matrix
+    from .utils.seed import verify_seed
+    
+    store = None
+    if not no_matrix:
+        store = open_distance_matrix(path or current_app.config['DISTANCE_MATRIX_PATH'])
+        if store is None:
+            raise click.ClickException("Distance matrix not available; use --no-matrix to check the database only")
+    
+    report = verify_seed(db.session, store)
+    click.echo(json.dumps(report, indent=2))
+    if report['problems']:
+        raise click.ClickException(f"{len(report['problems'])} problems found")
\ No newline at end of file
@@ -2,7 +2,8 @@
 Database models for AgriPort Optimizer
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean
+import json
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Text
 from geoalchemy2 import Geometry
 from . import db
 
@@ -64,8 +65,16 @@ class GridPoint(db.Model):
 class Distance(db.Model):
     """
     Distance model for storing precomputed distances between grid points and ports
+    
+    The (port_id, grid_point_id) index covers distance_km on PostgreSQL, so
+    reading the distances of a scenario's ports is one index-only range scan
+    per port.
     """
     __tablename__ = 'distances'
+    __table_args__ = (
+        db.UniqueConstraint('grid_point_id', 'port_id', name='uq_distances_grid_point_port'),
+        db.Index('ix_distances_port_grid_point', 'port_id', 'grid_point_id', postgresql_include=['distance_km']),
+    )
     
     id = Column(Integer, primary_key=True)
     grid_point_id = Column(Integer, db.ForeignKey('grid_points.id'), nullable=False)
@@ -77,4 +86,51 @@ class Distance(db.Model):
     port = db.relationship('Port', backref=db.backref('distances', lazy=True))
     
     def __repr__(self):
-        return f"<Distance Grid:{self.grid_point_id} to Port:{self.port_id} = {self.distance_km}km>"
\ No newline at end of file
+        return f"<Distance Grid:{self.grid_point_id} to Port:{self.port_id} = {self.distance_km}km>"
+
+class Job(db.Model):
+    """
+    Job model for long computations run in the background process pool
+    
+    Rows are the queue itself: any job runner claims queued rows, so queued
+    and interrupted jobs survive a restart of the web workers.
+    """
+    __tablename__ = 'jobs'
+    
+    id = Column(String(32), primary_key=True)
+    kind = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False, default='queued', index=True)
+    params = Column(Text, nullable=False, default='{}')
+    progress = Column(Float, nullable=False, default=0.0)
+    message = Column(String(255))
+    result = Column(Text)
+    error = Column(Text)
+    attempts = Column(Integer, nullable=False, default=0)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    
+    def __repr__(self):
+        return f"<Job {self.id} {self.kind} {self.status}>"
+    
+    def to_dict(self):
+        """
+        Convert job to dictionary for API responses
+        """
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'params': json.loads(self.params or '{}'),
+            'progress': round(self.progress or 0.0, 4),
+            'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'attempts': self.attempts,
+            'cancel_requested': bool(self.cancel_requested),
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
\ No newline at end of file
@@ -1,12 +1,370 @@
 """
 Main routes for AgriPort Optimizer
 """
-from flask import Blueprint, render_template, request, jsonify, current_app
+from flask import (
+    Blueprint, render_template, request, jsonify, current_app, Response, stream_with_context, send_file, url_for
+)
 import json
 import os
+import itertools
+import shutil
+import tempfile
+import numpy as np
+from .utils.matrix_store import STALE_CHECK_INTERVAL, open_distance_matrix
+from .utils.grid import Grid
+from .utils.adaptive import fill_cell_index, unpack_mask
+from .utils.export import (
+    EXPORT_FORMATS, RASTER_FIELDS, arrow_available, export_stream, gzip_stream, encode_result_raster,
+    pack_result_raster, result_raster_base64
+)
+from .utils.scenario import (
+    ScenarioError, ScenarioResult, parse_scenario, run_scenario, envelope_key, run_envelope,
+    parse_batch, run_batch, apply_port_delta, delta_response
+)
+from .utils.lookup import MAX_LOOKUP_POINTS, lookup_points, lookup_response
+from .utils.bulk import BULK_FORMATS, iter_point_chunks, port_coordinates, assign_stream
+from .utils.jobs import JobError, JOB_SUCCEEDED, job_results_dir
+from .utils.tiles import (
+    MAX_TILE_ZOOM, TILE_LAYERS, DEFAULT_PRERENDER_MAX_ZOOM, Tile, tile_key, render_tile
+)
 
 main_bp = Blueprint('main', __name__)
 
+class ResultNotModified(Exception):
+    """The client's If-None-Match already names the requested result"""
+    def __init__(self, etag: str):
+        super().__init__(etag)
+        self.etag = etag
+
+@main_bp.before_app_request
+def start_job_runner():
+    """Start the worker's job runner, which also picks up jobs left by earlier workers"""
+    current_app.extensions['job_runner'].start()
+
+def get_distance_matrix():
+    """
+    Get the worker's distance matrix, reopening it if the file was refreshed
+    
+    The file is checked at most once per STALE_CHECK_INTERVAL. Results and
+    grids are cached per matrix version; should a reopened file not have a
+    newer version (e.g. deleted and rebuilt), those caches are dropped.
+    
+    Returns:
+        DistanceMatrixStore or None if no matrix has been built
+    """
+    previous = current_app.extensions.get('distance_matrix')
+    if previous is not None and not previous.is_stale(min_interval=STALE_CHECK_INTERVAL):
+        return previous
+    
+    store = open_distance_matrix(current_app.config.get('DISTANCE_MATRIX_PATH'))
+    current_app.extensions['distance_matrix'] = store
+    if previous is not None and (store is None or store.version <= previous.version):
+        current_app.extensions['scenario_cache'].clear()
+        current_app.extensions['tile_cache'].clear()
+        for name in ('grid', 'grid_fill', 'grid_coordinates'):
+            current_app.extensions.pop(name, None)
+    return store
+
+def result_etag(key, variant=None):
+    """ETag of a scenario result, suffixed with the variant for other encodings"""
+    return key if variant is None else f"{key}-{variant}"
+
+def raster_variant(encoding, fields, compress):
+    """Variant name of a raster-encoded result (cache key and ETag suffix)"""
+    return '-'.join([encoding, *fields] + (['gz'] if compress else []))
+
+def not_modified_response(etag):
+    """304 response for a client that already has the result"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def get_scenario_result(data, envelope=False, variant=None):
+    """
+    Parse a scenario and return its result, from the cache when possible
+    
+    A client whose If-None-Match already names the result is answered before
+    the cache is consulted or anything is computed.
+    
+    Args:
+        data: Request JSON with fuel_price and ports
+        envelope: Return the fuel-price envelope (fuel_price optional,
+                  fuel_min/fuel_max bound the price range) instead of
+                  the result at a single fuel price
+        variant: ETag suffix of the encoding the response will use
+    
+    Returns:
+        Tuple of (ScenarioResult or EnvelopeResult, cache hit flag)
+    
+    Raises:
+        ScenarioError: If the scenario input is invalid
+        LookupError: If no distance matrix is available
+        ResultNotModified: If the client already has the result
+    """
+    store = get_distance_matrix()
+    if store is None:
+        raise LookupError("Distance matrix not available")
+    
+    scenario = parse_scenario(data, store, require_fuel_price=not envelope)
+    cache = current_app.extensions['scenario_cache']
+    
+    if envelope:
+        fuel_min = data.get('fuel_min', 0.0)
+        fuel_max = data.get('fuel_max')
+        if not isinstance(fuel_min, (int, float)) or fuel_min < 0:
+            raise ScenarioError("fuel_min must be a non-negative number")
+        if fuel_max is not None and (not isinstance(fuel_max, (int, float)) or fuel_max < fuel_min):
+            raise ScenarioError("fuel_max must be a number not below fuel_min")
+        key = envelope_key(scenario, fuel_min, fuel_max)
+    else:
+        key = scenario.key
+    
+    etag = result_etag(key, variant)
+    if etag in request.if_none_match:
+        raise ResultNotModified(etag)
+    
+    result = cache.get(key)
+    if result is not None:
+        return result, True
+    
+    if envelope:
+        result = run_envelope(scenario, store, fuel_min, fuel_max)
+    else:
+        result = run_scenario(scenario, store)
+    cache.put(result)
+    return result, False
+
+def cached_result_response(result, cache_hit, body=None, mimetype='application/json', variant=None):
+    """
+    Response for a cached result, honouring If-None-Match
+    
+    Args:
+        result: ScenarioResult or EnvelopeResult
+        cache_hit: Whether the result came from the cache
+        body: Payload to send (default: the result's JSON body)
+        mimetype: Payload content type
+        variant: Suffix distinguishing the ETag of other encodings
+    
+    Returns:
+        Flask Response (304 if the client already has this result)
+    """
+    etag = result_etag(result.key, variant)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(result.body if body is None else body, mimetype=mimetype)
+        # The body or encoding may have just been built
+        current_app.extensions['scenario_cache'].resize(result)
+    response.set_etag(etag)
+    response.headers['X-Scenario-Cache'] = 'hit' if cache_hit else 'miss'
+    return response
+
+def get_grid(store):
+    """
+    Get the Grid of the distance matrix, with one point per matrix row
+    
+    Grids built on a raster (raster description in the matrix metadata) are
+    rebuilt from the ids; otherwise the raster is inferred from the
+    grid_points coordinates. The grid is kept by the worker per matrix version.
+    
+    Args:
+        store: DistanceMatrixStore
+    
+    Returns:
+        Grid
+    
+    Raises:
+        ValueError: If the matrix rows cannot be placed on a raster
+    """
+    cached = current_app.extensions.get('grid')
+    if cached is not None and cached[0] == store.version:
+        return cached[1]
+    
+    raster = store.metadata.get('raster')
+    if raster is not None:
+        # Grids built on a raster use the flat cell index as grid point id
+        grid = Grid.from_ids(store.grid_ids, raster)
+    else:
+        lat, lon = get_grid_coordinates(store)(0, store.n_grid)
+        grid = Grid.from_coordinates(lat, lon)
+    
+    current_app.extensions['grid'] = (store.version, grid)
+    return grid
+
+def get_grid_raster(store):
+    """
+    Get the raster of the matrix's grid and the matrix row painted into each covered cell
+    
+    Args:
+        store: DistanceMatrixStore
+    
+    Returns:
+        Tuple of (raster description, flat raster cells, matrix row per cell);
+        the rows are None when every matrix row covers exactly its own cell
+    """
+    grid = get_grid(store)
+    if not store.metadata.get('adaptive'):
+        return grid.raster, grid.ids, None
+    
+    # Leaves of an adaptive grid cover many cells with one node
+    raster, cell_rows = get_raster_cell_rows(store)
+    cells = np.flatnonzero(cell_rows >= 0)
+    return raster, cells, cell_rows[cells]
+
+def get_raster_cell_rows(store):
+    """
+    Get the raster of the matrix's grid and the matrix row of every raster cell
+    
+    For adaptive grids every cell of the uniform grid the matrix was refined
+    from maps to the node of its quadtree leaf, so tiles and point lookups
+    cover the whole grid but not the cells it leaves out; the filled index is
+    kept by the worker per matrix version.
+    
+    Args:
+        store: DistanceMatrixStore
+    
+    Returns:
+        Tuple of (raster description, matrix row per raster cell, -1 for empty cells)
+    """
+    grid = get_grid(store)
+    adaptive = store.metadata.get('adaptive')
+    if not adaptive:
+        return grid.raster, grid.cell_index
+    
+    cached = current_app.extensions.get('grid_fill')
+    if cached is None or cached[0] != store.version:
+        # Matrices written before the mask was stored fill whole leaves
+        inside = adaptive.get('inside_mask')
+        if inside is not None:
+            inside = unpack_mask(inside, grid.n_rows, grid.n_cols)
+        cached = (store.version, fill_cell_index(grid, adaptive['max_step'], inside))
+        current_app.extensions['grid_fill'] = cached
+    return grid.raster, cached[1]
+
+def schedule_tile_prerender(result):
+    """
+    Queue the low zoom tiles of a new result on the worker's tile prerenderer
+    
+    Args:
+        result: ScenarioResult just computed
+    """
+    max_zoom = current_app.config.get('TILE_PRERENDER_MAX_ZOOM', DEFAULT_PRERENDER_MAX_ZOOM)
+    if max_zoom is None or max_zoom < 0:
+        return
+    
+    raster, cell_rows = get_raster_cell_rows(get_distance_matrix())
+    current_app.extensions['tile_prerenderer'].submit(
+        result, raster, cell_rows, current_app.extensions['tile_cache'], max_zoom
+    )
+
+def encoded_result_response(result, cache_hit, encoding, fields):
+    """
+    Raster-encoded response for the map client
+    
+    The encoded arrays are mostly runs of equal port indices and NaN
+    padding, so the body is gzipped for clients that accept it.
+    
+    Args:
+        result: ScenarioResult
+        cache_hit: Whether the result came from the cache
+        encoding: 'binary' (application/octet-stream) or 'base64' (JSON)
+        fields: Arrays to include
+    
+    Returns:
+        Flask Response
+    """
+    compress = 'gzip' in request.accept_encodings
+    variant = raster_variant(encoding, fields, compress)
+    
+    body = result.encodings.get(variant)
+    if body is None:
+        raster, cells, rows = get_grid_raster(get_distance_matrix())
+        header, arrays = encode_result_raster(result, raster, cells, fields, rows=rows)
+        if encoding == 'binary':
+            body = pack_result_raster(header, arrays)
+        else:
+            body = json.dumps(result_raster_base64(header, arrays), separators=(',', ':')).encode('utf-8')
+        if compress:
+            body = b''.join(gzip_stream([body]))
+        result.encodings[variant] = body
+    
+    mimetype = 'application/octet-stream' if encoding == 'binary' else 'application/json'
+    response = cached_result_response(result, cache_hit, body=body, mimetype=mimetype, variant=variant)
+    if compress and response.status_code == 200:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def get_grid_coordinates(store):
+    """
+    Get a function returning (lat, lon) for a range of distance matrix rows
+    
+    Grids built on a raster (raster description in the matrix metadata) are
+    computed from the ids chunk by chunk; otherwise coordinates are loaded
+    from grid_points once per matrix version and kept by the worker.
+    
+    Args:
+        store: DistanceMatrixStore
+    
+    Returns:
+        Function (start, stop) -> (lat, lon)
+    """
+    if store.metadata.get('raster') is not None:
+        grid = get_grid(store)
+        return lambda start, stop: (grid.lat[start:stop], grid.lon[start:stop])
+    
+    cached = current_app.extensions.get('grid_coordinates')
+    if cached is None or cached[0] != store.version:
+        from .models import GridPoint
+        rows = GridPoint.query.with_entities(GridPoint.id, GridPoint.lat, GridPoint.lon).all()
+        table = np.array(rows, dtype=np.float64).reshape(-1, 3)
+        order = np.argsort(table[:, 0])
+        ids, lats, lons = table[order, 0].astype(np.int64), table[order, 1], table[order, 2]
+        
+        # Align with the matrix rows; grid points missing from the table get NaN
+        positions = np.minimum(np.searchsorted(ids, store.grid_ids), max(len(ids) - 1, 0))
+        found = (ids[positions] == store.grid_ids) if len(ids) else np.zeros(store.n_grid, dtype=bool)
+        lat = np.where(found, lats[positions] if len(ids) else np.nan, np.nan)
+        lon = np.where(found, lons[positions] if len(ids) else np.nan, np.nan)
+        
+        cached = (store.version, lat, lon)
+        current_app.extensions['grid_coordinates'] = cached
+    
+    _, lat, lon = cached
+    return lambda start, stop: (lat[start:stop], lon[start:stop])
+
+def preload_data(app):
+    """
+    Load the worker data of the distance matrix into the application
+    
+    Meant for the server's master process before it forks workers (see
+    gunicorn.conf.py): the matrix stays a read-only memory map shared through
+    the page cache, and the arrays derived from it (raster cells, grid
+    coordinates) are built once and shared by the workers copy-on-write
+    instead of being rebuilt by each of them.
+    
+    Args:
+        app: Flask application
+    
+    Returns:
+        Number of grid points loaded (0 if no matrix has been built)
+    """
+    from . import db
+    
+    with app.app_context():
+        store = get_distance_matrix()
+        if store is None:
+            return 0
+        
+        store.prefetch()
+        get_raster_cell_rows(store)
+        get_grid_coordinates(store)
+        
+        # Connections opened while loading must not be shared with the workers
+        db.session.remove()
+        db.engine.dispose()
+        return store.n_grid
+
 @main_bp.route('/')
 def index():
     """Render the main page"""
@@ -25,11 +383,22 @@ def calculate():
                 "id": int,
                 "name": string,
                 "port_charge": float,
-                "sea_freight": float
+                "sea_freight": float,
+                "active": bool (optional, default true)
             },
             ...
         ]
     }
+    
+    Results are cached per scenario; the scenario id is sent as ETag and a
+    matching If-None-Match returns 304 Not Modified.
+    
+    Query parameters:
+    - format: 'json' (default), 'binary' (raster header and typed arrays as
+      application/octet-stream) or 'base64' (the same arrays base64-encoded
+      in JSON); see app/utils/export.py for the layout
+    - fields: comma-separated raster arrays for the binary formats
+      (default: port_index,total_cost,gradient)
     """
     try:
         # Validate input
@@ -37,46 +406,606 @@ def calculate():
             return jsonify({"error": "Request must be JSON"}), 400
         
         data = request.get_json()
-        
-        # Basic validation
-        if "fuel_price" not in data or not isinstance(data["fuel_price"], (int, float)):
-            return jsonify({"error": "Valid fuel price required"}), 400
-        
-        if "ports" not in data or not isinstance(data["ports"], list) or len(data["ports"]) == 0:
-            return jsonify({"error": "At least one port is required"}), 400
+        result_format = request.args.get('format', 'json').lower()
+        if result_format not in ('json', 'binary', 'base64'):
+            return jsonify({"error": "format must be json, binary or base64"}), 400
+        fields = tuple(field for field in request.args.get('fields', ','.join(RASTER_FIELDS)).split(',') if field)
+        if not fields or any(field not in RASTER_FIELDS for field in fields):
+            return jsonify({"error": f"fields must be a subset of {', '.join(RASTER_FIELDS)}"}), 400
         
         # Log the request (for development)
         if current_app.debug:
             current_app.logger.debug(f"Calculation request: {data}")
         
-        # TODO: This is where actual calculation logic will go
-        # For now, return placeholder data
+        variant = None
+        if result_format != 'json':
+            variant = raster_variant(result_format, fields, 'gzip' in request.accept_encodings)
+        
+        try:
+            result, cache_hit = get_scenario_result(data, variant=variant)
+        except ResultNotModified as e:
+            response = not_modified_response(e.etag)
+            if variant is not None:
+                response.vary.add('Accept-Encoding')
+            return response
+        except ScenarioError as e:
+            return jsonify({"error": str(e)}), 400
+        except LookupError as e:
+            return jsonify({"error": str(e)}), 503
         
-        return jsonify({
-            "status": "success",
-            "message": "Calculation endpoint ready. Implementation pending.",
-            "received_data": data
-        })
+        if not cache_hit:
+            schedule_tile_prerender(result)
+        
+        if result_format != 'json':
+            return encoded_result_response(result, cache_hit, result_format, fields)
+        return cached_result_response(result, cache_hit)
     
     except Exception as e:
         current_app.logger.error(f"Error in calculate: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+@main_bp.route('/calculate/envelope', methods=['POST'])
+def calculate_envelope():
+    """
+    Optimal port per grid point for every fuel price at once
+    
+    Takes the /calculate input (fuel_price optional) plus optional
+    fuel_min/fuel_max. For each grid point the response lists the sorted fuel
+    prices where the optimal port changes and the winning port index (into
+    port_ids) on each interval, in CSR form: grid point i has
+    breakpoints[offsets[i]:offsets[i+1]] and winners[offsets[i]+i:offsets[i+1]+i+1].
+    """
+    try:
+        if not request.is_json:
+            return jsonify({"error": "Request must be JSON"}), 400
+        
+        try:
+            result, cache_hit = get_scenario_result(request.get_json(), envelope=True)
+        except ResultNotModified as e:
+            return not_modified_response(e.etag)
+        except ScenarioError as e:
+            return jsonify({"error": str(e)}), 400
+        except LookupError as e:
+            return jsonify({"error": str(e)}), 503
+        
+        return cached_result_response(result, cache_hit)
+    
+    except Exception as e:
+        current_app.logger.error(f"Error in calculate_envelope: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@main_bp.route('/calculate/batch', methods=['POST'])
+def calculate_batch():
+    """
+    Evaluate many what-if scenarios in one request
+    
+    Expected input JSON:
+    {
+        "fuel_price": float (default for every scenario, optional),
+        "ports": [...] (default for every scenario, optional),
+        "baseline": {"fuel_price": ..., "ports": [...]} (optional, default: first scenario),
+        "scenarios": [{"fuel_price": ..., "ports": [...]}, ...],
+        "include_assignments": bool (default true)
+    }
+    
+    Each scenario reports the grid point count per port, the mean cost and
+    how many grid points change port compared with the baseline; with
+    include_assignments, "port_id" holds the optimal port of every grid point
+    (aligned with "grid_point_id", -1 if unreachable).
+    """
+    try:
+        if not request.is_json:
+            return jsonify({"error": "Request must be JSON"}), 400
+        
+        data = request.get_json()
+        store = get_distance_matrix()
+        if store is None:
+            return jsonify({"error": "Distance matrix not available"}), 503
+        
+        try:
+            scenarios, baseline = parse_batch(data, store)
+        except ScenarioError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        return jsonify(run_batch(
+            scenarios, store, baseline=baseline,
+            include_assignments=bool(data.get('include_assignments', True))
+        ))
+    
+    except Exception as e:
+        current_app.logger.error(f"Error in calculate_batch: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@main_bp.route('/calculate/delta', methods=['POST'])
+def calculate_delta():
+    """
+    Recalculate after one port's costs change, returning only the changed grid points
+    
+    Expected input JSON:
+    {
+        "scenario_id": string (from a previous /calculate or /calculate/delta),
+        "port_id": int,
+        "port_charge": float (optional),
+        "sea_freight": float (optional)
+    }
+    
+    The new scenario is cached like a /calculate result, so its scenario_id
+    can be the base of the next change.
+    """
+    try:
+        if not request.is_json:
+            return jsonify({"error": "Request must be JSON"}), 400
+        
+        data = request.get_json()
+        if not isinstance(data, dict) or not isinstance(data.get('port_id'), int) or isinstance(data['port_id'], bool):
+            return jsonify({"error": "An integer port_id is required"}), 400
+        if not isinstance(data.get('scenario_id'), str):
+            return jsonify({"error": "A scenario_id string is required"}), 400
+        for field in ('port_charge', 'sea_freight'):
+            value = data.get(field)
+            if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)):
+                return jsonify({"error": f"{field} must be a number"}), 400
+        
+        store = get_distance_matrix()
+        if store is None:
+            return jsonify({"error": "Distance matrix not available"}), 503
+        
+        cache = current_app.extensions['scenario_cache']
+        base = cache.get(data['scenario_id'])
+        if not isinstance(base, ScenarioResult):
+            return jsonify({"error": "Unknown scenario_id, run /calculate first"}), 404
+        if base.scenario.matrix_version != store.version:
+            return jsonify({"error": "Distance matrix has changed, run /calculate again"}), 409
+        
+        try:
+            result, changed_rows = apply_port_delta(
+                base, store, data['port_id'], data.get('port_charge'), data.get('sea_freight')
+            )
+        except ScenarioError as e:
+            return jsonify({"error": str(e)}), 400
+        # The base result may have gained a margin index
+        cache.resize(base)
+        cache.put(result)
+        schedule_tile_prerender(result)
+        
+        response = jsonify(delta_response(base, result, changed_rows, data['port_id']))
+        response.set_etag(result.key)
+        return response
+    
+    except Exception as e:
+        current_app.logger.error(f"Error in calculate_delta: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+def parse_lookup_points(data):
+    """
+    Parse the coordinates of a /lookup request
+    
+    Args:
+        data: Query arguments (lat, lon) or request JSON with points
+    
+    Returns:
+        Tuple of (lat, lon) arrays
+    
+    Raises:
+        ScenarioError: If the coordinates are missing or invalid
+    """
+    if 'points' in data:
+        points = data['points']
+        if not isinstance(points, list) or not points:
+            raise ScenarioError("points must be a non-empty list")
+        if len(points) > MAX_LOOKUP_POINTS:
+            raise ScenarioError(f"At most {MAX_LOOKUP_POINTS} points per request")
+        try:
+            pairs = [(point['lat'], point['lon']) if isinstance(point, dict) else tuple(point) for point in points]
+            coordinates = np.array(pairs, dtype=np.float64).reshape(len(points), 2)
+        except (KeyError, TypeError, ValueError):
+            raise ScenarioError("Each point must be {\"lat\": float, \"lon\": float} or [lat, lon]")
+    else:
+        try:
+            coordinates = np.array([[float(data['lat']), float(data['lon'])]])
+        except (KeyError, TypeError, ValueError):
+            raise ScenarioError("lat and lon are required numbers")
+    
+    lat, lon = coordinates[:, 0], coordinates[:, 1]
+    if not (np.all(np.abs(lat) <= 90) and np.all(np.abs(lon) <= 180)):
+        raise ScenarioError("Coordinates out of range")
+    return lat, lon
+
+@main_bp.route('/lookup', methods=['GET', 'POST'])
+def lookup():
+    """
+    Optimal and runner-up port for arbitrary coordinates
+    
+    Costs are interpolated from the precomputed distances of the four grid
+    points around each coordinate, so no routing request is made.
+    
+    GET query parameters: lat, lon and scenario_id (from /calculate).
+    
+    POST input JSON:
+    {
+        "points": [{"lat": float, "lon": float} or [lat, lon], ...],
+        "scenario_id": string (or fuel_price and ports as for /calculate)
+    }
+    """
+    try:
+        if request.method == 'POST':
+            if not request.is_json:
+                return jsonify({"error": "Request must be JSON"}), 400
+            data = request.get_json()
+            if not isinstance(data, dict):
+                return jsonify({"error": "Request must be a JSON object"}), 400
+        else:
+            data = request.args.to_dict()
+        
+        store = get_distance_matrix()
+        if store is None:
+            return jsonify({"error": "Distance matrix not available"}), 503
+        
+        try:
+            lat, lon = parse_lookup_points(data)
+            if 'scenario_id' in data:
+                if not isinstance(data['scenario_id'], str):
+                    raise ScenarioError("scenario_id must be a string")
+                result = current_app.extensions['scenario_cache'].get(data['scenario_id'])
+                if not isinstance(result, ScenarioResult):
+                    return jsonify({"error": "Unknown scenario_id, run /calculate first"}), 404
+                if result.scenario.matrix_version != store.version:
+                    return jsonify({"error": "Distance matrix has changed, run /calculate again"}), 409
+                scenario = result.scenario
+            else:
+                scenario = parse_scenario(data, store)
+        except ScenarioError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        raster, cell_rows = get_raster_cell_rows(store)
+        found = lookup_points(scenario, store, raster, cell_rows, lat, lon)
+        return jsonify(lookup_response(scenario, found, store.grid_ids, lat, lon))
+    
+    except Exception as e:
+        current_app.logger.error(f"Error in lookup: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+def get_bulk_router(scenario, store):
+    """
+    Build the router and port coordinates for points outside the grid
+    
+    Ports the matrix header has no coordinates for are looked up in the
+    ports table.
+    
+    Args:
+        scenario: Normalized scenario
+        store: DistanceMatrixStore
+    
+    Returns:
+        Tuple of (router selected by ROUTER_BACKEND, port coordinates aligned
+        with scenario.port_ids)
+    """
+    from .models import Port
+    from .utils.distance_cache import DistanceCache
+    from .utils.routing import create_router
+    
+    try:
+        ports_latlon = port_coordinates(store, scenario.port_ids)
+    except KeyError:
+        ports = Port.query.filter(Port.id.in_([int(port_id) for port_id in scenario.port_ids])).all()
+        ports_latlon = port_coordinates(
+            store, scenario.port_ids, fallback={port.id: (port.lat, port.lon) for port in ports}
+        )
+    return create_router(cache=DistanceCache()), ports_latlon
+
+@main_bp.route('/assign', methods=['POST'])
+def assign():
+    """
+    Assign an uploaded table of farm or silo coordinates to their optimal ports
+    
+    Multipart form fields:
+    - file: CSV or Parquet with lat/lon columns (latitude/longitude, lng and
+      x/y are accepted too) and an optional id column
+    - scenario_id: Scenario from /calculate, or
+    - scenario: JSON with fuel_price and ports as for /calculate
+    
+    Query parameters:
+    - format: 'csv' (default), 'parquet' or 'arrow'
+    - input_format: 'csv' or 'parquet' (default: from the file name)
+    - id_column: Column passed through as point id (default: id)
+    - osrm: '1' to route points outside the grid with OSRM
+    - gzip: '1' to gzip the output on the fly
+    
+    The assignments are streamed back in chunks in the input order.
+    """
+    try:
+        upload = request.files.get('file')
+        if upload is None:
+            return jsonify({"error": "A file upload is required"}), 400
+        
+        output_format = request.args.get('format', 'csv').lower()
+        if output_format not in BULK_FORMATS:
+            return jsonify({"error": f"Unsupported format, expected one of {', '.join(BULK_FORMATS)}"}), 400
+        
+        filename = (upload.filename or '').lower()
+        default_input = 'parquet' if filename.endswith(('.parquet', '.pq')) else 'csv'
+        input_format = request.args.get('input_format', default_input).lower()
+        if input_format not in ('csv', 'parquet'):
+            return jsonify({"error": "input_format must be csv or parquet"}), 400
+        if 'parquet' in (input_format, output_format) or output_format == 'arrow':
+            if not arrow_available():
+                return jsonify({"error": "Parquet and Arrow files require pyarrow"}), 501
+        
+        store = get_distance_matrix()
+        if store is None:
+            return jsonify({"error": "Distance matrix not available"}), 503
+        
+        try:
+            if request.form.get('scenario_id'):
+                result = current_app.extensions['scenario_cache'].get(request.form['scenario_id'])
+                if not isinstance(result, ScenarioResult):
+                    return jsonify({"error": "Unknown scenario_id, run /calculate first"}), 404
+                if result.scenario.matrix_version != store.version:
+                    return jsonify({"error": "Distance matrix has changed, run /calculate again"}), 409
+                scenario = result.scenario
+            else:
+                try:
+                    data = json.loads(request.form.get('scenario', ''))
+                except ValueError:
+                    raise ScenarioError("scenario must be JSON with fuel_price and ports, or give a scenario_id")
+                scenario = parse_scenario(data, store)
+            
+            # Uploads are closed when the view returns, before the response is
+            # streamed, so the points are read from a copy owned by the stream
+            points_file = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            shutil.copyfileobj(upload.stream, points_file)
+            points_file.seek(0)
+            
+            # Read the first chunk now so a malformed file fails before streaming starts
+            chunks = iter_point_chunks(points_file, input_format, request.args.get('id_column', 'id'))
+            first = next(chunks, None)
+            point_chunks = itertools.chain([first], chunks) if first is not None else iter(())
+        except (ScenarioError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        
+        router, ports_latlon = None, None
+        if request.args.get('osrm', '0').lower() in ('1', 'true', 'yes'):
+            try:
+                router, ports_latlon = get_bulk_router(scenario, store)
+            except KeyError as e:
+                return jsonify({"error": str(e.args[0])}), 400
+        
+        raster, cell_rows = get_raster_cell_rows(store)
+        gzip = request.args.get('gzip', '0').lower() in ('1', 'true', 'yes')
+        stream = assign_stream(
+            scenario, store, raster, cell_rows, point_chunks, output_format,
+            gzip=gzip, router=router, ports_latlon=ports_latlon
+        )
+        
+        def stream_and_close():
+            try:
+                yield from stream
+            finally:
+                points_file.close()
+        
+        mimetype, extension = BULK_FORMATS[output_format]
+        filename = f"agriport_assignments.{extension}"
+        if gzip:
+            mimetype, filename = 'application/gzip', filename + '.gz'
+        
+        return Response(
+            stream_with_context(stream_and_close()),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+    
+    except Exception as e:
+        current_app.logger.error(f"Error in assign: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@main_bp.route('/calculate/stats', methods=['GET'])
+def calculate_stats():
+    """Scenario cache statistics"""
+    store = get_distance_matrix()
+    return jsonify({
+        "matrix_version": store.version if store is not None else None,
+        "router_backend": store.router_backend if store is not None else None,
+        "scenario_cache": current_app.extensions['scenario_cache'].stats(),
+        "tile_cache": current_app.extensions['tile_cache'].stats(),
+        "tile_prerender_pending": current_app.extensions['tile_prerenderer'].pending()
+    })
+
+@main_bp.route('/tiles/<scenario_id>/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def tile(scenario_id, z, x, y):
+    """
+    Web Mercator PNG tile of a calculated scenario's optimal-port raster
+    
+    Tiles are cached per scenario id, and the low zoom levels are rendered
+    as soon as a scenario is calculated.
+    
+    Query parameters:
+    - layer: 'regions' (default, optimal port) or 'gradient' (blended
+      towards the runner-up port near region boundaries)
+    """
+    try:
+        layer = request.args.get('layer', 'regions').lower()
+        if layer not in TILE_LAYERS:
+            return jsonify({"error": f"layer must be one of {', '.join(TILE_LAYERS)}"}), 400
+        if not 0 <= z <= MAX_TILE_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            return jsonify({"error": "Tile out of range"}), 404
+        
+        key = tile_key(scenario_id, layer, z, x, y)
+        tile_cache = current_app.extensions['tile_cache']
+        cached = tile_cache.get(key)
+        
+        if cached is None:
+            store = get_distance_matrix()
+            if store is None:
+                return jsonify({"error": "Distance matrix not available"}), 503
+            
+            result = current_app.extensions['scenario_cache'].get(scenario_id)
+            if not isinstance(result, ScenarioResult):
+                return jsonify({"error": "Unknown scenario_id, run /calculate first"}), 404
+            if result.scenario.matrix_version != store.version:
+                return jsonify({"error": "Distance matrix has changed, run /calculate again"}), 409
+            
+            raster, cell_rows = get_raster_cell_rows(store)
+            cached = Tile(key, render_tile(result, raster, cell_rows, z, x, y, layer))
+            tile_cache.put(cached)
+        
+        # A scenario id always renders to the same tile
+        response = Response(cached.png, mimetype='image/png')
+        response.set_etag(key.replace('/', '-'))
+        response.cache_control.public = True
+        response.cache_control.max_age = 86400
+        return response.make_conditional(request)
+    
+    except Exception as e:
+        current_app.logger.error(f"Error in tile: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
 @main_bp.route('/export', methods=['GET'])
 def export():
     """
-    Export grid assignments as CSV
+    Export grid assignments of a calculated scenario, streamed in chunks
     
     Query parameters:
-    - format: 'csv' (default) or 'json'
+    - scenario_id: Scenario id returned by /calculate (required)
+    - format: 'csv' (default), 'geojson' ('json'), 'parquet' or 'arrow'
+    - gzip: '1' to gzip the file on the fly
     """
     try:
-        # TODO: Implement export logic when grid calculation is ready
-        return jsonify({
-            "status": "success",
-            "message": "Export endpoint ready. Implementation pending."
-        })
+        export_format = request.args.get('format', 'csv').lower()
+        if export_format == 'json':
+            export_format = 'geojson'
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({"error": f"Unsupported format, expected one of {', '.join(EXPORT_FORMATS)}"}), 400
+        if export_format in ('parquet', 'arrow') and not arrow_available():
+            return jsonify({"error": f"{export_format} export requires pyarrow"}), 501
+        
+        store = get_distance_matrix()
+        if store is None:
+            return jsonify({"error": "Distance matrix not available"}), 503
+        
+        result = current_app.extensions['scenario_cache'].get(request.args.get('scenario_id'))
+        if not isinstance(result, ScenarioResult):
+            return jsonify({"error": "Unknown scenario_id, run /calculate first"}), 404
+        if result.scenario.matrix_version != store.version:
+            return jsonify({"error": "Distance matrix has changed, run /calculate again"}), 409
+        
+        gzip = request.args.get('gzip', '0').lower() in ('1', 'true', 'yes')
+        stream = export_stream(result, store, get_grid_coordinates(store), export_format, gzip=gzip)
+        
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        filename = f"agriport_results.{extension}"
+        if gzip:
+            mimetype, filename = 'application/gzip', filename + '.gz'
+        
+        return Response(
+            stream_with_context(stream),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
     
     except Exception as e:
         current_app.logger.error(f"Error in export: {str(e)}")
-        return jsonify({"error": "Internal server error"}), 500
\ No newline at end of file
+        return jsonify({"error": "Internal server error"}), 500
+
+@main_bp.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue a long computation to run in the background process pool
+    
+    Expected input JSON:
+    {
+        "kind": "recompute" | "build_grid" | "build_adaptive_grid" | "refresh_distances",
+        "params": {...}
+    }
+    
+    Parameters by kind:
+    - recompute: scenario (as posted to /calculate), format (export
+      format, default csv), gzip
+    - build_grid: grid_size or cell_size_km
+    - build_adaptive_grid: scenario (fuel_price, optional ports), grid_size
+      or cell_size_km of the target resolution, levels, threshold
+    - refresh_distances: dry_run
+    
+    Jobs always read the configured boundary and write the configured
+    distance matrix; other files are only reachable through the CLI commands.
+    
+    Returns 202 with the job; poll /jobs/<id> for status and progress.
+    """
+    try:
+        if not request.is_json:
+            return jsonify({"error": "Request must be JSON"}), 400
+        
+        data = request.get_json()
+        if not isinstance(data, dict) or not isinstance(data.get('kind'), str):
+            return jsonify({"error": "A job kind is required"}), 400
+        
+        try:
+            job = current_app.extensions['job_runner'].submit(data['kind'], data.get('params'))
+        except JobError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        response = jsonify(job.to_dict())
+        response.status_code = 202
+        response.headers['Location'] = url_for('main.job_status', job_id=job.id)
+        return response
+    
+    except Exception as e:
+        current_app.logger.error(f"Error in submit_job: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@main_bp.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    List recent jobs, newest first
+    
+    Query parameters:
+    - status: Only jobs with this status
+    - limit: Maximum number of jobs (default 50)
+    """
+    from .models import Job
+    
+    query = Job.query.order_by(Job.created_at.desc())
+    if request.args.get('status'):
+        query = query.filter(Job.status == request.args['status'])
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return jsonify({"jobs": [job.to_dict() for job in query.limit(limit).all()]})
+
+@main_bp.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status, progress and result summary of a job"""
+    from . import db
+    from .models import Job
+    
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@main_bp.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """Download the result file of a finished job (or its JSON result if it has no file)"""
+    from . import db
+    from .models import Job
+    
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job.status != JOB_SUCCEEDED:
+        return jsonify({"error": f"Job is {job.status}", "job": job.to_dict()}), 409
+    
+    result = json.loads(job.result) if job.result else {}
+    filename = result.get('file') if isinstance(result, dict) else None
+    if not filename:
+        return jsonify(result)
+    
+    path = os.path.join(job_results_dir(current_app), os.path.basename(filename))
+    if not os.path.exists(path):
+        return jsonify({"error": "Result file no longer available"}), 410
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=f"agriport_{job.kind}_{filename}")
+
+@main_bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued job, or ask a running job to stop at its next progress report"""
+    job = current_app.extensions['job_runner'].cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
\ No newline at end of file
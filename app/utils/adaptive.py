@@ -0,0 +1,356 @@
+"""
+Adaptive quadtree grids for AgriPort Optimizer
+
+A uniform grid spends most of its points, and most routing calls, inside
+large catchments where the optimal port never changes. An adaptive grid
+starts from a coarse lattice on the raster of the target resolution and
+subdivides only the quadtree cells whose corners disagree on the optimal
+port or lie within the boundary cost gap, down to single raster cells. Nodes
+are points of the uniform grid at the target resolution (same raster, same
+ids), and each level routes only the nodes it adds.
+
+Every raster cell of the uniform grid inside a leaf is owned by the nearest
+corner of the smallest quadtree cell around it whose four corners are nodes
+(see fill_cell_index). That follows from the nodes, the coarse step and the
+uniform grid's mask, so a distance matrix keeps the step and the mask (a
+compressed bitmap, see pack_mask) in its metadata. Without the mask, leaves
+would also paint cells the uniform grid leaves out, such as lakes.
+"""
+import zlib
+import base64
+import logging
+from typing import Any, Callable, Dict, List, NamedTuple
+import numpy as np
+from .cost import DEFAULT_BOUNDARY_THRESHOLD, compute_cost_matrix, rank_ports
+from .grid import Grid
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Quadtree levels above the target resolution (coarse step of 2 ** levels cells)
+DEFAULT_ADAPTIVE_LEVELS = 4
+
+# Raster cells resolved at a time by fill_cell_index, to bound peak memory
+FILL_CHUNK_CELLS = 1 << 20
+
+class AdaptiveGrid(NamedTuple):
+    """Nodes of an adaptive grid and their routed distances"""
+    grid: Grid
+    distances: np.ndarray
+    max_step: int
+    stats: Dict[str, Any]
+
+def _corners(r0: np.ndarray, c0: np.ndarray, step: int):
+    """Rows and columns of the corners of quadtree cells, shape (4, n)"""
+    return (np.stack([r0, r0 + step, r0, r0 + step]),
+            np.stack([c0, c0, c0 + step, c0 + step]))
+
+def _block_sums(integral: np.ndarray, r0: np.ndarray, c0: np.ndarray, step: int) -> np.ndarray:
+    """Sums over the raster cells [r0, r0 + step) x [c0, c0 + step) from an integral image"""
+    n_rows, n_cols = integral.shape[0] - 1, integral.shape[1] - 1
+    r1, c1 = np.minimum(r0 + step, n_rows), np.minimum(c0 + step, n_cols)
+    return integral[r1, c1] - integral[r0, c1] - integral[r1, c0] + integral[r0, c0]
+
+def pack_mask(mask: np.ndarray) -> str:
+    """
+    Encode a boolean raster as a compact string (zlib-compressed packed bits, base64)
+    
+    Args:
+        mask: Boolean array (n_rows, n_cols)
+    
+    Returns:
+        ASCII string for JSON metadata
+    """
+    packed = np.packbits(np.asarray(mask, dtype=bool).ravel())
+    return base64.b64encode(zlib.compress(packed.tobytes(), 9)).decode('ascii')
+
+def unpack_mask(text: str, n_rows: int, n_cols: int) -> np.ndarray:
+    """
+    Decode a boolean raster encoded by pack_mask
+    
+    Args:
+        text: Encoded mask
+        n_rows: Raster rows
+        n_cols: Raster columns
+    
+    Returns:
+        Boolean array (n_rows, n_cols)
+    """
+    packed = np.frombuffer(zlib.decompress(base64.b64decode(text)), dtype=np.uint8)
+    return np.unpackbits(packed, count=n_rows * n_cols).astype(bool).reshape(n_rows, n_cols)
+
+def refine_grid(grid: Grid, ports_latlon: np.ndarray, port_charges: np.ndarray,
+                sea_freights: np.ndarray, fuel_price: float, router,
+                levels: int = DEFAULT_ADAPTIVE_LEVELS, threshold: float = DEFAULT_BOUNDARY_THRESHOLD,
+                competing: np.ndarray = None, progress: Callable = None) -> AdaptiveGrid:
+    """
+    Build an adaptive grid over the points of a uniform grid
+    
+    Quadtree cells of 2 ** levels raster cells are split while their corner
+    nodes disagree on the optimal port, any corner's relative cost gap to the
+    runner-up is within threshold, or a corner is missing (outside the
+    uniform grid) while the cell still holds uncovered grid points. Splitting
+    adds the edge midpoints and the centre; cells of two raster cells split
+    into single cells, so boundaries end at the uniform grid's resolution.
+    
+    Args:
+        grid: Uniform grid at the target resolution (e.g. from gis.build_grid)
+        ports_latlon: Array of (lat, lon) per port
+        port_charges: Port charge per port in dollars per ton
+        sea_freights: Sea freight per port in dollars per ton
+        fuel_price: Fuel price in dollars per liter
+        router: Router providing get_distance_matrix_array (e.g. OSRMRouter)
+        levels: Quadtree levels above the target resolution
+        threshold: Relative cost gap at or below which cells are refined
+        competing: Boolean mask of the ports that compete for grid points
+                   (default: all); the others are routed but not ranked
+        progress: Optional callback (fraction, message)
+    
+    Returns:
+        AdaptiveGrid with nodes in raster order, their distance matrix
+        (n_nodes, n_ports) and routing statistics
+    
+    Raises:
+        ValueError: If levels is negative
+        RuntimeError: If routing batches fail
+    """
+    if levels < 0:
+        raise ValueError("levels must not be negative")
+    
+    ports_latlon = np.asarray(ports_latlon, dtype=np.float64).reshape(-1, 2)
+    competing = np.ones(len(ports_latlon), dtype=bool) if competing is None else np.asarray(competing, dtype=bool)
+    port_charges = np.asarray(port_charges, dtype=np.float64)[competing]
+    sea_freights = np.asarray(sea_freights, dtype=np.float64)[competing]
+    
+    raster, n_rows, n_cols = grid.raster, grid.n_rows, grid.n_cols
+    inside = grid.mask
+    max_step = 2 ** levels
+    
+    node_index = np.full(n_rows * n_cols, -1, dtype=np.int64)
+    node_cells, node_distances = [], []
+    best = np.empty(0, dtype=np.int64)
+    near_boundary = np.empty(0, dtype=bool)
+    routed_per_level = []
+    
+    def add_nodes(row: np.ndarray, col: np.ndarray) -> int:
+        """Route and rank the uniform grid points at (row, col) that are not nodes yet"""
+        nonlocal best, near_boundary
+        
+        on_raster = (row >= 0) & (row < n_rows) & (col >= 0) & (col < n_cols)
+        cells = np.unique(row[on_raster] * n_cols + col[on_raster])
+        cells = cells[inside.ravel()[cells] & (node_index[cells] < 0)]
+        if len(cells) == 0:
+            routed_per_level.append(0)
+            return 0
+        
+        new_row, new_col = np.divmod(cells, n_cols)
+        origins = np.column_stack([
+            raster['origin_lat'] + new_row * raster['cell_lat'],
+            raster['origin_lon'] + new_col * raster['cell_lon']
+        ])
+        distances = router.get_distance_matrix_array(origins, ports_latlon)
+        if getattr(router, 'failed_batches', None):
+            raise RuntimeError(f"{len(router.failed_batches)} routing batches failed; adaptive grid not built")
+        
+        ranking = rank_ports(
+            compute_cost_matrix(distances[:, competing], port_charges, sea_freights, fuel_price), threshold
+        )
+        node_index[cells] = np.arange(len(best), len(best) + len(cells))
+        node_cells.append(cells)
+        node_distances.append(np.asarray(distances, dtype=np.float32))
+        best = np.concatenate([best, ranking.best_idx])
+        near_boundary = np.concatenate([near_boundary, ranking.is_boundary])
+        routed_per_level.append(len(cells))
+        return len(cells)
+    
+    # Coarse lattice; every coarse cell starts as a candidate for splitting
+    lattice_rows, lattice_cols = np.arange(0, n_rows, max_step), np.arange(0, n_cols, max_step)
+    r0, c0 = (axis.ravel() for axis in np.meshgrid(lattice_rows, lattice_cols, indexing='ij'))
+    add_nodes(r0, c0)
+    
+    step = max_step
+    while step >= 2 and len(r0):
+        if progress is not None:
+            progress(1.0 - np.log2(step) / (levels + 1), f"Refining {len(r0)} cells of {step} raster cells")
+        
+        corner_rows, corner_cols = _corners(r0, c0, step)
+        corner_nodes = np.where(
+            (corner_rows < n_rows) & (corner_cols < n_cols),
+            node_index[np.minimum(corner_rows, n_rows - 1) * n_cols + np.minimum(corner_cols, n_cols - 1)],
+            -1
+        )
+        exists = corner_nodes >= 0
+        complete = exists.all(axis=0)
+        
+        # Missing corners (-1) pick the appended sentinel
+        corner_best = np.append(best, -2)[corner_nodes]
+        disagree = (corner_best != corner_best[0]).any(axis=0)
+        close = np.append(near_boundary, False)[corner_nodes].any(axis=0)
+        
+        # Cells with a corner outside the grid split while they hold grid points
+        # that are not nodes yet
+        uncovered = np.zeros(len(r0), dtype=bool)
+        if not complete.all():
+            free = (inside.ravel() & (node_index < 0)).reshape(n_rows, n_cols)
+            integral = np.zeros((n_rows + 1, n_cols + 1), dtype=np.int64)
+            np.cumsum(np.cumsum(free, axis=0), axis=1, out=integral[1:, 1:])
+            partial = ~complete
+            uncovered[partial] = _block_sums(integral, r0[partial], c0[partial], step) > 0
+        
+        split = np.where(complete, disagree | close, uncovered)
+        r0, c0, half = r0[split], c0[split], step // 2
+        
+        # Edge midpoints and centre of every split cell
+        add_nodes(
+            np.concatenate([r0 + half, r0, r0 + half, r0 + half, r0 + step]),
+            np.concatenate([c0, c0 + half, c0 + half, c0 + step, c0 + half])
+        )
+        
+        r0 = np.concatenate([r0, r0 + half, r0, r0 + half])
+        c0 = np.concatenate([c0, c0, c0 + half, c0 + half])
+        keep = (r0 < n_rows) & (c0 < n_cols)
+        r0, c0, step = r0[keep], c0[keep], half
+    
+    cells = np.concatenate(node_cells) if node_cells else np.empty(0, dtype=np.int64)
+    distances = np.concatenate(node_distances) if node_distances else np.empty((0, len(ports_latlon)), dtype=np.float32)
+    order = np.argsort(cells)
+    row, col = np.divmod(cells[order], n_cols)
+    adaptive = Grid(raster, row, col, ids=cells[order])
+    
+    n_ports = len(ports_latlon)
+    stats = {
+        'nodes': len(adaptive),
+        'uniform_points': len(grid),
+        'node_fraction': round(len(adaptive) / len(grid), 4) if len(grid) else 0.0,
+        'routed_pairs': len(adaptive) * n_ports,
+        'uniform_pairs': len(grid) * n_ports,
+        'routed_per_level': routed_per_level,
+        'max_step': max_step,
+    }
+    logger.info(f"Adaptive grid: {len(adaptive)} nodes for {len(grid)} uniform points "
+                f"({stats['node_fraction']:.1%}), coarse step {max_step}")
+    
+    return AdaptiveGrid(adaptive, distances[order], max_step, stats)
+
+def fill_cell_index(grid: Grid, max_step: int, inside: np.ndarray = None) -> np.ndarray:
+    """
+    Owning node of every raster cell covered by an adaptive grid
+    
+    Nodes own their own cell. Any other cell of the uniform grid belongs to
+    the nearest corner (ties to the south-west) of the smallest quadtree cell
+    around it, up to max_step raster cells, whose four corners are all nodes;
+    for a grid built by refine_grid that is the leaf the cell lies in.
+    
+    Args:
+        grid: Adaptive grid (nodes on the raster of the target resolution)
+        max_step: Coarse step of the quadtree in raster cells
+        inside: Boolean raster (n_rows, n_cols) of the uniform grid the
+                adaptive grid was refined from; cells outside it stay empty
+                (default: fill every cell of a leaf)
+    
+    Returns:
+        int64 array with the node index of every raster cell, -1 for cells
+        outside the grid; a drop-in for Grid.cell_index in tiles and lookups
+    """
+    cell_index = grid.cell_index.copy()
+    pending = cell_index < 0
+    if inside is not None:
+        pending &= np.asarray(inside, dtype=bool).ravel()
+    pending = np.flatnonzero(pending)
+    
+    for start in range(0, len(pending), FILL_CHUNK_CELLS):
+        cells = pending[start:start + FILL_CHUNK_CELLS]
+        step = 2
+        while step <= max_step and len(cells):
+            row, col = np.divmod(cells, grid.n_cols)
+            r0, c0 = row - row % step, col - col % step
+            corner_rows, corner_cols = _corners(r0, c0, step)
+            corner_nodes = grid.index_at(corner_rows, corner_cols)
+            complete = (corner_nodes >= 0).all(axis=0)
+            
+            # Corner order of _corners: south-west, north-west, south-east, north-east
+            nearest = (2 * (row - r0) > step).astype(np.int64) + 2 * (2 * (col - c0) > step)
+            resolved = np.flatnonzero(complete)
+            cell_index[cells[resolved]] = corner_nodes[nearest[resolved], resolved]
+            cells = cells[~complete]
+            step *= 2
+    
+    return cell_index
+
+def build_adaptive_matrix(path: str, grid: Grid, ports: List[Dict[str, Any]], scenario: Dict[str, Any],
+                          router, levels: int = DEFAULT_ADAPTIVE_LEVELS,
+                          threshold: float = DEFAULT_BOUNDARY_THRESHOLD,
+                          progress: Callable = None) -> Dict[str, Any]:
+    """
+    Refine an adaptive grid for a scenario and write it as the distance matrix
+    
+    All active ports are routed for every node, so the matrix serves any
+    scenario; the scenario's ports and costs decide where the grid is refined.
+    
+    Args:
+        path: Path of the distance matrix store to write (replaced atomically)
+        grid: Uniform grid at the target resolution
+        ports: Ports as dictionaries with id, lat, lon, active and updated_at
+        scenario: Dictionary with fuel_price and optionally ports
+                  ({id, port_charge, sea_freight, active}) as posted to /calculate;
+                  without ports, all active ports compete at no charge
+        router: Router providing get_distance_matrix_array (e.g. OSRMRouter)
+        levels: Quadtree levels above the target resolution
+        threshold: Relative cost gap at or below which cells are refined
+        progress: Optional callback (fraction, message)
+    
+    Returns:
+        Summary with the refinement statistics and the new matrix version
+    
+    Raises:
+        ValueError: If the scenario is invalid or no port can be routed
+    """
+    from .matrix_store import DistanceMatrixStore, _port_snapshot, _router_backend
+    
+    fuel_price = scenario.get('fuel_price')
+    if not isinstance(fuel_price, (int, float)) or isinstance(fuel_price, bool) or fuel_price < 0:
+        raise ValueError("Valid fuel price required")
+    
+    ports = [port for port in ports if port.get('active', True)]
+    if not ports:
+        raise ValueError("No active ports to route")
+    
+    requested = {port.get('id'): port for port in scenario.get('ports') or []}
+    settings = [requested.get(int(port['id']), {}) for port in ports]
+    if requested:
+        competing = np.array([int(port['id']) in requested and setting.get('active', True)
+                              for port, setting in zip(ports, settings)])
+    else:
+        competing = np.ones(len(ports), dtype=bool)
+    if not competing.any():
+        raise ValueError("None of the scenario's ports are active")
+    
+    result = refine_grid(
+        grid,
+        np.array([[port['lat'], port['lon']] for port in ports], dtype=np.float64),
+        np.array([setting.get('port_charge', 0) for setting in settings], dtype=np.float64),
+        np.array([setting.get('sea_freight', 0) for setting in settings], dtype=np.float64),
+        float(fuel_price), router, levels=levels, threshold=threshold, competing=competing,
+        progress=progress
+    )
+    
+    metadata = {
+        'raster': result.grid.raster,
+        'adaptive': {
+            'max_step': result.max_step,
+            'threshold': threshold,
+            'fuel_price': float(fuel_price),
+            'uniform_points': len(grid),
+            'inside_mask': pack_mask(grid.mask),
+        },
+        'ports': {str(int(port['id'])): _port_snapshot(port) for port in ports},
+        # Later refreshes must route with the same backend
+        'router_backend': _router_backend(router),
+    }
+    # create() bumps the version of an existing file, which makes workers drop
+    # grids and results of the old matrix
+    store = DistanceMatrixStore.create(
+        path, result.grid.ids, [int(port['id']) for port in ports], result.distances, metadata=metadata
+    )
+    
+    return {**result.stats, 'path': path, 'matrix_version': store.version}
\ No newline at end of file
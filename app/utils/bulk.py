@@ -0,0 +1,286 @@
+"""
+Bulk assignment of farm and silo locations for AgriPort Optimizer
+
+An uploaded table of coordinates is read in fixed-size chunks, each chunk is
+resolved against the stored distance matrix with the vectorized lookup of
+lookup.py, and the assignments are streamed back as CSV, Parquet or Arrow.
+Points the grid cannot answer (outside the grid boundary) can optionally be
+routed to OSRM, one batched /table request set per chunk.
+"""
+import io
+import csv
+import math
+import logging
+from typing import Any, Dict, Iterator, Iterable, Optional, Tuple
+import numpy as np
+from .cost import compute_cost_matrix, rank_ports
+from .export import gzip_stream, write_arrow
+from .lookup import lookup_points
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+BULK_CHUNK_ROWS = 50000
+
+BULK_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+BULK_COLUMNS = [
+    'id', 'lat', 'lon', 'optimal_port_id', 'total_cost', 'runner_up_port_id', 'runner_up_cost', 'source'
+]
+
+# Arrow types of the non-numeric columns of an empty Parquet or Arrow file
+BULK_EMPTY_TYPES = {'id': 'string', 'source': 'string'}
+
+# Accepted header names of the coordinate columns
+LAT_COLUMNS = ('lat', 'latitude', 'y')
+LON_COLUMNS = ('lon', 'lng', 'long', 'longitude', 'x')
+
+# Where an assignment came from
+SOURCE_GRID = 'grid'
+SOURCE_OSRM = 'osrm'
+SOURCE_NONE = 'none'
+
+def _find_column(names, candidates, what: str) -> str:
+    """Pick the first column whose lower-cased name is one of the candidates"""
+    by_name = {str(name).strip().lower(): name for name in names}
+    for candidate in candidates:
+        if candidate in by_name:
+            return by_name[candidate]
+    raise ValueError(f"No {what} column found, expected one of {', '.join(candidates)}")
+
+def _coordinate_values(values) -> np.ndarray:
+    """Coordinates as floats; cells that are empty or not numbers become NaN"""
+    import pandas as pd
+    
+    return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+def _valid_coordinates(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Mask of finite coordinates within [-90, 90] latitude and [-180, 180] longitude"""
+    with np.errstate(invalid='ignore'):
+        return np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+
+def iter_point_chunks(source, input_format: str = 'csv', id_column: str = 'id',
+                      chunk_rows: int = BULK_CHUNK_ROWS) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Read coordinates from a CSV or Parquet file in chunks
+    
+    Args:
+        source: Path or binary file object
+        input_format: 'csv' or 'parquet' (requires pyarrow)
+        id_column: Column passed through as the point id (read as text from
+            CSV, so its type cannot change between chunks); row numbers are
+            used when the file has no such column
+        chunk_rows: Rows per chunk
+    
+    Yields:
+        Tuples of (ids, lat, lon) arrays; coordinates that are empty or not
+        numbers are NaN
+    
+    Raises:
+        ValueError: If the format is unknown or the coordinate columns are missing
+    """
+    if input_format == 'csv':
+        import pandas as pd
+        
+        header = pd.read_csv(source, nrows=0).columns
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        lat_column = _find_column(header, LAT_COLUMNS, 'latitude')
+        lon_column = _find_column(header, LON_COLUMNS, 'longitude')
+        columns = [lat_column, lon_column] + ([id_column] if id_column in header else [])
+        
+        batches = (
+            {column: (frame[column].fillna('') if column == id_column else frame[column]).to_numpy()
+             for column in columns}
+            for frame in pd.read_csv(source, usecols=columns, chunksize=chunk_rows, dtype={id_column: str})
+        )
+    elif input_format == 'parquet':
+        import pyarrow.parquet as pq
+        
+        parquet_file = pq.ParquetFile(source)
+        header = parquet_file.schema_arrow.names
+        lat_column = _find_column(header, LAT_COLUMNS, 'latitude')
+        lon_column = _find_column(header, LON_COLUMNS, 'longitude')
+        columns = [lat_column, lon_column] + ([id_column] if id_column in header else [])
+        
+        batches = (
+            {column: batch.column(i).to_numpy(zero_copy_only=False) for i, column in enumerate(columns)}
+            for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns)
+        )
+    else:
+        raise ValueError(f"Unknown input format '{input_format}', expected csv or parquet")
+    
+    offset = 0
+    for batch in batches:
+        lat = _coordinate_values(batch[lat_column])
+        lon = _coordinate_values(batch[lon_column])
+        ids = batch[id_column] if id_column in batch else np.arange(offset, offset + len(lat))
+        offset += len(lat)
+        yield np.asarray(ids), lat, lon
+
+def port_coordinates(store, port_ids, fallback: Optional[Dict[int, Tuple[float, float]]] = None) -> np.ndarray:
+    """
+    Coordinates of scenario ports, as routed when the matrix was built
+    
+    Args:
+        store: DistanceMatrixStore
+        port_ids: Port ids
+        fallback: (lat, lon) by port id for ports the store has no snapshot of
+    
+    Returns:
+        Array of (lat, lon) rows
+    
+    Raises:
+        KeyError: If a port's coordinates are unknown
+    """
+    snapshots = store.metadata.get('ports', {})
+    coordinates = []
+    for port_id in port_ids:
+        snapshot = snapshots.get(str(int(port_id)))
+        if snapshot is not None:
+            coordinates.append((snapshot['lat'], snapshot['lon']))
+        elif fallback is not None and int(port_id) in fallback:
+            coordinates.append(tuple(fallback[int(port_id)]))
+        else:
+            raise KeyError(f"No coordinates for port {int(port_id)}")
+    return np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+
+def assign_chunk(scenario, store, raster: Dict[str, Any], cell_rows: np.ndarray,
+                 ids: np.ndarray, lat: np.ndarray, lon: np.ndarray,
+                 router=None, ports_latlon: np.ndarray = None) -> Dict[str, np.ndarray]:
+    """
+    Assign one chunk of points to their optimal ports
+    
+    Args:
+        scenario: Normalized scenario
+        store: DistanceMatrixStore the scenario was parsed against
+        raster: Raster description of the store's grid
+        cell_rows: Matrix row of every raster cell
+        ids: Point ids
+        lat: Latitudes
+        lon: Longitudes
+        router: Router with get_distance_matrix_array (e.g. OSRMRouter) for
+            points outside the grid; such points are left unassigned without one
+        ports_latlon: Port coordinates aligned with scenario.port_ids (needed with a router)
+    
+    Returns:
+        Dictionary of column arrays (see BULK_COLUMNS); unassigned points,
+        including those without valid coordinates, have port id -1 and cost NaN
+    """
+    valid = _valid_coordinates(lat, lon)
+    best_idx, best_cost = np.full(len(lat), -1, dtype=np.int64), np.full(len(lat), np.inf)
+    second_idx, second_cost = best_idx.copy(), best_cost.copy()
+    if valid.any():
+        ranking = lookup_points(scenario, store, raster, cell_rows, lat[valid], lon[valid]).ranking
+        best_idx[valid], best_cost[valid] = ranking.best_idx, ranking.best_cost
+        second_idx[valid], second_cost[valid] = ranking.second_idx, ranking.second_cost
+    source = np.where(best_idx >= 0, SOURCE_GRID, SOURCE_NONE).astype(object)
+    
+    # Invalid coordinates are never sent to the router
+    outside = np.flatnonzero((best_idx < 0) & valid)
+    if router is not None and len(outside):
+        distances = router.get_distance_matrix_array(np.column_stack([lat[outside], lon[outside]]), ports_latlon)
+        routed = rank_ports(compute_cost_matrix(
+            distances, scenario.port_charges, scenario.sea_freights, scenario.fuel_price
+        ))
+        best_idx[outside], best_cost[outside] = routed.best_idx, routed.best_cost
+        second_idx[outside], second_cost[outside] = routed.second_idx, routed.second_cost
+        source[outside[routed.best_idx >= 0]] = SOURCE_OSRM
+    
+    port_ids = scenario.port_ids
+    return {
+        'id': ids,
+        'lat': lat,
+        'lon': lon,
+        'optimal_port_id': np.where(best_idx >= 0, port_ids[np.maximum(best_idx, 0)], -1),
+        'total_cost': np.where(best_idx >= 0, best_cost, np.nan),
+        'runner_up_port_id': np.where(second_idx >= 0, port_ids[np.maximum(second_idx, 0)], -1),
+        'runner_up_cost': np.where(second_idx >= 0, second_cost, np.nan),
+        'source': source,
+    }
+
+def write_assignments_csv(chunks: Iterable[Dict[str, np.ndarray]]) -> Iterator[bytes]:
+    """
+    Stream assignment chunks as CSV with a header row
+    
+    Ids are passed through as text and quoted where they contain commas,
+    quotes or line breaks; coordinates that are not finite are left empty.
+    
+    Args:
+        chunks: Column chunks from assign_chunk
+    
+    Yields:
+        Encoded CSV text
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    
+    def drain() -> bytes:
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+    
+    writer.writerow(BULK_COLUMNS)
+    yield drain()
+    
+    for chunk in chunks:
+        writer.writerows(
+            (point_id, f'{lat:.6f}' if math.isfinite(lat) else '', f'{lon:.6f}' if math.isfinite(lon) else '',
+             *((port_id, f'{cost:.4f}') if port_id >= 0 else ('', '')),
+             *((runner_up_id, f'{runner_up_cost:.4f}') if runner_up_id >= 0 else ('', '')),
+             source)
+            for point_id, lat, lon, port_id, cost, runner_up_id, runner_up_cost, source in zip(
+                *(chunk[column].tolist() for column in BULK_COLUMNS)
+            )
+        )
+        yield drain()
+
+def assign_stream(scenario, store, raster: Dict[str, Any], cell_rows: np.ndarray, point_chunks,
+                  output_format: str = 'csv', gzip: bool = False, router=None,
+                  ports_latlon: np.ndarray = None, stats: Dict[str, int] = None) -> Iterator[bytes]:
+    """
+    Stream the assignments of a point file in one of BULK_FORMATS
+    
+    Args:
+        scenario: Normalized scenario
+        store: DistanceMatrixStore the scenario was parsed against
+        raster: Raster description of the store's grid
+        cell_rows: Matrix row of every raster cell
+        point_chunks: Chunks of (ids, lat, lon) from iter_point_chunks
+        output_format: 'csv', 'parquet' or 'arrow'
+        gzip: Compress the output with gzip
+        router: Router for points outside the grid (optional)
+        ports_latlon: Port coordinates aligned with scenario.port_ids (needed with a router)
+        stats: Dictionary updated with point counts per source as chunks are written
+    
+    Returns:
+        Generator of bytes
+    
+    Raises:
+        ValueError: If the format is unknown
+    """
+    if output_format not in BULK_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {', '.join(BULK_FORMATS)}")
+    if stats is None:
+        stats = {}
+    
+    def chunks():
+        for ids, lat, lon in point_chunks:
+            chunk = assign_chunk(scenario, store, raster, cell_rows, ids, lat, lon, router, ports_latlon)
+            for source in (SOURCE_GRID, SOURCE_OSRM, SOURCE_NONE):
+                stats[source] = stats.get(source, 0) + int((chunk['source'] == source).sum())
+            yield chunk
+        logger.info(f"Assigned points: {stats}")
+    
+    if output_format == 'csv':
+        stream = write_assignments_csv(chunks())
+    else:
+        stream = write_arrow(chunks(), parquet=output_format == 'parquet', columns=BULK_COLUMNS,
+                             empty_types=BULK_EMPTY_TYPES)
+    
+    return gzip_stream(stream) if gzip else stream
\ No newline at end of file
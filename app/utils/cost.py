@@ -1,16 +1,34 @@
 """
 Cost calculation utilities for AgriPort Optimizer
 """
-import pandas as pd
+from __future__ import annotations
 import numpy as np
-from typing import Dict, List, Tuple, Union, Any
+from typing import Dict, List, NamedTuple, Tuple, Union, Any, TYPE_CHECKING
 import logging
+from .grid import Grid
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# We assume a standard truck carrying 25 tons
+TRUCK_CAPACITY_TONS = 25.0
+
+# Typical truck fuel consumption in liters per kilometer
+DEFAULT_FUEL_EFFICIENCY = 0.4
+
+# Relative cost gap between best and runner-up port below which a grid point
+# counts as a catchment boundary
+DEFAULT_BOUNDARY_THRESHOLD = 0.05
+
+# Upper bound on (scenario x grid x port) cost elements held at once by
+# best_ports_batch (float64, so about 32 MB per block)
+BATCH_CHUNK_ELEMENTS = 1 << 22
+
 def calculate_transportation_cost(distance_km: float, fuel_price: float, 
-                                 fuel_efficiency: float = 0.4) -> float:
+                                 fuel_efficiency: float = DEFAULT_FUEL_EFFICIENCY) -> float:
     """
     Calculate transportation cost based on distance and fuel price
     
@@ -27,14 +45,11 @@ def calculate_transportation_cost(distance_km: float, fuel_price: float,
         return None
     
     # Basic cost formula: distance * fuel consumption * fuel price
-    # We assume a standard truck carrying 25 tons
-    truck_capacity_tons = 25.0
-    
     # Cost per truck
     cost_per_truck = distance_km * fuel_efficiency * fuel_price
     
     # Cost per ton
-    cost_per_ton = cost_per_truck / truck_capacity_tons
+    cost_per_ton = cost_per_truck / TRUCK_CAPACITY_TONS
     
     return cost_per_ton
 
@@ -63,70 +78,418 @@ def calculate_total_cost(port_charge: float, sea_freight: float,
     
     return total_cost
 
-def find_optimal_port(grid_distances: pd.DataFrame, ports_data: Dict[int, Dict], 
-                     fuel_price: float) -> pd.DataFrame:
+class PortRanking(NamedTuple):
     """
-    Find the optimal port for each grid point based on total cost
+    Best and runner-up port for every grid point of a cost matrix
+    
+    Port positions are column indices into the cost matrix; -1 marks a grid
+    point without a reachable (runner-up) port, in which case the matching
+    cost is infinite. relative_gap is (second_cost - best_cost) / best_cost,
+    gradient runs from 1.0 (equal costs) to 0.0 (gap at the boundary
+    threshold or above) and is_boundary flags gaps within the threshold.
+    """
+    best_idx: np.ndarray
+    best_cost: np.ndarray
+    second_idx: np.ndarray
+    second_cost: np.ndarray
+    relative_gap: np.ndarray
+    gradient: np.ndarray
+    is_boundary: np.ndarray
+
+def compute_cost_matrix(distance_matrix: np.ndarray, port_charges: np.ndarray,
+                        sea_freights: np.ndarray, fuel_price: float,
+                        fuel_efficiency: float = DEFAULT_FUEL_EFFICIENCY) -> np.ndarray:
+    """
+    Calculate total cost for every (grid point, port) pair at once
     
     Args:
-        grid_distances: DataFrame with distances from each grid point to each port
-        ports_data: Dictionary of port data (id -> {port_charge, sea_freight})
+        distance_matrix: Array of shape (n_grid, n_ports) with road distances in km,
+                         NaN where a port is unreachable
+        port_charges: Port charge per port in dollars per ton, shape (n_ports,)
+        sea_freights: Sea freight per port in dollars per ton, shape (n_ports,)
         fuel_price: Fuel price in dollars per liter
+        fuel_efficiency: Fuel consumption in liters per kilometer
+    
+    Returns:
+        Array of shape (n_grid, n_ports) with total cost in dollars per ton,
+        infinite where the distance is missing
+    """
+    distances = np.asarray(distance_matrix, dtype=np.float64)
+    fixed_costs = np.asarray(port_charges, dtype=np.float64) + np.asarray(sea_freights, dtype=np.float64)
+    
+    # Same formula as calculate_total_cost, broadcast over the whole matrix
+    cost_per_km = fuel_efficiency * fuel_price / TRUCK_CAPACITY_TONS
+    costs = distances * cost_per_km + fixed_costs[np.newaxis, :]
+    costs[np.isnan(costs)] = np.inf
+    
+    return costs
+
+def boundary_metrics(best_cost: np.ndarray, second_cost: np.ndarray,
+                     threshold: float = DEFAULT_BOUNDARY_THRESHOLD) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Relative gap, gradient value and boundary flag from best and runner-up costs
+    
+    Args:
+        best_cost: Cost of the best port per grid point
+        second_cost: Cost of the runner-up port per grid point
+        threshold: Relative gap at or below which a grid point is a boundary
+    
+    Returns:
+        Tuple of (relative_gap, gradient, is_boundary) arrays; the gap is
+        infinite where either cost is missing
+    """
+    best_cost = np.asarray(best_cost, dtype=np.float64)
+    second_cost = np.asarray(second_cost, dtype=np.float64)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_gap = (second_cost - best_cost) / best_cost
+    relative_gap = np.where(np.isfinite(relative_gap), relative_gap, np.inf)
+    
+    is_boundary = relative_gap <= threshold
+    gradient = np.where(is_boundary, 1.0 - relative_gap / threshold, 0.0)
+    
+    return relative_gap, gradient, is_boundary
+
+def rank_ports(cost_matrix: np.ndarray, 
+               threshold: float = DEFAULT_BOUNDARY_THRESHOLD) -> PortRanking:
+    """
+    Find the best and runner-up port for every grid point of a cost matrix
+    
+    This is the single top-2 kernel behind the optimal-port table, cost
+    gradients and boundary detection. It selects the two cheapest ports per
+    row with a partial selection (no full sort) and derives the gap metrics
+    from them.
+    
+    Args:
+        cost_matrix: Array of shape (n_grid, n_ports) with total costs
+        threshold: Relative gap at or below which a grid point is a boundary
+    
+    Returns:
+        PortRanking with port column indices, costs and boundary metrics
+    """
+    n_grid, n_ports = cost_matrix.shape
+    
+    if n_ports == 0:
+        best_idx = np.full(n_grid, -1, dtype=np.int64)
+        best_cost = np.full(n_grid, np.inf)
+    else:
+        best_idx = np.zeros(n_grid, dtype=np.int64)
+        best_cost = cost_matrix[:, 0].astype(np.float64)
+    second_idx = np.full(n_grid, -1, dtype=np.int64)
+    second_cost = np.full(n_grid, np.inf)
+    
+    if n_ports > 1:
+        # Two cheapest columns per row, in no particular order
+        top2 = np.argpartition(cost_matrix, 1, axis=1)[:, :2]
+        top2_cost = np.take_along_axis(cost_matrix, top2, axis=1)
+        
+        # Order the pair; ties go to the lower column like argmin would
+        swap = (top2_cost[:, 1] < top2_cost[:, 0]) | (
+            (top2_cost[:, 1] == top2_cost[:, 0]) & (top2[:, 1] < top2[:, 0])
+        )
+        first, second = np.where(swap, 1, 0), np.where(swap, 0, 1)
+        rows = np.arange(n_grid)
+        best_idx, second_idx = top2[rows, first], top2[rows, second]
+        best_cost, second_cost = top2_cost[rows, first], top2_cost[rows, second]
         
+        # The selection picks arbitrarily among columns tied with the
+        # runner-up; re-pick the lowest columns on those (rare) rows
+        tied = np.flatnonzero((cost_matrix <= second_cost[:, np.newaxis]).sum(axis=1) > 2)
+        if len(tied):
+            tied_costs = cost_matrix[tied]
+            best_idx[tied] = np.argmax(tied_costs == best_cost[tied, np.newaxis], axis=1)
+            candidates = tied_costs == second_cost[tied, np.newaxis]
+            candidates[np.arange(len(tied)), best_idx[tied]] = False
+            second_idx[tied] = np.argmax(candidates, axis=1)
+    
+    best_idx = np.where(np.isfinite(best_cost), best_idx, -1)
+    second_idx = np.where(np.isfinite(second_cost), second_idx, -1)
+    relative_gap, gradient, is_boundary = boundary_metrics(best_cost, second_cost, threshold)
+    
+    return PortRanking(best_idx, best_cost, second_idx, second_cost, relative_gap, gradient, is_boundary)
+
+def rank_cost_table(ports_costs: pd.DataFrame, 
+                    threshold: float = DEFAULT_BOUNDARY_THRESHOLD) -> Tuple[np.ndarray, np.ndarray, PortRanking]:
+    """
+    Run the top-2 kernel over a long-format cost table
+    
+    Args:
+        ports_costs: DataFrame with grid_point_id, port_id and total_cost columns
+        threshold: Relative gap at or below which a grid point is a boundary
+    
+    Returns:
+        Tuple of (grid point ids, port ids, PortRanking)
+    """
+    costs = ports_costs[['grid_point_id', 'port_id', 'total_cost']]
+    costs = costs.drop_duplicates(['grid_point_id', 'port_id'])
+    cost_df = costs.pivot(index='grid_point_id', columns='port_id', values='total_cost')
+    
+    cost_matrix = cost_df.to_numpy(dtype=np.float64, na_value=np.inf)
+    cost_matrix[np.isnan(cost_matrix)] = np.inf
+    
+    ranking = rank_ports(cost_matrix, threshold)
+    return cost_df.index.to_numpy(), cost_df.columns.to_numpy(), ranking
+
+def find_optimal_ports_matrix(distance_matrix: np.ndarray, port_charges: np.ndarray,
+                              sea_freights: np.ndarray, fuel_price: float) -> PortRanking:
+    """
+    Find the optimal and runner-up port for each grid point from a dense distance matrix
+    
+    Args:
+        distance_matrix: Array of shape (n_grid, n_ports) with road distances in km
+        port_charges: Port charge per port in dollars per ton, shape (n_ports,)
+        sea_freights: Sea freight per port in dollars per ton, shape (n_ports,)
+        fuel_price: Fuel price in dollars per liter
+    
+    Returns:
+        PortRanking with port column indices and costs
+    """
+    cost_matrix = compute_cost_matrix(distance_matrix, port_charges, sea_freights, fuel_price)
+    return rank_ports(cost_matrix)
+
+def best_ports_batch(distance_matrix: np.ndarray, port_fixed_costs: np.ndarray, fuel_prices: np.ndarray,
+                     fuel_efficiency: float = DEFAULT_FUEL_EFFICIENCY,
+                     max_elements: int = BATCH_CHUNK_ELEMENTS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the optimal port for every grid point under many cost scenarios at once
+    
+    Grid rows and scenarios are processed in blocks covering at most
+    max_elements (scenario, grid, port) combinations, so memory stays bounded
+    however many scenarios are passed. Within a block a running minimum over
+    the (few) port columns replaces a 3-D argmin, which is several times
+    faster in NumPy. Ties go to the lower port column, as in rank_ports.
+    
+    Args:
+        distance_matrix: Array of shape (n_grid, n_ports) with road distances in km
+        port_fixed_costs: Port charge plus sea freight per scenario and port,
+                          shape (n_scenarios, n_ports); inf excludes a port
+                          from a scenario
+        fuel_prices: Fuel price per scenario, shape (n_scenarios,)
+        fuel_efficiency: Fuel consumption in liters per kilometer
+        max_elements: Maximum number of cost elements computed per block
+    
     Returns:
-        DataFrame with optimal port and cost for each grid point
+        Tuple of (best_idx, best_cost), both of shape (n_scenarios, n_grid);
+        best_idx is -1 and best_cost inf where no port is reachable
     """
-    # Create empty results dataframe
-    results = []
+    distances = np.asarray(distance_matrix)
+    fixed_costs = np.asarray(port_fixed_costs, dtype=np.float64)
+    cost_per_km = np.asarray(fuel_prices, dtype=np.float64) * fuel_efficiency / TRUCK_CAPACITY_TONS
+    
+    n_grid, n_ports = distances.shape
+    n_scenarios = len(cost_per_km)
+    best_idx = np.full((n_scenarios, n_grid), -1, dtype=np.int64)
+    best_cost = np.full((n_scenarios, n_grid), np.inf)
     
-    # Process each grid point
-    for grid_point_id in grid_distances['grid_point_id'].unique():
-        grid_point_distances = grid_distances[grid_distances['grid_point_id'] == grid_point_id]
+    if n_ports == 0 or n_scenarios == 0:
+        return best_idx, best_cost
+    
+    scenarios_per_block = min(n_scenarios, max(1, max_elements // n_ports))
+    rows_per_block = max(1, max_elements // (scenarios_per_block * n_ports))
+    
+    for row_start in range(0, n_grid, rows_per_block):
+        row_stop = min(row_start + rows_per_block, n_grid)
+        columns = np.ascontiguousarray(distances[row_start:row_stop].T, dtype=np.float64)
         
-        # Calculate costs for each port
-        for _, row in grid_point_distances.iterrows():
-            port_id = row['port_id']
-            distance_km = row['distance_km']
-            
-            # Skip if port not in data or distance is None
-            if port_id not in ports_data or distance_km is None:
-                continue
-            
-            port_data = ports_data[port_id]
-            port_charge = port_data.get('port_charge', 0)
-            sea_freight = port_data.get('sea_freight', 0)
+        for s_start in range(0, n_scenarios, scenarios_per_block):
+            s_stop = min(s_start + scenarios_per_block, n_scenarios)
             
-            # Calculate total cost
-            total_cost = calculate_total_cost(port_charge, sea_freight, distance_km, fuel_price)
+            block_idx = best_idx[s_start:s_stop, row_start:row_stop]
+            block_cost = best_cost[s_start:s_stop, row_start:row_stop]
             
-            if total_cost is not None:
-                results.append({
-                    'grid_point_id': grid_point_id,
-                    'port_id': port_id,
-                    'distance_km': distance_km,
-                    'port_charge': port_charge,
-                    'sea_freight': sea_freight,
-                    'fuel_price': fuel_price,
-                    'total_cost': total_cost
-                })
-    
-    # Convert to DataFrame
-    results_df = pd.DataFrame(results)
-    
-    # Find optimal (lowest cost) port for each grid point
-    if not results_df.empty:
-        # Sort by grid_point_id and total_cost
-        results_df = results_df.sort_values(['grid_point_id', 'total_cost'])
-        
-        # Get the lowest cost port for each grid point
-        optimal_ports = results_df.groupby('grid_point_id').first().reset_index()
-        optimal_ports['optimal_port_id'] = optimal_ports['port_id']
+            for port in range(n_ports):
+                # (scenario, grid) costs of one port; NaN distances never compare lower
+                costs = np.multiply.outer(cost_per_km[s_start:s_stop], columns[port])
+                costs += fixed_costs[s_start:s_stop, port, np.newaxis]
+                
+                better = costs < block_cost
+                np.copyto(block_idx, port, where=better)
+                np.copyto(block_cost, costs, where=better)
+    
+    return best_idx, best_cost
+
+def candidate_port_mask(lower_bound_costs: np.ndarray, cost_matrix: np.ndarray,
+                        routed_mask: np.ndarray) -> np.ndarray:
+    """
+    Select the unrouted (grid point, port) pairs that could still be best or runner-up
+    
+    Routed pairs use their real cost and unrouted pairs their lower bound. If
+    the two cheapest ports of a grid point under that optimistic view are both
+    routed, no unrouted port can beat them; otherwise the unrouted ones among
+    the two cheapest have to be routed before the answer is known.
+    
+    Args:
+        lower_bound_costs: Array of shape (n_grid, n_ports) with costs of a
+                           distance that is never longer than the road distance
+        cost_matrix: Array of shape (n_grid, n_ports) with real costs (ignored
+                     where not routed)
+        routed_mask: Boolean array of shape (n_grid, n_ports) of routed pairs
+    
+    Returns:
+        Boolean array of shape (n_grid, n_ports) of pairs to route next
+    """
+    optimistic = np.where(routed_mask, cost_matrix, lower_bound_costs)
+    ranking = rank_ports(optimistic)
+    
+    candidates = np.zeros(optimistic.shape, dtype=bool)
+    rows = np.arange(optimistic.shape[0])
+    for idx in (ranking.best_idx, ranking.second_idx):
+        valid = idx >= 0
+        candidates[rows[valid], idx[valid]] = True
+    
+    return candidates & ~routed_mask
+
+def ranking_to_dataframe(ranking: PortRanking, grid_point_ids: np.ndarray, port_ids: np.ndarray,
+                         distance_matrix: np.ndarray, port_charges: np.ndarray,
+                         sea_freights: np.ndarray, fuel_price: float) -> pd.DataFrame:
+    """
+    Build the optimal-port table (one row per grid point) from a PortRanking
+    
+    Args:
+        ranking: Result of rank_ports
+        grid_point_ids: Grid point id for each matrix row
+        port_ids: Port id for each matrix column
+        distance_matrix: Array of shape (n_grid, n_ports) with road distances in km
+        port_charges: Port charge per port in dollars per ton
+        sea_freights: Sea freight per port in dollars per ton
+        fuel_price: Fuel price in dollars per liter
+    
+    Returns:
+        DataFrame with optimal port, cost and runner-up for each reachable grid point
+    """
+    import pandas as pd
+    
+    grid_point_ids = np.asarray(grid_point_ids)
+    port_ids = np.asarray(port_ids)
+    port_charges = np.asarray(port_charges, dtype=np.float64)
+    sea_freights = np.asarray(sea_freights, dtype=np.float64)
+    
+    reachable = ranking.best_idx >= 0
+    rows = np.flatnonzero(reachable)
+    best_idx = ranking.best_idx[reachable]
+    second_idx = ranking.second_idx[reachable]
+    has_second = second_idx >= 0
+    
+    # Nullable ids so grid points with a single reachable port keep an integer column
+    runner_up_port_id = pd.Series(port_ids[np.maximum(second_idx, 0)], dtype='Int64').where(has_second)
+    
+    optimal_ports = pd.DataFrame({
+        'grid_point_id': grid_point_ids[rows],
+        'port_id': port_ids[best_idx],
+        'distance_km': np.asarray(distance_matrix)[rows, best_idx].astype(np.float64),
+        'port_charge': port_charges[best_idx],
+        'sea_freight': sea_freights[best_idx],
+        'fuel_price': fuel_price,
+        'total_cost': ranking.best_cost[reachable],
+        'runner_up_port_id': runner_up_port_id,
+        'runner_up_cost': np.where(has_second, ranking.second_cost[reachable], np.nan),
+    })
+    optimal_ports.insert(1, 'optimal_port_id', optimal_ports['port_id'])
+    
+    return optimal_ports
+
+def cost_matrix_to_dataframe(cost_matrix: np.ndarray, grid_point_ids: np.ndarray, port_ids: np.ndarray,
+                             distance_matrix: np.ndarray, port_charges: np.ndarray,
+                             sea_freights: np.ndarray, fuel_price: float) -> pd.DataFrame:
+    """
+    Build the long-format cost table (one row per reachable grid point/port pair)
+    
+    Args:
+        cost_matrix: Array of shape (n_grid, n_ports) with total costs
+        grid_point_ids: Grid point id for each matrix row
+        port_ids: Port id for each matrix column
+        distance_matrix: Array of shape (n_grid, n_ports) with road distances in km
+        port_charges: Port charge per port in dollars per ton
+        sea_freights: Sea freight per port in dollars per ton
+        fuel_price: Fuel price in dollars per liter
+    
+    Returns:
+        DataFrame sorted by grid_point_id and total_cost
+    """
+    import pandas as pd
+    
+    rows, cols = np.nonzero(np.isfinite(cost_matrix))
+    
+    costs_df = pd.DataFrame({
+        'grid_point_id': np.asarray(grid_point_ids)[rows],
+        'port_id': np.asarray(port_ids)[cols],
+        'distance_km': np.asarray(distance_matrix)[rows, cols].astype(np.float64),
+        'port_charge': np.asarray(port_charges, dtype=np.float64)[cols],
+        'sea_freight': np.asarray(sea_freights, dtype=np.float64)[cols],
+        'fuel_price': fuel_price,
+        'total_cost': cost_matrix[rows, cols],
+    })
+    
+    return costs_df.sort_values(['grid_point_id', 'total_cost'], kind='stable').reset_index(drop=True)
+
+def distances_to_matrix(grid_distances: pd.DataFrame, 
+                        port_ids: List[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pivot a long-format distance table into a dense (grid x port) matrix
+    
+    Args:
+        grid_distances: DataFrame with grid_point_id, port_id and distance_km columns
+        port_ids: Port ids to use as columns, in order (default: ports in the table)
+    
+    Returns:
+        Tuple of (distance matrix, grid point ids, port ids); missing pairs are NaN
+    """
+    distances = grid_distances[['grid_point_id', 'port_id', 'distance_km']]
+    distances = distances.drop_duplicates(['grid_point_id', 'port_id'])
+    
+    matrix_df = distances.pivot(index='grid_point_id', columns='port_id', values='distance_km')
+    if port_ids is not None:
+        matrix_df = matrix_df.reindex(columns=list(port_ids))
+    
+    matrix = matrix_df.to_numpy(dtype=np.float64, na_value=np.nan)
+    return matrix, matrix_df.index.to_numpy(), matrix_df.columns.to_numpy()
+
+def find_optimal_port(grid_distances: pd.DataFrame, ports_data: Dict[int, Dict], 
+                     fuel_price: float, 
+                     include_all_costs: bool = False) -> Union[pd.DataFrame, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Find the optimal port for each grid point based on total cost
+    
+    Args:
+        grid_distances: DataFrame with distances from each grid point to each port
+        ports_data: Dictionary of port data (id -> {port_charge, sea_freight})
+        fuel_price: Fuel price in dollars per liter
+        include_all_costs: Also return the long-format cost table for every
+                           grid point/port pair
         
-        return results_df
+    Returns:
+        DataFrame with optimal port, cost and runner-up for each grid point,
+        or a tuple of (optimal ports, all costs) if include_all_costs is set
+    """
+    import pandas as pd
+    
+    # Only ports we have cost data for take part in the comparison
+    grid_distances = grid_distances[grid_distances['port_id'].isin(list(ports_data.keys()))]
+    
+    if grid_distances.empty:
+        return (pd.DataFrame(), pd.DataFrame()) if include_all_costs else pd.DataFrame()
+    
+    distance_matrix, grid_point_ids, port_ids = distances_to_matrix(grid_distances)
+    port_charges = np.array([ports_data[port_id].get('port_charge', 0) for port_id in port_ids], dtype=np.float64)
+    sea_freights = np.array([ports_data[port_id].get('sea_freight', 0) for port_id in port_ids], dtype=np.float64)
+    
+    cost_matrix = compute_cost_matrix(distance_matrix, port_charges, sea_freights, fuel_price)
+    ranking = rank_ports(cost_matrix)
+    
+    optimal_ports = ranking_to_dataframe(
+        ranking, grid_point_ids, port_ids, distance_matrix, port_charges, sea_freights, fuel_price
+    )
+    
+    if include_all_costs:
+        all_costs = cost_matrix_to_dataframe(
+            cost_matrix, grid_point_ids, port_ids, distance_matrix, port_charges, sea_freights, fuel_price
+        )
+        return optimal_ports, all_costs
     
-    return pd.DataFrame()
+    return optimal_ports
 
-def generate_cost_gradients(ports_costs: pd.DataFrame, threshold: float = 0.05) -> pd.DataFrame:
+def generate_cost_gradients(ports_costs: pd.DataFrame, 
+                            threshold: float = DEFAULT_BOUNDARY_THRESHOLD) -> pd.DataFrame:
     """
     Generate cost gradient data for visualization
     
@@ -137,49 +500,50 @@ def generate_cost_gradients(ports_costs: pd.DataFrame, threshold: float = 0.05)
     Returns:
         DataFrame with gradient information
     """
-    # Find points where costs are close between best and second-best port
-    gradients = []
+    import pandas as pd
     
-    for grid_id, group in ports_costs.groupby('grid_point_id'):
-        if len(group) < 2:
-            continue
-            
-        # Sort by cost
-        group = group.sort_values('total_cost')
-        
-        # Get costs for best and second-best ports
-        best_port = group.iloc[0]
-        second_best = group.iloc[1]
-        
-        # Calculate relative cost difference
-        cost_diff = (second_best['total_cost'] - best_port['total_cost']) / best_port['total_cost']
-        
-        if cost_diff <= threshold:
-            # This is a boundary point with gradient
-            gradient_value = 1.0 - (cost_diff / threshold)  # 1.0 = equal costs, 0.0 = at threshold
-            
-            gradients.append({
-                'grid_point_id': grid_id,
-                'port_id_1': best_port['port_id'],
-                'port_id_2': second_best['port_id'],
-                'cost_1': best_port['total_cost'],
-                'cost_2': second_best['total_cost'],
-                'gradient_value': gradient_value
-            })
+    columns = ['grid_point_id', 'port_id_1', 'port_id_2', 'cost_1', 'cost_2', 'gradient_value']
+    if ports_costs.empty:
+        return pd.DataFrame(columns=columns)
+    
+    grid_point_ids, port_ids, ranking = rank_cost_table(ports_costs, threshold)
     
-    return pd.DataFrame(gradients)
+    # Points where costs are close between best and second-best port
+    boundary = ranking.is_boundary
+    return pd.DataFrame({
+        'grid_point_id': grid_point_ids[boundary],
+        'port_id_1': port_ids[ranking.best_idx[boundary]],
+        'port_id_2': port_ids[ranking.second_idx[boundary]],
+        'cost_1': ranking.best_cost[boundary],
+        'cost_2': ranking.second_cost[boundary],
+        'gradient_value': ranking.gradient[boundary]  # 1.0 = equal costs, 0.0 = at threshold
+    }, columns=columns)
 
-def format_results_for_export(grid_points: pd.DataFrame, optimal_ports: pd.DataFrame) -> pd.DataFrame:
+def format_results_for_export(grid_points: Union[Grid, pd.DataFrame], optimal_ports: pd.DataFrame) -> pd.DataFrame:
     """
     Format results for CSV export
     
     Args:
-        grid_points: DataFrame with grid point coordinates
+        grid_points: Grid, or DataFrame with grid point coordinates indexed by grid point id
         optimal_ports: DataFrame with optimal port for each grid point
         
     Returns:
         DataFrame ready for export
     """
+    columns = ['grid_point_id', 'lat', 'lon', 'optimal_port_id', 'distance_km', 'total_cost']
+    
+    if isinstance(grid_points, Grid):
+        # Coordinates are looked up by id on the grid (no join), in grid order
+        export_df = optimal_ports[['grid_point_id', 'optimal_port_id', 'distance_km', 'total_cost']]
+        position = grid_points.index_of(export_df['grid_point_id'].to_numpy())
+        rows = np.flatnonzero(position >= 0)
+        rows = rows[np.argsort(position[rows], kind='stable')]
+        export_df = export_df.iloc[rows].assign(
+            lat=grid_points.lat[position[rows]],
+            lon=grid_points.lon[position[rows]]
+        )
+        return export_df[columns]
+    
     # Merge grid points with optimal ports
     export_df = grid_points.merge(
         optimal_ports[['grid_point_id', 'optimal_port_id', 'distance_km', 'total_cost']],
@@ -188,6 +552,6 @@ def format_results_for_export(grid_points: pd.DataFrame, optimal_ports: pd.DataF
     )
     
     # Clean up columns for export
-    export_df = export_df[['grid_point_id', 'lat', 'lon', 'optimal_port_id', 'distance_km', 'total_cost']]
+    export_df = export_df[columns]
     
     return export_df
\ No newline at end of file
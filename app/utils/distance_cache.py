@@ -0,0 +1,286 @@
+"""
+Persistent cache of routed distances for AgriPort Optimizer
+
+Distances returned by OSRM are stored in a local SQLite file keyed by the
+origin and destination coordinates (quantized to 1e-5 degrees, the precision
+sent to OSRM) and a road-network version tag, so routes computed once do not
+need a running OSRM instance again until the OSM extract changes.
+"""
+import os
+import sqlite3
+import threading
+import logging
+from typing import Dict, Tuple
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Coordinates are stored as integers in units of 1e-5 degrees (about 1 m)
+COORDINATE_SCALE = 100000
+
+def quantize_coordinates(points) -> np.ndarray:
+    """
+    Quantize (lat, lon) rows to integer cache keys
+    
+    Args:
+        points: Sequence or array of (lat, lon)
+    
+    Returns:
+        int64 array of shape (n, 2)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return np.rint(points * COORDINATE_SCALE).astype(np.int64)
+
+class DistanceCache:
+    """
+    SQLite-backed cache of road distances between coordinate pairs
+    
+    Missing routes (OSRM returned null) are cached as NULL so they count as hits.
+    """
+    def __init__(self, path: str = None, network_version: str = None):
+        """
+        Open (and create if needed) the cache file
+        
+        Args:
+            path: Path to the SQLite file (default: env var or data/osrm_cache.sqlite)
+            network_version: Road network tag, e.g. the OSM extract date
+                             (default: env var or 'default')
+        """
+        self.path = path or os.environ.get('OSRM_CACHE_PATH', os.path.join('data', 'osrm_cache.sqlite'))
+        self.network_version = network_version or os.environ.get('OSRM_NETWORK_VERSION', 'default')
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS route_cache (
+                network_version TEXT NOT NULL,
+                origin_lat INTEGER NOT NULL,
+                origin_lon INTEGER NOT NULL,
+                dest_lat INTEGER NOT NULL,
+                dest_lon INTEGER NOT NULL,
+                distance_km REAL,
+                PRIMARY KEY (network_version, origin_lat, origin_lon, dest_lat, dest_lon)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("CREATE TEMP TABLE lookup_origins (idx INTEGER, lat INTEGER, lon INTEGER)")
+        self._conn.execute("CREATE TEMP TABLE lookup_destinations (idx INTEGER, lat INTEGER, lon INTEGER)")
+        self._conn.commit()
+    
+    def close(self):
+        """Close the underlying SQLite connection"""
+        with self._lock:
+            self._conn.close()
+    
+    def get(self, origin: Tuple[float, float], destination: Tuple[float, float]) -> Tuple[bool, float]:
+        """
+        Look up a single pair
+        
+        Args:
+            origin: (lat, lon) of origin
+            destination: (lat, lon) of destination
+        
+        Returns:
+            Tuple of (found, distance_km); distance_km is None for a cached missing route
+        """
+        (o_lat, o_lon), (d_lat, d_lon) = quantize_coordinates([origin, destination]).tolist()
+        
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT distance_km FROM route_cache WHERE network_version = ? "
+                "AND origin_lat = ? AND origin_lon = ? AND dest_lat = ? AND dest_lon = ?",
+                (self.network_version, o_lat, o_lon, d_lat, d_lon)
+            ).fetchone()
+            
+            if row is None:
+                self.misses += 1
+                return False, None
+            
+            self.hits += 1
+            return True, row[0]
+    
+    def put(self, origin: Tuple[float, float], destination: Tuple[float, float], distance_km: float):
+        """
+        Store a single pair
+        
+        Args:
+            origin: (lat, lon) of origin
+            destination: (lat, lon) of destination
+            distance_km: Road distance in km, or None if there is no route
+        """
+        (o_lat, o_lon), (d_lat, d_lon) = quantize_coordinates([origin, destination]).tolist()
+        
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO route_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (self.network_version, o_lat, o_lon, d_lat, d_lon, distance_km)
+            )
+            self._conn.commit()
+    
+    def get_matrix(self, origins, destinations) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up every origin/destination pair in bulk
+        
+        Args:
+            origins: Sequence or array of (lat, lon) for origins
+            destinations: Sequence or array of (lat, lon) for destinations
+        
+        Returns:
+            Tuple of (distances, found): distances in km with NaN where missing
+            or unroutable, and a boolean mask of cached pairs
+        """
+        origin_keys = quantize_coordinates(origins)
+        destination_keys = quantize_coordinates(destinations)
+        distances = np.full((len(origin_keys), len(destination_keys)), np.nan)
+        found = np.zeros(distances.shape, dtype=bool)
+        
+        if distances.size == 0:
+            return distances, found
+        
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("DELETE FROM lookup_origins")
+            cursor.execute("DELETE FROM lookup_destinations")
+            cursor.executemany(
+                "INSERT INTO lookup_origins VALUES (?, ?, ?)",
+                ((i, lat, lon) for i, (lat, lon) in enumerate(origin_keys.tolist()))
+            )
+            cursor.executemany(
+                "INSERT INTO lookup_destinations VALUES (?, ?, ?)",
+                ((j, lat, lon) for j, (lat, lon) in enumerate(destination_keys.tolist()))
+            )
+            
+            # CROSS JOIN pins the loop order: one primary-key probe per pair
+            rows = cursor.execute("""
+                SELECT o.idx, d.idx, c.distance_km
+                FROM lookup_origins o
+                CROSS JOIN lookup_destinations d
+                CROSS JOIN route_cache c
+                WHERE c.network_version = ?
+                  AND c.origin_lat = o.lat AND c.origin_lon = o.lon
+                  AND c.dest_lat = d.lat AND c.dest_lon = d.lon
+            """, (self.network_version,)).fetchall()
+            
+            if rows:
+                result = np.array(rows, dtype=np.float64)
+                i, j = result[:, 0].astype(np.int64), result[:, 1].astype(np.int64)
+                distances[i, j] = result[:, 2]
+                found[i, j] = True
+            
+            n_found = int(found.sum())
+            self.hits += n_found
+            self.misses += found.size - n_found
+        
+        return distances, found
+    
+    def put_matrix(self, origins, destinations, distances: np.ndarray, mask: np.ndarray = None) -> int:
+        """
+        Store a block of routed distances
+        
+        Args:
+            origins: Sequence or array of (lat, lon) for origins
+            destinations: Sequence or array of (lat, lon) for destinations
+            distances: Array of shape (n_origins, n_destinations), NaN for no route
+            mask: Boolean array selecting the pairs to store (default: all)
+        
+        Returns:
+            Number of pairs stored
+        """
+        origin_keys = quantize_coordinates(origins)
+        destination_keys = quantize_coordinates(destinations)
+        distances = np.asarray(distances, dtype=np.float64)
+        
+        if mask is None:
+            mask = np.ones(distances.shape, dtype=bool)
+        rows, cols = np.nonzero(mask)
+        
+        values = distances[rows, cols]
+        records = [
+            (self.network_version, o_lat, o_lon, d_lat, d_lon, None if np.isnan(value) else value)
+            for (o_lat, o_lon), (d_lat, d_lon), value in zip(
+                origin_keys[rows].tolist(), destination_keys[cols].tolist(), values.tolist()
+            )
+        ]
+        
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO route_cache VALUES (?, ?, ?, ?, ?, ?)", records)
+            self._conn.commit()
+        
+        return len(records)
+    
+    def sample(self, size: int = 10000) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Draw a random sample of routed pairs of the current network version
+        
+        Args:
+            size: Maximum number of pairs
+        
+        Returns:
+            Tuple of (origins, destinations, distances): (lat, lon) arrays of
+            shape (n, 2) and distances in km; missing routes are left out
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT origin_lat, origin_lon, dest_lat, dest_lon, distance_km FROM route_cache "
+                "WHERE network_version = ? AND distance_km IS NOT NULL ORDER BY random() LIMIT ?",
+                (self.network_version, int(size))
+            ).fetchall()
+        
+        table = np.array(rows, dtype=np.float64).reshape(-1, 5)
+        return table[:, 0:2] / COORDINATE_SCALE, table[:, 2:4] / COORDINATE_SCALE, table[:, 4]
+    
+    def invalidate(self, network_version: str = None, keep_current: bool = False) -> int:
+        """
+        Delete cached distances, e.g. after the OSM extract changed
+        
+        Args:
+            network_version: Version to delete (default: every version)
+            keep_current: When deleting every version, keep this cache's
+                          current network_version
+        
+        Returns:
+            Number of pairs deleted
+        """
+        with self._lock:
+            if network_version is not None:
+                cursor = self._conn.execute(
+                    "DELETE FROM route_cache WHERE network_version = ?", (network_version,)
+                )
+            elif keep_current:
+                cursor = self._conn.execute(
+                    "DELETE FROM route_cache WHERE network_version != ?", (self.network_version,)
+                )
+            else:
+                cursor = self._conn.execute("DELETE FROM route_cache")
+            self._conn.commit()
+            deleted = cursor.rowcount
+        
+        logger.info(f"Invalidated {deleted} cached distances")
+        return deleted
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get hit/miss counters and the number of cached pairs
+        
+        Returns:
+            Dictionary with hits, misses and entries for the current network version
+        """
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM route_cache WHERE network_version = ?", (self.network_version,)
+            ).fetchone()[0]
+        
+        return {
+            'network_version': self.network_version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': entries
+        }
\ No newline at end of file
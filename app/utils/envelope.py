@@ -0,0 +1,199 @@
+"""
+Fuel-price lower envelopes for AgriPort Optimizer
+
+With port charges and sea freight fixed, the cost of each port at a grid
+point is a line in the fuel price:
+
+    cost = port_charge + sea_freight + distance_km * fuel_efficiency * fuel_price / 25
+
+so the optimal port as a function of fuel price is the lower envelope of one
+line per port. This module precomputes, for every grid point, the sorted fuel
+prices at which the optimal port changes and the winning port on each
+interval. Any fuel price can then be answered from the envelope alone, without
+the distance matrix.
+"""
+import logging
+from typing import Dict, Any, NamedTuple
+import numpy as np
+from .cost import TRUCK_CAPACITY_TONS, DEFAULT_FUEL_EFFICIENCY
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+class FuelPriceEnvelope(NamedTuple):
+    """
+    Optimal port per grid point as a piecewise-constant function of fuel price
+    
+    breakpoints has shape (n_grid, n_breaks), sorted per row and padded with
+    inf; winners has shape (n_grid, n_breaks + 1) and holds the port column
+    index on each interval (-1 for grid points without a reachable port).
+    The interval of a fuel price is the number of breakpoints at or below it.
+    """
+    port_ids: np.ndarray
+    breakpoints: np.ndarray
+    winners: np.ndarray
+    fuel_min: float
+    fuel_max: float
+    
+    @property
+    def n_breaks(self) -> np.ndarray:
+        """Number of breakpoints per grid point"""
+        return np.isfinite(self.breakpoints).sum(axis=1)
+    
+    def winner_index(self, fuel_price: float) -> np.ndarray:
+        """
+        Optimal port column for every grid point at one fuel price
+        
+        Rows are sorted, so counting the breakpoints at or below the price is
+        the row's binary-search position; rows are short (one entry per port
+        at most), so counting is done for all rows at once.
+        
+        Args:
+            fuel_price: Fuel price in dollars per liter
+        
+        Returns:
+            Array of port column indices, -1 for unreachable grid points
+        """
+        interval = (self.breakpoints <= fuel_price).sum(axis=1)
+        return self.winners[np.arange(len(self.winners)), interval]
+    
+    def winner_ids(self, fuel_price: float) -> np.ndarray:
+        """
+        Optimal port id for every grid point at one fuel price
+        
+        Args:
+            fuel_price: Fuel price in dollars per liter
+        
+        Returns:
+            Array of port ids, -1 for unreachable grid points
+        """
+        index = self.winner_index(fuel_price)
+        return np.where(index >= 0, self.port_ids[np.maximum(index, 0)], -1)
+    
+    def sweep(self, fuel_prices) -> np.ndarray:
+        """
+        Optimal port column for every grid point at several fuel prices
+        
+        Args:
+            fuel_prices: Sequence of fuel prices
+        
+        Returns:
+            Array of shape (n_prices, n_grid) of port column indices
+        """
+        return np.stack([self.winner_index(fuel_price) for fuel_price in fuel_prices])
+    
+    def change_points(self) -> np.ndarray:
+        """
+        Fuel prices at which the optimal port changes for at least one grid point
+        
+        Returns:
+            Sorted array of unique breakpoints
+        """
+        return np.unique(self.breakpoints[np.isfinite(self.breakpoints)])
+    
+    def to_compact(self) -> Dict[str, Any]:
+        """
+        Ragged (CSR-style) form for JSON responses
+        
+        Grid point i has breakpoints[offsets[i]:offsets[i + 1]] and winners
+        [offsets[i] + i : offsets[i + 1] + i + 1].
+        
+        Returns:
+            Dictionary with offsets, breakpoints and winners lists
+        """
+        n_breaks = self.n_breaks
+        offsets = np.concatenate([[0], np.cumsum(n_breaks)])
+        finite = np.isfinite(self.breakpoints)
+        
+        # Winners in use are the first n_breaks + 1 of each row
+        winner_mask = np.arange(self.winners.shape[1])[np.newaxis, :] <= n_breaks[:, np.newaxis]
+        
+        return {
+            'offsets': offsets.tolist(),
+            'breakpoints': np.round(self.breakpoints[finite], 6).tolist(),
+            'winners': self.winners[winner_mask].tolist(),
+        }
+
+def build_fuel_envelope(distance_matrix: np.ndarray, port_charges: np.ndarray, sea_freights: np.ndarray,
+                        port_ids=None, fuel_min: float = 0.0, fuel_max: float = np.inf,
+                        fuel_efficiency: float = DEFAULT_FUEL_EFFICIENCY) -> FuelPriceEnvelope:
+    """
+    Precompute the fuel-price lower envelope for every grid point
+    
+    Starting from the optimal port at fuel_min, each step moves every grid
+    point to the flatter line that crosses its current winner first. Slopes
+    strictly decrease along the envelope, so there are fewer steps than
+    ports, each vectorized over the whole grid.
+    
+    Args:
+        distance_matrix: Array of shape (n_grid, n_ports) with road distances in km
+        port_charges: Port charge per port in dollars per ton, shape (n_ports,)
+        sea_freights: Sea freight per port in dollars per ton, shape (n_ports,)
+        port_ids: Port id for each matrix column (default: column positions)
+        fuel_min: Lowest fuel price of interest
+        fuel_max: Highest fuel price of interest; later breakpoints are dropped
+        fuel_efficiency: Fuel consumption in liters per kilometer
+    
+    Returns:
+        FuelPriceEnvelope
+    """
+    distances = np.asarray(distance_matrix, dtype=np.float64)
+    n_grid, n_ports = distances.shape
+    port_ids = np.arange(n_ports) if port_ids is None else np.asarray(port_ids)
+    
+    intercepts = np.asarray(port_charges, dtype=np.float64) + np.asarray(sea_freights, dtype=np.float64)
+    slopes = distances * (fuel_efficiency / TRUCK_CAPACITY_TONS)
+    available = np.isfinite(slopes)
+    
+    # Winner at fuel_min; on a tie the flatter line wins just above it
+    start_costs = np.where(available, intercepts[np.newaxis, :] + slopes * fuel_min, np.inf)
+    reachable = np.isfinite(start_costs).any(axis=1) if n_ports else np.zeros(n_grid, dtype=bool)
+    current = np.full(n_grid, -1, dtype=np.int64)
+    if n_ports:
+        tied = start_costs == start_costs.min(axis=1, keepdims=True)
+        current = np.where(reachable, np.argmin(np.where(tied & available, slopes, np.inf), axis=1), -1)
+    
+    breakpoint_columns = []
+    winner_columns = [current.copy()]
+    position = np.full(n_grid, float(fuel_min))
+    open_rows = np.flatnonzero(reachable)
+    
+    while len(open_rows):
+        winner = current[open_rows]
+        winner_intercept = intercepts[winner]
+        winner_slope = slopes[open_rows, winner]
+        row_slopes = slopes[open_rows]
+        
+        # Price at which each flatter line undercuts the current winner
+        flatter = row_slopes < winner_slope[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing = (intercepts[np.newaxis, :] - winner_intercept[:, np.newaxis]) / (
+                winner_slope[:, np.newaxis] - row_slopes
+            )
+        crossing = np.where(flatter, np.maximum(crossing, position[open_rows, np.newaxis]), np.inf)
+        next_price = crossing.min(axis=1)
+        
+        # Among lines crossing at the same price the flattest takes over
+        at_next = crossing == next_price[:, np.newaxis]
+        successor = np.argmin(np.where(at_next, row_slopes, np.inf), axis=1)
+        
+        moves = np.isfinite(next_price) & (next_price <= fuel_max)
+        breaks = np.full(n_grid, np.inf)
+        breaks[open_rows[moves]] = next_price[moves]
+        current[open_rows[moves]] = successor[moves]
+        position[open_rows[moves]] = next_price[moves]
+        
+        breakpoint_columns.append(breaks)
+        winner_columns.append(current.copy())
+        open_rows = open_rows[moves]
+    
+    breakpoints = np.column_stack(breakpoint_columns) if breakpoint_columns else np.empty((n_grid, 0))
+    winners = np.column_stack(winner_columns)
+    
+    # The last iteration only closes rows; drop its all-inf column
+    if breakpoints.shape[1] and not np.isfinite(breakpoints[:, -1]).any():
+        breakpoints = breakpoints[:, :-1]
+        winners = winners[:, :-1]
+    
+    logger.info(f"Built fuel envelope: {n_grid} grid points, up to {breakpoints.shape[1]} breakpoints each")
+    return FuelPriceEnvelope(port_ids, breakpoints, winners, float(fuel_min), float(fuel_max))
\ No newline at end of file
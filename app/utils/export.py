@@ -0,0 +1,414 @@
+"""
+Streaming export and compact encodings of scenario results for AgriPort Optimizer
+
+Results are written in fixed-size row chunks straight from the ranking
+arrays and the memory-mapped distance matrix, so the memory used by an export
+does not grow with the size of the grid. Every writer is a generator of bytes
+that can back a streaming HTTP response.
+
+For the map client, results are also encoded as a raster: a small JSON
+header followed by typed arrays covering the grid's lattice row by row
+(row 0 in the south):
+    
+    magic       4 bytes, RASTER_MAGIC
+    length      uint32 little-endian, length of the JSON header
+    header      JSON (raster, port_ids, arrays with dtype/offset/length),
+                zero padded to a multiple of 8 bytes
+    arrays      port_index (uint8 or uint16, nodata = dtype max),
+                total_cost and gradient (float32, NaN for nodata),
+                each starting at a multiple of 8 bytes
+"""
+import io
+import json
+import base64
+import struct
+import zlib
+import logging
+import importlib.util
+from typing import Any, Callable, Dict, Iterator, Iterable, Sequence, Tuple
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_ROWS = 65536
+
+EXPORT_COLUMNS = [
+    'grid_point_id', 'lat', 'lon', 'optimal_port_id', 'distance_km', 'total_cost',
+    'runner_up_port_id', 'runner_up_cost'
+]
+
+FLOAT_COLUMNS = {'lat', 'lon', 'distance_km', 'total_cost', 'runner_up_cost'}
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'geojson': ('application/geo+json', 'geojson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+RASTER_MAGIC = b'APRS'
+RASTER_FORMAT_VERSION = 1
+RASTER_FIELDS = ('port_index', 'total_cost', 'gradient')
+
+# Maps matrix rows [start, stop) to their (lat, lon) arrays
+CoordinateSource = Callable[[int, int], Tuple[np.ndarray, np.ndarray]]
+
+def iter_result_chunks(result, store, coordinates: CoordinateSource,
+                       chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Yield the export columns of a scenario result in row chunks
+    
+    Grid points without a reachable port are skipped; a missing runner-up
+    has id -1 and cost NaN.
+    
+    Args:
+        result: ScenarioResult to export
+        store: DistanceMatrixStore the scenario was evaluated on
+        coordinates: Function returning (lat, lon) for a range of matrix rows
+        chunk_rows: Matrix rows per chunk
+    
+    Yields:
+        Dictionary of column arrays (see EXPORT_COLUMNS)
+    """
+    scenario, ranking = result.scenario, result.ranking
+    positions = store.port_positions(scenario.port_ids)
+    matrix = store.matrix
+    
+    for start in range(0, len(ranking.best_idx), chunk_rows):
+        stop = min(start + chunk_rows, len(ranking.best_idx))
+        best_idx = ranking.best_idx[start:stop]
+        second_idx = ranking.second_idx[start:stop]
+        reachable = best_idx >= 0
+        if not reachable.any():
+            continue
+        
+        rows = np.flatnonzero(reachable)
+        best = best_idx[rows]
+        second = second_idx[rows]
+        lat, lon = coordinates(start, stop)
+        
+        yield {
+            'grid_point_id': np.asarray(store.grid_ids[start:stop])[rows],
+            'lat': np.asarray(lat)[rows],
+            'lon': np.asarray(lon)[rows],
+            'optimal_port_id': scenario.port_ids[best],
+            'distance_km': matrix[start + rows, positions[best]].astype(np.float64),
+            'total_cost': ranking.best_cost[start:stop][rows],
+            'runner_up_port_id': np.where(second >= 0, scenario.port_ids[np.maximum(second, 0)], -1),
+            'runner_up_cost': np.where(second >= 0, ranking.second_cost[start:stop][rows], np.nan),
+        }
+
+def _located(chunk: Dict[str, np.ndarray]) -> np.ndarray:
+    """Rows of a column chunk with finite coordinates"""
+    return np.isfinite(chunk['lat']) & np.isfinite(chunk['lon'])
+
+def write_csv(chunks: Iterable[Dict[str, np.ndarray]]) -> Iterator[bytes]:
+    """
+    Stream chunks as CSV with a header row
+    
+    Grid points without finite coordinates get empty lat and lon fields.
+    
+    Args:
+        chunks: Column chunks from iter_result_chunks
+    
+    Yields:
+        Encoded CSV text
+    """
+    yield (','.join(EXPORT_COLUMNS) + '\n').encode('utf-8')
+    
+    # Plain string formatting is several times faster than DataFrame.to_csv here
+    for chunk in chunks:
+        lines = [
+            f'{grid_id},' + (f'{lat:.6f},{lon:.6f},' if located else ',,')
+            + f'{port_id},{distance:.3f},{cost:.4f},'
+            + (f'{runner_up_id},{runner_up_cost:.4f}\n' if runner_up_id >= 0 else ',\n')
+            for located, grid_id, lat, lon, port_id, distance, cost, runner_up_id, runner_up_cost in zip(
+                _located(chunk).tolist(), *(chunk[column].tolist() for column in EXPORT_COLUMNS)
+            )
+        ]
+        yield ''.join(lines).encode('utf-8')
+
+def write_geojson(chunks: Iterable[Dict[str, np.ndarray]], precision: int = 5) -> Iterator[bytes]:
+    """
+    Stream chunks as a GeoJSON FeatureCollection of points
+    
+    Grid points without finite coordinates get a null geometry, since NaN
+    is not valid JSON.
+    
+    Args:
+        chunks: Column chunks from iter_result_chunks
+        precision: Decimal places of the coordinates
+    
+    Yields:
+        Encoded GeoJSON text
+    """
+    yield b'{"type":"FeatureCollection","features":['
+    
+    separator = ''
+    for chunk in chunks:
+        features = [
+            '{"type":"Feature","geometry":'
+            + (f'{{"type":"Point","coordinates":[{lon:.{precision}f},{lat:.{precision}f}]}}' if located else 'null')
+            + f',"properties":{{"grid_point_id":{grid_id},"optimal_port_id":{port_id},'
+            f'"distance_km":{distance:.3f},"total_cost":{cost:.4f},'
+            + (f'"runner_up_port_id":{runner_up_id},"runner_up_cost":{runner_up_cost:.4f}}}}}'
+               if runner_up_id >= 0 else '"runner_up_port_id":null,"runner_up_cost":null}}')
+            for located, grid_id, lat, lon, port_id, distance, cost, runner_up_id, runner_up_cost in zip(
+                _located(chunk).tolist(), *(chunk[column].tolist() for column in EXPORT_COLUMNS)
+            )
+        ]
+        
+        if features:
+            yield (separator + ','.join(features)).encode('utf-8')
+            separator = ','
+    
+    yield b']}'
+
+class _StreamSink(io.RawIOBase):
+    """Write-only file object whose contents are drained after every write batch"""
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._position = 0
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        return self._position
+    
+    def drain(self) -> bytes:
+        """Return and forget everything written since the last drain"""
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+def _arrow_table(chunk: Dict[str, np.ndarray], pa):
+    """Build an Arrow table from a column chunk; missing port ids (-1) and costs (NaN) become nulls"""
+    arrays = {}
+    for column, values in chunk.items():
+        if column.endswith('port_id'):
+            arrays[column] = pa.array(values, mask=values < 0)
+        elif column in FLOAT_COLUMNS:
+            arrays[column] = pa.array(values, from_pandas=True)
+        else:
+            arrays[column] = pa.array(values)
+    return pa.table(arrays)
+
+def write_arrow(chunks: Iterable[Dict[str, np.ndarray]], parquet: bool = True,
+                columns: Sequence[str] = EXPORT_COLUMNS, empty_types: Dict[str, str] = None) -> Iterator[bytes]:
+    """
+    Stream chunks as Parquet (one row group per chunk) or an Arrow IPC stream
+    
+    The schema is fixed by the first chunk and later chunks are cast to it.
+    Requires pyarrow, which is imported on first use.
+    
+    Args:
+        chunks: Column chunks, e.g. from iter_result_chunks
+        parquet: Write Parquet; otherwise the Arrow IPC stream format
+        columns: Columns of the empty file written when there are no chunks
+        empty_types: Arrow type names (e.g. 'string') of empty-file columns
+                     that are neither float (FLOAT_COLUMNS) nor int64
+    
+    Yields:
+        Encoded file bytes
+    
+    Raises:
+        ImportError: If pyarrow is not installed
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    sink = _StreamSink()
+    writer = None
+    
+    for chunk in chunks:
+        table = _arrow_table(chunk, pa)
+        if writer is None:
+            schema = table.schema
+            writer = pq.ParquetWriter(sink, schema) if parquet else pa.ipc.new_stream(sink, schema)
+        elif not table.schema.equals(schema):
+            table = table.cast(schema)
+        writer.write_table(table)
+        yield sink.drain()
+    
+    if writer is None:
+        # No rows: still produce a valid, empty file
+        empty_types = empty_types or {}
+        schema = pa.schema([
+            (column, pa.type_for_alias(empty_types.get(column, 'double' if column in FLOAT_COLUMNS else 'int64')))
+            for column in columns
+        ])
+        writer = pq.ParquetWriter(sink, schema) if parquet else pa.ipc.new_stream(sink, schema)
+    
+    writer.close()
+    yield sink.drain()
+
+def arrow_available() -> bool:
+    """Check whether pyarrow is installed (needed for Parquet and Arrow export)"""
+    return importlib.util.find_spec('pyarrow') is not None
+
+def gzip_stream(parts: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """
+    Compress a byte stream into gzip format on the fly
+    
+    Args:
+        parts: Byte chunks
+        level: zlib compression level
+    
+    Yields:
+        Gzip-compressed bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for part in parts:
+        compressed = compressor.compress(part)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def encode_result_raster(result, raster: Dict[str, Any], cells: np.ndarray, 
+                         fields: Sequence[str] = RASTER_FIELDS,
+                         rows: np.ndarray = None) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """
+    Lay a scenario result out on the grid's raster as typed arrays
+    
+    Args:
+        result: ScenarioResult to encode
+        raster: Raster description (origin_lat/lon, cell_lat/lon, n_rows, n_cols)
+        cells: Flat raster cell (row * n_cols + col) of each matrix row, or
+            the cells painted from rows
+        fields: Arrays to include, a subset of RASTER_FIELDS
+        rows: Matrix row painted into each of cells (e.g. the covering node
+            of an adaptive grid); default: cells[i] shows matrix row i
+    
+    Returns:
+        Tuple of (header, arrays); port_index holds positions into
+        header['port_ids']
+    """
+    scenario, ranking = result.scenario, result.ranking
+    n_cells = int(raster['n_rows']) * int(raster['n_cols'])
+    
+    index_dtype = np.dtype('<u1') if len(scenario.port_ids) < 255 else np.dtype('<u2')
+    nodata = int(np.iinfo(index_dtype).max)
+    if rows is None:
+        source = ranking.best_idx >= 0
+        target = cells[source]
+    else:
+        reachable = ranking.best_idx[rows] >= 0
+        target, source = cells[reachable], rows[reachable]
+    
+    arrays = {}
+    for field in fields:
+        if field == 'port_index':
+            array, values = np.full(n_cells, nodata, dtype=index_dtype), ranking.best_idx
+        elif field == 'total_cost':
+            array, values = np.full(n_cells, np.nan, dtype='<f4'), ranking.best_cost
+        elif field == 'gradient':
+            array, values = np.full(n_cells, np.nan, dtype='<f4'), ranking.gradient
+        else:
+            raise ValueError(f"Unknown raster field: {field}")
+        array[target] = values[source]
+        arrays[field] = array
+    
+    header = {
+        'format_version': RASTER_FORMAT_VERSION,
+        'scenario_id': result.key,
+        'matrix_version': scenario.matrix_version,
+        'fuel_price': scenario.fuel_price,
+        'raster': {key: raster[key] for key in ('origin_lat', 'origin_lon', 'cell_lat', 'cell_lon', 'n_rows', 'n_cols')},
+        'port_ids': scenario.port_ids.tolist(),
+        'port_index_nodata': nodata,
+    }
+    return header, arrays
+
+def _align8(offset: int) -> int:
+    """Round an offset up to a multiple of 8 bytes"""
+    return (offset + 7) // 8 * 8
+
+def pack_result_raster(header: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> bytes:
+    """
+    Serialize an encoded raster into the binary format described above
+    
+    Args:
+        header: Header from encode_result_raster
+        arrays: Arrays from encode_result_raster
+    
+    Returns:
+        Binary payload
+    """
+    # Offsets are relative to the end of the padded header, so they do not
+    # depend on the header's own length
+    layout, offset = [], 0
+    for name, array in arrays.items():
+        layout.append({'name': name, 'dtype': array.dtype.str, 'offset': offset, 'length': int(array.size)})
+        offset = _align8(offset + array.nbytes)
+    
+    payload = json.dumps({**header, 'arrays': layout}, separators=(',', ':')).encode('utf-8')
+    header_size = _align8(8 + len(payload))
+    
+    buffer = bytearray(header_size + offset)
+    buffer[:8] = RASTER_MAGIC + struct.pack('<I', len(payload))
+    buffer[8:8 + len(payload)] = payload
+    for entry, array in zip(layout, arrays.values()):
+        start = header_size + entry['offset']
+        buffer[start:start + array.nbytes] = array.tobytes()
+    
+    return bytes(buffer)
+
+def result_raster_base64(header: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    """
+    Encode a raster as JSON with base64 typed arrays
+    
+    Args:
+        header: Header from encode_result_raster
+        arrays: Arrays from encode_result_raster
+    
+    Returns:
+        JSON-serializable dictionary; arrays maps name to {dtype, data}
+    """
+    return {
+        **header,
+        'arrays': {
+            name: {'dtype': array.dtype.str, 'data': base64.b64encode(array.tobytes()).decode('ascii')}
+            for name, array in arrays.items()
+        },
+    }
+
+def export_stream(result, store, coordinates: CoordinateSource, export_format: str = 'csv',
+                  gzip: bool = False, chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[bytes]:
+    """
+    Stream a scenario result in one of EXPORT_FORMATS
+    
+    Args:
+        result: ScenarioResult to export
+        store: DistanceMatrixStore the scenario was evaluated on
+        coordinates: Function returning (lat, lon) for a range of matrix rows
+        export_format: 'csv', 'geojson', 'parquet' or 'arrow'
+        gzip: Compress the output with gzip
+        chunk_rows: Matrix rows per chunk
+    
+    Returns:
+        Generator of bytes
+    
+    Raises:
+        ValueError: If the format is unknown
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}', expected one of {', '.join(EXPORT_FORMATS)}")
+    
+    chunks = iter_result_chunks(result, store, coordinates, chunk_rows)
+    if export_format == 'csv':
+        stream = write_csv(chunks)
+    elif export_format == 'geojson':
+        stream = write_geojson(chunks)
+    else:
+        stream = write_arrow(chunks, parquet=export_format == 'parquet')
+    
+    return gzip_stream(stream) if gzip else stream
\ No newline at end of file
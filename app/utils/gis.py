@@ -4,9 +4,16 @@ GIS utilities for AgriPort Optimizer
 import os
 import geopandas as gpd
 import numpy as np
-from shapely.geometry import Point, Polygon
+import shapely
+from shapely.geometry import Point, Polygon, MultiPolygon, mapping
 import pandas as pd
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Union
+from .cost import DEFAULT_BOUNDARY_THRESHOLD, boundary_metrics, rank_cost_table
+from .raster import KM_PER_DEGREE, grid_raster, raster_coordinates, infer_raster, label_raster
+from .grid import Grid
+
+# Rows tested against the boundary at a time, to bound peak memory
+GRID_CHUNK_ROWS = 256
 
 def load_argentina_boundary(shapefile_path: str = None) -> gpd.GeoDataFrame:
     """
@@ -14,7 +21,7 @@ def load_argentina_boundary(shapefile_path: str = None) -> gpd.GeoDataFrame:
     
     Args:
         shapefile_path: Path to shapefile (optional)
-        
+    
     Returns:
         GeoDataFrame with Argentina boundary
     """
@@ -34,107 +41,302 @@ def load_argentina_boundary(shapefile_path: str = None) -> gpd.GeoDataFrame:
     except Exception as e:
         raise FileNotFoundError(f"Could not load Argentina boundary shapefile: {str(e)}")
 
-def create_grid(boundary_gdf: gpd.GeoDataFrame, grid_size: int = 100) -> gpd.GeoDataFrame:
+def prepare_boundary(boundary_gdf: gpd.GeoDataFrame, simplify_tolerance: float = 0.0):
+    """
+    Merge, simplify and prepare a boundary for fast point-in-polygon tests
+    
+    Args:
+        boundary_gdf: GeoDataFrame with Argentina boundary
+        simplify_tolerance: Topology-preserving simplification tolerance in degrees
+                            (0 keeps the boundary as is)
+    
+    Returns:
+        Prepared shapely geometry
+    """
+    boundary = shapely.union_all(np.asarray(boundary_gdf.geometry.values))
+    if simplify_tolerance:
+        boundary = shapely.simplify(boundary, simplify_tolerance, preserve_topology=True)
+    
+    shapely.prepare(boundary)
+    return boundary
+
+def build_grid(boundary_gdf: gpd.GeoDataFrame, grid_size: int = 100,
+               cell_size_km: float = None, simplify_tolerance: float = None) -> Grid:
+    """
+    Create the grid points inside a boundary
+    
+    Points are tested against a prepared boundary in chunks of rows with a
+    vectorized point-in-polygon test, so no per-point objects are created.
+    Grid point ids are raster indices (row * n_cols + col), matching the
+    index create_grid has always produced.
+    
+    Args:
+        boundary_gdf: GeoDataFrame with Argentina boundary
+        grid_size: Number of points per axis when cell_size_km is not given
+        cell_size_km: Spacing between grid points in kilometers (optional)
+        simplify_tolerance: Boundary simplification in degrees
+                            (default: a tenth of the grid spacing)
+    
+    Returns:
+        Grid with points in raster order
+    """
+    raster = grid_raster(boundary_gdf.total_bounds, grid_size=grid_size, cell_size_km=cell_size_km)
+    n_rows, n_cols = raster['n_rows'], raster['n_cols']
+    
+    if simplify_tolerance is None:
+        simplify_tolerance = min(raster['cell_lat'], raster['cell_lon']) / 10
+    boundary = prepare_boundary(boundary_gdf, simplify_tolerance)
+    
+    lons = raster['origin_lon'] + np.arange(n_cols) * raster['cell_lon']
+    
+    rows, cols = [], []
+    for start in range(0, n_rows, GRID_CHUNK_ROWS):
+        chunk_rows = np.arange(start, min(start + GRID_CHUNK_ROWS, n_rows))
+        lats = raster['origin_lat'] + chunk_rows * raster['cell_lat']
+        
+        x, y = np.meshgrid(lons, lats)
+        inside = shapely.contains_xy(boundary, x, y)
+        
+        row_idx, col_idx = np.nonzero(inside)
+        rows.append(chunk_rows[row_idx].astype(np.int32))
+        cols.append(col_idx.astype(np.int32))
+    
+    row = np.concatenate(rows) if rows else np.empty(0, dtype=np.int32)
+    col = np.concatenate(cols) if cols else np.empty(0, dtype=np.int32)
+    return Grid(raster, row, col)
+
+def create_grid_arrays(boundary_gdf: gpd.GeoDataFrame, grid_size: int = 100,
+                       cell_size_km: float = None, 
+                       simplify_tolerance: float = None) -> Dict[str, Any]:
+    """
+    Create the grid points inside a boundary as compact coordinate arrays
+    
+    Args:
+        boundary_gdf: GeoDataFrame with Argentina boundary
+        grid_size: Number of points per axis when cell_size_km is not given
+        cell_size_km: Spacing between grid points in kilometers (optional)
+        simplify_tolerance: Boundary simplification in degrees
+                            (default: a tenth of the grid spacing)
+    
+    Returns:
+        Dictionary with grid_point_id (int64), lat/lon (float64) and row/col
+        (int32) arrays plus the raster description from grid_raster
+    """
+    return build_grid(boundary_gdf, grid_size, cell_size_km, simplify_tolerance).to_arrays()
+
+def grid_arrays_to_geodataframe(grid: Union[Grid, Dict[str, Any]]) -> gpd.GeoDataFrame:
+    """
+    Build a GeoDataFrame of grid points
+    
+    Args:
+        grid: Grid, or grid arrays from create_grid_arrays
+    
+    Returns:
+        GeoDataFrame indexed by grid point id with lat, lon, row and col columns
+    """
+    if not isinstance(grid, Grid):
+        grid = Grid(grid['raster'], grid['row'], grid['col'], ids=grid['grid_point_id'])
+    return grid.to_geodataframe()
+
+def create_grid(boundary_gdf: gpd.GeoDataFrame, grid_size: int = 100, cell_size_km: float = None,
+                as_geodataframe: bool = True) -> Union[gpd.GeoDataFrame, Grid]:
     """
     Create a grid of points covering Argentina
     
     Args:
         boundary_gdf: GeoDataFrame with Argentina boundary
         grid_size: Size of grid (grid_size x grid_size)
-        
+        cell_size_km: Spacing between grid points in kilometers; overrides grid_size
+        as_geodataframe: Return a GeoDataFrame; otherwise the compact Grid
+    
+    Returns:
+        GeoDataFrame with grid points, or Grid
+    """
+    grid = build_grid(boundary_gdf, grid_size=grid_size, cell_size_km=cell_size_km)
+    
+    if not as_geodataframe:
+        return grid
+    
+    return grid.to_geodataframe()
+
+def polygonize_labels(labels_2d: np.ndarray, raster: Dict[str, Any], nodata: int = -1) -> Dict[int, MultiPolygon]:
+    """
+    Extract exact region polygons from a label raster
+    
+    Each grid point owns the cell centred on it. Horizontal runs of equal
+    labels become rectangles, and each label's rectangles are unioned, so
+    regions follow the grid exactly (including holes and disconnected parts)
+    rather than their convex hull. Neighbouring regions share their borders
+    exactly, without gaps or overlaps.
+    
+    Args:
+        labels_2d: Label raster from label_raster
+        raster: Raster description
+        nodata: Label of cells outside the grid
+    
     Returns:
-        GeoDataFrame with grid points
+        Dictionary of label -> valid MultiPolygon
+    """
+    n_rows, n_cols = labels_2d.shape
+    
+    # Run boundaries: where the label changes along a row, plus the row ends
+    change = np.ones((n_rows, n_cols), dtype=bool)
+    change[:, 1:] = labels_2d[:, 1:] != labels_2d[:, :-1]
+    run_rows, run_starts = np.nonzero(change)
+    run_ends = np.append(run_starts[1:], 0)
+    run_ends[np.append(run_rows[1:] != run_rows[:-1], True)] = n_cols
+    run_labels = labels_2d[run_rows, run_starts]
+    
+    keep = run_labels != nodata
+    run_rows, run_starts, run_ends, run_labels = (
+        run_rows[keep], run_starts[keep], run_ends[keep], run_labels[keep]
+    )
+    
+    # Cell edges lie half a step either side of the grid points
+    x0 = raster['origin_lon'] + (run_starts - 0.5) * raster['cell_lon']
+    x1 = raster['origin_lon'] + (run_ends - 0.5) * raster['cell_lon']
+    y0 = raster['origin_lat'] + (run_rows - 0.5) * raster['cell_lat']
+    y1 = raster['origin_lat'] + (run_rows + 0.5) * raster['cell_lat']
+    boxes = shapely.box(x0, y0, x1, y1)
+    
+    regions = {}
+    for label in np.unique(run_labels):
+        # Rectangles of adjacent rows meet at T-junctions rather than shared
+        # vertices, so they need a full overlay union, not a coverage union
+        region = shapely.union_all(boxes[run_labels == label])
+        
+        # Drop the collinear vertices run ends leave on straight edges; no
+        # vertex moves, so shared borders stay identical
+        region = shapely.simplify(region, 0.0)
+        if isinstance(region, Polygon):
+            region = MultiPolygon([region])
+        regions[int(label)] = region
+    
+    return regions
+
+def port_regions_geojson(row: np.ndarray, col: np.ndarray, port_ids: np.ndarray,
+                         raster: Dict[str, Any], precision: int = 5) -> Dict[str, Any]:
     """
-    # Get the bounds of Argentina
-    minx, miny, maxx, maxy = boundary_gdf.total_bounds
+    Build a GeoJSON FeatureCollection with one MultiPolygon per port
+    
+    Args:
+        row: Raster row of each grid point
+        col: Raster column of each grid point
+        port_ids: Optimal port id of each grid point (-1 for none)
+        raster: Raster description
+        precision: Decimal places kept in the coordinates
     
-    # Create a grid of points
-    x_coords = np.linspace(minx, maxx, grid_size)
-    y_coords = np.linspace(miny, maxy, grid_size)
+    Returns:
+        GeoJSON FeatureCollection as a dictionary
+    """
+    labels_2d = label_raster(row, col, port_ids, raster)
+    regions = polygonize_labels(labels_2d, raster)
+    cell_counts = dict(zip(*np.unique(np.asarray(port_ids), return_counts=True)))
     
-    # Create all combinations of x,y coordinates
-    grid_points = []
-    for y in y_coords:
-        for x in x_coords:
-            point = Point(x, y)
-            grid_points.append(point)
+    features = []
+    for port_id, region in regions.items():
+        region = shapely.transform(region, lambda coords: np.round(coords, precision))
+        features.append({
+            'type': 'Feature',
+            'properties': {'port_id': port_id, 'cell_count': int(cell_counts.get(port_id, 0))},
+            'geometry': mapping(region)
+        })
     
-    # Create GeoDataFrame
-    grid_gdf = gpd.GeoDataFrame(geometry=grid_points, crs='EPSG:4326')
+    return {'type': 'FeatureCollection', 'features': features}
+
+def grid_port_ids(grid: Grid, optimal_ports: pd.DataFrame) -> np.ndarray:
+    """
+    Optimal port id of each grid point, positioned by id instead of a join
     
-    # Only keep points that are within Argentina
-    grid_gdf = gpd.sjoin(grid_gdf, boundary_gdf, predicate='within', how='inner')
+    Args:
+        grid: Grid
+        optimal_ports: DataFrame with grid_point_id (or indexed by grid point
+                       id) and optimal_port_id columns
     
-    # Add lat/lon columns
-    grid_gdf['lon'] = grid_gdf.geometry.x
-    grid_gdf['lat'] = grid_gdf.geometry.y
+    Returns:
+        int64 array with one port id per grid point, -1 where unassigned
+    """
+    if 'grid_point_id' in optimal_ports.columns:
+        ids = optimal_ports['grid_point_id'].to_numpy()
+    else:
+        ids = optimal_ports.index.to_numpy()
+    port_ids = optimal_ports['optimal_port_id'].to_numpy(dtype=np.float64, na_value=np.nan)
     
-    return grid_gdf
+    position = grid.index_of(ids)
+    found = (position >= 0) & ~np.isnan(port_ids)
+    result = np.full(len(grid), -1, dtype=np.int64)
+    result[position[found]] = port_ids[found]
+    return result
 
-def create_port_regions(grid_gdf: gpd.GeoDataFrame, optimal_ports: pd.DataFrame) -> gpd.GeoDataFrame:
+def create_port_regions(grid: Union[Grid, gpd.GeoDataFrame], optimal_ports: pd.DataFrame,
+                        cell_index: np.ndarray = None) -> gpd.GeoDataFrame:
     """
     Create polygons representing regions for each port
     
     Args:
-        grid_gdf: GeoDataFrame with grid points
+        grid: Grid, or GeoDataFrame with grid points indexed by grid point id
         optimal_ports: DataFrame with optimal port assigned to each grid point
-        
+        cell_index: Grid point index of every raster cell, for grids whose
+                    points cover more than their own cell (see
+                    adaptive.fill_cell_index); default: grid.cell_index
+    
     Returns:
-        GeoDataFrame with port regions
-    """
-    # Combine grid points with optimal ports
-    grid_with_ports = grid_gdf.copy()
-    grid_with_ports['optimal_port_id'] = optimal_ports['optimal_port_id']
-    
-    # Group by port and create convex hull for each group
-    port_regions = []
-    for port_id, group in grid_with_ports.groupby('optimal_port_id'):
-        if len(group) >= 3:  # Need at least 3 points for a polygon
-            # Create convex hull around points
-            hull = group.unary_union.convex_hull
-            port_regions.append({
-                'port_id': port_id,
-                'geometry': hull
-            })
-    
-    # Create GeoDataFrame
-    regions_gdf = gpd.GeoDataFrame(port_regions, crs='EPSG:4326')
-    
-    return regions_gdf
+        GeoDataFrame with one MultiPolygon per port
+    """
+    if not isinstance(grid, Grid):
+        grid = Grid.from_geodataframe(grid)
+    
+    port_ids = grid_port_ids(grid, optimal_ports)
+    if cell_index is None:
+        labels_2d = label_raster(grid.row, grid.col, port_ids, grid.raster)
+    else:
+        labels_2d = np.where(cell_index >= 0, port_ids[cell_index], -1).reshape(grid.n_rows, grid.n_cols)
+    regions = polygonize_labels(labels_2d, grid.raster)
+    
+    return gpd.GeoDataFrame(
+        {'port_id': list(regions.keys())},
+        geometry=list(regions.values()),
+        crs='EPSG:4326'
+    )
 
-def find_boundary_points(grid_gdf: gpd.GeoDataFrame, optimal_ports: pd.DataFrame, threshold: float = 0.05) -> gpd.GeoDataFrame:
+def find_boundary_points(grid_gdf: Union[Grid, gpd.GeoDataFrame], optimal_ports: pd.DataFrame, 
+                         threshold: float = DEFAULT_BOUNDARY_THRESHOLD) -> gpd.GeoDataFrame:
     """
     Find grid points at boundaries where port costs are similar
     
     Args:
-        grid_gdf: GeoDataFrame with grid points
-        optimal_ports: DataFrame with optimal port and costs for each grid point
+        grid_gdf: Grid, or GeoDataFrame with grid points
+        optimal_ports: Either the optimal-port table from find_optimal_port
+                       (with runner_up_cost) or a long-format table with costs
+                       for each grid point and port
         threshold: Threshold for cost difference to consider as boundary
-        
+    
     Returns:
         GeoDataFrame with boundary points
     """
-    # Add cost difference to second-best port
-    optimal_ports = optimal_ports.sort_values(['grid_point_id', 'total_cost'])
-    
-    cost_diffs = []
-    for grid_id, group in optimal_ports.groupby('grid_point_id'):
-        if len(group) >= 2:
-            # Calculate difference between best and second-best
-            best_cost = group.iloc[0]['total_cost']
-            second_best = group.iloc[1]['total_cost']
-            cost_diff = (second_best - best_cost) / best_cost  # Relative difference
-            
-            cost_diffs.append({
-                'grid_point_id': grid_id,
-                'cost_diff': cost_diff,
-                'is_boundary': cost_diff <= threshold
-            })
-    
-    cost_diff_df = pd.DataFrame(cost_diffs)
+    # Relative cost difference to the second-best port, from the top-2 kernel
+    if 'runner_up_cost' in optimal_ports.columns:
+        grid_point_ids = optimal_ports['grid_point_id'].to_numpy()
+        cost_diff, _, is_boundary = boundary_metrics(
+            optimal_ports['total_cost'].to_numpy(dtype=np.float64),
+            optimal_ports['runner_up_cost'].to_numpy(dtype=np.float64, na_value=np.inf),
+            threshold
+        )
+    else:
+        grid_point_ids, _, ranking = rank_cost_table(optimal_ports, threshold)
+        cost_diff, is_boundary = ranking.relative_gap, ranking.is_boundary
     
-    # Join with grid points
-    boundary_gdf = grid_gdf.merge(cost_diff_df, left_index=True, right_on='grid_point_id')
-    boundary_gdf = boundary_gdf[boundary_gdf['is_boundary']]
+    cost_diff_df = pd.DataFrame({
+        'grid_point_id': grid_point_ids[is_boundary],
+        'cost_diff': cost_diff[is_boundary],
+        'is_boundary': True
+    })
     
-    return boundary_gdf
\ No newline at end of file
+    if isinstance(grid_gdf, Grid):
+        # Only the boundary points get a GeoDataFrame, positioned by id
+        position = grid_gdf.index_of(cost_diff_df['grid_point_id'].to_numpy())
+        boundary_gdf = grid_gdf.take(position[position >= 0]).to_geodataframe().reset_index(drop=True)
+        return pd.concat([boundary_gdf, cost_diff_df[position >= 0].reset_index(drop=True)], axis=1)
+    
+    # Join with grid points
+    return grid_gdf.merge(cost_diff_df, left_index=True, right_on='grid_point_id')
\ No newline at end of file
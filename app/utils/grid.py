@@ -0,0 +1,246 @@
+"""
+Compact raster-backed grid for AgriPort Optimizer
+
+A Grid holds the points of a regular lat/lon raster as contiguous arrays
+(float64 lat/lon, int32 raster row/col) together with the raster geometry.
+Grid point ids are flat raster cells (row * n_cols + col), so ids, raster
+positions and point indices convert into each other arithmetically or
+through one lookup table, without joins or per-point Python objects.
+GeoDataFrame views are only built on request.
+"""
+from __future__ import annotations
+from typing import Any, Dict, TYPE_CHECKING
+import numpy as np
+from .raster import infer_raster
+
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+class Grid:
+    """
+    Grid points on a regular lat/lon raster
+    
+    Points keep the order they were created in (for a stored distance
+    matrix: the matrix rows). lat, lon, row and col hold one entry per
+    point; ids and cell_index are derived on first use and kept.
+    """
+    def __init__(self, raster: Dict[str, Any], row: np.ndarray, col: np.ndarray, ids: np.ndarray = None):
+        """
+        Initialize a grid from raster positions
+        
+        Args:
+            raster: Raster description (origin_lat, origin_lon, cell_lat,
+                cell_lon, n_rows, n_cols)
+            row: Raster row of each point (row 0 in the south)
+            col: Raster column of each point
+            ids: Grid point ids, if already at hand (row * n_cols + col)
+        
+        Raises:
+            ValueError: If a point lies outside the raster
+        """
+        self.raster = dict(raster)
+        self.n_rows = int(raster['n_rows'])
+        self.n_cols = int(raster['n_cols'])
+        self.row = np.ascontiguousarray(row, dtype=np.int32)
+        self.col = np.ascontiguousarray(col, dtype=np.int32)
+        
+        if len(self.row) != len(self.col):
+            raise ValueError("row and col must have the same length")
+        if len(self.row) and (
+            self.row.min() < 0 or self.row.max() >= self.n_rows or
+            self.col.min() < 0 or self.col.max() >= self.n_cols
+        ):
+            raise ValueError("Grid points must lie inside the raster")
+        
+        self.lat = raster['origin_lat'] + self.row * float(raster['cell_lat'])
+        self.lon = raster['origin_lon'] + self.col * float(raster['cell_lon'])
+        self._ids = None if ids is None else np.ascontiguousarray(ids, dtype=np.int64)
+        self._cell_index = None
+    
+    @classmethod
+    def from_ids(cls, ids: np.ndarray, raster: Dict[str, Any]) -> 'Grid':
+        """
+        Build a grid from raster ids, e.g. the grid ids of a distance matrix
+        
+        Args:
+            ids: Grid point ids (row * n_cols + col)
+            raster: Raster description
+        
+        Returns:
+            Grid with points in the order of ids
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        row, col = np.divmod(ids, int(raster['n_cols']))
+        return cls(raster, row, col, ids=ids)
+    
+    @classmethod
+    def from_coordinates(cls, lat: np.ndarray, lon: np.ndarray, raster: Dict[str, Any] = None) -> 'Grid':
+        """
+        Build a grid from point coordinates, snapping them to the raster
+        
+        Args:
+            lat: Latitudes
+            lon: Longitudes
+            raster: Raster description (inferred from the coordinates if not given)
+        
+        Returns:
+            Grid with points in the order of the coordinates
+        
+        Raises:
+            ValueError: If a coordinate is missing or outside the raster
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        if not (np.isfinite(lat).all() and np.isfinite(lon).all()):
+            raise ValueError("Grid point coordinates must be finite")
+        
+        if raster is None:
+            raster = infer_raster(lat, lon)
+        row = np.rint((lat - raster['origin_lat']) / raster['cell_lat'])
+        col = np.rint((lon - raster['origin_lon']) / raster['cell_lon'])
+        return cls(raster, row, col)
+    
+    @classmethod
+    def from_mask(cls, raster: Dict[str, Any], mask: np.ndarray) -> 'Grid':
+        """
+        Build a grid from the cells of a raster that hold a point
+        
+        Args:
+            raster: Raster description
+            mask: Boolean array (n_rows, n_cols), row 0 in the south
+        
+        Returns:
+            Grid with points in raster order (by id)
+        """
+        row, col = np.nonzero(mask)
+        return cls(raster, row, col)
+    
+    @classmethod
+    def from_geodataframe(cls, grid_gdf: gpd.GeoDataFrame) -> 'Grid':
+        """
+        Build a grid from a GeoDataFrame of grid points (see to_geodataframe)
+        
+        Args:
+            grid_gdf: Grid points with lat/lon (and row/col) columns, indexed
+                by grid point id; the raster is taken from attrs['raster'] or
+                inferred from the coordinates
+        
+        Returns:
+            Grid with points in the order of the GeoDataFrame rows
+        """
+        raster = grid_gdf.attrs.get('raster')
+        if raster is not None and {'row', 'col'}.issubset(grid_gdf.columns):
+            return cls(raster, grid_gdf['row'].to_numpy(), grid_gdf['col'].to_numpy())
+        return cls.from_coordinates(grid_gdf['lat'].to_numpy(), grid_gdf['lon'].to_numpy(), raster)
+    
+    def __len__(self) -> int:
+        return len(self.row)
+    
+    def __repr__(self):
+        return f"<Grid {len(self)} points on {self.n_rows}x{self.n_cols} raster>"
+    
+    @property
+    def ids(self) -> np.ndarray:
+        """Grid point id (flat raster cell) of each point"""
+        if self._ids is None:
+            self._ids = self.row.astype(np.int64) * self.n_cols + self.col
+        return self._ids
+    
+    @property
+    def cell_index(self) -> np.ndarray:
+        """Point index of every raster cell (flat), -1 for cells without a point"""
+        if self._cell_index is None:
+            cell_index = np.full(self.n_rows * self.n_cols, -1, dtype=np.int64)
+            cell_index[self.ids] = np.arange(len(self))
+            self._cell_index = cell_index
+        return self._cell_index
+    
+    @property
+    def mask(self) -> np.ndarray:
+        """Boolean raster (n_rows, n_cols) of the cells that hold a point"""
+        return (self.cell_index >= 0).reshape(self.n_rows, self.n_cols)
+    
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the grid's arrays in bytes"""
+        arrays = [self.row, self.col, self.lat, self.lon, self._ids, self._cell_index]
+        return sum(array.nbytes for array in arrays if array is not None)
+    
+    def index_of(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Point index of grid point ids
+        
+        Args:
+            ids: Grid point ids
+        
+        Returns:
+            int64 array of point indices, -1 for ids that are not grid points
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        on_raster = (ids >= 0) & (ids < self.n_rows * self.n_cols)
+        return np.where(on_raster, self.cell_index[np.where(on_raster, ids, 0)], -1)
+    
+    def index_at(self, row: np.ndarray, col: np.ndarray) -> np.ndarray:
+        """
+        Point index at raster positions
+        
+        Args:
+            row: Raster rows
+            col: Raster columns
+        
+        Returns:
+            int64 array of point indices, -1 for positions without a point
+        """
+        row = np.asarray(row, dtype=np.int64)
+        col = np.asarray(col, dtype=np.int64)
+        on_raster = (row >= 0) & (row < self.n_rows) & (col >= 0) & (col < self.n_cols)
+        cells = np.where(on_raster, row * self.n_cols + col, 0)
+        return np.where(on_raster, self.cell_index[cells], -1)
+    
+    def take(self, index: np.ndarray) -> 'Grid':
+        """
+        Grid of a subset of the points
+        
+        Args:
+            index: Point indices or a boolean mask over the points
+        
+        Returns:
+            Grid on the same raster
+        """
+        return Grid(self.raster, self.row[index], self.col[index], ids=self.ids[index])
+    
+    def to_arrays(self) -> Dict[str, Any]:
+        """
+        Grid as the dictionary of arrays returned by gis.create_grid_arrays
+        
+        Returns:
+            Dictionary with grid_point_id, lat, lon, row, col and raster
+        """
+        return {
+            'grid_point_id': self.ids,
+            'lat': self.lat,
+            'lon': self.lon,
+            'row': self.row,
+            'col': self.col,
+            'raster': self.raster
+        }
+    
+    def to_geodataframe(self) -> gpd.GeoDataFrame:
+        """
+        GeoDataFrame view of the grid points
+        
+        Returns:
+            GeoDataFrame indexed by grid point id with lat, lon, row and col
+            columns and the raster in attrs['raster']
+        """
+        import geopandas as gpd
+        import pandas as pd
+        
+        grid_gdf = gpd.GeoDataFrame(
+            {'lon': self.lon, 'lat': self.lat, 'row': self.row, 'col': self.col},
+            geometry=gpd.points_from_xy(self.lon, self.lat),
+            index=pd.Index(self.ids, name='grid_point_id'),
+            crs='EPSG:4326'
+        )
+        grid_gdf.attrs['raster'] = self.raster
+        return grid_gdf
\ No newline at end of file
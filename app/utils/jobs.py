@@ -0,0 +1,593 @@
+"""
+Background jobs for AgriPort Optimizer
+
+Long computations (full-resolution recomputes, grid rebuilds, distance
+refreshes, adaptive grid builds) run in a local process pool instead of
+inside a web request. The jobs table is the queue: a JobRunner in any process
+claims queued rows with a conditional update, hands them to its pool and
+requeues jobs whose worker stopped sending heartbeats, so no external broker
+is needed and queued or interrupted jobs survive a restart.
+
+Each pool process builds its own application (see _init_worker) and reports
+progress, heartbeats and results through the jobs table. Cancellation of a
+running job is cooperative: the job stops at its next progress report.
+"""
+import os
+import json
+import uuid
+import logging
+import threading
+import traceback
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, NamedTuple, Optional
+from sqlalchemy import update
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_POLL_SECONDS = 2.0
+DEFAULT_HEARTBEAT_SECONDS = 10.0
+DEFAULT_STALE_SECONDS = 60.0
+DEFAULT_MAX_ATTEMPTS = 3
+# File locations are chosen by the server configuration, never by a submission
+PATH_PARAMS = ('path', 'shapefile')
+
+class JobError(ValueError):
+    """Invalid job submission"""
+
+class JobCancelled(Exception):
+    """Raised inside a job when its cancellation has been requested"""
+
+class JobHandler(NamedTuple):
+    """Job implementation: validate runs at submission, run in a pool process"""
+    run: Callable
+    validate: Optional[Callable]
+
+JOB_HANDLERS: Dict[str, JobHandler] = {}
+
+def job_handler(kind: str, validate: Callable = None):
+    """
+    Register a job implementation
+    
+    The decorated function is called as run(context, params) in a pool
+    process with an application context, and returns a JSON-serializable
+    result. validate(params) runs in the submitting process and raises
+    JobError (or returns normalized params).
+    
+    Args:
+        kind: Job kind name
+        validate: Parameter validation (optional)
+    
+    Returns:
+        Decorator
+    """
+    def register(run):
+        JOB_HANDLERS[kind] = JobHandler(run, validate)
+        return run
+    return register
+
+def job_results_dir(app) -> str:
+    """Directory for job result files"""
+    return app.config.get('JOB_RESULTS_DIR') or os.path.join(app.instance_path, 'jobs')
+
+class JobContext:
+    """Progress reporting and result files for a job running in a pool process"""
+    def __init__(self, job_id: str, results_dir: str):
+        """
+        Initialize the context of one job run
+        
+        Args:
+            job_id: Job id
+            results_dir: Directory for result files
+        """
+        self.job_id = job_id
+        self.results_dir = results_dir
+    
+    def progress(self, fraction: float, message: str = None):
+        """
+        Report progress and stop if the job has been cancelled
+        
+        Args:
+            fraction: Completed fraction between 0 and 1
+            message: Short description of the current step
+        
+        Raises:
+            JobCancelled: If cancellation was requested
+        """
+        from .. import db
+        from ..models import Job
+        
+        values = {'progress': min(max(float(fraction), 0.0), 1.0), 'heartbeat_at': datetime.utcnow()}
+        if message is not None:
+            values['message'] = message[:255]
+        db.session.execute(update(Job).where(Job.id == self.job_id).values(**values))
+        db.session.commit()
+        
+        if db.session.query(Job.cancel_requested).filter(Job.id == self.job_id).scalar():
+            raise JobCancelled()
+    
+    def result_path(self, extension: str) -> str:
+        """
+        Path of the job's result file
+        
+        Args:
+            extension: File extension without the dot
+        
+        Returns:
+            Absolute path inside the results directory
+        """
+        os.makedirs(self.results_dir, exist_ok=True)
+        return os.path.join(self.results_dir, f"{self.job_id}.{extension}")
+
+# Application of a pool process, created once by the pool initializer
+_worker_app = None
+
+def _init_worker(config: Dict[str, Any]):
+    """Pool initializer: build the application used by every job of this process"""
+    global _worker_app
+    from .. import create_app
+    _worker_app = create_app(config)
+
+def _heartbeat(job_id: str, stop: threading.Event, interval: float):
+    """Keep a running job's heartbeat fresh during steps without progress reports"""
+    from .. import db
+    from ..models import Job
+    
+    with _worker_app.app_context():
+        while not stop.wait(interval):
+            try:
+                db.session.execute(update(Job).where(Job.id == job_id).values(heartbeat_at=datetime.utcnow()))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Heartbeat of job {job_id} failed: {str(e)}")
+
+def run_job(job_id: str) -> str:
+    """
+    Execute a claimed job in a pool process
+    
+    Args:
+        job_id: Job id (status already set to running)
+    
+    Returns:
+        Final job status
+    """
+    from .. import db
+    from ..models import Job
+    
+    with _worker_app.app_context():
+        job = db.session.get(Job, job_id)
+        handler = JOB_HANDLERS.get(job.kind)
+        context = JobContext(job_id, job_results_dir(_worker_app))
+        
+        stop = threading.Event()
+        interval = _worker_app.config.get('JOB_HEARTBEAT_SECONDS', DEFAULT_HEARTBEAT_SECONDS)
+        heartbeat = threading.Thread(target=_heartbeat, args=(job_id, stop, interval), daemon=True)
+        heartbeat.start()
+        
+        values = {'finished_at': datetime.utcnow()}
+        try:
+            if handler is None:
+                raise JobError(f"Unknown job kind '{job.kind}'")
+            result = handler.run(context, json.loads(job.params or '{}'))
+            values.update(status=JOB_SUCCEEDED, progress=1.0, message='Done', result=json.dumps(result))
+        except JobCancelled:
+            values.update(status=JOB_CANCELLED, message='Cancelled')
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            values.update(status=JOB_FAILED, error=f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=5)}")
+        finally:
+            stop.set()
+            heartbeat.join()
+            values['finished_at'] = datetime.utcnow()
+        
+        db.session.rollback()
+        db.session.execute(update(Job).where(Job.id == job_id).values(**values))
+        db.session.commit()
+        return values['status']
+
+class JobRunner:
+    """
+    Claims queued jobs from the jobs table and runs them in a process pool
+    
+    Several runners (web workers, `flask jobs-worker`) can share one
+    database; each job is claimed by exactly one of them. A runner with no
+    workers only submits and cancels jobs. The jobs table is created by the
+    database migrations like every other table.
+    """
+    def __init__(self, app, max_workers: int = DEFAULT_JOB_WORKERS):
+        """
+        Initialize a stopped runner
+        
+        Args:
+            app: Flask application (its config is used to build the pool's applications)
+            max_workers: Number of pool processes; 0 to only enqueue jobs
+        """
+        self.app = app
+        self.max_workers = max_workers
+        self.poll_seconds = app.config.get('JOB_POLL_SECONDS', DEFAULT_POLL_SECONDS)
+        self.stale_seconds = app.config.get('JOB_STALE_SECONDS', DEFAULT_STALE_SECONDS)
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self._pool = None
+        self._running = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+    
+    def _create_pool(self) -> ProcessPoolExecutor:
+        """Create the process pool whose processes each build their own application"""
+        # Pool processes are spawned, not forked, so they do not inherit
+        # this process's threads and open database connections
+        config = {
+            key: value for key, value in self.app.config.items()
+            if isinstance(value, (str, int, float, bool, type(None)))
+        }
+        config['JOB_WORKERS'] = 0
+        config['TILE_PRERENDER_MAX_ZOOM'] = -1
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(config,)
+        )
+    
+    def start(self):
+        """Start the pool and the dispatcher thread (no-op without workers or if started)"""
+        with self._lock:
+            if self.max_workers <= 0 or self._thread is not None:
+                return
+            self._pool = self._create_pool()
+            self._thread = threading.Thread(target=self._dispatch_loop, name='job-dispatcher', daemon=True)
+            self._thread.start()
+        logger.info(f"Job runner started with {self.max_workers} workers")
+    
+    def shutdown(self, wait: bool = True):
+        """Stop dispatching; running jobs finish unless the process exits"""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+    
+    def submit(self, kind: str, params: Dict[str, Any] = None):
+        """
+        Queue a job
+        
+        Args:
+            kind: Registered job kind
+            params: JSON-serializable parameters
+        
+        Returns:
+            Job row
+        
+        Raises:
+            JobError: If the kind is unknown or the parameters are invalid
+        """
+        from .. import db
+        from ..models import Job
+        
+        handler = JOB_HANDLERS.get(kind)
+        if handler is None:
+            raise JobError(f"Unknown job kind '{kind}', expected one of {', '.join(sorted(JOB_HANDLERS))}")
+        params = params or {}
+        if not isinstance(params, dict):
+            raise JobError("params must be an object")
+        if handler.validate is not None:
+            params = handler.validate(params) or params
+        
+        job = Job(id=uuid.uuid4().hex, kind=kind, status=JOB_QUEUED, params=json.dumps(params))
+        db.session.add(job)
+        db.session.commit()
+        
+        self.start()
+        self._wake.set()
+        return job
+    
+    def cancel(self, job_id: str):
+        """
+        Cancel a job: queued jobs stop at once, running jobs at their next progress report
+        
+        Args:
+            job_id: Job id
+        
+        Returns:
+            Job row, or None if there is no such job
+        """
+        from .. import db
+        from ..models import Job
+        
+        db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == JOB_QUEUED)
+            .values(status=JOB_CANCELLED, message='Cancelled', finished_at=datetime.utcnow())
+        )
+        db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == JOB_RUNNING).values(cancel_requested=True)
+        )
+        db.session.commit()
+        return db.session.get(Job, job_id)
+    
+    def requeue_stale(self) -> int:
+        """
+        Requeue running jobs whose worker stopped sending heartbeats
+        
+        Jobs that have used up their attempts are marked failed instead.
+        
+        Returns:
+            Number of jobs requeued or failed
+        """
+        from .. import db
+        from ..models import Job
+        
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        stale = (Job.status == JOB_RUNNING) & (Job.heartbeat_at < cutoff)
+        with self._lock:
+            if self._running:
+                stale &= Job.id.notin_(list(self._running))
+        
+        failed = db.session.execute(
+            update(Job).where(stale, Job.attempts >= self.max_attempts)
+            .values(status=JOB_FAILED, error='Worker lost too many times', finished_at=datetime.utcnow())
+        ).rowcount
+        requeued = db.session.execute(
+            update(Job).where(stale, Job.attempts < self.max_attempts)
+            .values(status=JOB_QUEUED, message='Requeued after worker loss')
+        ).rowcount
+        db.session.commit()
+        
+        if failed or requeued:
+            logger.warning(f"Requeued {requeued} and failed {failed} jobs of lost workers")
+        return failed + requeued
+    
+    def _claim(self):
+        """Claim the oldest queued job; returns its id or None"""
+        from .. import db
+        from ..models import Job
+        
+        candidates = db.session.query(Job.id).filter(Job.status == JOB_QUEUED).order_by(Job.created_at).limit(5)
+        for (job_id,) in candidates.all():
+            now = datetime.utcnow()
+            claimed = db.session.execute(
+                update(Job).where(Job.id == job_id, Job.status == JOB_QUEUED)
+                .values(status=JOB_RUNNING, started_at=now, heartbeat_at=now, cancel_requested=False,
+                        attempts=Job.attempts + 1, progress=0.0)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return job_id
+        return None
+    
+    def _unclaim(self, job_id: str):
+        """Put a claimed job that never reached the pool back in the queue"""
+        from .. import db
+        from ..models import Job
+        
+        db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == JOB_RUNNING)
+            .values(status=JOB_QUEUED, started_at=None, heartbeat_at=None, attempts=Job.attempts - 1)
+        )
+        db.session.commit()
+    
+    def _finished(self, job_id: str, future):
+        """Pool callback: free the slot and record jobs whose process died"""
+        with self._lock:
+            self._running.discard(job_id)
+        self._wake.set()
+        
+        error = future.exception() if not future.cancelled() else None
+        if error is not None:
+            from .. import db
+            from ..models import Job
+            
+            logger.error(f"Job {job_id} crashed its worker: {str(error)}")
+            with self.app.app_context():
+                db.session.execute(
+                    update(Job).where(Job.id == job_id, Job.status == JOB_RUNNING)
+                    .values(status=JOB_FAILED, error=f"Worker crashed: {error}", finished_at=datetime.utcnow())
+                )
+                db.session.commit()
+    
+    def _dispatch_loop(self):
+        """Dispatcher thread: requeue lost jobs and fill free pool slots"""
+        with self.app.app_context():
+            from .. import db
+            
+            while not self._stopped.is_set():
+                try:
+                    self.requeue_stale()
+                    while len(self._running) < self.max_workers and not self._stopped.is_set():
+                        job_id = self._claim()
+                        if job_id is None:
+                            break
+                        with self._lock:
+                            self._running.add(job_id)
+                        try:
+                            future = self._pool.submit(run_job, job_id)
+                        except BrokenProcessPool:
+                            # A pool process died; its jobs fail through _finished.
+                            # Requeue this one and continue with a fresh pool
+                            with self._lock:
+                                self._running.discard(job_id)
+                                broken, self._pool = self._pool, self._create_pool()
+                            self._unclaim(job_id)
+                            broken.shutdown(wait=False)
+                            logger.warning("Job pool broke; restarted it")
+                            continue
+                        future.add_done_callback(lambda f, job_id=job_id: self._finished(job_id, f))
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Job dispatcher error: {str(e)}")
+                finally:
+                    db.session.remove()
+                
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+def _validate_recompute(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Check the scenario of a recompute job against the current distance matrix"""
+    from flask import current_app
+    from .export import EXPORT_FORMATS
+    from .matrix_store import open_distance_matrix
+    from .scenario import ScenarioError, parse_scenario
+    
+    export_format = params.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        raise JobError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    
+    store = open_distance_matrix(current_app.config.get('DISTANCE_MATRIX_PATH'))
+    if store is None:
+        raise JobError("Distance matrix not available")
+    try:
+        parse_scenario(params.get('scenario') or {}, store)
+    except ScenarioError as e:
+        raise JobError(f"Invalid scenario: {e}")
+    return {**params, 'format': export_format}
+
+@job_handler('recompute', validate=_validate_recompute)
+def recompute_job(context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Evaluate a scenario over the full grid and export every assignment to a file"""
+    from flask import current_app
+    from .export import EXPORT_CHUNK_ROWS, EXPORT_FORMATS, export_stream
+    from .matrix_store import open_distance_matrix
+    from .scenario import parse_scenario, run_scenario
+    from ..routes import get_grid_coordinates
+    
+    store = open_distance_matrix(current_app.config.get('DISTANCE_MATRIX_PATH'))
+    if store is None:
+        raise RuntimeError("Distance matrix not available")
+    scenario = parse_scenario(params['scenario'], store)
+    
+    context.progress(0.05, 'Evaluating scenario')
+    result = run_scenario(scenario, store)
+    
+    export_format = params.get('format', 'csv')
+    gzip = bool(params.get('gzip', False))
+    extension = EXPORT_FORMATS[export_format][1] + ('.gz' if gzip else '')
+    path = context.result_path(extension)
+    
+    context.progress(0.4, 'Writing results')
+    n_chunks = max(1, -(-store.n_grid // EXPORT_CHUNK_ROWS))
+    with open(path, 'wb') as f:
+        stream = export_stream(result, store, get_grid_coordinates(store), export_format, gzip=gzip)
+        for written, part in enumerate(stream):
+            f.write(part)
+            context.progress(0.4 + 0.6 * min(written / n_chunks, 1.0))
+    
+    return {
+        'scenario_id': result.key,
+        'matrix_version': store.version,
+        'format': export_format,
+        'file': os.path.basename(path),
+        'bytes': os.path.getsize(path),
+    }
+
+def _reject_paths(params: Dict[str, Any]) -> None:
+    """Refuse file locations in submitted parameters (the CLI commands take them)"""
+    given = [name for name in PATH_PARAMS if name in params]
+    if given:
+        raise JobError(f"{', '.join(given)} cannot be set for a job; the configured files are used")
+
+def _validate_build_grid(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Check grid build parameters"""
+    _reject_paths(params)
+    grid_size = params.get('grid_size', 100)
+    cell_size_km = params.get('cell_size_km')
+    if not isinstance(grid_size, int) or grid_size < 2:
+        raise JobError("grid_size must be an integer of at least 2")
+    if cell_size_km is not None and (not isinstance(cell_size_km, (int, float)) or cell_size_km <= 0):
+        raise JobError("cell_size_km must be a positive number")
+    return params
+
+@job_handler('build_grid', validate=_validate_build_grid)
+def build_grid_job(context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the grid points inside the boundary and write them to a CSV file"""
+    import pandas as pd
+    from .gis import load_argentina_boundary, build_grid
+    
+    context.progress(0.05, 'Loading boundary')
+    boundary = load_argentina_boundary()
+    
+    context.progress(0.2, 'Creating grid')
+    grid = build_grid(boundary, grid_size=params.get('grid_size', 100), cell_size_km=params.get('cell_size_km'))
+    
+    context.progress(0.8, 'Writing grid points')
+    path = context.result_path('csv')
+    pd.DataFrame({'grid_point_id': grid.ids, 'lat': grid.lat, 'lon': grid.lon}).to_csv(path, index=False)
+    
+    return {'n_points': len(grid), 'raster': grid.raster, 'file': os.path.basename(path)}
+
+def _validate_adaptive_grid(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Check adaptive grid parameters"""
+    from .adaptive import DEFAULT_ADAPTIVE_LEVELS
+    from .cost import DEFAULT_BOUNDARY_THRESHOLD
+    
+    params = _validate_build_grid(params)
+    levels = params.get('levels', DEFAULT_ADAPTIVE_LEVELS)
+    threshold = params.get('threshold', DEFAULT_BOUNDARY_THRESHOLD)
+    scenario = params.get('scenario')
+    if not isinstance(levels, int) or not 0 <= levels <= 10:
+        raise JobError("levels must be an integer between 0 and 10")
+    if not isinstance(threshold, (int, float)) or threshold < 0:
+        raise JobError("threshold must be a non-negative number")
+    if not isinstance(scenario, dict) or not isinstance(scenario.get('fuel_price'), (int, float)):
+        raise JobError("scenario with a fuel_price is required")
+    return {**params, 'levels': levels, 'threshold': threshold}
+
+@job_handler('build_adaptive_grid', validate=_validate_adaptive_grid)
+def build_adaptive_grid_job(context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Refine an adaptive grid around a scenario's catchment boundaries and store its distances"""
+    from flask import current_app
+    from .. import db
+    from ..models import Port
+    from .adaptive import build_adaptive_matrix
+    from .distance_cache import DistanceCache
+    from .gis import load_argentina_boundary, build_grid
+    from .routing import create_router
+    
+    context.progress(0.02, 'Loading boundary')
+    boundary = load_argentina_boundary()
+    grid = build_grid(boundary, grid_size=params.get('grid_size', 100), cell_size_km=params.get('cell_size_km'))
+    ports = [
+        {**port.to_dict(), 'updated_at': port.updated_at}
+        for port in db.session.query(Port).order_by(Port.id).all()
+    ]
+    
+    context.progress(0.1, 'Routing coarse grid')
+    return build_adaptive_matrix(
+        current_app.config['DISTANCE_MATRIX_PATH'], grid, ports, params['scenario'],
+        create_router(cache=DistanceCache()), levels=params['levels'], threshold=params['threshold'],
+        progress=lambda fraction, message: context.progress(0.1 + 0.85 * fraction, message)
+    )
+
+def _validate_refresh_distances(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Check distance refresh parameters"""
+    _reject_paths(params)
+    if not isinstance(params.get('dry_run', False), bool):
+        raise JobError("dry_run must be a boolean")
+    return params
+
+@job_handler('refresh_distances', validate=_validate_refresh_distances)
+def refresh_distances_job(context: JobContext, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Route new or moved ports into the stored distance matrix"""
+    from flask import current_app
+    from .. import db
+    from .distance_cache import DistanceCache
+    from .matrix_store import refresh_from_database
+    from .routing import create_router
+    
+    context.progress(0.05, 'Routing new and moved ports')
+    router = create_router(cache=DistanceCache())
+    return refresh_from_database(current_app.config['DISTANCE_MATRIX_PATH'], db.session, router,
+                                 dry_run=params.get('dry_run', False))
\ No newline at end of file
@@ -0,0 +1,165 @@
+"""
+Point lookup of optimal ports for arbitrary coordinates for AgriPort Optimizer
+
+A coordinate that is not a grid node is placed on the grid's raster
+arithmetically (no spatial index or search), and its distance to every port
+is interpolated bilinearly from the four surrounding grid points' rows of
+the precomputed distance matrix. Costs and the port ranking then follow
+from the same kernel as /calculate, without any routing call.
+"""
+import logging
+from typing import Any, Dict, NamedTuple, Tuple
+import numpy as np
+from .cost import PortRanking, compute_cost_matrix, rank_ports
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+MAX_LOOKUP_POINTS = 100000
+
+class PointLookup(NamedTuple):
+    """
+    Optimal ports for a batch of coordinates
+    
+    nearest_rows is the matrix row of the grid point closest to each
+    coordinate (-1 off the grid); ranking holds port column indices into the
+    scenario's port_ids, -1 where no neighbouring grid point reaches a port.
+    """
+    nearest_rows: np.ndarray
+    ranking: PortRanking
+
+def locate_points(lat: np.ndarray, lon: np.ndarray, raster: Dict[str, Any],
+                  cell_rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the four surrounding grid points of each coordinate
+    
+    Args:
+        lat: Latitudes
+        lon: Longitudes
+        raster: Raster description of the grid
+        cell_rows: Matrix row of every raster cell, -1 for empty cells
+    
+    Returns:
+        Tuple of (neighbour rows (n, 4), bilinear weights (n, 4), nearest rows (n,));
+        rows are -1 where the neighbour is off the grid
+    """
+    n_rows, n_cols = int(raster['n_rows']), int(raster['n_cols'])
+    
+    # Fractional raster position; grid points sit at integer positions
+    row_pos = (np.asarray(lat, dtype=np.float64) - raster['origin_lat']) / raster['cell_lat']
+    col_pos = (np.asarray(lon, dtype=np.float64) - raster['origin_lon']) / raster['cell_lon']
+    row0 = np.floor(row_pos).astype(np.int64)
+    col0 = np.floor(col_pos).astype(np.int64)
+    row_frac = (row_pos - row0)[:, np.newaxis]
+    col_frac = (col_pos - col0)[:, np.newaxis]
+    
+    # Columns 0-3 are the bilinear neighbours, column 4 the nearest grid point
+    rows = row0[:, np.newaxis] + np.array([0, 0, 1, 1, 0])
+    cols = col0[:, np.newaxis] + np.array([0, 1, 0, 1, 0])
+    rows[:, 4] = np.rint(row_pos)
+    cols[:, 4] = np.rint(col_pos)
+    
+    inside = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+    found = np.full(rows.shape, -1, dtype=np.int64)
+    found[inside] = cell_rows[rows[inside] * n_cols + cols[inside]]
+    
+    weights = np.hstack([
+        (1 - row_frac) * (1 - col_frac),
+        (1 - row_frac) * col_frac,
+        row_frac * (1 - col_frac),
+        row_frac * col_frac,
+    ])
+    return found[:, :4], weights, found[:, 4]
+
+def interpolate_distances(matrix: np.ndarray, positions: np.ndarray,
+                          neighbours: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    Interpolate port distances from the neighbouring grid points
+    
+    Neighbours that are off the grid or cannot reach a port are left out and
+    the remaining weights renormalized, so coordinates on the edge of the
+    grid or next to an unroutable cell still get an estimate.
+    
+    Args:
+        matrix: Distance matrix (n_grid, n_columns), e.g. the memory map of a store
+        positions: Matrix columns of the ports of interest
+        neighbours: Neighbour rows from locate_points
+        weights: Bilinear weights from locate_points
+    
+    Returns:
+        Array (n, n_ports) of distances in km, NaN where no neighbour reaches the port
+    """
+    valid_rows = neighbours >= 0
+    
+    # Only the needed rows are read from the (memory-mapped) matrix
+    distances = np.full(neighbours.shape + (len(positions),), np.nan, dtype=np.float64)
+    if valid_rows.any():
+        distances[valid_rows] = matrix[neighbours[valid_rows]][:, positions]
+    
+    valid = np.isfinite(distances)
+    weighted = np.where(valid, weights[..., np.newaxis], 0.0)
+    total_weight = weighted.sum(axis=1)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        interpolated = (np.where(valid, distances, 0.0) * weighted).sum(axis=1) / total_weight
+    return np.where(total_weight > 0, interpolated, np.nan)
+
+def lookup_points(scenario, store, raster: Dict[str, Any], cell_rows: np.ndarray,
+                  lat: np.ndarray, lon: np.ndarray) -> PointLookup:
+    """
+    Rank the ports of a scenario at arbitrary coordinates
+    
+    Args:
+        scenario: Normalized scenario
+        store: DistanceMatrixStore the scenario was parsed against
+        raster: Raster description of the store's grid
+        cell_rows: Matrix row of every raster cell
+        lat: Latitudes
+        lon: Longitudes
+    
+    Returns:
+        PointLookup
+    """
+    neighbours, weights, nearest = locate_points(lat, lon, raster, cell_rows)
+    distances = interpolate_distances(store.matrix, store.port_positions(scenario.port_ids), neighbours, weights)
+    cost_matrix = compute_cost_matrix(distances, scenario.port_charges, scenario.sea_freights, scenario.fuel_price)
+    return PointLookup(nearest, rank_ports(cost_matrix))
+
+def lookup_response(scenario, lookup: PointLookup, grid_ids: np.ndarray,
+                    lat: np.ndarray, lon: np.ndarray) -> Dict[str, Any]:
+    """
+    Build the /lookup response
+    
+    Args:
+        scenario: Normalized scenario
+        lookup: Result of lookup_points
+        grid_ids: Grid point id for each matrix row
+        lat: Latitudes
+        lon: Longitudes
+    
+    Returns:
+        JSON-serializable dictionary with one entry per coordinate
+    """
+    ranking = lookup.ranking
+    port_ids = scenario.port_ids.tolist()
+    
+    results = []
+    for i in range(len(lookup.nearest_rows)):
+        best, second, nearest = int(ranking.best_idx[i]), int(ranking.second_idx[i]), int(lookup.nearest_rows[i])
+        results.append({
+            'lat': float(lat[i]),
+            'lon': float(lon[i]),
+            'nearest_grid_point_id': int(grid_ids[nearest]) if nearest >= 0 else None,
+            'port_id': port_ids[best] if best >= 0 else None,
+            'total_cost': round(float(ranking.best_cost[i]), 2) if best >= 0 else None,
+            'runner_up_port_id': port_ids[second] if second >= 0 else None,
+            'runner_up_cost': round(float(ranking.second_cost[i]), 2) if second >= 0 else None,
+            'is_boundary': bool(ranking.is_boundary[i]),
+        })
+    
+    return {
+        'status': 'success',
+        'matrix_version': scenario.matrix_version,
+        'fuel_price': scenario.fuel_price,
+        'results': results,
+    }
\ No newline at end of file
@@ -0,0 +1,720 @@
+"""
+On-disk distance matrix store for AgriPort Optimizer
+
+The store keeps the grid x port road distance matrix in a single binary file
+that workers open with a memory map, so the matrix is shared through the OS
+page cache instead of being reloaded and re-pivoted from the distances table.
+
+File layout (all integers little-endian):
+    header      HEADER_SIZES[format version] bytes: magic, format version,
+                JSON metadata length, JSON metadata (zero padded)
+    grid ids    int64[n_grid]
+    port ids    int64[port_capacity] (first n_ports slots in use)
+    distances   float32[n_ports][n_grid], one contiguous column per port
+
+Columns are stored port-major so a new port can be appended at the end of the
+file without rewriting existing data; the header is rewritten last and acts as
+the commit point.
+"""
+from __future__ import annotations
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+from datetime import datetime
+from typing import Dict, Any, Iterable, List, TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b'APDM'
+FORMAT_VERSION = 2
+# Header block size per format version; version 2 makes room for port snapshots
+HEADER_SIZES = {1: 4096, 2: 65536}
+HEADER_SIZE = HEADER_SIZES[FORMAT_VERSION]
+# Minimum seconds between on-disk checks in is_stale(min_interval=...)
+STALE_CHECK_INTERVAL = 1.0
+# Router backend assumed for stores written before the backend was recorded
+DEFAULT_ROUTER_BACKEND = 'osrm'
+DISTANCE_DTYPE = np.dtype('<f4')
+ID_DTYPE = np.dtype('<i8')
+
+# Magic, format version, reserved, JSON length
+_PREAMBLE = struct.Struct('<4sHHI')
+
+def _align(offset: int, alignment: int = 64) -> int:
+    """Round an offset up to the next multiple of alignment"""
+    return (offset + alignment - 1) // alignment * alignment
+
+def _layout(n_grid: int, port_capacity: int) -> Dict[str, int]:
+    """Compute array offsets for a store of the given size"""
+    grid_ids_offset = HEADER_SIZE
+    port_ids_offset = _align(grid_ids_offset + n_grid * ID_DTYPE.itemsize)
+    data_offset = _align(port_ids_offset + port_capacity * ID_DTYPE.itemsize)
+    return {
+        'grid_ids_offset': grid_ids_offset,
+        'port_ids_offset': port_ids_offset,
+        'data_offset': data_offset,
+    }
+
+def _pack_header(header: Dict[str, Any]) -> bytes:
+    """Serialize the header block, in the format of the file it belongs to"""
+    # The header block ends where the grid ids begin
+    header_size = header['grid_ids_offset']
+    format_version = next(
+        (version for version, size in HEADER_SIZES.items() if size == header_size), None
+    )
+    if format_version is None:
+        raise ValueError(f"Unsupported distance matrix header size {header_size}")
+    
+    payload = json.dumps(header, sort_keys=True).encode('utf-8')
+    if _PREAMBLE.size + len(payload) > header_size:
+        raise ValueError("Distance matrix metadata does not fit in the header block")
+    
+    block = _PREAMBLE.pack(MAGIC, format_version, 0, len(payload)) + payload
+    return block.ljust(header_size, b'\0')
+
+def _read_header(path: str) -> Dict[str, Any]:
+    """Read and validate the header block of a store file"""
+    with open(path, 'rb') as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ValueError(f"Not a distance matrix file (truncated header): {path}")
+        
+        magic, version, _, length = _PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise ValueError(f"Not a distance matrix file: {path}")
+        if version not in HEADER_SIZES:
+            raise ValueError(f"Unsupported distance matrix format version {version}: {path}")
+        
+        header_size = HEADER_SIZES[version]
+        block = preamble + f.read(header_size - _PREAMBLE.size)
+    
+    if len(block) < header_size or _PREAMBLE.size + length > header_size:
+        raise ValueError(f"Not a distance matrix file (truncated header): {path}")
+    
+    header = json.loads(block[_PREAMBLE.size:_PREAMBLE.size + length].decode('utf-8'))
+    if header.get('grid_ids_offset') != header_size:
+        raise ValueError(f"Corrupt distance matrix header (grid ids inside the header): {path}")
+    return header
+
+def _file_signature(path: str) -> tuple:
+    """Inode, size and modification time, which change whenever the file is replaced or updated"""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+class DistanceMatrixStore:
+    """
+    Memory-mapped grid x port distance matrix
+    
+    Open an existing file with DistanceMatrixStore.open() and build a new one
+    with DistanceMatrixStore.create() or one of the converters. The matrix
+    property is a zero-copy (n_grid, n_ports) view of the mapped file.
+    """
+    def __init__(self, path: str, header: Dict[str, Any], writable: bool = False):
+        """
+        Map an existing store file (use DistanceMatrixStore.open instead)
+        
+        Args:
+            path: Path to the store file
+            header: Parsed header block
+            writable: Map the file for in-place updates
+        """
+        self.path = path
+        self.header = header
+        self.writable = writable
+        self._signature = None
+        self._checked_at = time.monotonic()
+        self._map_arrays()
+    
+    def _map_arrays(self):
+        """Create memory maps for the id arrays and the distance columns"""
+        mode = 'r+' if self.writable else 'r'
+        n_grid = self.header['n_grid']
+        n_ports = self.header['n_ports']
+        
+        self._grid_ids = np.memmap(self.path, dtype=ID_DTYPE, mode=mode,
+                                   offset=self.header['grid_ids_offset'], shape=(n_grid,))
+        self._port_ids = np.memmap(self.path, dtype=ID_DTYPE, mode=mode,
+                                   offset=self.header['port_ids_offset'],
+                                   shape=(self.header['port_capacity'],))
+        
+        if n_ports > 0 and n_grid > 0:
+            self._columns = np.memmap(self.path, dtype=DISTANCE_DTYPE, mode=mode,
+                                      offset=self.header['data_offset'], shape=(n_ports, n_grid))
+        else:
+            self._columns = np.empty((n_ports, n_grid), dtype=DISTANCE_DTYPE)
+        
+        self._port_index = {int(port_id): i for i, port_id in enumerate(self.port_ids)}
+    
+    @classmethod
+    def open(cls, path: str, writable: bool = False) -> 'DistanceMatrixStore':
+        """
+        Open a store file with a memory map
+        
+        Args:
+            path: Path to the store file
+            writable: Open for in-place updates such as append_port
+        
+        Returns:
+            DistanceMatrixStore
+        """
+        # Stat before reading so a file replaced in between is seen as stale
+        signature = _file_signature(path)
+        store = cls(path, _read_header(path), writable=writable)
+        store._signature = signature
+        return store
+    
+    @classmethod
+    def create(cls, path: str, grid_ids: Iterable[int], port_ids: Iterable[int],
+               distance_matrix: np.ndarray, metadata: Dict[str, Any] = None,
+               port_capacity: int = None, matrix_version: int = None) -> 'DistanceMatrixStore':
+        """
+        Write a new store file, replacing any existing file atomically
+        
+        Args:
+            path: Path to the store file
+            grid_ids: Grid point id for each matrix row
+            port_ids: Port id for each matrix column
+            distance_matrix: Array of shape (n_grid, n_ports) with distances in km
+            metadata: Extra JSON-serializable metadata to keep in the header
+            port_capacity: Number of port id slots to reserve for later appends
+                           (default: twice the number of ports, at least 32)
+            matrix_version: Version number to record in the header (default: one
+                            past the version of the file being replaced, so
+                            versions keep increasing across rebuilds; 1 for a
+                            new file)
+        
+        Returns:
+            DistanceMatrixStore opened read-only
+        """
+        grid_ids = np.asarray(grid_ids, dtype=ID_DTYPE)
+        port_ids = np.asarray(port_ids, dtype=ID_DTYPE)
+        distance_matrix = np.asarray(distance_matrix)
+        n_grid, n_ports = len(grid_ids), len(port_ids)
+        
+        if distance_matrix.shape != (n_grid, n_ports):
+            raise ValueError(
+                f"Distance matrix shape {distance_matrix.shape} does not match "
+                f"{n_grid} grid points x {n_ports} ports"
+            )
+        if len(np.unique(port_ids)) != n_ports:
+            raise ValueError("Port ids must be unique")
+        
+        port_capacity = max(port_capacity or 2 * n_ports, n_ports, 32)
+        if matrix_version is None:
+            try:
+                matrix_version = _read_header(path)['matrix_version'] + 1
+            except (OSError, ValueError):
+                matrix_version = 1
+        
+        now = datetime.utcnow().isoformat()
+        header = {
+            'n_grid': n_grid,
+            'n_ports': n_ports,
+            'port_capacity': port_capacity,
+            'matrix_version': matrix_version,
+            'created_at': now,
+            'updated_at': now,
+            'metadata': metadata or {},
+            **_layout(n_grid, port_capacity),
+        }
+        
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(_pack_header(header))
+            f.seek(header['grid_ids_offset'])
+            f.write(grid_ids.tobytes())
+            
+            slots = np.zeros(port_capacity, dtype=ID_DTYPE)
+            slots[:n_ports] = port_ids
+            f.seek(header['port_ids_offset'])
+            f.write(slots.tobytes())
+            
+            # Port-major: write the transposed matrix one column at a time
+            f.seek(header['data_offset'])
+            for j in range(n_ports):
+                f.write(np.ascontiguousarray(distance_matrix[:, j], dtype=DISTANCE_DTYPE).tobytes())
+            
+            f.flush()
+            os.fsync(f.fileno())
+        
+        os.replace(tmp_path, path)
+        logger.info(f"Wrote distance matrix {path}: {n_grid} grid points x {n_ports} ports")
+        
+        return cls.open(path)
+    
+    @property
+    def n_grid(self) -> int:
+        """Number of grid points (matrix rows)"""
+        return self.header['n_grid']
+    
+    @property
+    def n_ports(self) -> int:
+        """Number of ports (matrix columns)"""
+        return self.header['n_ports']
+    
+    @property
+    def version(self) -> int:
+        """Matrix version, incremented on every update of the file"""
+        return self.header['matrix_version']
+    
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        """Free-form metadata stored in the header"""
+        return self.header['metadata']
+    
+    @property
+    def inactive_port_ids(self) -> set:
+        """Ports whose columns are kept but excluded from calculations"""
+        return set(self.metadata.get('inactive_port_ids', []))
+    
+    @property
+    def router_backend(self) -> str:
+        """Router backend the distances were computed with ('osrm' or 'haversine')"""
+        return self.metadata.get('router_backend', DEFAULT_ROUTER_BACKEND)
+    
+    @property
+    def active_mask(self) -> np.ndarray:
+        """Boolean mask over the matrix columns of ports that are in use"""
+        inactive = self.inactive_port_ids
+        return np.array([int(port_id) not in inactive for port_id in self.port_ids], dtype=bool)
+    
+    @property
+    def grid_ids(self) -> np.ndarray:
+        """Grid point id for each matrix row"""
+        return self._grid_ids
+    
+    @property
+    def port_ids(self) -> np.ndarray:
+        """Port id for each matrix column"""
+        return self._port_ids[:self.n_ports]
+    
+    @property
+    def matrix(self) -> np.ndarray:
+        """Zero-copy (n_grid, n_ports) float32 view of the distances in km"""
+        return self._columns.T
+    
+    def column(self, port_id: int) -> np.ndarray:
+        """
+        Get the distances from every grid point to one port
+        
+        Args:
+            port_id: Port id
+        
+        Returns:
+            Zero-copy float32 array of shape (n_grid,)
+        """
+        return self._columns[self._port_index[int(port_id)]]
+    
+    def port_positions(self, port_ids: Iterable[int]) -> np.ndarray:
+        """
+        Map port ids to matrix column positions
+        
+        Args:
+            port_ids: Port ids
+        
+        Returns:
+            Array of column positions, -1 for ports not in the store
+        """
+        return np.array([self._port_index.get(int(port_id), -1) for port_id in port_ids], dtype=np.int64)
+    
+    def is_stale(self, min_interval: float = 0.0) -> bool:
+        """
+        Check whether the file on disk has been updated since it was opened
+        
+        The header is only re-read when the file's inode, size or modification
+        time changed, so a check is a single stat call in the common case.
+        
+        Args:
+            min_interval: Skip the check (report fresh) if the previous one
+                          was less than this many seconds ago
+        
+        Returns:
+            True if the store should be reopened
+        """
+        now = time.monotonic()
+        if now - self._checked_at < min_interval:
+            return False
+        self._checked_at = now
+        
+        try:
+            signature = _file_signature(self.path)
+            if signature == self._signature:
+                return False
+            stale = _read_header(self.path)['matrix_version'] != self.version
+        except (OSError, ValueError):
+            return True
+        
+        if not stale:
+            self._signature = signature
+        return stale
+    
+    def prefetch(self) -> bool:
+        """
+        Ask the OS to read the mapped file into the page cache ahead of use
+        
+        The page cache is shared by every process mapping the file, so a
+        prefetch in the server's master process warms all of its workers.
+        
+        Returns:
+            True if read-ahead was requested, False where madvise is unavailable
+        """
+        if not hasattr(mmap, 'MADV_WILLNEED'):
+            return False
+        
+        for array in (self._grid_ids, self._port_ids, self._columns):
+            mapped = getattr(array, '_mmap', None)
+            if mapped is not None:
+                mapped.madvise(mmap.MADV_WILLNEED)
+        return True
+    
+    def _write_header(self):
+        """Rewrite the header block in place (the commit point of an update)"""
+        self.header['updated_at'] = datetime.utcnow().isoformat()
+        with open(self.path, 'r+b') as f:
+            f.write(_pack_header(self.header))
+            f.flush()
+            os.fsync(f.fileno())
+        self._signature = _file_signature(self.path)
+    
+    def append_port(self, port_id: int, distances: np.ndarray) -> 'DistanceMatrixStore':
+        """
+        Append one port column without rewriting the existing columns
+        
+        Args:
+            port_id: Id of the new port
+            distances: Distances in km from every grid point, shape (n_grid,)
+        
+        Returns:
+            The updated store (a new object if the file had to be rewritten)
+        """
+        if not self.writable:
+            raise PermissionError("Distance matrix store is open read-only")
+        if int(port_id) in self._port_index:
+            raise ValueError(f"Port {port_id} is already in the distance matrix")
+        
+        distances = np.ascontiguousarray(distances, dtype=DISTANCE_DTYPE)
+        if distances.shape != (self.n_grid,):
+            raise ValueError(f"Expected {self.n_grid} distances, got {distances.shape}")
+        
+        if self.n_ports >= self.header['port_capacity'] or self.header['grid_ids_offset'] != HEADER_SIZE:
+            # Out of port id slots, or an older format: rewrite once with room to grow
+            matrix = np.column_stack([self.matrix, distances])
+            port_ids = np.append(self.port_ids, port_id)
+            DistanceMatrixStore.create(self.path, self.grid_ids, port_ids, matrix,
+                                       metadata=self.metadata, port_capacity=2 * len(port_ids),
+                                       matrix_version=self.version + 1)
+            return DistanceMatrixStore.open(self.path, writable=True)
+        
+        n_ports = self.n_ports
+        column_offset = self.header['data_offset'] + n_ports * self.n_grid * DISTANCE_DTYPE.itemsize
+        slot_offset = self.header['port_ids_offset'] + n_ports * ID_DTYPE.itemsize
+        
+        with open(self.path, 'r+b') as f:
+            f.seek(column_offset)
+            f.write(distances.tobytes())
+            f.seek(slot_offset)
+            f.write(np.array([port_id], dtype=ID_DTYPE).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        
+        self.header['n_ports'] = n_ports + 1
+        self.header['matrix_version'] += 1
+        self._write_header()
+        self._map_arrays()
+        
+        logger.info(f"Appended port {port_id} to distance matrix {self.path}")
+        return self
+    
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Convert to the long format used by the distances table
+        
+        Returns:
+            DataFrame with grid_point_id, port_id and distance_km columns
+            (missing distances are dropped)
+        """
+        import pandas as pd
+        
+        matrix = self.matrix
+        rows, cols = np.nonzero(~np.isnan(matrix))
+        return pd.DataFrame({
+            'grid_point_id': self.grid_ids[rows],
+            'port_id': self.port_ids[cols],
+            'distance_km': matrix[rows, cols].astype(np.float64),
+        })
+    
+    @classmethod
+    def from_dataframe(cls, path: str, distances_df: pd.DataFrame,
+                       metadata: Dict[str, Any] = None) -> 'DistanceMatrixStore':
+        """
+        Build a store from a long-format distance table
+        
+        Args:
+            path: Path to the store file
+            distances_df: DataFrame with grid_point_id, port_id and distance_km columns
+            metadata: Extra metadata to keep in the header
+        
+        Returns:
+            DistanceMatrixStore opened read-only
+        """
+        from .cost import distances_to_matrix
+        
+        distance_matrix, grid_ids, port_ids = distances_to_matrix(distances_df)
+        return cls.create(path, grid_ids, port_ids, distance_matrix, metadata=metadata)
+    
+    @classmethod
+    def from_database(cls, path: str, session, port_ids: Iterable[int] = None,
+                      metadata: Dict[str, Any] = None) -> 'DistanceMatrixStore':
+        """
+        Build a store from the distances table
+        
+        Rows are read in (port_id, grid_point_id) order, which the
+        ix_distances_port_grid_point index serves as one range scan per port.
+        
+        Args:
+            path: Path to the store file
+            session: SQLAlchemy session
+            port_ids: Ports to read (default: all ports in the table)
+            metadata: Extra metadata to keep in the header
+        
+        Returns:
+            DistanceMatrixStore opened read-only
+        """
+        import pandas as pd
+        from ..models import Distance
+        
+        query = session.query(Distance.grid_point_id, Distance.port_id, Distance.distance_km)
+        if port_ids is not None:
+            query = query.filter(Distance.port_id.in_([int(port_id) for port_id in port_ids]))
+        query = query.order_by(Distance.port_id, Distance.grid_point_id)
+        distances_df = pd.read_sql(query.statement, session.connection())
+        return cls.from_dataframe(path, distances_df, metadata=metadata)
+    
+    def to_database(self, session, batch_size: int = 100000) -> int:
+        """
+        Replace the distances table rows for the stored ports with the matrix contents
+        
+        Args:
+            session: SQLAlchemy session (committed on success)
+            batch_size: Number of rows per COPY or insert batch
+        
+        Returns:
+            Number of rows written
+        
+        Raises:
+            ValueError: If the grid points of the matrix are not loaded
+        """
+        from .seed import seed_distances
+        
+        return seed_distances(session, self, batch_rows=batch_size)['distances']
+
+def open_distance_matrix(path: str) -> DistanceMatrixStore:
+    """
+    Open a distance matrix store read-only, returning None if it does not exist
+    
+    Args:
+        path: Path to the store file
+    
+    Returns:
+        DistanceMatrixStore or None
+    """
+    if not path or not os.path.exists(path):
+        return None
+    
+    try:
+        return DistanceMatrixStore.open(path)
+    except ValueError as e:
+        logger.error(f"Could not open distance matrix {path}: {str(e)}")
+        return None
+
+def _port_snapshot(port: Dict[str, Any]) -> Dict[str, Any]:
+    """Coordinates a port's column was routed from, as kept in the header"""
+    updated_at = port.get('updated_at')
+    return {
+        'lat': float(port['lat']),
+        'lon': float(port['lon']),
+        'updated_at': updated_at.isoformat() if isinstance(updated_at, datetime) else updated_at
+    }
+
+def _router_backend(router) -> str:
+    """Backend name of a router; routers without one are taken for OSRM"""
+    return getattr(router, 'backend', DEFAULT_ROUTER_BACKEND)
+
+def diff_ports(store: DistanceMatrixStore, ports: List[Dict[str, Any]], 
+               tolerance_deg: float = 1e-5) -> Dict[str, List[int]]:
+    """
+    Compare the current ports with the ports a stored matrix was built from
+    
+    Args:
+        store: Distance matrix store
+        ports: Current ports as dictionaries with id, lat, lon and active
+        tolerance_deg: Coordinate change below which a port has not moved
+    
+    Returns:
+        Dictionary of port id lists: added, moved, deactivated, reactivated, unchanged
+        (an active port that moved is listed as moved, even if it was inactive,
+        and so is an active stored port without a snapshot)
+    """
+    snapshots = store.metadata.get('ports', {})
+    inactive = store.inactive_port_ids
+    current_ids = {int(port['id']) for port in ports}
+    
+    changes = {'added': [], 'moved': [], 'deactivated': [], 'reactivated': [], 'unchanged': []}
+    for port in ports:
+        port_id = int(port['id'])
+        active = port.get('active', True)
+        
+        if port_id not in store._port_index:
+            if active:
+                changes['added'].append(port_id)
+            continue
+        
+        snapshot = snapshots.get(str(port_id))
+        if active and snapshot is None:
+            # Without a snapshot (stores written before they were kept) the
+            # column may be stale, so it is routed once and snapshotted
+            logger.warning(f"Port {port_id} has no snapshot in {store.path}; routing it again")
+            changes['moved'].append(port_id)
+        elif active and (
+            abs(snapshot['lat'] - float(port['lat'])) > tolerance_deg
+            or abs(snapshot['lon'] - float(port['lon'])) > tolerance_deg
+        ):
+            changes['moved'].append(port_id)
+        elif not active and port_id not in inactive:
+            changes['deactivated'].append(port_id)
+        elif active and port_id in inactive:
+            changes['reactivated'].append(port_id)
+        else:
+            changes['unchanged'].append(port_id)
+    
+    # Ports deleted from the table are masked like deactivated ones
+    for port_id in store.port_ids:
+        if int(port_id) not in current_ids and int(port_id) not in inactive:
+            changes['deactivated'].append(int(port_id))
+    
+    return changes
+
+def refresh_from_database(path: str, session, router, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Bring a stored distance matrix up to date with the ports and grid_points tables
+    
+    Args:
+        path: Path to the store file
+        session: SQLAlchemy session
+        router: Router providing get_distance_matrix_array (e.g. OSRMRouter)
+        dry_run: Only report what would change
+    
+    Returns:
+        Summary from refresh_distance_matrix
+    
+    Raises:
+        ValueError: If grid points of the matrix are missing from grid_points, or
+                    the router's backend differs from the stored matrix's
+    """
+    from ..models import Port, GridPoint
+    
+    store = DistanceMatrixStore.open(path)
+    ports = [
+        {**port.to_dict(), 'updated_at': port.updated_at}
+        for port in session.query(Port).order_by(Port.id).all()
+    ]
+    
+    # Grid coordinates in the row order of the stored matrix
+    rows = session.query(GridPoint.id, GridPoint.lat, GridPoint.lon).all()
+    coordinates = {grid_id: (lat, lon) for grid_id, lat, lon in rows}
+    missing = [int(grid_id) for grid_id in store.grid_ids if int(grid_id) not in coordinates]
+    if missing:
+        raise ValueError(f"{len(missing)} grid points of the matrix are not in grid_points")
+    grid_coordinates = np.array([coordinates[int(grid_id)] for grid_id in store.grid_ids])
+    
+    return refresh_distance_matrix(path, ports, grid_coordinates, router, dry_run=dry_run)
+
+def refresh_distance_matrix(path: str, ports: List[Dict[str, Any]], grid_coordinates: np.ndarray,
+                            router, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Bring a stored distance matrix up to date with the ports table
+    
+    Only the columns of new or moved ports are routed; deactivated ports are
+    masked in the header and keep their data. The updated file replaces the old
+    one atomically, so workers holding the old map keep a consistent view until
+    they reopen it.
+    
+    Args:
+        path: Path to the store file
+        ports: Current ports as dictionaries with id, lat, lon, active and updated_at
+        grid_coordinates: Array of (lat, lon) rows aligned with the store's grid ids
+        router: Router providing get_distance_matrix_array (e.g. OSRMRouter)
+        dry_run: Only report what would change
+    
+    Returns:
+        Dictionary with the port changes and the new matrix version
+    
+    Raises:
+        ValueError: If the grid coordinates do not match the store, or the router's
+                    backend differs from the one the stored distances came from
+    """
+    store = DistanceMatrixStore.open(path)
+    backend = _router_backend(router)
+    if backend != store.router_backend:
+        raise ValueError(
+            f"Distance matrix {path} holds {store.router_backend} distances; "
+            f"refusing to add {backend} distances (rebuild the matrix to switch backends)"
+        )
+    grid_coordinates = np.asarray(grid_coordinates, dtype=np.float64).reshape(-1, 2)
+    if len(grid_coordinates) != store.n_grid:
+        raise ValueError(f"Expected {store.n_grid} grid coordinates, got {len(grid_coordinates)}")
+    
+    changes = diff_ports(store, ports)
+    to_route = changes['added'] + changes['moved']
+    summary = {**changes, 'routed_ports': len(to_route), 'matrix_version': store.version}
+    
+    if dry_run or not (to_route or changes['deactivated'] or changes['reactivated']):
+        return summary
+    
+    ports_by_id = {int(port['id']): port for port in ports}
+    columns = {}
+    if to_route:
+        port_coordinates = np.array([[ports_by_id[port_id]['lat'], ports_by_id[port_id]['lon']]
+                                     for port_id in to_route], dtype=np.float64)
+        routed = router.get_distance_matrix_array(grid_coordinates, port_coordinates)
+        if getattr(router, 'failed_batches', None):
+            raise RuntimeError(
+                f"{len(router.failed_batches)} routing batches failed; distance matrix left unchanged"
+            )
+        columns = {port_id: routed[:, k] for k, port_id in enumerate(to_route)}
+    
+    # Moved ports are overwritten in place, new ports appended
+    port_ids = [int(port_id) for port_id in store.port_ids] + changes['added']
+    matrix = np.empty((store.n_grid, len(port_ids)), dtype=DISTANCE_DTYPE)
+    matrix[:, :store.n_ports] = store.matrix
+    for port_id, distances in columns.items():
+        matrix[:, port_ids.index(port_id)] = distances
+    
+    metadata = dict(store.metadata)
+    snapshots = dict(metadata.get('ports', {}))
+    # Inactive ports without a snapshot keep none, so they are routed when reactivated
+    for port_id in to_route + [port_id for port_id in changes['unchanged'] if str(port_id) in snapshots]:
+        snapshots[str(port_id)] = _port_snapshot(ports_by_id[port_id])
+    metadata['ports'] = snapshots
+    
+    # A reactivated port that also moved is listed as moved; both are unmasked
+    inactive = (store.inactive_port_ids | set(changes['deactivated'])) - set(changes['reactivated']) - set(to_route)
+    metadata['inactive_port_ids'] = sorted(inactive)
+    metadata['router_backend'] = backend
+    
+    updated = DistanceMatrixStore.create(
+        path, store.grid_ids, port_ids, matrix, metadata=metadata,
+        port_capacity=store.header['port_capacity'], matrix_version=store.version + 1
+    )
+    summary['matrix_version'] = updated.version
+    logger.info(f"Refreshed distance matrix {path}: {summary}")
+    
+    return summary
\ No newline at end of file
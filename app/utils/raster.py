@@ -0,0 +1,116 @@
+"""
+Regular lat/lon raster helpers for AgriPort Optimizer
+
+Grids are built on a regular lattice described by a small dictionary
+(origin, cell size, shape), and grid point ids are flat raster cells. These
+helpers only need NumPy, so request handlers can map ids, coordinates and
+cells without importing the GeoPandas stack of gis.py.
+"""
+import math
+from typing import Any, Dict, Tuple
+import numpy as np
+
+# Length of one degree of latitude in kilometers
+KM_PER_DEGREE = 111.32
+
+def grid_raster(bounds: Tuple[float, float, float, float], grid_size: int = 100,
+                cell_size_km: float = None) -> Dict[str, Any]:
+    """
+    Describe the regular lat/lon lattice of a grid over the given bounds
+    
+    Args:
+        bounds: (minx, miny, maxx, maxy) in degrees
+        grid_size: Number of points per axis when cell_size_km is not given
+        cell_size_km: Spacing between grid points in kilometers (optional)
+    
+    Returns:
+        Dictionary with origin_lat/origin_lon (the south-west grid point),
+        cell_lat/cell_lon (spacing in degrees) and n_rows/n_cols
+    """
+    minx, miny, maxx, maxy = (float(value) for value in bounds)
+    
+    if cell_size_km is not None:
+        if cell_size_km <= 0:
+            raise ValueError("cell_size_km must be positive")
+        # Keep cells roughly square on the ground at the grid's mean latitude
+        cell_lat = cell_size_km / KM_PER_DEGREE
+        cell_lon = cell_size_km / (KM_PER_DEGREE * math.cos(math.radians((miny + maxy) / 2)))
+        n_rows = int(math.floor((maxy - miny) / cell_lat)) + 1
+        n_cols = int(math.floor((maxx - minx) / cell_lon)) + 1
+    else:
+        if grid_size < 2:
+            raise ValueError("grid_size must be at least 2")
+        n_rows = n_cols = grid_size
+        cell_lat = (maxy - miny) / (grid_size - 1)
+        cell_lon = (maxx - minx) / (grid_size - 1)
+    
+    return {
+        'origin_lat': miny,
+        'origin_lon': minx,
+        'cell_lat': cell_lat,
+        'cell_lon': cell_lon,
+        'n_rows': n_rows,
+        'n_cols': n_cols
+    }
+
+def raster_coordinates(grid_ids: np.ndarray, raster: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Recover grid point coordinates from raster ids (row * n_cols + col)
+    
+    Args:
+        grid_ids: Grid point ids of a grid built by create_grid_arrays
+        raster: Raster description from grid_raster
+    
+    Returns:
+        Tuple of (lat, lon) arrays
+    """
+    row, col = np.divmod(np.asarray(grid_ids, dtype=np.int64), raster['n_cols'])
+    return (raster['origin_lat'] + row * raster['cell_lat'], 
+            raster['origin_lon'] + col * raster['cell_lon'])
+
+def infer_raster(lat: np.ndarray, lon: np.ndarray) -> Dict[str, Any]:
+    """
+    Recover the raster description of a regular grid from its coordinates
+    
+    Args:
+        lat: Latitudes of the grid points
+        lon: Longitudes of the grid points
+    
+    Returns:
+        Raster description as returned by grid_raster
+    """
+    def axis(values):
+        unique = np.unique(np.asarray(values, dtype=np.float64))
+        steps = np.diff(unique)
+        step = float(steps[steps > 1e-9].min()) if len(unique) > 1 else 1.0
+        return float(unique[0]), step, int(round((unique[-1] - unique[0]) / step)) + 1
+    
+    origin_lat, cell_lat, n_rows = axis(lat)
+    origin_lon, cell_lon, n_cols = axis(lon)
+    return {
+        'origin_lat': origin_lat,
+        'origin_lon': origin_lon,
+        'cell_lat': cell_lat,
+        'cell_lon': cell_lon,
+        'n_rows': n_rows,
+        'n_cols': n_cols
+    }
+
+def label_raster(row: np.ndarray, col: np.ndarray, labels: np.ndarray, 
+                 raster: Dict[str, Any], nodata: int = -1) -> np.ndarray:
+    """
+    Scatter per-point labels (e.g. optimal port ids) into a 2D raster
+    
+    Args:
+        row: Raster row of each grid point
+        col: Raster column of each grid point
+        labels: Integer label of each grid point
+        raster: Raster description
+        nodata: Value for cells without a grid point
+    
+    Returns:
+        int64 array of shape (n_rows, n_cols), row 0 in the south
+    """
+    labels_2d = np.full((raster['n_rows'], raster['n_cols']), nodata, dtype=np.int64)
+    labels_2d[np.asarray(row), np.asarray(col)] = np.asarray(labels)
+    return labels_2d
\ No newline at end of file
@@ -1,30 +1,463 @@
 """
-Routing utilities for AgriPort Optimizer using OSRM
+Routing utilities for AgriPort Optimizer
+
+OSRMRouter queries an OSRM server; HaversineRouter estimates road distances
+offline from great-circle distances. Both implement BaseRouter, and
+create_router picks one from the ROUTER_BACKEND setting.
 """
+from __future__ import annotations
 import os
 import requests
-import pandas as pd
-import geopandas as gpd
 import numpy as np
-from typing import List, Dict, Tuple, Union, Any
+from typing import Callable, List, Dict, NamedTuple, Tuple, Union, Any, TYPE_CHECKING
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+import random
+import threading
 import time
 import logging
+from .distance_cache import DistanceCache
+from .grid import Grid
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import geopandas as gpd
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-class OSRMRouter:
+# HTTP status codes worth retrying: rate limiting and transient server errors
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# osrm-routed --max-table-size default: sources x destinations <= size ** 2
+DEFAULT_MAX_TABLE_SIZE = 100
+
+# Conservative limit for request URLs accepted by OSRM and proxies in front of it
+DEFAULT_MAX_URL_LENGTH = 8192
+
+# Longest formatted coordinate ("-180.00000,-90.00000") plus separator
+COORDINATE_CHARS = 21
+
+# Mean Earth radius used for great-circle distances
+EARTH_RADIUS_KM = 6371.0088
+
+# Origins per block of haversine_matrix, to keep temporaries cache-sized
+HAVERSINE_CHUNK_ROWS = 65536
+
+# Road distance over great-circle distance assumed where no calibration applies
+DEFAULT_CIRCUITY = 1.3
+
+# Side of the lat/lon regions circuity factors are calibrated for, in degrees
+DEFAULT_REGION_SIZE_DEG = 2.0
+
+# Routed pairs a region needs before it gets its own circuity factor
+MIN_REGION_SAMPLES = 30
+
+# Pairs closer than this are left out of calibration (snapping dominates)
+MIN_CALIBRATION_DISTANCE_KM = 5.0
+
+# Cached pairs drawn to calibrate HaversineRouter
+CALIBRATION_SAMPLE_SIZE = 20000
+
+ROUTER_BACKENDS = ('osrm', 'haversine')
+
+# Calibrated HaversineRouter factors per (cache path, network version, region
+# size, sample size)
+_calibrations: Dict[Tuple[str, str, float, int], Tuple[float, Any]] = {}
+_calibrations_lock = threading.Lock()
+
+# Request directions: origins as OSRM sources, or destinations as sources
+DIRECTION_FORWARD = 'forward'
+DIRECTION_REVERSE = 'reverse'
+
+class TableBatch(NamedTuple):
+    """
+    One OSRM table request: a block of origins against a block of destinations
+    
+    In a reversed batch the destinations are sent as OSRM sources and the
+    result is transposed, which is only valid on a symmetric road network.
+    """
+    origin_start: int
+    origin_stop: int
+    destination_start: int
+    destination_stop: int
+    reverse: bool = False
+
+class TablePlan(NamedTuple):
+    """
+    Sizing of the OSRM table requests for one distance matrix
+    """
+    batches: List[TableBatch]
+    origins_per_call: int
+    destinations_per_call: int
+    direction: str
+    
+    @property
+    def expected_calls(self) -> int:
+        """Number of table requests the plan will issue"""
+        return len(self.batches)
+
+def _estimate_table_url_length(base_length: int, n_points: int) -> int:
+    """Upper bound on the URL length of a table request for n_points coordinates"""
+    # Every index is listed once in sources or destinations, joined by an encoded ';'
+    index_chars = n_points * (len(str(max(n_points - 1, 0))) + 3)
+    return base_length + n_points * COORDINATE_CHARS + index_chars + len('?sources=&destinations=&annotations=distance')
+
+def plan_table_requests(n_origins: int, n_destinations: int, 
+                        max_table_size: int = DEFAULT_MAX_TABLE_SIZE,
+                        max_url_length: int = DEFAULT_MAX_URL_LENGTH,
+                        base_url_length: int = 64,
+                        direction: str = DIRECTION_FORWARD) -> TablePlan:
+    """
+    Plan OSRM table requests for a many-origins, few-destinations matrix
+    
+    Every call carries as many destinations as the server accepts (all ports in
+    practice) and is packed with as many origins as both the table size limit
+    (sources x destinations <= max_table_size ** 2) and the URL length limit allow.
+    
+    Args:
+        n_origins: Number of origins (grid points)
+        n_destinations: Number of destinations (ports)
+        max_table_size: The osrm-routed --max-table-size setting
+        max_url_length: Longest request URL to send
+        base_url_length: Length of the URL up to the coordinate list
+        direction: DIRECTION_FORWARD to send origins as sources, or
+                   DIRECTION_REVERSE to send destinations as sources
+    
+    Returns:
+        TablePlan with the batches to request
+    """
+    if direction not in (DIRECTION_FORWARD, DIRECTION_REVERSE):
+        raise ValueError(f"Unknown table direction: {direction}")
+    
+    if n_origins == 0 or n_destinations == 0:
+        return TablePlan([], 0, 0, direction)
+    
+    max_cells = max_table_size * max_table_size
+    
+    # Largest number of coordinates per call that still fits in the URL
+    max_points = 2
+    while (max_points < n_origins + n_destinations
+           and _estimate_table_url_length(base_url_length, max_points + 1) <= max_url_length):
+        max_points += 1
+    
+    # Keep all destinations together unless they alone exhaust the limits
+    destinations_per_call = max(1, min(n_destinations, max_table_size, max_points // 2))
+    origins_per_call = max(1, min(
+        n_origins,
+        max_cells // destinations_per_call,
+        max_points - destinations_per_call
+    ))
+    
+    reverse = direction == DIRECTION_REVERSE
+    batches = [
+        TableBatch(i, min(i + origins_per_call, n_origins),
+                   j, min(j + destinations_per_call, n_destinations), reverse)
+        for i in range(0, n_origins, origins_per_call)
+        for j in range(0, n_destinations, destinations_per_call)
+    ]
+    
+    return TablePlan(batches, origins_per_call, destinations_per_call, direction)
+
+def _unit_vectors(points: np.ndarray) -> np.ndarray:
+    """Unit vectors on the sphere for (lat, lon) rows in degrees, shape (n, 3)"""
+    radians = np.radians(points)
+    cos_lat = np.cos(radians[:, 0])
+    return np.column_stack([cos_lat * np.cos(radians[:, 1]), cos_lat * np.sin(radians[:, 1]), np.sin(radians[:, 0])])
+
+def haversine_matrix(origins, destinations) -> np.ndarray:
+    """
+    Great-circle distance between every origin and destination
+    
+    Computed from the dot products of unit vectors (one matrix product per
+    block of origins) and the haversine of the central angle, in place over
+    the output, so a 1M x 30 matrix takes a fraction of a second.
+    
+    Args:
+        origins: Sequence or array of (lat, lon) for origins
+        destinations: Sequence or array of (lat, lon) for destinations
+    
+    Returns:
+        Array of shape (n_origins, n_destinations) with distances in km
+    """
+    origins = _unit_vectors(np.asarray(origins, dtype=np.float64).reshape(-1, 2))
+    destinations = _unit_vectors(np.asarray(destinations, dtype=np.float64).reshape(-1, 2)).T
+    distances = np.empty((len(origins), destinations.shape[1]), dtype=np.float64)
+    
+    for start in range(0, len(origins), HAVERSINE_CHUNK_ROWS):
+        block = distances[start:start + HAVERSINE_CHUNK_ROWS]
+        np.matmul(origins[start:start + HAVERSINE_CHUNK_ROWS], destinations, out=block)
+        
+        # sin(angle / 2) = sqrt((1 - cos(angle)) / 2)
+        np.subtract(1.0, block, out=block)
+        block *= 0.5
+        np.clip(block, 0.0, 1.0, out=block)
+        np.sqrt(block, out=block)
+        np.arcsin(block, out=block)
+        block *= 2 * EARTH_RADIUS_KM
+    
+    return distances
+
+class OSRMRequestError(Exception):
+    """
+    Raised when an OSRM request fails
+    
+    Attributes:
+        transient: True if the failure is worth retrying (timeouts, 429, 5xx)
+    """
+    def __init__(self, message: str, transient: bool = False):
+        super().__init__(message)
+        self.transient = transient
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Additive-increase/multiplicative-decrease limit on in-flight requests
+    
+    The limit grows by one after a full window of successful requests and is
+    halved whenever OSRM signals overload, so throughput follows what the
+    server can sustain instead of sleeping a fixed time between requests.
+    """
+    def __init__(self, max_limit: int, initial_limit: int = 2):
+        """
+        Initialize the limiter
+        
+        Args:
+            max_limit: Upper bound on concurrent requests
+            initial_limit: Number of concurrent requests to start with
+        """
+        self.max_limit = max(1, max_limit)
+        self.limit = max(1, min(initial_limit, self.max_limit))
+        self.in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+    
+    def acquire(self):
+        """Block until a request slot is free"""
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+    
+    def release(self, overloaded: bool = False):
+        """
+        Free a request slot and adjust the limit
+        
+        Args:
+            overloaded: True if the request failed in a way that suggests
+                        the server is overloaded
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+def _format_coordinates(points: np.ndarray) -> List[str]:
+    """Format (lat, lon) rows as OSRM lon,lat strings (1e-5 degrees is about 1 m)"""
+    return [f"{lon:.5f},{lat:.5f}" for lat, lon in points]
+
+def _index_runs(index: np.ndarray) -> List[Tuple[int, int]]:
+    """Split sorted positions into (start, stop) ranges of consecutive values"""
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    return [(int(run[0]), int(run[-1]) + 1) for run in np.split(index, breaks) if len(run)]
+
+def _remap_failures(failures: List[Dict[str, Any]], rows: np.ndarray, 
+                    cols: np.ndarray) -> List[Dict[str, Any]]:
+    """Translate failed batches of a sub-matrix to the rows and columns it was taken from"""
+    return [
+        dict(failure, origins=rows[failure['origins']], destinations=cols[failure['destinations']])
+        for failure in failures
+    ]
+
+def _failure_mask(failures: List[Dict[str, Any]], shape: Tuple[int, int]) -> np.ndarray:
+    """Boolean mask of the pairs covered by failed batches"""
+    mask = np.zeros(shape, dtype=bool)
+    for failure in failures:
+        mask[np.ix_(failure['origins'], failure['destinations'])] = True
+    return mask
+
+class BaseRouter(ABC):
+    """
+    Interface of the routers that fill grid x port distance matrices
+    
+    Implementations provide get_distance_matrix_array and report blocks they
+    could not route in failed_batches (empty when every pair was computed);
+    single distances, DataFrame matrices and grid-to-port tables are built
+    on it. Each failed batch is a dictionary with the 'origins' and
+    'destinations' it covers (index arrays into the arguments of the last
+    get_distance_matrix_array call), 'reverse' and the 'error' message.
+    The backend name (one of ROUTER_BACKENDS) is recorded in the distance
+    matrices a router fills, so routed and estimated distances never mix.
+    """
+    backend: str
+    failed_batches: List[Dict[str, Any]]
+    
+    @abstractmethod
+    def get_distance_matrix_array(self, origins: List[Tuple[float, float]], 
+                                  destinations: List[Tuple[float, float]], 
+                                  batch_size: int = None,
+                                  direction: str = DIRECTION_FORWARD) -> np.ndarray:
+        """
+        Get distance matrix between multiple origins and destinations as a NumPy array
+        
+        Args:
+            origins: List of (lat, lon) tuples for origins
+            destinations: List of (lat, lon) tuples for destinations
+            batch_size: Number of origins and destinations per request, for
+                        backends that batch (optional)
+            direction: DIRECTION_FORWARD, or DIRECTION_REVERSE to route from the
+                       destinations
+        
+        Returns:
+            Array of shape (n_origins, n_destinations) with distances in km,
+            NaN where no distance is available
+        """
+    
+    def failed_pairs(self, n_origins: int, n_destinations: int) -> np.ndarray:
+        """
+        Mask of the pairs the last get_distance_matrix_array call could not route
+        
+        Args:
+            n_origins: Number of origins passed to that call
+            n_destinations: Number of destinations passed to that call
+        
+        Returns:
+            Boolean array of shape (n_origins, n_destinations)
+        """
+        return _failure_mask(self.failed_batches, (n_origins, n_destinations))
+    
+    def check_connection(self) -> bool:
+        """
+        Check if the routing backend is available
+        
+        Returns:
+            True if distances can be computed
+        """
+        return True
+    
+    def get_distance(self, origin: Tuple[float, float], destination: Tuple[float, float]) -> float:
+        """
+        Get distance between two points
+        
+        Args:
+            origin: (lat, lon) of origin
+            destination: (lat, lon) of destination
+        
+        Returns:
+            Distance in kilometers, or None if there is no route
+        """
+        distance_km = self.get_distance_matrix_array([origin], [destination])[0, 0]
+        return None if np.isnan(distance_km) else float(distance_km)
+    
+    def get_distance_matrix(self, origins: List[Tuple[float, float]], 
+                            destinations: List[Tuple[float, float]], 
+                            batch_size: int = None) -> pd.DataFrame:
+        """
+        Get distance matrix between multiple origins and destinations as a DataFrame
+        
+        Args:
+            origins: List of (lat, lon) tuples for origins
+            destinations: List of (lat, lon) tuples for destinations
+            batch_size: Fixed number of locations per batch (default: planned)
+        
+        Returns:
+            DataFrame with distances (km) from each origin to each destination
+        """
+        import pandas as pd
+        
+        # Check inputs
+        if len(origins) == 0 or len(destinations) == 0:
+            return pd.DataFrame()
+        
+        matrix = self.get_distance_matrix_array(origins, destinations, batch_size=batch_size)
+        
+        return pd.DataFrame(
+            matrix,
+            index=pd.RangeIndex(len(origins), name='origin_idx'),
+            columns=pd.RangeIndex(len(destinations), name='destination_idx')
+        )
+    
+    def compute_grid_to_ports_distances(self, grid: Union[Grid, gpd.GeoDataFrame], 
+                                       ports_gdf: gpd.GeoDataFrame,
+                                       direction: str = DIRECTION_FORWARD) -> pd.DataFrame:
+        """
+        Compute distances from each grid point to each port
+        
+        Args:
+            grid: Grid, or GeoDataFrame with grid points indexed by grid point id
+            ports_gdf: GeoDataFrame with ports
+            direction: DIRECTION_FORWARD, or DIRECTION_REVERSE to route from the ports
+        
+        Returns:
+            DataFrame with distances from each grid point to each port
+        """
+        import pandas as pd
+        
+        # Extract coordinates
+        if isinstance(grid, Grid):
+            grid_points = np.column_stack([grid.lat, grid.lon])
+            grid_ids = grid.ids
+        else:
+            grid_points = grid[['lat', 'lon']].to_numpy(dtype=np.float64)
+            grid_ids = grid.index.to_numpy()
+        port_points = ports_gdf[['lat', 'lon']].to_numpy(dtype=np.float64)
+        
+        # Get distance matrix
+        distances = self.get_distance_matrix_array(grid_points, port_points, direction=direction)
+        
+        # Format results, skipping missing values
+        rows, cols = np.nonzero(~np.isnan(distances))
+        return pd.DataFrame({
+            'grid_point_id': grid_ids[rows],
+            'port_id': ports_gdf.index.to_numpy()[cols],
+            'distance_km': distances[rows, cols]
+        })
+
+class OSRMRouter(BaseRouter):
     """
     Router class for interacting with OSRM service
     """
-    def __init__(self, osrm_url: str = None):
+    backend = 'osrm'
+    
+    def __init__(self, osrm_url: str = None, max_concurrency: int = 8, max_retries: int = 3,
+                 backoff_factor: float = 0.5, timeout: float = 60, max_table_size: int = None,
+                 max_url_length: int = None, cache: DistanceCache = None):
         """
         Initialize the OSRM router
         
         Args:
             osrm_url: URL to OSRM service (default: env var or localhost:5000)
+            max_concurrency: Maximum number of table requests in flight
+            max_retries: Retries per request on transient failures
+            backoff_factor: Base delay in seconds for exponential backoff
+            timeout: Timeout in seconds for a single HTTP request
+            max_table_size: The server's --max-table-size (default: env var or 100)
+            max_url_length: Longest table request URL to send (default: env var or 8192)
+            cache: Persistent distance cache to consult before calling OSRM (optional)
         """
         self.osrm_url = osrm_url or os.environ.get('OSRM_URL', 'http://localhost:5000')
+        self.max_table_size = max_table_size or int(os.environ.get('OSRM_MAX_TABLE_SIZE', DEFAULT_MAX_TABLE_SIZE))
+        self.max_url_length = max_url_length or int(os.environ.get('OSRM_MAX_URL_LENGTH', DEFAULT_MAX_URL_LENGTH))
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.failed_batches: List[Dict[str, Any]] = []
+        self.cache = cache
+        
+        # Pooled keep-alive connections, one per concurrent request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_concurrency, pool_maxsize=self.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
         logger.info(f"Initialized OSRM router with URL: {self.osrm_url}")
     
     def check_connection(self) -> bool:
@@ -35,7 +468,7 @@ class OSRMRouter:
             True if service is available, False otherwise
         """
         try:
-            response = requests.get(f"{self.osrm_url}/health")
+            response = self.session.get(f"{self.osrm_url}/health", timeout=self.timeout)
             return response.status_code == 200
         except requests.RequestException:
             return False
@@ -47,10 +480,15 @@ class OSRMRouter:
         Args:
             origin: (lat, lon) of origin
             destination: (lat, lon) of destination
-            
+        
         Returns:
             Distance in kilometers
         """
+        if self.cache is not None:
+            found, distance_km = self.cache.get(origin, destination)
+            if found:
+                return distance_km
+        
         # Format coordinates for OSRM (lon,lat format)
         origin_str = f"{origin[1]},{origin[0]}"
         dest_str = f"{destination[1]},{destination[0]}"
@@ -59,7 +497,7 @@ class OSRMRouter:
         url = f"{self.osrm_url}/route/v1/driving/{origin_str};{dest_str}?overview=false"
         
         try:
-            response = requests.get(url)
+            response = self.session.get(url, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
             
@@ -69,6 +507,9 @@ class OSRMRouter:
             
             # Get distance in kilometers
             distance_km = data['routes'][0]['distance'] / 1000
+            
+            if self.cache is not None:
+                self.cache.put(origin, destination, distance_km)
             return distance_km
         
         except requests.RequestException as e:
@@ -78,132 +519,585 @@ class OSRMRouter:
             logger.error(f"Error parsing OSRM response: {str(e)}")
             return None
     
-    def get_distance_matrix(self, origins: List[Tuple[float, float]], 
-                            destinations: List[Tuple[float, float]], 
-                            batch_size: int = 100) -> pd.DataFrame:
+    def _request_with_retry(self, url: str, params: Dict[str, str] = None,
+                            on_transient: Callable[[OSRMRequestError], None] = None) -> Dict[str, Any]:
         """
-        Get distance matrix between multiple origins and destinations using OSRM table service
+        GET an OSRM endpoint, retrying transient failures with exponential backoff
         
         Args:
-            origins: List of (lat, lon) tuples for origins
-            destinations: List of (lat, lon) tuples for destinations
-            batch_size: Number of locations per batch
+            url: Request URL
+            params: Query parameters
+            on_transient: Called with each transient failure that is about to be
+                          retried, before the backoff (optional)
+        
+        Returns:
+            Parsed JSON response with code 'Ok'
+        
+        Raises:
+            OSRMRequestError: If the request fails after all retries
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                if response.status_code in TRANSIENT_STATUS_CODES:
+                    raise OSRMRequestError(f"HTTP {response.status_code}", transient=True)
+                response.raise_for_status()
+                
+                data = response.json()
+                if data.get('code') != 'Ok':
+                    raise OSRMRequestError(f"OSRM error: {data.get('code')}")
+                return data
+            
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = OSRMRequestError(str(e), transient=True)
+            except requests.RequestException as e:
+                error = OSRMRequestError(str(e))
+            except ValueError as e:
+                error = OSRMRequestError(f"Invalid OSRM response: {str(e)}")
+            except OSRMRequestError as e:
+                error = e
             
+            if not error.transient or attempt == self.max_retries:
+                raise error
+            if on_transient is not None:
+                on_transient(error)
+            
+            # Exponential backoff with jitter
+            delay = self.backoff_factor * (2 ** attempt) * (1 + random.random())
+            logger.warning(f"Transient OSRM failure ({error}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+    
+    def _fetch_table_batch(self, batch: TableBatch, origins: np.ndarray, destinations: np.ndarray,
+                           on_transient: Callable[[OSRMRequestError], None] = None) -> np.ndarray:
+        """
+        Fetch one block of the distance matrix from the OSRM table service
+        
+        Args:
+            batch: Origin and destination ranges of the block
+            origins: Array of (lat, lon) rows for all origins
+            destinations: Array of (lat, lon) rows for all destinations
+            on_transient: Passed to _request_with_retry (optional)
+        
         Returns:
-            DataFrame with distances (km) from each origin to each destination
+            Array of distances in km for the block, NaN where no route exists
         """
-        # Check inputs
-        if not origins or not destinations:
-            return pd.DataFrame()
+        batch_origins = origins[batch.origin_start:batch.origin_stop]
+        batch_destinations = destinations[batch.destination_start:batch.destination_stop]
+        
+        sources, targets = batch_origins, batch_destinations
+        if batch.reverse:
+            sources, targets = targets, sources
+        n_sources = len(sources)
         
-        # Initialize results
-        results = []
+        coords_str = ";".join(_format_coordinates(sources) + _format_coordinates(targets))
+        url = f"{self.osrm_url}/table/v1/driving/{coords_str}"
+        params = {
+            "sources": ";".join(map(str, range(n_sources))),
+            "destinations": ";".join(map(str, range(n_sources, n_sources + len(targets)))),
+            "annotations": "distance"
+        }
+        
+        data = self._request_with_retry(url, params, on_transient=on_transient)
+        
+        try:
+            # Unreachable pairs come back as null
+            distances = np.array(data['distances'], dtype=np.float64)
+        except (KeyError, TypeError, ValueError) as e:
+            raise OSRMRequestError(f"Error parsing OSRM table response: {str(e)}")
+        
+        if distances.shape != (n_sources, len(targets)):
+            raise OSRMRequestError(f"Unexpected OSRM table shape {distances.shape}")
+        
+        if batch.reverse:
+            distances = distances.T
+        
+        return distances / 1000
+    
+    def _run_table_batches(self, batches: List[TableBatch], origins: np.ndarray,
+                           destinations: np.ndarray, matrix: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        Fetch table batches concurrently and write them into a preallocated matrix
+        
+        Args:
+            batches: Blocks to fetch
+            origins: Array of (lat, lon) rows for all origins
+            destinations: Array of (lat, lon) rows for all destinations
+            matrix: Output array of shape (n_origins, n_destinations)
         
-        # Process in batches to avoid overloading OSRM
-        for i in range(0, len(origins), batch_size):
-            batch_origins = origins[i:i+batch_size]
+        Returns:
+            List of failed batches (see BaseRouter) indexing origins and destinations
+        """
+        limiter = AdaptiveConcurrencyLimiter(self.max_concurrency)
+        failures = []
+        
+        def backoff(error: OSRMRequestError):
+            # Report the overload as it happens and retry only once a slot
+            # under the reduced limit is free
+            limiter.release(overloaded=True)
+            limiter.acquire()
+        
+        def fetch(batch: TableBatch) -> np.ndarray:
+            limiter.acquire()
+            overloaded = False
+            try:
+                return self._fetch_table_batch(batch, origins, destinations, on_transient=backoff)
+            except OSRMRequestError as e:
+                overloaded = e.transient
+                raise
+            finally:
+                limiter.release(overloaded=overloaded)
+        
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {executor.submit(fetch, batch): batch for batch in batches}
             
-            for j in range(0, len(destinations), batch_size):
-                batch_destinations = destinations[j:j+batch_size]
-                
-                # Format coordinates for OSRM (lon,lat format)
-                coords = []
-                for lat, lon in batch_origins:
-                    coords.append(f"{lon},{lat}")
-                for lat, lon in batch_destinations:
-                    coords.append(f"{lon},{lat}")
-                
-                # Create sources and destinations indices
-                sources = list(range(len(batch_origins)))
-                destinations_idx = list(range(len(batch_origins), len(batch_origins) + len(batch_destinations)))
-                
-                # Build URL
-                coords_str = ";".join(coords)
-                url = f"{self.osrm_url}/table/v1/driving/{coords_str}"
-                params = {
-                    "sources": ",".join(map(str, sources)),
-                    "destinations": ",".join(map(str, destinations_idx))
-                }
-                
+            for future in as_completed(futures):
+                batch = futures[future]
                 try:
-                    response = requests.get(url, params=params)
-                    response.raise_for_status()
-                    data = response.json()
-                    
-                    if data['code'] != 'Ok':
-                        logger.warning(f"OSRM error: {data['code']} for batch table request")
-                        continue
-                    
-                    # Process distances
-                    for src_idx, distances in enumerate(data['distances']):
-                        origin_idx = i + src_idx
-                        if origin_idx >= len(origins):
-                            break
-                        
-                        for dst_idx, distance in enumerate(distances):
-                            dest_idx = j + dst_idx
-                            if dest_idx >= len(destinations):
-                                break
-                            
-                            # Convert to kilometers
-                            distance_km = distance / 1000 if distance >= 0 else None
-                            
-                            results.append({
-                                'origin_idx': origin_idx,
-                                'destination_idx': dest_idx,
-                                'distance_km': distance_km
-                            })
-                
-                except requests.RequestException as e:
-                    logger.error(f"Error in OSRM table request: {str(e)}")
-                except (KeyError, IndexError) as e:
-                    logger.error(f"Error parsing OSRM table response: {str(e)}")
-                
-                # Avoid overloading the OSRM server
-                time.sleep(0.5)
+                    matrix[batch.origin_start:batch.origin_stop,
+                           batch.destination_start:batch.destination_stop] = future.result()
+                except OSRMRequestError as e:
+                    logger.error(f"OSRM table batch {tuple(batch)} failed: {str(e)}")
+                    failures.append({
+                        'origins': np.arange(batch.origin_start, batch.origin_stop),
+                        'destinations': np.arange(batch.destination_start, batch.destination_stop),
+                        'reverse': batch.reverse,
+                        'error': str(e)
+                    })
+        
+        return failures
+    
+    def plan_distance_matrix(self, n_origins: int, n_destinations: int, 
+                             direction: str = DIRECTION_FORWARD) -> TablePlan:
+        """
+        Plan the table requests for a matrix using this server's limits
+        
+        Args:
+            n_origins: Number of origins (grid points)
+            n_destinations: Number of destinations (ports)
+            direction: DIRECTION_FORWARD or DIRECTION_REVERSE (ports as sources)
+        
+        Returns:
+            TablePlan; plan.expected_calls is the number of requests it will send
+        """
+        return plan_table_requests(
+            n_origins, n_destinations,
+            max_table_size=self.max_table_size,
+            max_url_length=self.max_url_length,
+            base_url_length=len(f"{self.osrm_url}/table/v1/driving/"),
+            direction=direction
+        )
+    
+    def get_distance_matrix_array(self, origins: List[Tuple[float, float]], 
+                                  destinations: List[Tuple[float, float]], 
+                                  batch_size: int = None,
+                                  direction: str = DIRECTION_FORWARD) -> np.ndarray:
+        """
+        Get distance matrix between multiple origins and destinations as a NumPy array
+        
+        With a cache, cached pairs are served locally and only origins with
+        missing pairs are sent to OSRM. Requests are sized by
+        plan_distance_matrix unless batch_size is given. Batches are fetched
+        concurrently. Batches that still fail after retries are left as NaN and
+        recorded in self.failed_batches so they can be fetched again with
+        retry_failed_batches.
+        
+        Args:
+            origins: List of (lat, lon) tuples for origins
+            destinations: List of (lat, lon) tuples for destinations
+            batch_size: Fixed number of origins and destinations per batch (optional)
+            direction: DIRECTION_FORWARD, or DIRECTION_REVERSE to route from the
+                       destinations (valid on a symmetric road network)
+        
+        Returns:
+            Array of shape (n_origins, n_destinations) with distances in km,
+            NaN where no distance is available
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+        destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+        
+        if self.cache is None:
+            return self._fetch_distance_matrix(origins, destinations, batch_size, direction)
         
-        # Create DataFrame
-        df = pd.DataFrame(results)
+        matrix, found = self.cache.get_matrix(origins, destinations)
+        missing_rows = np.flatnonzero(~found.all(axis=1))
+        missing_cols = np.flatnonzero(~found[missing_rows].all(axis=0))
         
-        # Reshape to matrix format
-        if not df.empty:
-            matrix = df.pivot(index='origin_idx', columns='destination_idx', values='distance_km')
+        if len(missing_rows) == 0:
+            self.failed_batches = []
             return matrix
+        
+        logger.info(f"Distance cache: {int(found.sum())} of {found.size} pairs cached, "
+                    f"routing {len(missing_rows)} origins x {len(missing_cols)} destinations")
+        
+        sub_origins = origins[missing_rows]
+        sub_destinations = destinations[missing_cols]
+        routed = self._fetch_distance_matrix(sub_origins, sub_destinations, batch_size, direction)
+        
+        # Cache everything except blocks whose request failed
+        fetched = ~_failure_mask(self.failed_batches, routed.shape)
+        self.cache.put_matrix(sub_origins, sub_destinations, routed, mask=fetched)
+        self.failed_batches = _remap_failures(self.failed_batches, missing_rows, missing_cols)
+        
+        matrix[np.ix_(missing_rows, missing_cols)] = np.where(
+            found[np.ix_(missing_rows, missing_cols)], matrix[np.ix_(missing_rows, missing_cols)], routed
+        )
+        return matrix
+    
+    def _fetch_distance_matrix(self, origins: np.ndarray, destinations: np.ndarray,
+                               batch_size: int = None, 
+                               direction: str = DIRECTION_FORWARD) -> np.ndarray:
+        """
+        Fetch a full distance matrix from OSRM without consulting the cache
+        
+        Args:
+            origins: Array of (lat, lon) rows for origins
+            destinations: Array of (lat, lon) rows for destinations
+            batch_size: Fixed number of origins and destinations per batch (optional)
+            direction: DIRECTION_FORWARD or DIRECTION_REVERSE
+        
+        Returns:
+            Array of shape (n_origins, n_destinations) with distances in km
+        """
+        matrix = np.full((len(origins), len(destinations)), np.nan, dtype=np.float64)
+        
+        if batch_size is not None:
+            batches = [
+                TableBatch(i, min(i + batch_size, len(origins)),
+                           j, min(j + batch_size, len(destinations)), direction == DIRECTION_REVERSE)
+                for i in range(0, len(origins), batch_size)
+                for j in range(0, len(destinations), batch_size)
+            ]
         else:
-            return pd.DataFrame()
-            
-    def compute_grid_to_ports_distances(self, grid_gdf: gpd.GeoDataFrame, 
-                                       ports_gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+            plan = self.plan_distance_matrix(len(origins), len(destinations), direction=direction)
+            batches = plan.batches
+            logger.info(
+                f"Planned {plan.expected_calls} OSRM table calls "
+                f"({plan.origins_per_call} origins x {plan.destinations_per_call} destinations each)"
+            )
+        
+        self.failed_batches = self._run_table_batches(batches, origins, destinations, matrix)
+        if self.failed_batches:
+            logger.warning(f"{len(self.failed_batches)} of {len(batches)} OSRM table batches failed")
+        
+        return matrix
+    
+    def retry_failed_batches(self, origins: List[Tuple[float, float]], 
+                             destinations: List[Tuple[float, float]], 
+                             matrix: np.ndarray) -> np.ndarray:
         """
-        Compute distances from each grid point to each port
+        Fetch the batches recorded in self.failed_batches again
+        
+        The failed blocks are requested again as they were (concurrently);
+        with a cache, the distances that arrive are cached too.
         
         Args:
-            grid_gdf: GeoDataFrame with grid points
-            ports_gdf: GeoDataFrame with ports
-            
+            origins: Origins passed to the call that produced the failures
+            destinations: Destinations passed to the call that produced the failures
+            matrix: Matrix returned by that call, filled in place
+        
         Returns:
-            DataFrame with distances from each grid point to each port
+            The updated matrix
         """
-        # Extract coordinates
-        grid_points = [(row.lat, row.lon) for _, row in grid_gdf.iterrows()]
-        port_points = [(row.lat, row.lon) for _, row in ports_gdf.iterrows()]
+        failures = self.failed_batches
+        if not failures:
+            return matrix
         
-        # Get distance matrix
-        distances = self.get_distance_matrix(grid_points, port_points)
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+        destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
         
-        # Format results
-        results = []
-        for i, grid_idx in enumerate(grid_gdf.index):
-            for j, port_idx in enumerate(ports_gdf.index):
-                try:
-                    distance = distances.loc[i, j]
-                    results.append({
-                        'grid_point_id': grid_idx,
-                        'port_id': port_idx,
-                        'distance_km': distance
-                    })
-                except (KeyError, IndexError):
-                    # Skip missing values
-                    pass
+        # Route the failed blocks within the sub-matrix of the rows and columns they cover
+        rows = np.unique(np.concatenate([failure['origins'] for failure in failures]))
+        cols = np.unique(np.concatenate([failure['destinations'] for failure in failures]))
+        batches = [
+            TableBatch(origin_start, origin_stop, destination_start, destination_stop, failure['reverse'])
+            for failure in failures
+            for origin_start, origin_stop in _index_runs(np.searchsorted(rows, np.sort(failure['origins'])))
+            for destination_start, destination_stop in _index_runs(
+                np.searchsorted(cols, np.sort(failure['destinations']))
+            )
+        ]
+        
+        retried = np.zeros((len(rows), len(cols)), dtype=bool)
+        for batch in batches:
+            retried[batch.origin_start:batch.origin_stop, batch.destination_start:batch.destination_stop] = True
+        
+        sub_origins, sub_destinations = origins[rows], destinations[cols]
+        routed = np.full(retried.shape, np.nan)
+        failures = self._run_table_batches(batches, sub_origins, sub_destinations, routed)
+        fetched = retried & ~_failure_mask(failures, routed.shape)
+        if self.cache is not None:
+            self.cache.put_matrix(sub_origins, sub_destinations, routed, mask=fetched)
+        
+        block = np.ix_(rows, cols)
+        matrix[block] = np.where(fetched, routed, matrix[block])
+        self.failed_batches = _remap_failures(failures, rows, cols)
+        
+        return matrix
+    
+    def warm_cache(self, origins: List[Tuple[float, float]], 
+                   destinations: List[Tuple[float, float]], 
+                   direction: str = DIRECTION_FORWARD) -> Dict[str, int]:
+        """
+        Route and cache every pair that is not cached yet
+        
+        Args:
+            origins: List of (lat, lon) tuples for origins
+            destinations: List of (lat, lon) tuples for destinations
+            direction: DIRECTION_FORWARD or DIRECTION_REVERSE
         
-        return pd.DataFrame(results)
\ No newline at end of file
+        Returns:
+            Cache statistics after warm-up
+        """
+        if self.cache is None:
+            raise ValueError("OSRMRouter has no distance cache to warm up")
+        
+        self.get_distance_matrix_array(origins, destinations, direction=direction)
+        return self.cache.stats()
+
+class HaversineRouter(BaseRouter):
+    """
+    Offline router estimating road distances from great-circle distances
+    
+    Every distance is the great-circle distance times a road circuity factor:
+    one factor everywhere, or one per lat/lon region of the origin once
+    calibrated against distances OSRM has routed before (see calibrate). No
+    routing service is needed, so the whole pipeline can run and be
+    benchmarked in development; a 1M x 30 matrix takes well under a second.
+    """
+    backend = 'haversine'
+    
+    def __init__(self, circuity: float = None, region_size_deg: float = None):
+        """
+        Initialize the router
+        
+        Args:
+            circuity: Road circuity factor outside calibrated regions
+                      (default: env var ROUTER_CIRCUITY or 1.3)
+            region_size_deg: Side of the calibration regions in degrees
+                             (default: env var ROUTER_REGION_SIZE_DEG or 2.0)
+        """
+        self.circuity = float(circuity or os.environ.get('ROUTER_CIRCUITY', DEFAULT_CIRCUITY))
+        self.region_size_deg = float(
+            region_size_deg or os.environ.get('ROUTER_REGION_SIZE_DEG', DEFAULT_REGION_SIZE_DEG)
+        )
+        if self.circuity < 1.0:
+            raise ValueError("circuity must be at least 1")
+        if self.region_size_deg <= 0:
+            raise ValueError("region_size_deg must be positive")
+        
+        # Circuity per region on a global lat/lon lattice, NaN where not calibrated
+        self.region_factors = None
+        self.failed_batches: List[Dict[str, Any]] = []
+    
+    def _region_index(self, points: np.ndarray) -> np.ndarray:
+        """Flat region of each (lat, lon) row on the global lattice"""
+        n_cols = int(np.ceil(360.0 / self.region_size_deg))
+        n_rows = int(np.ceil(180.0 / self.region_size_deg))
+        row = np.clip(((points[:, 0] + 90.0) // self.region_size_deg).astype(np.int64), 0, n_rows - 1)
+        col = np.clip(((points[:, 1] + 180.0) // self.region_size_deg).astype(np.int64), 0, n_cols - 1)
+        return row * n_cols + col
+    
+    def calibrate(self, cache: DistanceCache, sample_size: int = CALIBRATION_SAMPLE_SIZE,
+                  min_samples: int = MIN_REGION_SAMPLES) -> Dict[str, Any]:
+        """
+        Fit circuity factors from a sample of cached OSRM distances
+        
+        The default factor becomes the median ratio of road to great-circle
+        distance over the sample, and every region of origins with at least
+        min_samples routed pairs gets its own median.
+        
+        Args:
+            cache: Distance cache filled by OSRMRouter
+            sample_size: Number of cached pairs to draw
+            min_samples: Pairs a region needs for its own factor
+        
+        Returns:
+            Dictionary with the number of pairs used, the default factor and
+            the number of calibrated regions
+        """
+        origins, destinations, road_km = cache.sample(sample_size)
+        # Great-circle distance of each sampled pair (not the full matrix)
+        cos_angle = np.sum(_unit_vectors(origins) * _unit_vectors(destinations), axis=1)
+        great_circle_km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip((1.0 - cos_angle) * 0.5, 0.0, 1.0)))
+        
+        usable = great_circle_km >= MIN_CALIBRATION_DISTANCE_KM
+        if not usable.any():
+            logger.warning("No cached OSRM distances to calibrate against; keeping circuity "
+                           f"{self.circuity:.3f}")
+            return {'pairs': 0, 'circuity': self.circuity, 'regions': 0}
+        
+        # Road distances shorter than the great circle come from snapping
+        ratios = np.maximum(road_km[usable] / great_circle_km[usable], 1.0)
+        regions = self._region_index(origins[usable])
+        self.circuity = float(np.median(ratios))
+        
+        n_regions = int(np.ceil(180.0 / self.region_size_deg)) * int(np.ceil(360.0 / self.region_size_deg))
+        self.region_factors = np.full(n_regions, np.nan)
+        order = np.argsort(regions, kind='stable')
+        region_ids, starts, counts = np.unique(regions[order], return_index=True, return_counts=True)
+        for region, start, count in zip(region_ids, starts, counts):
+            if count >= min_samples:
+                self.region_factors[region] = np.median(ratios[order[start:start + count]])
+        
+        calibrated = int(np.count_nonzero(~np.isnan(self.region_factors)))
+        logger.info(f"Calibrated circuity {self.circuity:.3f} from {int(usable.sum())} cached pairs, "
+                    f"{calibrated} regions with their own factor")
+        return {'pairs': int(usable.sum()), 'circuity': round(self.circuity, 4), 'regions': calibrated}
+    
+    def circuity_factors(self, points) -> np.ndarray:
+        """
+        Circuity factor for each (lat, lon) row
+        
+        Args:
+            points: Sequence or array of (lat, lon)
+        
+        Returns:
+            Array of factors, the default circuity outside calibrated regions
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self.region_factors is None:
+            return np.full(len(points), self.circuity)
+        
+        factors = self.region_factors[self._region_index(points)]
+        return np.where(np.isnan(factors), self.circuity, factors)
+    
+    def get_distance_matrix_array(self, origins: List[Tuple[float, float]], 
+                                  destinations: List[Tuple[float, float]], 
+                                  batch_size: int = None,
+                                  direction: str = DIRECTION_FORWARD) -> np.ndarray:
+        """
+        Estimate road distances between every origin and destination
+        
+        Args:
+            origins: List of (lat, lon) tuples for origins
+            destinations: List of (lat, lon) tuples for destinations
+            batch_size: Ignored (no requests are made)
+            direction: Ignored (the estimate is symmetric)
+        
+        Returns:
+            Array of shape (n_origins, n_destinations) with distances in km
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+        distances = haversine_matrix(origins, destinations)
+        distances *= self.circuity_factors(origins)[:, np.newaxis]
+        return distances
+
+def create_router(backend: str = None, cache: DistanceCache = None) -> BaseRouter:
+    """
+    Create the router selected by configuration
+    
+    Args:
+        backend: 'osrm' or 'haversine' (default: env var ROUTER_BACKEND or 'osrm')
+        cache: Distance cache; OSRMRouter consults it before routing and
+               HaversineRouter calibrates its circuity factors from it (again
+               whenever the number of pairs it would sample changes)
+    
+    Returns:
+        Router implementing BaseRouter
+    
+    Raises:
+        ValueError: If the backend is unknown
+    """
+    backend = (backend or os.environ.get('ROUTER_BACKEND', 'osrm')).lower()
+    if backend == 'osrm':
+        return OSRMRouter(cache=cache)
+    if backend == 'haversine':
+        router = HaversineRouter()
+        if cache is not None:
+            # Sampling the cache is a table scan, so the factors are reused
+            # until the sample would change: while the cache is filling up
+            # (or after it was invalidated) every new size recalibrates, once
+            # it holds a full sample the factors stay for the network version
+            prefix = (os.path.abspath(cache.path), cache.network_version, router.region_size_deg)
+            key = prefix + (min(cache.stats()['entries'], CALIBRATION_SAMPLE_SIZE),)
+            with _calibrations_lock:
+                if key not in _calibrations:
+                    router.calibrate(cache, CALIBRATION_SAMPLE_SIZE)
+                    for stale in [other for other in _calibrations if other[:3] == prefix]:
+                        del _calibrations[stale]
+                    _calibrations[key] = (router.circuity, router.region_factors)
+                router.circuity, router.region_factors = _calibrations[key]
+        return router
+    raise ValueError(f"Unknown router backend {backend!r}, expected one of: {', '.join(ROUTER_BACKENDS)}")
+
+def compute_pruned_distance_matrix(router: BaseRouter, origins, destinations,
+                                   port_charges: np.ndarray, sea_freights: np.ndarray,
+                                   fuel_price: float, distance_matrix: np.ndarray = None,
+                                   routed_mask: np.ndarray = None,
+                                   lower_bound_factor: float = 0.9) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Route only the grid point/port pairs that can be optimal or runner-up
+    
+    Road distance is never shorter than great-circle distance, so the cost of
+    the great-circle distance is a lower bound on a port's real cost. Pairs are
+    routed in rounds until, for every grid point, no unrouted port's lower bound
+    undercuts the real cost of the best and runner-up port. Unrouted pairs stay
+    NaN; pass the returned matrix and mask back in after a price change to route
+    only the pairs that have become relevant.
+    
+    Args:
+        router: Router providing get_distance_matrix_array
+        origins: Sequence or array of (lat, lon) for grid points
+        destinations: Sequence or array of (lat, lon) for ports
+        port_charges: Port charge per port in dollars per ton
+        sea_freights: Sea freight per port in dollars per ton
+        fuel_price: Fuel price in dollars per liter
+        distance_matrix: Distances from an earlier call (optional)
+        routed_mask: Boolean mask of pairs already routed in distance_matrix
+        lower_bound_factor: Scale applied to great-circle distances to allow
+                            for OSRM snapping grid points onto the road network
+    
+    Returns:
+        Tuple of (distance matrix in km, boolean mask of routed pairs)
+    """
+    from .cost import candidate_port_mask, compute_cost_matrix
+    
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+    destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+    shape = (len(origins), len(destinations))
+    
+    if distance_matrix is None:
+        distance_matrix = np.full(shape, np.nan)
+        routed_mask = np.zeros(shape, dtype=bool)
+    else:
+        distance_matrix = np.array(distance_matrix, dtype=np.float64)
+        routed_mask = np.array(routed_mask, dtype=bool)
+    
+    lower_bounds = compute_cost_matrix(
+        haversine_matrix(origins, destinations) * lower_bound_factor,
+        port_charges, sea_freights, fuel_price
+    )
+    
+    rounds = 0
+    while True:
+        costs = compute_cost_matrix(distance_matrix, port_charges, sea_freights, fuel_price)
+        candidates = candidate_port_mask(lower_bounds, costs, routed_mask)
+        if not candidates.any():
+            break
+        
+        rounds += 1
+        logger.info(f"Pruned routing round {rounds}: {int(candidates.sum())} pairs "
+                    f"({candidates.mean():.1%} of the full matrix)")
+        
+        # One port against the grid points that still need it
+        failed = False
+        for j in np.flatnonzero(candidates.any(axis=0)):
+            rows = np.flatnonzero(candidates[:, j])
+            distances = router.get_distance_matrix_array(origins[rows], destinations[j:j + 1])
+            
+            # Pairs from failed batches stay unrouted so a later call retries them
+            failures = getattr(router, 'failed_batches', None) or []
+            fetched = ~_failure_mask(failures, distances.shape)[:, 0]
+            failed = failed or bool(failures)
+            
+            distance_matrix[rows, j] = distances[:, 0]
+            routed_mask[rows[fetched], j] = True
+        
+        if failed:
+            logger.warning("Some pruned routing batches failed; stopping early")
+            break
+    
+    logger.info(f"Routed {int(routed_mask.sum())} of {routed_mask.size} pairs "
+                f"({routed_mask.mean():.1%}) in {rounds} rounds")
+    
+    return distance_matrix, routed_mask
\ No newline at end of file
@@ -0,0 +1,808 @@
+"""
+Scenario evaluation and result caching for AgriPort Optimizer
+
+A scenario is one combination of fuel price and per-port costs evaluated
+against a version of the stored distance matrix. Scenarios are identified by
+a canonical hash of their inputs so identical requests (in any port order or
+number formatting) map to the same cached result.
+"""
+import json
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Any, NamedTuple, Optional, Tuple, Union
+import numpy as np
+from .cost import (
+    PortRanking, TRUCK_CAPACITY_TONS, DEFAULT_FUEL_EFFICIENCY, compute_cost_matrix, rank_ports,
+    boundary_metrics, best_ports_batch
+)
+from .envelope import FuelPriceEnvelope, build_fuel_envelope
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_MAX_ENTRIES = 128
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+MAX_BATCH_SCENARIOS = 1000
+
+class ScenarioError(ValueError):
+    """Raised for scenario input that cannot be evaluated"""
+
+class Scenario(NamedTuple):
+    """
+    Normalized scenario input
+    
+    Ports are sorted by id and limited to the active ports that have a column
+    in the distance matrix.
+    """
+    fuel_price: Optional[float]
+    port_ids: np.ndarray
+    port_names: List[str]
+    port_charges: np.ndarray
+    sea_freights: np.ndarray
+    matrix_version: int
+    
+    @property
+    def key(self) -> str:
+        """Canonical hash of the scenario, used as cache key and ETag"""
+        return scenario_key(
+            self.fuel_price, self.port_ids, self.port_charges, self.sea_freights, self.matrix_version
+        )
+
+class PortMargins(NamedTuple):
+    """
+    Margin-to-win index of one port over the grid points where it is not in the top 2
+    
+    margins holds, sorted ascending, how much the port's cost would have to
+    drop to undercut the runner-up of each grid point in rows.
+    """
+    margins: np.ndarray
+    rows: np.ndarray
+
+class ScenarioResult:
+    """
+    Evaluated scenario: the top-2 ranking, kept as state for incremental
+    updates, and its serialized forms (JSON body and other encodings, built
+    on first use)
+    """
+    def __init__(self, scenario: Scenario, ranking: PortRanking, grid_ids: np.ndarray,
+                 port_margins: Dict[int, PortMargins] = None):
+        """
+        Initialize a result
+        
+        Args:
+            scenario: Normalized scenario
+            ranking: Top-2 ranking with column indices into scenario.port_ids
+            grid_ids: Grid point id for each matrix row
+            port_margins: Margin indices already known, by port column
+        """
+        self.key = scenario.key
+        self.scenario = scenario
+        self.ranking = ranking
+        self.grid_ids = grid_ids
+        self.port_margins = port_margins or {}
+        self.encodings = {}
+        self._body = None
+    
+    @property
+    def body(self) -> bytes:
+        """Serialized /calculate response"""
+        if self._body is None:
+            response = scenario_response(self.scenario, self.ranking, self.grid_ids)
+            self._body = json.dumps(response, separators=(',', ':')).encode('utf-8')
+        return self._body
+    
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the result"""
+        nbytes = len(self._body) if self._body is not None else 0
+        nbytes += sum(np.asarray(array).nbytes for array in self.ranking)
+        nbytes += sum(index.margins.nbytes + index.rows.nbytes for index in self.port_margins.values())
+        nbytes += sum(len(encoded) for encoded in self.encodings.values())
+        return nbytes
+
+class EnvelopeResult(NamedTuple):
+    """
+    Fuel-price envelope of a scenario and its serialized response body
+    """
+    key: str
+    scenario: Scenario
+    envelope: FuelPriceEnvelope
+    body: bytes
+    
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the result"""
+        return len(self.body) + self.envelope.breakpoints.nbytes + self.envelope.winners.nbytes
+
+def scenario_key(fuel_price: Optional[float], port_ids, port_charges, sea_freights, 
+                 matrix_version: int, **extra) -> str:
+    """
+    Hash scenario inputs into a stable hex key
+    
+    Args:
+        fuel_price: Fuel price in dollars per liter (None if not part of the result)
+        port_ids: Active port ids, sorted
+        port_charges: Port charge per port in dollars per ton
+        sea_freights: Sea freight per port in dollars per ton
+        matrix_version: Version of the distance matrix the scenario runs on
+        **extra: Further JSON-serializable inputs that change the result
+    
+    Returns:
+        SHA-256 hex digest
+    """
+    payload = {
+        **extra,
+        'fuel_price': None if fuel_price is None else float(fuel_price),
+        'ports': [
+            [int(port_id), float(port_charge), float(sea_freight)]
+            for port_id, port_charge, sea_freight in zip(port_ids, port_charges, sea_freights)
+        ],
+        'matrix_version': int(matrix_version),
+    }
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def _is_number(value) -> bool:
+    """Check for a real number (bools are not costs)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+def parse_scenario(data: Dict[str, Any], store, require_fuel_price: bool = True) -> Scenario:
+    """
+    Validate a /calculate request body and normalize it against a distance matrix
+    
+    Args:
+        data: Request JSON with fuel_price and a list of ports
+              ({id, name, port_charge, sea_freight, active})
+        store: DistanceMatrixStore the scenario runs on
+        require_fuel_price: Reject input without a fuel price; otherwise a
+                            missing fuel price is kept as None
+    
+    Returns:
+        Scenario
+    
+    Raises:
+        ScenarioError: If the input is invalid or no requested port can be used
+    """
+    if not isinstance(data, dict):
+        raise ScenarioError("Request body must be a JSON object")
+    
+    fuel_price = data.get('fuel_price')
+    if fuel_price is None and not require_fuel_price:
+        pass
+    elif not _is_number(fuel_price) or fuel_price < 0:
+        raise ScenarioError("Valid fuel price required")
+    
+    ports = data.get('ports')
+    if not isinstance(ports, list) or len(ports) == 0:
+        raise ScenarioError("At least one port is required")
+    
+    requested = {}
+    for port in ports:
+        if not isinstance(port, dict) or not isinstance(port.get('id'), int) or isinstance(port['id'], bool):
+            raise ScenarioError("Every port needs an integer id")
+        if port['id'] in requested:
+            raise ScenarioError(f"Port {port['id']} is listed more than once")
+        for field in ('port_charge', 'sea_freight'):
+            if not _is_number(port.get(field, 0)):
+                raise ScenarioError(f"Port {port['id']}: {field} must be a number")
+        requested[port['id']] = port
+    
+    # Ports switched off in the request or in the matrix do not compete
+    store_active = {int(port_id) for port_id in store.port_ids[store.active_mask]}
+    port_ids = sorted(
+        port_id for port_id, port in requested.items()
+        if port.get('active', True) and port_id in store_active
+    )
+    if not port_ids:
+        raise ScenarioError("None of the requested ports are active in the distance matrix")
+    
+    return Scenario(
+        fuel_price=None if fuel_price is None else float(fuel_price),
+        port_ids=np.array(port_ids, dtype=np.int64),
+        port_names=[requested[port_id].get('name') for port_id in port_ids],
+        port_charges=np.array([requested[port_id].get('port_charge', 0) for port_id in port_ids], dtype=np.float64),
+        sea_freights=np.array([requested[port_id].get('sea_freight', 0) for port_id in port_ids], dtype=np.float64),
+        matrix_version=store.version,
+    )
+
+def evaluate_scenario(scenario: Scenario, store) -> PortRanking:
+    """
+    Rank ports for every grid point of the distance matrix
+    
+    Args:
+        scenario: Normalized scenario
+        store: DistanceMatrixStore the scenario was parsed against
+    
+    Returns:
+        PortRanking with column indices into scenario.port_ids
+    """
+    distances = store.matrix[:, store.port_positions(scenario.port_ids)]
+    cost_matrix = compute_cost_matrix(
+        distances, scenario.port_charges, scenario.sea_freights, scenario.fuel_price
+    )
+    return rank_ports(cost_matrix)
+
+def scenario_response(scenario: Scenario, ranking: PortRanking, grid_ids: np.ndarray) -> Dict[str, Any]:
+    """
+    Build the /calculate response for an evaluated scenario
+    
+    Assignments are columnar (one list per field, aligned with grid_point_id)
+    to keep the payload compact for large grids.
+    
+    Args:
+        scenario: Normalized scenario
+        ranking: Result of evaluate_scenario
+        grid_ids: Grid point id for each matrix row
+    
+    Returns:
+        JSON-serializable dictionary
+    """
+    reachable = ranking.best_idx >= 0
+    best_idx = ranking.best_idx[reachable]
+    second_idx = ranking.second_idx[reachable]
+    has_second = second_idx >= 0
+    
+    n_ports = len(scenario.port_ids)
+    counts = np.bincount(best_idx, minlength=n_ports)
+    cost_sums = np.bincount(best_idx, weights=ranking.best_cost[reachable], minlength=n_ports)
+    
+    port_summary = [
+        {
+            'id': int(port_id),
+            'name': name,
+            'grid_points': int(count),
+            'mean_cost': float(cost_sum / count) if count else None,
+        }
+        for port_id, name, count, cost_sum in zip(scenario.port_ids, scenario.port_names, counts, cost_sums)
+    ]
+    
+    return {
+        'status': 'success',
+        'scenario_id': scenario.key,
+        'matrix_version': scenario.matrix_version,
+        'fuel_price': scenario.fuel_price,
+        'ports': port_summary,
+        'unreachable_grid_points': int((~reachable).sum()),
+        'assignments': {
+            'grid_point_id': np.asarray(grid_ids)[reachable].tolist(),
+            'port_id': scenario.port_ids[best_idx].tolist(),
+            'total_cost': np.round(ranking.best_cost[reachable], 4).tolist(),
+            'runner_up_port_id': [
+                int(port_id) if valid else None
+                for port_id, valid in zip(scenario.port_ids[np.maximum(second_idx, 0)], has_second)
+            ],
+            'runner_up_cost': [
+                round(float(cost), 4) if valid else None
+                for cost, valid in zip(ranking.second_cost[reachable], has_second)
+            ],
+        },
+    }
+
+def run_scenario(scenario: Scenario, store) -> ScenarioResult:
+    """
+    Evaluate a scenario; its response body is serialized on first use
+    
+    Args:
+        scenario: Normalized scenario
+        store: DistanceMatrixStore the scenario was parsed against
+    
+    Returns:
+        ScenarioResult
+    """
+    return ScenarioResult(scenario, evaluate_scenario(scenario, store), store.grid_ids)
+
+def envelope_key(scenario: Scenario, fuel_min: float = 0.0, fuel_max: Optional[float] = None) -> str:
+    """
+    Cache key of a scenario's fuel-price envelope over a fuel price range
+    
+    Args:
+        scenario: Normalized scenario (its fuel price is not part of the key)
+        fuel_min: Lowest fuel price of interest
+        fuel_max: Highest fuel price of interest (None for unbounded)
+    
+    Returns:
+        SHA-256 hex digest
+    """
+    return scenario_key(
+        None, scenario.port_ids, scenario.port_charges, scenario.sea_freights, scenario.matrix_version,
+        result='fuel_envelope', fuel_min=float(fuel_min),
+        fuel_max=None if fuel_max is None else float(fuel_max)
+    )
+
+def run_envelope(scenario: Scenario, store, fuel_min: float = 0.0, 
+                 fuel_max: Optional[float] = None) -> EnvelopeResult:
+    """
+    Precompute the fuel-price envelope of a scenario and serialize its response
+    
+    The scenario's own fuel price is ignored; the envelope covers every
+    fuel price in [fuel_min, fuel_max].
+    
+    Args:
+        scenario: Normalized scenario
+        store: DistanceMatrixStore the scenario was parsed against
+        fuel_min: Lowest fuel price of interest
+        fuel_max: Highest fuel price of interest (default: unbounded)
+    
+    Returns:
+        EnvelopeResult
+    """
+    key = envelope_key(scenario, fuel_min, fuel_max)
+    distances = store.matrix[:, store.port_positions(scenario.port_ids)]
+    envelope = build_fuel_envelope(
+        distances, scenario.port_charges, scenario.sea_freights, port_ids=scenario.port_ids,
+        fuel_min=fuel_min, fuel_max=np.inf if fuel_max is None else fuel_max
+    )
+    
+    response = {
+        'status': 'success',
+        'scenario_id': key,
+        'matrix_version': scenario.matrix_version,
+        'fuel_min': float(fuel_min),
+        'fuel_max': fuel_max,
+        'port_ids': scenario.port_ids.tolist(),
+        'port_names': scenario.port_names,
+        'grid_point_id': np.asarray(store.grid_ids).tolist(),
+        'change_points': np.round(envelope.change_points(), 6).tolist(),
+        **envelope.to_compact(),
+    }
+    body = json.dumps(response, separators=(',', ':')).encode('utf-8')
+    return EnvelopeResult(key, scenario, envelope, body)
+
+def parse_batch(data: Dict[str, Any], store) -> Tuple[List[Scenario], Optional[Scenario]]:
+    """
+    Validate a /calculate/batch request body
+    
+    Top-level fuel_price and ports are defaults that each scenario (and the
+    baseline) may override, so a fuel-price sweep only needs
+    {"ports": [...], "scenarios": [{"fuel_price": 1.0}, {"fuel_price": 1.1}, ...]}.
+    
+    Args:
+        data: Request JSON with scenarios, optional baseline and defaults
+        store: DistanceMatrixStore the scenarios run on
+    
+    Returns:
+        Tuple of (scenarios, baseline scenario or None)
+    
+    Raises:
+        ScenarioError: If the input is invalid
+    """
+    if not isinstance(data, dict):
+        raise ScenarioError("Request body must be a JSON object")
+    
+    scenarios = data.get('scenarios')
+    if not isinstance(scenarios, list) or len(scenarios) == 0:
+        raise ScenarioError("At least one scenario is required")
+    if len(scenarios) > MAX_BATCH_SCENARIOS:
+        raise ScenarioError(f"At most {MAX_BATCH_SCENARIOS} scenarios per batch")
+    
+    defaults = {field: data[field] for field in ('fuel_price', 'ports') if field in data}
+    
+    def parse(index, overrides):
+        if not isinstance(overrides, dict):
+            raise ScenarioError(f"Scenario {index} must be a JSON object")
+        try:
+            return parse_scenario({**defaults, **overrides}, store)
+        except ScenarioError as e:
+            raise ScenarioError(f"Scenario {index}: {e}")
+    
+    parsed = [parse(index, scenario) for index, scenario in enumerate(scenarios)]
+    baseline = parse('baseline', data['baseline']) if data.get('baseline') is not None else None
+    
+    return parsed, baseline
+
+def run_batch(scenarios: List[Scenario], store, baseline: Optional[Scenario] = None,
+              include_assignments: bool = True) -> Dict[str, Any]:
+    """
+    Evaluate many scenarios in one broadcast computation
+    
+    Every scenario is compared against the baseline (default: the first
+    scenario) to count the grid points whose optimal port changes.
+    
+    Args:
+        scenarios: Normalized scenarios
+        store: DistanceMatrixStore the scenarios were parsed against
+        baseline: Reference scenario for change counts
+        include_assignments: Include the optimal port id of every grid point
+                             per scenario
+    
+    Returns:
+        JSON-serializable dictionary
+    """
+    evaluated = scenarios + ([baseline] if baseline is not None else [])
+    
+    # One column per port used by any scenario; absent ports cost inf
+    port_ids = np.unique(np.concatenate([scenario.port_ids for scenario in evaluated]))
+    fixed_costs = np.full((len(evaluated), len(port_ids)), np.inf)
+    for row, scenario in enumerate(evaluated):
+        columns = np.searchsorted(port_ids, scenario.port_ids)
+        fixed_costs[row, columns] = scenario.port_charges + scenario.sea_freights
+    fuel_prices = np.array([scenario.fuel_price for scenario in evaluated])
+    
+    distances = store.matrix[:, store.port_positions(port_ids)]
+    best_idx, best_cost = best_ports_batch(distances, fixed_costs, fuel_prices)
+    
+    reachable = best_idx >= 0
+    best_port_ids = np.where(reachable, port_ids[np.maximum(best_idx, 0)], -1)
+    reference = best_port_ids[-1] if baseline is not None else best_port_ids[0]
+    
+    # Cell counts per (scenario, port) in one bincount
+    n_ports = len(port_ids)
+    flat = (np.arange(len(evaluated))[:, np.newaxis] * n_ports + best_idx)[reachable]
+    counts = np.bincount(flat, minlength=len(evaluated) * n_ports).reshape(len(evaluated), n_ports)
+    changed = (best_port_ids != reference[np.newaxis, :]).sum(axis=1)
+    n_reachable = reachable.sum(axis=1)
+    cost_sums = np.where(reachable, best_cost, 0.0).sum(axis=1)
+    
+    def summary(row, scenario):
+        result = {
+            'scenario_id': scenario.key,
+            'fuel_price': scenario.fuel_price,
+            'port_counts': {str(port_id): int(count) for port_id, count in zip(port_ids, counts[row]) if count},
+            'mean_cost': float(cost_sums[row] / n_reachable[row]) if n_reachable[row] else None,
+            'unreachable_grid_points': int(len(reference) - n_reachable[row]),
+            'changed_vs_baseline': int(changed[row]),
+        }
+        if include_assignments:
+            result['port_id'] = best_port_ids[row].tolist()
+        return result
+    
+    response = {
+        'status': 'success',
+        'matrix_version': store.version,
+        'port_ids': port_ids.tolist(),
+        'scenarios': [summary(row, scenario) for row, scenario in enumerate(scenarios)],
+    }
+    if baseline is not None:
+        response['baseline'] = summary(len(scenarios), baseline)
+    if include_assignments:
+        response['grid_point_id'] = np.asarray(store.grid_ids).tolist()
+    
+    return response
+
+def port_costs(scenario: Scenario, store, column: int, rows: np.ndarray = None) -> np.ndarray:
+    """
+    Total cost of one scenario port at (a subset of) the grid points
+    
+    Args:
+        scenario: Normalized scenario
+        store: DistanceMatrixStore the scenario was parsed against
+        column: Port column in scenario.port_ids
+        rows: Matrix rows to evaluate (default: all)
+    
+    Returns:
+        Costs in dollars per ton, inf where the port is unreachable
+    """
+    distances = store.column(scenario.port_ids[column])
+    if rows is not None:
+        distances = distances[rows]
+    
+    cost_per_km = DEFAULT_FUEL_EFFICIENCY * scenario.fuel_price / TRUCK_CAPACITY_TONS
+    costs = distances.astype(np.float64) * cost_per_km + (scenario.port_charges[column] + scenario.sea_freights[column])
+    costs[np.isnan(costs)] = np.inf
+    return costs
+
+def build_port_margins(result: ScenarioResult, store, column: int) -> PortMargins:
+    """
+    Build the margin-to-win index of one port for a scenario result
+    
+    Args:
+        result: Evaluated scenario
+        store: DistanceMatrixStore the scenario was parsed against
+        column: Port column in scenario.port_ids
+    
+    Returns:
+        PortMargins over the reachable grid points where the port is not in the top 2
+    """
+    ranking = result.ranking
+    costs = port_costs(result.scenario, store, column)
+    
+    outside = (ranking.best_idx != column) & (ranking.second_idx != column) & np.isfinite(costs)
+    rows = np.flatnonzero(outside)
+    margins = costs[rows] - ranking.second_cost[rows]
+    
+    order = np.argsort(margins, kind='stable')
+    return PortMargins(margins[order], rows[order])
+
+def _beats(cost_a, idx_a, cost_b, idx_b) -> np.ndarray:
+    """Whether port a ranks before port b (lower cost, ties to the lower column)"""
+    return (cost_a < cost_b) | ((cost_a == cost_b) & (idx_a < idx_b))
+
+def apply_port_delta(base: ScenarioResult, store, port_id: int, port_charge: float = None,
+                     sea_freight: float = None) -> Tuple[ScenarioResult, np.ndarray]:
+    """
+    Derive a scenario result from a previous one after one port's costs change
+    
+    Only grid points where the port is, or would become, best or runner-up
+    are touched. A cheaper port can only enter the top 2 where its margin to
+    the runner-up is smaller than the price drop, which the port's sorted
+    margin index answers with a binary search. A more expensive port can only
+    change grid points where it was in the top 2; those rows are re-ranked.
+    The margin index of the changed port is carried over to the new result.
+    
+    Args:
+        base: Previous scenario result
+        store: DistanceMatrixStore the base scenario was evaluated on
+        port_id: Port whose costs change
+        port_charge: New port charge (default: unchanged)
+        sea_freight: New sea freight (default: unchanged)
+    
+    Returns:
+        Tuple of (new ScenarioResult, matrix rows whose best or runner-up port changed)
+    
+    Raises:
+        ScenarioError: If the port is not part of the base scenario
+    """
+    scenario = base.scenario
+    columns = np.flatnonzero(scenario.port_ids == port_id)
+    if len(columns) == 0:
+        raise ScenarioError(f"Port {port_id} is not part of scenario {base.key}")
+    column = int(columns[0])
+    
+    port_charges = scenario.port_charges.copy()
+    sea_freights = scenario.sea_freights.copy()
+    if port_charge is not None:
+        port_charges[column] = port_charge
+    if sea_freight is not None:
+        sea_freights[column] = sea_freight
+    
+    shift = (port_charges[column] + sea_freights[column]) - (scenario.port_charges[column] + scenario.sea_freights[column])
+    new_scenario = scenario._replace(port_charges=port_charges, sea_freights=sea_freights)
+    if shift == 0:
+        return ScenarioResult(new_scenario, base.ranking, base.grid_ids, dict(base.port_margins)), np.empty(0, dtype=np.int64)
+    
+    old = base.ranking
+    best_idx, best_cost = old.best_idx.copy(), old.best_cost.copy()
+    second_idx, second_cost = old.second_idx.copy(), old.second_cost.copy()
+    
+    margins = base.port_margins.get(column)
+    if margins is None:
+        margins = base.port_margins[column] = build_port_margins(base, store, column)
+    best_rows = np.flatnonzero(old.best_idx == column)
+    second_rows = np.flatnonzero(old.second_idx == column)
+    
+    if shift < 0:
+        # Still best where it was best, only cheaper
+        best_cost[best_rows] = port_costs(new_scenario, store, column, best_rows)
+        
+        # Runner-up rows: the port may now overtake the best one
+        costs = port_costs(new_scenario, store, column, second_rows)
+        overtakes = _beats(costs, column, best_cost[second_rows], best_idx[second_rows])
+        second_idx[second_rows] = np.where(overtakes, best_idx[second_rows], column)
+        second_cost[second_rows] = np.where(overtakes, best_cost[second_rows], costs)
+        best_idx[second_rows] = np.where(overtakes, column, best_idx[second_rows])
+        best_cost[second_rows] = np.where(overtakes, costs, best_cost[second_rows])
+        
+        # Elsewhere it enters the top 2 only where its margin is below the drop;
+        # the slack catches exact ties, which the full comparison settles
+        slack = 1e-9 * max(1.0, abs(shift))
+        n_candidates = np.searchsorted(margins.margins, -shift + slack, side='right')
+        candidates = margins.rows[:n_candidates]
+        costs = port_costs(new_scenario, store, column, candidates)
+        enters = _beats(costs, column, second_cost[candidates], second_idx[candidates])
+        entered = candidates[enters]
+        costs = costs[enters]
+        
+        first = _beats(costs, column, best_cost[entered], best_idx[entered])
+        second_idx[entered] = np.where(first, best_idx[entered], column)
+        second_cost[entered] = np.where(first, best_cost[entered], costs)
+        best_idx[entered] = np.where(first, column, best_idx[entered])
+        best_cost[entered] = np.where(first, costs, best_cost[entered])
+        
+        # Remaining grid points keep their runner-up, so margins shift uniformly
+        keep = np.ones(len(margins.rows), dtype=bool)
+        keep[np.flatnonzero(enters)] = False
+        new_margins = PortMargins(margins.margins[keep] + shift, margins.rows[keep])
+        touched = np.concatenate([best_rows, second_rows, entered])
+    else:
+        # Only grid points where the port was in the top 2 can change; re-rank them
+        touched = np.concatenate([best_rows, second_rows])
+        distances = store.matrix[touched][:, store.port_positions(scenario.port_ids)]
+        ranking = rank_ports(compute_cost_matrix(distances, port_charges, sea_freights, scenario.fuel_price))
+        best_idx[touched], best_cost[touched] = ranking.best_idx, ranking.best_cost
+        second_idx[touched], second_cost[touched] = ranking.second_idx, ranking.second_cost
+        
+        # Grid points where it dropped out of the top 2 join its margin index
+        dropped = touched[(ranking.best_idx != column) & (ranking.second_idx != column)]
+        costs = port_costs(new_scenario, store, column, dropped)
+        dropped, costs = dropped[np.isfinite(costs)], costs[np.isfinite(costs)]
+        added = costs - second_cost[dropped]
+        order = np.argsort(added, kind='stable')
+        
+        shifted = margins.margins + shift
+        positions = np.searchsorted(shifted, added[order])
+        new_margins = PortMargins(
+            np.insert(shifted, positions, added[order]),
+            np.insert(margins.rows, positions, dropped[order])
+        )
+    
+    relative_gap, gradient, is_boundary = old.relative_gap.copy(), old.gradient.copy(), old.is_boundary.copy()
+    relative_gap[touched], gradient[touched], is_boundary[touched] = boundary_metrics(
+        best_cost[touched], second_cost[touched]
+    )
+    
+    ranking = PortRanking(best_idx, best_cost, second_idx, second_cost, relative_gap, gradient, is_boundary)
+    changed = touched[(best_idx[touched] != old.best_idx[touched]) | (second_idx[touched] != old.second_idx[touched])]
+    
+    return ScenarioResult(new_scenario, ranking, base.grid_ids, {column: new_margins}), np.unique(changed)
+
+def delta_response(base: ScenarioResult, result: ScenarioResult, changed_rows: np.ndarray,
+                   port_id: int) -> Dict[str, Any]:
+    """
+    Build the /calculate/delta response
+    
+    Only grid points whose best or runner-up port changed are listed. For
+    every other grid point the assignment is unchanged, and costs involving
+    the changed port move by cost_shift.
+    
+    Args:
+        base: Previous scenario result
+        result: Result after the change
+        changed_rows: Matrix rows whose best or runner-up port changed
+        port_id: Port whose costs changed
+    
+    Returns:
+        JSON-serializable dictionary
+    """
+    scenario, ranking = result.scenario, result.ranking
+    column = int(np.flatnonzero(scenario.port_ids == port_id)[0])
+    shift = (scenario.port_charges[column] + scenario.sea_freights[column]) - (
+        base.scenario.port_charges[column] + base.scenario.sea_freights[column]
+    )
+    
+    best_idx = ranking.best_idx[changed_rows]
+    second_idx = ranking.second_idx[changed_rows]
+    reachable = best_idx >= 0
+    counts = np.bincount(ranking.best_idx[ranking.best_idx >= 0], minlength=len(scenario.port_ids))
+    
+    def ids(idx):
+        return [int(scenario.port_ids[i]) if i >= 0 else None for i in idx]
+    
+    def costs(values):
+        return [round(float(value), 4) if np.isfinite(value) else None for value in values]
+    
+    return {
+        'status': 'success',
+        'scenario_id': result.key,
+        'base_scenario_id': base.key,
+        'matrix_version': scenario.matrix_version,
+        'port_id': int(port_id),
+        'cost_shift': float(shift),
+        'port_counts': {str(port_id): int(count) for port_id, count in zip(scenario.port_ids, counts)},
+        'changed_grid_points': int(len(changed_rows)),
+        'changes': {
+            'grid_point_id': np.asarray(result.grid_ids)[changed_rows].tolist(),
+            'port_id': ids(np.where(reachable, best_idx, -1)),
+            'total_cost': costs(ranking.best_cost[changed_rows]),
+            'runner_up_port_id': ids(second_idx),
+            'runner_up_cost': costs(ranking.second_cost[changed_rows]),
+        },
+    }
+
+class ScenarioCache:
+    """
+    Thread-safe LRU cache of scenario results bounded by entry count and bytes
+    
+    Any result with key and nbytes (ScenarioResult, EnvelopeResult) can be
+    stored. Sizes are measured on insert and kept as a running total; since
+    scenario results grow as their body, encodings and margin indices are
+    built on demand, call resize() after a cached result has grown.
+    """
+    def __init__(self, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        """
+        Initialize an empty cache
+        
+        Args:
+            max_entries: Maximum number of cached scenarios
+            max_bytes: Maximum total size of cached results
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> ScenarioResult:
+        """
+        Look up a scenario result and mark it as recently used
+        
+        Args:
+            key: Scenario key
+        
+        Returns:
+            ScenarioResult or None
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+    
+    def put(self, result: Union[ScenarioResult, EnvelopeResult]):
+        """
+        Store a scenario result, evicting least recently used entries as needed
+        
+        Results larger than max_bytes on their own are not cached.
+        
+        Args:
+            result: ScenarioResult or EnvelopeResult to store
+        """
+        nbytes = result.nbytes
+        with self._lock:
+            self._discard(result.key)
+            if nbytes > self.max_bytes:
+                logger.warning(f"Scenario result of {nbytes} bytes exceeds the cache size, not cached")
+                return
+            
+            self._entries[result.key] = result
+            self._sizes[result.key] = nbytes
+            self._bytes += nbytes
+            self._evict()
+    
+    def resize(self, result: Union[ScenarioResult, EnvelopeResult]):
+        """
+        Re-measure a cached result after its lazily built parts grew
+        
+        Results no longer in the cache are ignored.
+        
+        Args:
+            result: ScenarioResult or EnvelopeResult previously stored
+        """
+        nbytes = result.nbytes
+        with self._lock:
+            if self._entries.get(result.key) is not result:
+                return
+            if nbytes > self.max_bytes:
+                self._discard(result.key)
+                return
+            
+            self._bytes += nbytes - self._sizes[result.key]
+            self._sizes[result.key] = nbytes
+            self._evict()
+    
+    def _discard(self, key: str):
+        """Remove one entry if present (call with the lock held)"""
+        if self._entries.pop(key, None) is not None:
+            self._bytes -= self._sizes.pop(key)
+    
+    def _evict(self):
+        """Drop least recently used entries until within bounds (call with the lock held)"""
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            key, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(key)
+            self.evictions += 1
+    
+    def clear(self):
+        """Drop every cached result"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get hit/miss counters and current size
+        
+        Returns:
+            Dictionary with hits, misses, evictions, entries and bytes
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+            }
\ No newline at end of file
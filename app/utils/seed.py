@@ -0,0 +1,276 @@
+"""
+Bulk loading of grid points and distances for AgriPort Optimizer
+
+Rows are generated from compact arrays (a Grid, the distance matrix store)
+in fixed-size batches and streamed into the database without ORM objects:
+PostgreSQL receives each batch through COPY FROM STDIN, other databases
+(SQLite with SpatiaLite in development) through a batched executemany of one
+core INSERT statement.
+"""
+import io
+import time
+import logging
+from typing import Any, Dict, Iterable, Iterator, List
+import numpy as np
+from sqlalchemy import func, inspect, text
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+SEED_BATCH_ROWS = 100000
+SRID = 4326
+
+def is_postgresql(connection) -> bool:
+    """Whether a SQLAlchemy connection talks to PostgreSQL"""
+    return connection.dialect.name == 'postgresql'
+
+def copy_batches(connection, table, columns: List[str], batches: Iterable[Dict[str, np.ndarray]]) -> int:
+    """
+    Stream batches of column arrays into a table
+    
+    Args:
+        connection: SQLAlchemy connection (the caller commits)
+        table: SQLAlchemy Table
+        columns: Columns to fill, in order
+        batches: Dictionaries of equally long arrays keyed by column
+    
+    Returns:
+        Number of rows written
+    """
+    import pandas as pd
+    
+    written = 0
+    if is_postgresql(connection):
+        # COPY goes through the DBAPI cursor of the connection's transaction
+        cursor = connection.connection.cursor()
+        statement = f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        try:
+            for batch in batches:
+                buffer = io.StringIO()
+                pd.DataFrame({column: batch[column] for column in columns}).to_csv(
+                    buffer, header=False, index=False, na_rep=''
+                )
+                buffer.seek(0)
+                cursor.copy_expert(statement, buffer)
+                written += len(batch[columns[0]])
+        finally:
+            cursor.close()
+    else:
+        # One compiled INSERT (with the geometry conversion functions of the
+        # dialect) executed through the driver, without per-row SQLAlchemy work
+        compiled = table.insert().compile(dialect=connection.dialect, column_keys=columns)
+        for batch in batches:
+            values = {column: np.asarray(batch[column]).tolist() for column in columns}
+            if compiled.positional:
+                records = list(zip(*(values[key] for key in compiled.positiontup)))
+            else:
+                records = [dict(zip(columns, row)) for row in zip(*(values[column] for column in columns))]
+            if records:
+                connection.exec_driver_sql(str(compiled), records)
+            written += len(records)
+    
+    return written
+
+def grid_point_batches(grid, batch_rows: int = SEED_BATCH_ROWS,
+                       ids: np.ndarray = None) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Rows of the grid_points table for a grid
+    
+    Args:
+        grid: Grid
+        batch_rows: Rows per batch
+        ids: Database id of each grid point (default: grid.ids)
+    
+    Yields:
+        Dictionaries with id, location (EWKT), lat and lon arrays
+    """
+    ids = grid.ids if ids is None else np.asarray(ids, dtype=np.int64)
+    for start in range(0, len(grid), batch_rows):
+        batch_ids = ids[start:start + batch_rows]
+        lat = grid.lat[start:start + batch_rows]
+        lon = grid.lon[start:start + batch_rows]
+        yield {
+            'id': batch_ids,
+            'location': [f'SRID={SRID};POINT({x!r} {y!r})' for x, y in zip(lon.tolist(), lat.tolist())],
+            'lat': lat,
+            'lon': lon,
+        }
+
+def distance_batches(store, port_ids: Iterable[int] = None,
+                     batch_rows: int = SEED_BATCH_ROWS) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Rows of the distances table from a distance matrix store, port by port
+    
+    Args:
+        store: DistanceMatrixStore
+        port_ids: Ports to load (default: all stored ports)
+        batch_rows: Rows per batch
+    
+    Yields:
+        Dictionaries with grid_point_id, port_id and distance_km arrays;
+        unroutable pairs (NaN) are skipped
+    """
+    grid_ids = np.asarray(store.grid_ids, dtype=np.int64)
+    for port_id in (store.port_ids if port_ids is None else port_ids):
+        column = store.column(int(port_id))
+        for start in range(0, store.n_grid, batch_rows):
+            distances = np.asarray(column[start:start + batch_rows], dtype=np.float64)
+            routed = np.flatnonzero(~np.isnan(distances))
+            if len(routed) == 0:
+                continue
+            yield {
+                'grid_point_id': grid_ids[start + routed],
+                'port_id': np.full(len(routed), int(port_id), dtype=np.int64),
+                'distance_km': distances[routed],
+            }
+
+def analyze(connection, table_names: Iterable[str]):
+    """Refresh planner statistics after a bulk load (PostgreSQL only)"""
+    if is_postgresql(connection):
+        for name in table_names:
+            connection.execute(text(f"ANALYZE {name}"))
+
+def seed_grid(session, grid, replace: bool = False, batch_rows: int = SEED_BATCH_ROWS,
+              ids: np.ndarray = None) -> Dict[str, Any]:
+    """
+    Load a grid into the grid_points table
+    
+    Args:
+        session: SQLAlchemy session (committed on success)
+        grid: Grid
+        replace: Delete existing grid points (and their distances) first
+        batch_rows: Rows per batch
+        ids: Database id of each grid point when they are not the grid's
+             raster ids, e.g. ids from a file whose raster was inferred
+             (default: grid.ids)
+    
+    Returns:
+        Summary with the number of rows and the elapsed time
+    
+    Raises:
+        ValueError: If grid points exist and replace is not set, or the ids
+                    do not match the grid
+    """
+    from ..models import Distance, GridPoint
+    
+    if ids is not None:
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) != len(grid):
+            raise ValueError(f"Got {len(ids)} ids for {len(grid)} grid points")
+        if len(np.unique(ids)) != len(ids):
+            raise ValueError("Grid point ids must be unique")
+    
+    started = time.perf_counter()
+    connection = session.connection()
+    existing = session.query(func.count(GridPoint.id)).scalar()
+    if existing and not replace:
+        raise ValueError(f"grid_points already holds {existing} rows; use replace to reload")
+    
+    if existing:
+        session.query(Distance).delete(synchronize_session=False)
+        session.query(GridPoint).delete(synchronize_session=False)
+    
+    written = copy_batches(connection, GridPoint.__table__, ['id', 'location', 'lat', 'lon'],
+                           grid_point_batches(grid, batch_rows, ids=ids))
+    analyze(connection, ['grid_points'])
+    session.commit()
+    
+    elapsed = time.perf_counter() - started
+    logger.info(f"Loaded {written} grid points in {elapsed:.1f}s")
+    return {'grid_points': written, 'replaced': int(existing), 'seconds': round(elapsed, 2)}
+
+def seed_distances(session, store, port_ids: Iterable[int] = None,
+                   batch_rows: int = SEED_BATCH_ROWS) -> Dict[str, Any]:
+    """
+    Load the distances of a distance matrix store, replacing the rows of its ports
+    
+    Args:
+        session: SQLAlchemy session (committed on success)
+        store: DistanceMatrixStore
+        port_ids: Ports to load (default: all stored ports)
+        batch_rows: Rows per batch
+    
+    Returns:
+        Summary with the number of rows and the elapsed time
+    
+    Raises:
+        ValueError: If the grid points of the matrix are not loaded or a port is not stored
+    """
+    from ..models import Distance, GridPoint
+    
+    port_ids = [int(port_id) for port_id in (store.port_ids if port_ids is None else port_ids)]
+    missing_ports = [port_id for port_id in port_ids if port_id not in set(store.port_ids.tolist())]
+    if missing_ports:
+        raise ValueError(f"Ports not in the distance matrix: {missing_ports}")
+    
+    started = time.perf_counter()
+    connection = session.connection()
+    n_grid_points = session.query(func.count(GridPoint.id)).scalar()
+    if n_grid_points < store.n_grid:
+        raise ValueError(
+            f"grid_points holds {n_grid_points} rows but the matrix has {store.n_grid}; run seed-grid first"
+        )
+    
+    session.query(Distance).filter(Distance.port_id.in_(port_ids)).delete(synchronize_session=False)
+    written = copy_batches(connection, Distance.__table__, ['grid_point_id', 'port_id', 'distance_km'],
+                           distance_batches(store, port_ids, batch_rows))
+    analyze(connection, ['distances'])
+    session.commit()
+    
+    elapsed = time.perf_counter() - started
+    logger.info(f"Loaded {written} distances for {len(port_ids)} ports in {elapsed:.1f}s")
+    return {'distances': written, 'ports': len(port_ids), 'seconds': round(elapsed, 2)}
+
+def verify_seed(session, store=None) -> Dict[str, Any]:
+    """
+    Check the loaded grid and distances against each other and the matrix store
+    
+    Args:
+        session: SQLAlchemy session
+        store: DistanceMatrixStore to compare with (optional)
+    
+    Returns:
+        Report dictionary; 'problems' lists everything that does not match
+    """
+    from ..models import Distance, GridPoint
+    
+    problems = []
+    n_grid_points = session.query(func.count(GridPoint.id)).scalar()
+    per_port = dict(
+        session.query(Distance.port_id, func.count(Distance.id)).group_by(Distance.port_id).all()
+    )
+    orphans = session.query(func.count(Distance.id)).outerjoin(
+        GridPoint, GridPoint.id == Distance.grid_point_id
+    ).filter(GridPoint.id.is_(None)).scalar()
+    if orphans:
+        problems.append(f"{orphans} distances reference missing grid points")
+    
+    report = {
+        'grid_points': n_grid_points,
+        'distances': int(sum(per_port.values())),
+        'distances_per_port': {int(port_id): int(count) for port_id, count in sorted(per_port.items())},
+    }
+    
+    # Indexes the scenario queries rely on
+    inspector = inspect(session.connection())
+    indexes = {index['name'] for index in inspector.get_indexes('distances')}
+    indexes |= {constraint['name'] for constraint in inspector.get_unique_constraints('distances')}
+    for name in ('uq_distances_grid_point_port', 'ix_distances_port_grid_point'):
+        if name not in indexes:
+            problems.append(f"Missing index {name} on distances")
+    if is_postgresql(session.connection()):
+        if 'idx_grid_points_location' not in {index['name'] for index in inspector.get_indexes('grid_points')}:
+            problems.append("Missing spatial index idx_grid_points_location on grid_points")
+    
+    if store is not None:
+        report['matrix_grid_points'] = store.n_grid
+        if n_grid_points != store.n_grid:
+            problems.append(f"grid_points holds {n_grid_points} rows, the matrix {store.n_grid}")
+        for port_id in store.port_ids.tolist():
+            expected = int(np.count_nonzero(~np.isnan(store.column(port_id))))
+            loaded = int(per_port.get(port_id, 0))
+            if loaded != expected:
+                problems.append(f"Port {port_id}: {loaded} distances loaded, {expected} in the matrix")
+    
+    report['problems'] = problems
+    return report
\ No newline at end of file
@@ -0,0 +1,320 @@
+"""
+Raster map tiles of scenario results for AgriPort Optimizer
+
+Renders the optimal-port raster of a scenario into 256x256 Web Mercator
+(slippy map) PNG tiles with NumPy alone: every tile pixel is mapped to the
+nearest grid cell, coloured by its optimal port and, on the gradient layer,
+blended towards the runner-up port where the two costs are close. The PNG
+encoder is the minimal subset of the format needed for RGBA images.
+"""
+import math
+import zlib
+import struct
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, NamedTuple, Tuple
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+MAX_TILE_ZOOM = 18
+DEFAULT_PRERENDER_MAX_ZOOM = 6
+DEFAULT_PRERENDER_QUEUE_SIZE = 4
+DEFAULT_TILE_CACHE_MAX_ENTRIES = 4096
+DEFAULT_TILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TILE_LAYERS = ('regions', 'gradient')
+
+# Port colours by port column, cycled for larger port sets; keep in sync
+# with portColors in templates/index.html
+TILE_PALETTE = np.array([
+    [0x1e, 0x88, 0xe5],
+    [0x43, 0xa0, 0x47],
+    [0xe5, 0x39, 0x35],
+    [0xfb, 0x8c, 0x00],
+    [0x8e, 0x24, 0xaa],
+    [0x00, 0x89, 0x7b],
+], dtype=np.float32)
+REGION_ALPHA = 110
+BOUNDARY_ALPHA = 200
+
+class Tile(NamedTuple):
+    """Rendered PNG tile, stored in a ScenarioCache under its tile key"""
+    key: str
+    png: bytes
+    
+    @property
+    def nbytes(self) -> int:
+        """Size of the encoded tile in bytes"""
+        return len(self.png)
+
+def tile_key(scenario_id: str, layer: str, z: int, x: int, y: int) -> str:
+    """
+    Cache key of one tile of a scenario
+    
+    Args:
+        scenario_id: Scenario key
+        layer: Tile layer
+        z: Zoom level
+        x: Tile column
+        y: Tile row (from the north)
+    
+    Returns:
+        Tile key string
+    """
+    return f"{scenario_id}/{layer}/{z}/{x}/{y}"
+
+def encode_png(rgba: np.ndarray, level: int = 6) -> bytes:
+    """
+    Encode an RGBA image as PNG
+    
+    Args:
+        rgba: uint8 array of shape (height, width, 4)
+        level: zlib compression level
+    
+    Returns:
+        PNG file contents
+    """
+    height, width = rgba.shape[:2]
+    
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    
+    # Every scanline starts with its filter type (0: none)
+    scanlines = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, width * 4)
+    
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(scanlines.tobytes(), level)),
+        chunk(b'IEND', b''),
+    ])
+
+EMPTY_TILE = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+def tile_pixel_centers(z: int, x: int, y: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Latitudes of the pixel rows and longitudes of the pixel columns of a tile
+    
+    Args:
+        z: Zoom level
+        x: Tile column
+        y: Tile row (from the north)
+    
+    Returns:
+        Tuple of (lat, lon) arrays of length TILE_SIZE
+    """
+    n = 2 ** z
+    offsets = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lon = (x + offsets) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * (y + offsets) / n))))
+    return lat, lon
+
+def tile_range(raster: Dict[str, Any], z: int) -> Tuple[range, range]:
+    """
+    Tiles of a zoom level that overlap the raster
+    
+    Args:
+        raster: Raster description
+        z: Zoom level
+    
+    Returns:
+        Tuple of (x range, y range)
+    """
+    n = 2 ** z
+    south = raster['origin_lat'] - raster['cell_lat'] / 2
+    north = raster['origin_lat'] + (raster['n_rows'] - 0.5) * raster['cell_lat']
+    west = raster['origin_lon'] - raster['cell_lon'] / 2
+    east = raster['origin_lon'] + (raster['n_cols'] - 0.5) * raster['cell_lon']
+    
+    def tile_x(lon):
+        return min(n - 1, max(0, int((lon + 180.0) / 360.0 * n)))
+    
+    def tile_y(lat):
+        lat = math.radians(max(-85.0511, min(85.0511, lat)))
+        return min(n - 1, max(0, int((1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n)))
+    
+    return range(tile_x(west), tile_x(east) + 1), range(tile_y(north), tile_y(south) + 1)
+
+def raster_cell_rows(cells: np.ndarray, raster: Dict[str, Any]) -> np.ndarray:
+    """
+    Inverse of the cell index: the matrix row of every raster cell
+    
+    Args:
+        cells: Flat raster cell of each matrix row
+        raster: Raster description
+    
+    Returns:
+        int64 array with one entry per raster cell, -1 for cells without a grid point
+    """
+    cell_rows = np.full(int(raster['n_rows']) * int(raster['n_cols']), -1, dtype=np.int64)
+    cell_rows[cells] = np.arange(len(cells))
+    return cell_rows
+
+def render_tile(result, raster: Dict[str, Any], cell_rows: np.ndarray,
+                z: int, x: int, y: int, layer: str = 'regions') -> bytes:
+    """
+    Render one tile of a scenario result
+    
+    Args:
+        result: ScenarioResult
+        raster: Raster description of the result's grid
+        cell_rows: Matrix row of every raster cell (from raster_cell_rows)
+        z: Zoom level
+        x: Tile column
+        y: Tile row (from the north)
+        layer: 'regions' (optimal port) or 'gradient' (optimal port blended
+            towards the runner-up near boundaries)
+    
+    Returns:
+        PNG bytes
+    """
+    lat, lon = tile_pixel_centers(z, x, y)
+    
+    # Nearest cell per pixel row and column, separately for each axis
+    row = np.rint((lat - raster['origin_lat']) / raster['cell_lat']).astype(np.int64)
+    col = np.rint((lon - raster['origin_lon']) / raster['cell_lon']).astype(np.int64)
+    row_valid = (row >= 0) & (row < raster['n_rows'])
+    col_valid = (col >= 0) & (col < raster['n_cols'])
+    if not row_valid.any() or not col_valid.any():
+        return EMPTY_TILE
+    
+    cells = np.clip(row, 0, raster['n_rows'] - 1)[:, np.newaxis] * raster['n_cols'] + \
+        np.clip(col, 0, raster['n_cols'] - 1)[np.newaxis, :]
+    rows = np.where(row_valid[:, np.newaxis] & col_valid[np.newaxis, :], cell_rows[cells], -1)
+    
+    ranking = result.ranking
+    safe_rows = np.maximum(rows, 0)
+    best = ranking.best_idx[safe_rows]
+    covered = (rows >= 0) & (best >= 0)
+    if not covered.any():
+        return EMPTY_TILE
+    
+    colors = TILE_PALETTE[best % len(TILE_PALETTE)]
+    alpha = np.full(rows.shape, REGION_ALPHA, dtype=np.float32)
+    
+    if layer == 'gradient':
+        # At equal costs a cell is an even mix of the two ports
+        gradient = ranking.gradient[safe_rows].astype(np.float32)
+        second = ranking.second_idx[safe_rows]
+        weight = np.where(second >= 0, gradient / 2, 0.0)[..., np.newaxis]
+        colors = colors * (1 - weight) + TILE_PALETTE[second % len(TILE_PALETTE)] * weight
+        alpha += (BOUNDARY_ALPHA - REGION_ALPHA) * gradient
+    
+    rgba = np.zeros(rows.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = np.rint(colors).astype(np.uint8)
+    rgba[..., 3] = np.where(covered, np.rint(alpha), 0).astype(np.uint8)
+    return encode_png(rgba)
+
+def iter_prerender_tiles(raster: Dict[str, Any],
+                         max_zoom: int = DEFAULT_PRERENDER_MAX_ZOOM) -> Iterator[Tuple[int, int, int]]:
+    """
+    Tiles of the low zoom levels that overlap the raster
+    
+    Args:
+        raster: Raster description
+        max_zoom: Highest zoom level to include
+    
+    Yields:
+        (z, x, y) tuples, lowest zoom first
+    """
+    for z in range(max_zoom + 1):
+        x_range, y_range = tile_range(raster, z)
+        for x in x_range:
+            for y in y_range:
+                yield z, x, y
+
+def prerender_tiles(result, raster: Dict[str, Any], cell_rows: np.ndarray, cache,
+                    max_zoom: int = DEFAULT_PRERENDER_MAX_ZOOM, layers=TILE_LAYERS) -> int:
+    """
+    Render the low zoom levels of a scenario into a tile cache
+    
+    Args:
+        result: ScenarioResult
+        raster: Raster description of the result's grid
+        cell_rows: Matrix row of every raster cell
+        cache: ScenarioCache holding Tile entries
+        max_zoom: Highest zoom level to render
+        layers: Tile layers to render
+    
+    Returns:
+        Number of tiles rendered
+    """
+    rendered = 0
+    for z, x, y in iter_prerender_tiles(raster, max_zoom):
+        for layer in layers:
+            key = tile_key(result.key, layer, z, x, y)
+            if cache.get(key) is None:
+                cache.put(Tile(key, render_tile(result, raster, cell_rows, z, x, y, layer)))
+                rendered += 1
+    
+    logger.info(f"Prerendered {rendered} tiles up to zoom {max_zoom} for scenario {result.key[:12]}")
+    return rendered
+
+class TilePrerenderer:
+    """
+    Per-process background queue for prerender_tiles
+    
+    A single worker thread renders one scenario at a time, so bursts of new
+    scenarios cannot pile up rendering threads. Scenarios already queued are
+    skipped, and new ones are dropped while the queue is full: prerendering
+    only warms the tile cache, /tiles renders missing tiles on demand.
+    """
+    def __init__(self, max_queued: int = DEFAULT_PRERENDER_QUEUE_SIZE):
+        """
+        Initialize an idle prerenderer (the worker thread starts with the first submit)
+        
+        Args:
+            max_queued: Maximum number of scenarios waiting or being rendered
+        """
+        self.max_queued = max_queued
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tile-prerender')
+    
+    def submit(self, result, raster: Dict[str, Any], cell_rows: np.ndarray, cache,
+               max_zoom: int = DEFAULT_PRERENDER_MAX_ZOOM) -> bool:
+        """
+        Queue the low zoom tiles of a scenario for rendering
+        
+        Args:
+            result: ScenarioResult
+            raster: Raster description of the result's grid
+            cell_rows: Matrix row of every raster cell
+            cache: ScenarioCache holding Tile entries
+            max_zoom: Highest zoom level to render
+        
+        Returns:
+            True if queued, False if the scenario is already queued or the queue is full
+        """
+        with self._lock:
+            if result.key in self._queued or len(self._queued) >= self.max_queued:
+                return False
+            self._queued.add(result.key)
+        
+        try:
+            self._executor.submit(self._render, result, raster, cell_rows, cache, max_zoom)
+        except RuntimeError:
+            # Executor shut down at interpreter exit
+            with self._lock:
+                self._queued.discard(result.key)
+            return False
+        return True
+    
+    def _render(self, result, raster, cell_rows, cache, max_zoom):
+        """Run prerender_tiles for one queued scenario"""
+        try:
+            prerender_tiles(result, raster, cell_rows, cache, max_zoom)
+        except Exception as e:
+            logger.error(f"Prerendering tiles for scenario {result.key[:12]} failed: {e}")
+        finally:
+            with self._lock:
+                self._queued.discard(result.key)
+    
+    def pending(self) -> int:
+        """Number of scenarios waiting or being rendered"""
+        with self._lock:
+            return len(self._queued)
\ No newline at end of file
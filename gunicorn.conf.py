@@ -0,0 +1,40 @@
+"""
+Gunicorn configuration for AgriPort Optimizer
+
+The application is loaded once in the master process (preload_app) and the
+distance matrix data is warmed there before any worker is forked, so workers
+start serving at once and share the matrix memory map and the derived grid
+arrays instead of each loading its own copy. Adding workers then adds only
+their private heap (request buffers, scenario and tile caches), not another
+copy of the grid.
+
+Settings can be overridden with the usual GUNICORN_CMD_ARGS or the
+environment variables below.
+"""
+import os
+
+# Every web worker would otherwise start its own pool of JOB_WORKERS job
+# processes: jobs run in a separate `flask jobs-worker` process (the
+# jobs-worker service in docker-compose.yml) unless JOB_WORKERS is set
+os.environ.setdefault('JOB_WORKERS', '0')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+preload_app = True
+
+def when_ready(server):
+    """Warm the distance matrix data in the master before workers are forked"""
+    from app.routes import preload_data
+    
+    n_grid = preload_data(server.app.wsgi())
+    server.log.info(f"Preloaded distance matrix data for {n_grid} grid points")
+
+def post_fork(server, worker):
+    """Drop database connections inherited from the master"""
+    from app import db
+    
+    with server.app.wsgi().app_context():
+        db.engine.dispose(close=False)
\ No newline at end of file
@@ -0,0 +1,86 @@
+"""Initial schema with distance and spatial indexes
+
+Revision ID: 3f2a9c1d7e04
+Revises:
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from geoalchemy2 import Geometry
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7e04'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ports',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('location', Geometry(geometry_type='POINT', srid=4326, spatial_index=False), nullable=False),
+    sa.Column('lat', sa.Float(), nullable=False),
+    sa.Column('lon', sa.Float(), nullable=False),
+    sa.Column('active', sa.Boolean(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_index('idx_ports_location', 'ports', ['location'], unique=False, postgresql_using='gist')
+
+    op.create_table('grid_points',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('location', Geometry(geometry_type='POINT', srid=4326, spatial_index=False), nullable=False),
+    sa.Column('lat', sa.Float(), nullable=False),
+    sa.Column('lon', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('idx_grid_points_location', 'grid_points', ['location'], unique=False, postgresql_using='gist')
+
+    op.create_table('distances',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('grid_point_id', sa.Integer(), nullable=False),
+    sa.Column('port_id', sa.Integer(), nullable=False),
+    sa.Column('distance_km', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['grid_point_id'], ['grid_points.id'], ),
+    sa.ForeignKeyConstraint(['port_id'], ['ports.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('grid_point_id', 'port_id', name='uq_distances_grid_point_port')
+    )
+    # Covering index: one port's distances are read with an index-only range scan
+    op.create_index('ix_distances_port_grid_point', 'distances', ['port_id', 'grid_point_id'], unique=False,
+                    postgresql_include=['distance_km'])
+
+    op.create_table('jobs',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('kind', sa.String(length=50), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('params', sa.Text(), nullable=False),
+    sa.Column('progress', sa.Float(), nullable=False),
+    sa.Column('message', sa.String(length=255), nullable=True),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('cancel_requested', sa.Boolean(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_jobs_status'), 'jobs', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_jobs_status'), table_name='jobs')
+    op.drop_table('jobs')
+    op.drop_index('ix_distances_port_grid_point', table_name='distances')
+    op.drop_table('distances')
+    op.drop_index('idx_grid_points_location', table_name='grid_points')
+    op.drop_table('grid_points')
+    op.drop_index('idx_ports_location', table_name='ports')
+    op.drop_table('ports')
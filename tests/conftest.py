@@ -0,0 +1,116 @@
+"""
+Shared fixtures for the AgriPort Optimizer tests
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+import pytest
+from app.utils.routing import haversine_matrix
+
+# Road distance the stub server reports, relative to the great-circle distance
+STUB_CIRCUITY = 1.25
+
+class StubOSRMServer(ThreadingHTTPServer):
+    """
+    Local HTTP server answering OSRM /table, /route and /health requests
+    
+    Distances are STUB_CIRCUITY times the great-circle distance. Tests steer
+    failures through the attributes:
+        transient_failures: Number of upcoming table requests answered with 503
+        failing_points: (lat, lon) points whose table requests fail with 400
+        unreachable_points: (lat, lon) points without routes (null distances)
+        delay: Seconds to wait before answering a table request
+    """
+    daemon_threads = True
+    
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubOSRMHandler)
+        self.transient_failures = 0
+        self.failing_points = set()
+        self.unreachable_points = set()
+        self.delay = 0.0
+        self.table_requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+class StubOSRMHandler(BaseHTTPRequestHandler):
+    """Request handler of StubOSRMServer"""
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _send_json(self, status: int, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/health':
+            return self._send_json(200, {'status': 'ok'})
+        
+        service, _, _, coords = url.path.strip('/').split('/', 3)
+        points = [tuple(reversed([round(float(x), 5) for x in pair.split(',')])) for pair in coords.split(';')]
+        if service == 'route':
+            distance_m = haversine_matrix(points[:1], points[1:2])[0, 0] * STUB_CIRCUITY * 1000
+            return self._send_json(200, {'code': 'Ok', 'routes': [{'distance': distance_m}]})
+        
+        server = self.server
+        with server.lock:
+            server.table_requests.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            transient = server.transient_failures > 0
+            server.transient_failures -= int(transient)
+        
+        try:
+            if server.delay:
+                threading.Event().wait(server.delay)
+            if transient:
+                return self._send_json(503, {'code': 'Busy'})
+            if server.failing_points.intersection(points):
+                return self._send_json(400, {'code': 'InvalidQuery'})
+            
+            query = parse_qs(url.query)
+            sources = [points[int(i)] for i in query['sources'][0].split(';')]
+            targets = [points[int(i)] for i in query['destinations'][0].split(';')]
+            distances = haversine_matrix(sources, targets) * STUB_CIRCUITY * 1000
+            table = [
+                [None if source in server.unreachable_points or target in server.unreachable_points else value
+                 for target, value in zip(targets, row)]
+                for source, row in zip(sources, distances.tolist())
+            ]
+            return self._send_json(200, {'code': 'Ok', 'distances': table})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+@pytest.fixture
+def osrm_server():
+    """Running StubOSRMServer, shut down after the test"""
+    server = StubOSRMServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def points():
+    """Random (lat, lon) points over Argentina, rounded like OSRM coordinates"""
+    rng = np.random.default_rng(7)
+    return np.round(np.column_stack([rng.uniform(-40, -25, 60), rng.uniform(-68, -56, 60)]), 5)
+
+def expected_distances(origins, destinations) -> np.ndarray:
+    """Distances in km the stub server reports"""
+    return haversine_matrix(origins, destinations) * STUB_CIRCUITY
\ No newline at end of file
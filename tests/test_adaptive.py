@@ -0,0 +1,72 @@
+"""
+Tests for adaptive quadtree grids and the raster fill that serves them
+"""
+import numpy as np
+import pytest
+from app.utils.adaptive import build_adaptive_matrix, fill_cell_index, pack_mask, unpack_mask
+from app.utils.cost import compute_cost_matrix, rank_ports
+from app.utils.grid import Grid
+from app.utils.matrix_store import DistanceMatrixStore
+from .conftest import expected_distances
+
+RASTER = {'origin_lat': -40.0, 'origin_lon': -66.0, 'cell_lat': 0.05, 'cell_lon': 0.05, 'n_rows': 150, 'n_cols': 120}
+
+PORTS = [
+    {'id': 1, 'lat': -34.6, 'lon': -58.4, 'active': True},
+    {'id': 2, 'lat': -38.7, 'lon': -62.3, 'active': True},
+    {'id': 3, 'lat': -32.9, 'lon': -60.6, 'active': True},
+    {'id': 4, 'lat': -36.2, 'lon': -67.5, 'active': True},
+]
+
+SCENARIO = {'fuel_price': 1.2, 'ports': [
+    {'id': 1, 'port_charge': 3, 'sea_freight': 20}, {'id': 2, 'port_charge': 2, 'sea_freight': 24},
+    {'id': 3, 'port_charge': 4, 'sea_freight': 21}, {'id': 4, 'port_charge': 1, 'sea_freight': 30},
+]}
+
+class StubRouter:
+    """Router returning the stub server's distances without HTTP"""
+    failed_batches = []
+    
+    def get_distance_matrix_array(self, origins, destinations, **kwargs):
+        return expected_distances(origins, destinations)
+
+@pytest.fixture
+def uniform():
+    """Uniform grid on an irregular region with an interior lake"""
+    rows, cols = np.mgrid[0:RASTER['n_rows'], 0:RASTER['n_cols']]
+    mask = ((rows - 75) / 72.0) ** 2 + ((cols - 60) / 58.0) ** 2 + 0.05 * np.sin(rows / 6.0) < 1
+    # Lake strictly inside one coarse quadtree cell (corners 88-96, 40-48)
+    lake = np.hypot(rows - 92, cols - 44) < 3.5
+    return Grid.from_mask(RASTER, mask & ~lake), lake
+
+def test_mask_round_trip(uniform):
+    grid, _ = uniform
+    
+    np.testing.assert_array_equal(unpack_mask(pack_mask(grid.mask), grid.n_rows, grid.n_cols), grid.mask)
+
+def test_adaptive_fill_matches_uniform_grid(uniform, tmp_path):
+    grid, lake = uniform
+    ports_latlon = np.array([[port['lat'], port['lon']] for port in PORTS])
+    charges = np.array([port['port_charge'] for port in SCENARIO['ports']], dtype=np.float64)
+    freights = np.array([port['sea_freight'] for port in SCENARIO['ports']], dtype=np.float64)
+    
+    summary = build_adaptive_matrix(str(tmp_path / 'm.apdm'), grid, PORTS, SCENARIO, StubRouter(), levels=3)
+    store = DistanceMatrixStore.open(str(tmp_path / 'm.apdm'))
+    adaptive = Grid.from_ids(store.grid_ids, store.metadata['raster'])
+    inside = unpack_mask(store.metadata['adaptive']['inside_mask'], grid.n_rows, grid.n_cols)
+    cell_rows = fill_cell_index(adaptive, store.metadata['adaptive']['max_step'], inside)
+    
+    # Exactly the uniform grid's cells are painted, the lake stays empty
+    np.testing.assert_array_equal(cell_rows >= 0, grid.mask.ravel())
+    assert (cell_rows[lake.ravel()] == -1).all()
+    assert (fill_cell_index(adaptive, store.metadata['adaptive']['max_step'])[lake.ravel()] >= 0).any()
+    
+    # Every cell gets the optimal port of the uniform build
+    uniform_best = rank_ports(compute_cost_matrix(
+        expected_distances(np.column_stack([grid.lat, grid.lon]), ports_latlon), charges, freights, 1.2
+    )).best_idx
+    adaptive_best = rank_ports(compute_cost_matrix(store.matrix, charges, freights, 1.2)).best_idx
+    filled = cell_rows[grid.ids]
+    assert summary['nodes'] < len(grid) / 2
+    assert store.router_backend == 'osrm'
+    assert (adaptive_best[filled] != uniform_best).sum() == 0
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Tests for reading point files and writing bulk assignments
+"""
+import csv
+import io
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from app.utils.bulk import BULK_COLUMNS, BULK_EMPTY_TYPES, assign_stream, iter_point_chunks, write_assignments_csv
+from app.utils.export import write_arrow
+from app.utils.matrix_store import DistanceMatrixStore
+from app.utils.scenario import parse_scenario
+
+RASTER = {'origin_lat': -35.0, 'origin_lon': -60.0, 'cell_lat': 0.1, 'cell_lon': 0.1, 'n_rows': 3, 'n_cols': 3}
+
+class RecordingRouter:
+    """Router answering every pair with 100 km and recording what it routes"""
+    def __init__(self):
+        self.routed = []
+    
+    def get_distance_matrix_array(self, origins, destinations, **kwargs):
+        self.routed.extend(map(tuple, np.asarray(origins).tolist()))
+        return np.full((len(origins), len(destinations)), 100.0)
+
+def make_chunk(ids):
+    n = len(ids)
+    return {
+        'id': np.asarray(ids, dtype=object),
+        'lat': np.linspace(-35, -34, n),
+        'lon': np.linspace(-60, -59, n),
+        'optimal_port_id': np.where(np.arange(n) % 3 == 2, -1, 7),
+        'total_cost': np.where(np.arange(n) % 3 == 2, np.nan, 41.5),
+        'runner_up_port_id': np.full(n, 9),
+        'runner_up_cost': np.full(n, 43.25),
+        'source': np.array(['grid', 'osrm', 'none'] * (n // 3) + ['grid'] * (n % 3), dtype=object),
+    }
+
+def test_csv_ids_are_quoted():
+    ids = ['plain', 'farm, north', 'silo "B"', 'two\nlines']
+    
+    text = b''.join(write_assignments_csv([make_chunk(ids[:3]), make_chunk(ids[3:])])).decode('utf-8')
+    
+    rows = list(csv.reader(io.StringIO(text)))
+    assert rows[0] == BULK_COLUMNS
+    assert [row[0] for row in rows[1:]] == ids
+    assert all(len(row) == len(BULK_COLUMNS) for row in rows)
+    assert rows[1][1:] == ['-35.000000', '-60.000000', '7', '41.5000', '9', '43.2500', 'grid']
+    assert rows[3][3:5] == ['', ''] and rows[3][7] == 'none'
+
+def test_csv_ids_keep_one_type_across_chunks():
+    source = io.BytesIO(b'id,lat,lon\n' + b''.join(
+        f'{point_id},-34.5,-59.5\n'.encode() for point_id in ['001', '2', '', 'A-3', '5']
+    ))
+    
+    chunks = list(iter_point_chunks(source, chunk_rows=2))
+    
+    assert [ids.tolist() for ids, _, _ in chunks] == [['001', '2'], ['', 'A-3'], ['5']]
+
+def test_parquet_schema_is_fixed_by_the_first_chunk():
+    sink = io.BytesIO(b''.join(write_arrow(
+        [make_chunk(['a', 'b', 'c']), make_chunk([None] * 3)],
+        columns=BULK_COLUMNS, empty_types=BULK_EMPTY_TYPES
+    )))
+    
+    table = pq.read_table(sink)
+    
+    assert table.schema.field('id').type == pa.string()
+    assert table.column('id').to_pylist() == ['a', 'b', 'c', None, None, None]
+    assert table.column('optimal_port_id').null_count == 2
+
+def test_empty_files_have_the_bulk_schema():
+    for parquet in (True, False):
+        data = b''.join(write_arrow([], parquet=parquet, columns=BULK_COLUMNS, empty_types=BULK_EMPTY_TYPES))
+        
+        table = pq.read_table(io.BytesIO(data)) if parquet else pa.ipc.open_stream(data).read_all()
+        
+        assert table.num_rows == 0
+        assert table.schema.names == BULK_COLUMNS
+        assert table.schema.field('id').type == pa.string()
+        assert table.schema.field('source').type == pa.string()
+        assert table.schema.field('lat').type == pa.float64()
+        assert table.schema.field('optimal_port_id').type == pa.int64()
+
+def test_invalid_coordinates_are_left_unassigned(tmp_path):
+    store = DistanceMatrixStore.create(str(tmp_path / 'm.bin'), np.arange(9), [7], np.full((9, 1), 50.0))
+    scenario = parse_scenario({'fuel_price': 1.0, 'ports': [{'id': 7, 'port_charge': 1, 'sea_freight': 1}]}, store)
+    rows = ['a,-34.9,-59.9', 'b,-20.0,-59.9', 'c,abc,-59.9', 'd,,-59.9', 'e,95,-59.9', 'f,-34.8,-200', 'g,-34.8,-59.8']
+    source = io.BytesIO(('id,lat,lon\n' + '\n'.join(rows) + '\n').encode())
+    router = RecordingRouter()
+    stats = {}
+    
+    # The bad values are in later chunks than the first
+    text = b''.join(assign_stream(scenario, store, RASTER, np.arange(9), iter_point_chunks(source, chunk_rows=2),
+                                  router=router, ports_latlon=np.array([[-38.0, -57.5]]), stats=stats)).decode()
+    
+    records = {row[0]: row for row in csv.reader(io.StringIO(text))}
+    assert [records[point_id][7] for point_id in 'abcdefg'] == ['grid', 'osrm', 'none', 'none', 'none', 'none', 'grid']
+    assert router.routed == [(-20.0, -59.9)]
+    assert records['c'][1:5] == ['', '-59.900000', '', '']
+    assert records['e'][1:3] == ['95.000000', '-59.900000']
+    assert stats == {'grid': 2, 'osrm': 1, 'none': 4}
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""
+Tests for the fuel-price lower envelope
+"""
+import numpy as np
+import pytest
+from app.utils.cost import compute_cost_matrix, rank_ports
+from app.utils.envelope import build_fuel_envelope
+
+def compact_winners(compact, fuel_price):
+    """Winner per grid point read from the compact form the way index.html does"""
+    offsets, breakpoints, winners = compact['offsets'], compact['breakpoints'], compact['winners']
+    result = np.empty(len(offsets) - 1, dtype=np.int64)
+    for i in range(len(result)):
+        k = offsets[i]
+        while k < offsets[i + 1] and breakpoints[k] <= fuel_price:
+            k += 1
+        result[i] = winners[k + i]
+    return result
+
+@pytest.fixture
+def inputs():
+    """Random distances with some unreachable pairs and one unreachable grid point"""
+    rng = np.random.default_rng(3)
+    distances = rng.uniform(10, 900, (400, 8))
+    distances[rng.random(distances.shape) < 0.1] = np.nan
+    distances[17] = np.nan
+    return distances, rng.uniform(0, 30, 8), rng.uniform(5, 40, 8)
+
+def test_envelope_matches_ranking_at_any_price(inputs):
+    distances, charges, freights = inputs
+    envelope = build_fuel_envelope(distances, charges, freights, port_ids=np.arange(8) + 100)
+    
+    for fuel_price in np.random.default_rng(4).uniform(0, 5, 25):
+        best = rank_ports(compute_cost_matrix(distances, charges, freights, fuel_price)).best_idx
+        np.testing.assert_array_equal(envelope.winner_index(fuel_price), best)
+        np.testing.assert_array_equal(envelope.winner_ids(fuel_price), np.where(best >= 0, best + 100, -1))
+    assert envelope.winner_index(1.0)[17] == -1
+    assert envelope.n_breaks.max() > 1
+
+def test_compact_form_round_trips(inputs):
+    distances, charges, freights = inputs
+    envelope = build_fuel_envelope(distances, charges, freights)
+    
+    compact = envelope.to_compact()
+    
+    assert compact['offsets'][-1] == len(compact['breakpoints']) == envelope.n_breaks.sum()
+    assert len(compact['winners']) == len(compact['breakpoints']) + len(distances)
+    for fuel_price in [0.0, *envelope.change_points()[::7] + 1e-4, 10.0]:
+        np.testing.assert_array_equal(compact_winners(compact, fuel_price), envelope.winner_index(fuel_price))
+
+def test_fuel_max_drops_later_breakpoints(inputs):
+    distances, charges, freights = inputs
+    full = build_fuel_envelope(distances, charges, freights)
+    
+    capped = build_fuel_envelope(distances, charges, freights, fuel_max=1.5)
+    
+    assert capped.change_points().max() <= 1.5
+    np.testing.assert_array_equal(capped.change_points(), full.change_points()[full.change_points() <= 1.5])
+    for fuel_price in [0.2, 0.9, 1.5]:
+        np.testing.assert_array_equal(capped.winner_index(fuel_price), full.winner_index(fuel_price))
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Tests for the streaming CSV and GeoJSON exports of scenario results
+"""
+import csv
+import gzip
+import io
+import json
+import numpy as np
+import pytest
+from app.utils.export import EXPORT_COLUMNS, export_stream
+from app.utils.matrix_store import DistanceMatrixStore
+from app.utils.scenario import parse_scenario, run_scenario
+
+N_GRID = 300
+
+@pytest.fixture
+def result(tmp_path):
+    """Result with unreachable grid points, missing runners-up and whole chunks without a port"""
+    rng = np.random.default_rng(2)
+    matrix = rng.uniform(10, 500, (N_GRID, 3))
+    matrix[rng.random(N_GRID) < 0.2] = np.nan
+    matrix[:70] = np.nan
+    matrix[100:120, 1:] = np.nan
+    store = DistanceMatrixStore.create(str(tmp_path / 'm.bin'), np.arange(N_GRID) + 1000, [1, 2, 3], matrix)
+    scenario = parse_scenario({'fuel_price': 1.1, 'ports': [
+        {'id': port_id, 'port_charge': port_id, 'sea_freight': 4} for port_id in (1, 2, 3)
+    ]}, store)
+    return run_scenario(scenario, store), store
+
+def coordinates(start, stop):
+    """Row coordinates, with every 11th row missing from grid_points"""
+    rows = np.arange(start, stop)
+    lat = np.where(rows % 11 == 0, np.nan, -40 + rows * 0.01)
+    return lat, -65 + rows * 0.02
+
+def expected_rows(result, store):
+    """Reachable matrix rows and their assignment columns"""
+    ranking = result.ranking
+    rows = np.flatnonzero(ranking.best_idx >= 0)
+    lat, lon = coordinates(0, N_GRID)
+    has_second = ranking.second_idx[rows] >= 0
+    return rows, {
+        'grid_point_id': store.grid_ids[rows],
+        'lat': lat[rows],
+        'lon': lon[rows],
+        'optimal_port_id': result.scenario.port_ids[ranking.best_idx[rows]],
+        'total_cost': ranking.best_cost[rows],
+        'runner_up_port_id': np.where(has_second, result.scenario.port_ids[np.maximum(ranking.second_idx[rows], 0)], -1),
+    }
+
+def read_stream(result, store, export_format, compress):
+    data = b''.join(export_stream(result, store, coordinates, export_format, gzip=compress, chunk_rows=64))
+    return (gzip.decompress(data) if compress else data).decode('utf-8')
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_csv_stream_parses(result, compress):
+    result, store = result
+    rows, expected = expected_rows(result, store)
+    
+    records = list(csv.reader(io.StringIO(read_stream(result, store, 'csv', compress))))
+    
+    assert records[0] == EXPORT_COLUMNS
+    body = records[1:]
+    assert len(body) == len(rows) and all(len(record) == len(EXPORT_COLUMNS) for record in body)
+    np.testing.assert_array_equal([int(record[0]) for record in body], expected['grid_point_id'])
+    np.testing.assert_array_equal([int(record[3]) for record in body], expected['optimal_port_id'])
+    np.testing.assert_allclose([float(record[5]) for record in body], expected['total_cost'], atol=1e-4)
+    np.testing.assert_array_equal([int(record[6]) if record[6] else -1 for record in body],
+                                  expected['runner_up_port_id'])
+    located = np.isfinite(expected['lat'])
+    assert not located.all()
+    assert all(record[1:3] == ['', ''] for record, ok in zip(body, located) if not ok)
+    np.testing.assert_allclose([float(record[1]) for record, ok in zip(body, located) if ok],
+                               expected['lat'][located], atol=1e-6)
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_geojson_stream_parses(result, compress):
+    result, store = result
+    rows, expected = expected_rows(result, store)
+    
+    collection = json.loads(read_stream(result, store, 'geojson', compress))
+    
+    features = collection['features']
+    assert collection['type'] == 'FeatureCollection' and len(features) == len(rows)
+    properties = [feature['properties'] for feature in features]
+    np.testing.assert_array_equal([p['grid_point_id'] for p in properties], expected['grid_point_id'])
+    np.testing.assert_array_equal([p['optimal_port_id'] for p in properties], expected['optimal_port_id'])
+    np.testing.assert_allclose([p['total_cost'] for p in properties], expected['total_cost'], atol=1e-4)
+    np.testing.assert_array_equal([p['runner_up_port_id'] if p['runner_up_port_id'] is not None else -1
+                                   for p in properties], expected['runner_up_port_id'])
+    located = np.isfinite(expected['lat'])
+    assert all((feature['geometry'] is None) == (not ok) for feature, ok in zip(features, located))
+    np.testing.assert_allclose([feature['geometry']['coordinates'] for feature in features if feature['geometry']],
+                               np.column_stack([expected['lon'], expected['lat']])[located], atol=1e-5)
+
+def test_empty_result_is_valid(result):
+    result, store = result
+    result.ranking.best_idx[:] = -1
+    
+    assert read_stream(result, store, 'csv', False) == ','.join(EXPORT_COLUMNS) + '\n'
+    assert json.loads(read_stream(result, store, 'geojson', True)) == {'type': 'FeatureCollection', 'features': []}
\ No newline at end of file
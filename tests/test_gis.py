@@ -0,0 +1,89 @@
+"""
+Tests for polygonizing port regions from the assignment raster
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from app.utils.gis import create_port_regions, polygonize_labels, port_regions_geojson
+from app.utils.grid import Grid
+
+def make_raster(n_rows, n_cols, cell=0.05):
+    return {'origin_lat': -40.0, 'origin_lon': -65.0, 'cell_lat': cell, 'cell_lon': cell,
+            'n_rows': n_rows, 'n_cols': n_cols}
+
+def nearest_seed_labels(n_rows, n_cols, n_seeds, seed=0):
+    """Voronoi-like labels clipped to an ellipse, -1 outside"""
+    rng = np.random.default_rng(seed)
+    seeds = np.column_stack([rng.uniform(0, n_rows, n_seeds), rng.uniform(0, n_cols, n_seeds)])
+    rows, cols = np.mgrid[0:n_rows, 0:n_cols]
+    distances = (rows[..., None] - seeds[:, 0]) ** 2 + 1.7 * (cols[..., None] - seeds[:, 1]) ** 2
+    labels = distances.argmin(axis=-1)
+    labels[((rows / n_rows - 0.5) ** 2 / 0.25 + (cols / n_cols - 0.5) ** 2 / 0.2) >= 1] = -1
+    return labels
+
+def test_disc_and_ring_come_out_whole():
+    rows, cols = np.mgrid[0:100, 0:100]
+    radius = np.hypot(rows - 50, cols - 50)
+    labels = np.full((100, 100), -1)
+    labels[radius < 45] = 2
+    labels[radius < 30] = 1
+    labels[radius < 10] = -1
+    
+    regions = polygonize_labels(labels, make_raster(100, 100))
+    
+    for label in (1, 2):
+        region = regions[label]
+        assert region.is_valid
+        assert len(region.geoms) == 1
+        assert len(region.geoms[0].interiors) == 1
+        assert region.area == pytest.approx((labels == label).sum() * 0.05 ** 2)
+    assert regions[2].geoms[0].interiors[0].equals(regions[1].geoms[0].exterior)
+
+@pytest.mark.parametrize('shape', [(60, 90), (300, 150)])
+def test_regions_tile_the_grid_exactly(shape):
+    labels = nearest_seed_labels(*shape, n_seeds=12)
+    raster = make_raster(*shape)
+    
+    regions = polygonize_labels(labels, raster)
+    
+    assert set(regions) == set(np.unique(labels[labels >= 0]).tolist())
+    geometries = list(regions.values())
+    assert all(region.is_valid for region in geometries)
+    for label, region in regions.items():
+        assert region.area == pytest.approx((labels == label).sum() * 0.05 ** 2)
+    
+    # No overlaps and no gaps: the regions add up to their union
+    union = shapely.union_all(geometries)
+    assert union.area == pytest.approx(sum(region.area for region in geometries))
+    assert union.area == pytest.approx((labels >= 0).sum() * 0.05 ** 2)
+
+def test_disconnected_catchments_stay_separate():
+    labels = np.full((10, 10), -1)
+    labels[1:3, 1:3] = 4
+    labels[6:9, 5:9] = 4
+    labels[6:9, 1:4] = 5
+    
+    regions = polygonize_labels(labels, make_raster(10, 10, cell=1.0))
+    
+    assert len(regions[4].geoms) == 2
+    assert regions[4].area == pytest.approx(16)
+    assert regions[5].equals(shapely.box(0.5 - 65, 5.5 - 40, 3.5 - 65, 8.5 - 40))
+
+def test_regions_geojson_and_geodataframe_agree():
+    labels = nearest_seed_labels(40, 50, n_seeds=5, seed=3)
+    raster = make_raster(40, 50)
+    row, col = np.nonzero(labels >= 0)
+    port_ids = labels[row, col] + 100
+    
+    collection = port_regions_geojson(row, col, port_ids, raster)
+    grid = Grid(raster, row, col)
+    regions_gdf = create_port_regions(grid, pd.DataFrame({'grid_point_id': grid.ids, 'optimal_port_id': port_ids}))
+    
+    counts = {feature['properties']['port_id']: feature['properties']['cell_count']
+              for feature in collection['features']}
+    assert counts == dict(zip(*map(np.ndarray.tolist, np.unique(port_ids, return_counts=True))))
+    assert all(feature['geometry']['type'] == 'MultiPolygon' for feature in collection['features'])
+    for _, region in regions_gdf.iterrows():
+        assert region.geometry.is_valid
+        assert region.geometry.area == pytest.approx(counts[region['port_id']] * 0.05 ** 2)
\ No newline at end of file
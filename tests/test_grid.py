@@ -0,0 +1,77 @@
+"""
+Tests for the raster-backed Grid
+"""
+import numpy as np
+import pytest
+from app.utils.grid import Grid
+
+RASTER = {'origin_lat': -40.0, 'origin_lon': -65.0, 'cell_lat': 0.05, 'cell_lon': 0.08, 'n_rows': 6, 'n_cols': 9}
+
+@pytest.fixture
+def grid():
+    """Points in a scrambled order, with empty cells"""
+    rng = np.random.default_rng(1)
+    ids = rng.permutation(54)[:30]
+    return Grid.from_ids(ids, RASTER)
+
+def test_ids_round_trip(grid):
+    rebuilt = Grid(RASTER, grid.row, grid.col)
+    
+    np.testing.assert_array_equal(rebuilt.ids, grid.ids)
+    np.testing.assert_array_equal(grid.ids, grid.row * 9 + grid.col)
+    np.testing.assert_allclose(grid.lat, -40.0 + grid.row * 0.05)
+    np.testing.assert_allclose(grid.lon, -65.0 + grid.col * 0.08)
+    np.testing.assert_array_equal(Grid.from_ids(grid.ids, RASTER).index_of(grid.ids), np.arange(len(grid)))
+    assert grid.mask.sum() == len(grid)
+
+def test_lookups_return_minus_one_off_the_grid(grid):
+    empty = np.setdiff1d(np.arange(54), grid.ids)[:3]
+    
+    assert (grid.index_of(np.concatenate([empty, [-1, 54, 10 ** 9]])) == -1).all()
+    np.testing.assert_array_equal(grid.index_at(grid.row, grid.col), np.arange(len(grid)))
+    rows, cols = np.divmod(empty, 9)
+    assert (grid.index_at(rows, cols) == -1).all()
+    assert (grid.index_at([-1, 0, 6, 2], [0, -1, 0, 9]) == -1).all()
+
+def test_from_coordinates_snaps_to_the_raster(grid):
+    rng = np.random.default_rng(2)
+    lat = grid.lat + rng.uniform(-0.4, 0.4, len(grid)) * 0.05
+    lon = grid.lon + rng.uniform(-0.4, 0.4, len(grid)) * 0.08
+    
+    snapped = Grid.from_coordinates(lat, lon, RASTER)
+    
+    np.testing.assert_array_equal(snapped.ids, grid.ids)
+    with pytest.raises(ValueError):
+        Grid.from_coordinates([-40.0, np.nan], [-65.0, -64.0], RASTER)
+    with pytest.raises(ValueError):
+        Grid.from_coordinates([-50.0], [-65.0], RASTER)
+
+def test_inferred_raster_keeps_the_lattice():
+    rows, cols = np.divmod(np.arange(54)[::3], 9)
+    
+    snapped = Grid.from_coordinates(-40.0 + rows * 0.05, -65.0 + cols * 0.08)
+    
+    np.testing.assert_allclose(snapped.lat, -40.0 + rows * 0.05)
+    np.testing.assert_allclose(snapped.lon, -65.0 + cols * 0.08)
+    assert len(np.unique(snapped.ids)) == len(rows)
+
+def test_geodataframe_round_trip(grid):
+    grid_gdf = grid.to_geodataframe()
+    
+    rebuilt = Grid.from_geodataframe(grid_gdf)
+    
+    np.testing.assert_array_equal(grid_gdf.index.to_numpy(), grid.ids)
+    np.testing.assert_allclose(grid_gdf.geometry.x, grid.lon)
+    np.testing.assert_allclose(grid_gdf.geometry.y, grid.lat)
+    assert rebuilt.raster == grid.raster
+    np.testing.assert_array_equal(rebuilt.ids, grid.ids)
+    
+    # Without row/col columns the points are snapped from their coordinates
+    coordinates_only = Grid.from_geodataframe(grid_gdf.drop(columns=['row', 'col']))
+    np.testing.assert_array_equal(coordinates_only.ids, grid.ids)
+
+def test_take_keeps_ids(grid):
+    subset = grid.take(grid.row < 3)
+    
+    np.testing.assert_array_equal(subset.ids, grid.ids[grid.row < 3])
+    assert (subset.index_of(grid.ids[grid.row >= 3]) == -1).all()
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Tests for the job runner's dispatcher
+"""
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+from app import create_app, db
+from app.models import Job
+from app.utils.jobs import JOB_RUNNING, JobRunner, job_handler
+
+@job_handler('noop')
+def noop_job(context, params):
+    return {}
+
+class FakePool:
+    """Pool that records submissions, or raises BrokenProcessPool like a pool whose process died"""
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.submitted = []
+        self.shut_down = False
+        self.done = threading.Event()
+    
+    def submit(self, fn, job_id):
+        if self.broken:
+            raise BrokenProcessPool("A process in the process pool was terminated abruptly")
+        self.submitted.append(job_id)
+        self.done.set()
+        return Future()
+    
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'jobs.sqlite'}",
+                      'DISTANCE_MATRIX_PATH': str(tmp_path / 'missing.apdm'),
+                      'JOB_WORKERS': 0, 'JOB_POLL_SECONDS': 0.05, 'TESTING': True})
+    with app.app_context():
+        # Created by the migrations in a deployed database
+        Job.__table__.create(bind=db.engine)
+    return app
+
+def test_broken_pool_is_replaced_and_job_requeued(app, monkeypatch):
+    pools = [FakePool(broken=True), FakePool()]
+    runner = JobRunner(app, max_workers=1)
+    monkeypatch.setattr(runner, '_create_pool', lambda: pools.pop(0))
+    broken, fresh = pools
+    
+    with app.app_context():
+        job_id = runner.submit('noop').id
+        assert fresh.done.wait(5)
+        runner.shutdown()
+        
+        job = db.session.get(Job, job_id)
+        assert fresh.submitted == [job_id]
+        assert broken.shut_down
+        assert job.status == JOB_RUNNING and job.attempts == 1
+        assert runner._running == {job_id}
+
+@pytest.mark.parametrize('kind, params', [
+    ('build_grid', {'shapefile': '/etc/passwd'}),
+    ('build_adaptive_grid', {'scenario': {'fuel_price': 1.2}, 'path': '/tmp/overwritten'}),
+    ('refresh_distances', {'path': '../instance/other.apdm'}),
+])
+def test_submitted_jobs_cannot_choose_files(app, kind, params):
+    response = app.test_client().post('/jobs', json={'kind': kind, 'params': params})
+    
+    assert response.status_code == 400
+    assert 'cannot be set' in response.get_json()['error']
+    with app.app_context():
+        assert db.session.query(Job).count() == 0
\ No newline at end of file
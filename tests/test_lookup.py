@@ -0,0 +1,93 @@
+"""
+Tests for placing coordinates on the grid and interpolating their port distances
+"""
+import numpy as np
+import pytest
+from app.utils.lookup import interpolate_distances, locate_points, lookup_points, lookup_response
+from app.utils.matrix_store import DistanceMatrixStore
+from app.utils.scenario import parse_scenario
+
+RASTER = {'origin_lat': -40.0, 'origin_lon': -65.0, 'cell_lat': 0.5, 'cell_lon': 0.25, 'n_rows': 4, 'n_cols': 5}
+
+@pytest.fixture
+def grid():
+    """Cell rows with the matrix in reverse cell order, and distances linear in row and column"""
+    rows, cols = np.divmod(np.arange(20), 5)
+    cell_rows = np.arange(20)[::-1].copy()
+    matrix = np.empty((20, 2))
+    matrix[cell_rows, 0] = 10 + 3 * rows + 7 * cols
+    matrix[cell_rows, 1] = 100 - 2 * rows + cols
+    return cell_rows, matrix
+
+def raster_point(row, col):
+    """Coordinate at a fractional raster position"""
+    return RASTER['origin_lat'] + row * RASTER['cell_lat'], RASTER['origin_lon'] + col * RASTER['cell_lon']
+
+def interpolate(grid, row, col, positions=(0, 1)):
+    cell_rows, matrix = grid
+    lat, lon = raster_point(row, col)
+    neighbours, weights, nearest = locate_points(np.array([lat]), np.array([lon]), RASTER, cell_rows)
+    return interpolate_distances(matrix, np.array(positions), neighbours, weights)[0], nearest[0]
+
+@pytest.mark.parametrize('row, col', [(0, 0), (2, 3), (3, 4), (3, 0)])
+def test_grid_point_returns_stored_value(grid, row, col):
+    cell_rows, matrix = grid
+    
+    distances, nearest = interpolate(grid, row, col)
+    
+    assert nearest == cell_rows[row * 5 + col]
+    np.testing.assert_allclose(distances, matrix[nearest], rtol=1e-12)
+
+def test_cell_midpoint_averages_the_four_corners(grid):
+    cell_rows, matrix = grid
+    
+    distances, nearest = interpolate(grid, 1.5, 2.5)
+    
+    corners = cell_rows[[1 * 5 + 2, 1 * 5 + 3, 2 * 5 + 2, 2 * 5 + 3]]
+    np.testing.assert_allclose(distances, matrix[corners].mean(axis=0))
+    assert nearest in corners
+    # Distances are linear in row and column, so bilinear interpolation is exact
+    np.testing.assert_allclose(interpolate(grid, 0.3, 1.8)[0], [10 + 3 * 0.3 + 7 * 1.8, 100 - 2 * 0.3 + 1.8])
+
+def test_missing_neighbour_renormalizes_weights(grid):
+    cell_rows, matrix = grid
+    cell_rows[1 * 5 + 3] = -1
+    matrix[cell_rows[2 * 5 + 2], 1] = np.nan
+    
+    distances, _ = interpolate(grid, 1.25, 2.5)
+    
+    # Bilinear weights (row 1, col 2), (1, 3), (2, 2), (2, 3): 0.375, 0.375, 0.125, 0.125
+    corners = cell_rows[[1 * 5 + 2, 2 * 5 + 2, 2 * 5 + 3]]
+    first = matrix[corners, 0] @ [0.375, 0.125, 0.125] / 0.625
+    second = matrix[corners[[0, 2]], 1] @ [0.375, 0.125] / 0.5
+    np.testing.assert_allclose(distances, [first, second])
+
+def test_edge_of_the_raster_uses_the_grid_side(grid):
+    cell_rows, matrix = grid
+    
+    distances, nearest = interpolate(grid, 3, 1.5)
+    
+    np.testing.assert_allclose(distances, matrix[cell_rows[[3 * 5 + 1, 3 * 5 + 2]]].mean(axis=0))
+    assert nearest == cell_rows[3 * 5 + 2]
+
+@pytest.mark.parametrize('row, col', [(-1.5, 2), (2, 5.5), (10, 10)])
+def test_outside_the_raster_has_no_distance(grid, row, col):
+    distances, nearest = interpolate(grid, row, col)
+    
+    assert np.isnan(distances).all()
+    assert nearest == -1
+
+def test_lookup_leaves_points_off_the_grid_unassigned(grid, tmp_path):
+    cell_rows, matrix = grid
+    store = DistanceMatrixStore.create(str(tmp_path / 'm.bin'), np.arange(20) + 500, [8, 9], matrix)
+    scenario = parse_scenario({'fuel_price': 1.0, 'ports': [{'id': 8, 'port_charge': 0, 'sea_freight': 0},
+                                                             {'id': 9, 'port_charge': 0, 'sea_freight': 0}]}, store)
+    lat, lon = map(np.array, zip(raster_point(0, 0), raster_point(-3, 0)))
+    
+    lookup = lookup_points(scenario, store, RASTER, cell_rows, lat, lon)
+    response = lookup_response(scenario, lookup, store.grid_ids, lat, lon)
+    
+    inside, outside = response['results']
+    assert inside['port_id'] == 8 and inside['nearest_grid_point_id'] == 500 + cell_rows[0]
+    assert outside['port_id'] is None and outside['total_cost'] is None
+    assert outside['nearest_grid_point_id'] is None
\ No newline at end of file
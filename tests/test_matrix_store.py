@@ -0,0 +1,217 @@
+"""
+Tests for the memory-mapped distance matrix store and its incremental refresh
+"""
+import numpy as np
+import pytest
+from app.utils import matrix_store
+from app.utils.matrix_store import DistanceMatrixStore, diff_ports, refresh_distance_matrix
+from .conftest import expected_distances
+
+class RecordingRouter:
+    """Router returning the stub server's distances and recording the ports it routes"""
+    def __init__(self):
+        self.failed_batches = []
+        self.routed = []
+    
+    def get_distance_matrix_array(self, origins, destinations, **kwargs):
+        self.routed.append(np.asarray(destinations).copy())
+        return expected_distances(origins, destinations)
+
+def build_store(path, grid, ports, inactive=()):
+    """Store routed for grid x ports, with port snapshots in the header"""
+    port_coordinates = np.array([[port['lat'], port['lon']] for port in ports])
+    metadata = {
+        'ports': {str(port['id']): {'lat': port['lat'], 'lon': port['lon'], 'updated_at': None} for port in ports},
+        'inactive_port_ids': sorted(inactive),
+    }
+    return DistanceMatrixStore.create(
+        str(path), np.arange(100, 100 + len(grid)), [port['id'] for port in ports],
+        expected_distances(grid, port_coordinates), metadata=metadata
+    )
+
+@pytest.fixture
+def ports():
+    return [
+        {'id': 1, 'lat': -34.6, 'lon': -58.4, 'active': True},
+        {'id': 2, 'lat': -38.0, 'lon': -57.5, 'active': True},
+        {'id': 3, 'lat': -32.9, 'lon': -60.6, 'active': True},
+    ]
+
+def test_create_and_open_round_trip(tmp_path, points):
+    matrix = expected_distances(points, points[:4])
+    matrix[5, 2] = np.nan
+    DistanceMatrixStore.create(str(tmp_path / 'm.bin'), np.arange(len(points)), [7, 8, 9, 10], matrix)
+    
+    store = DistanceMatrixStore.open(str(tmp_path / 'm.bin'))
+    
+    assert (store.n_grid, store.n_ports, store.version) == (len(points), 4, 1)
+    np.testing.assert_array_equal(store.grid_ids, np.arange(len(points)))
+    np.testing.assert_array_equal(store.matrix, matrix.astype(np.float32))
+    np.testing.assert_array_equal(store.column(9), matrix[:, 2].astype(np.float32))
+    np.testing.assert_array_equal(store.port_positions([10, 5]), [3, -1])
+
+def test_append_port_bumps_version(tmp_path, points):
+    path = str(tmp_path / 'm.bin')
+    DistanceMatrixStore.create(path, np.arange(len(points)), [1, 2], expected_distances(points, points[:2]))
+    reader = DistanceMatrixStore.open(path)
+    store = DistanceMatrixStore.open(path, writable=True)
+    
+    store = store.append_port(3, expected_distances(points, points[2:3])[:, 0])
+    
+    assert store.version == 2 and store.n_ports == 3
+    assert reader.is_stale()
+    np.testing.assert_allclose(DistanceMatrixStore.open(path).matrix, expected_distances(points, points[:3]), rtol=1e-6)
+    with pytest.raises(ValueError):
+        store.append_port(3, np.zeros(len(points)))
+
+@pytest.mark.parametrize('n_grid', [3, 5000])
+def test_format_1_files_keep_working(tmp_path, monkeypatch, n_grid):
+    path = str(tmp_path / 'v1.bin')
+    rng = np.random.default_rng(0)
+    grid = np.column_stack([rng.uniform(-40, -25, n_grid), rng.uniform(-68, -56, n_grid)])
+    with monkeypatch.context() as patch:
+        # Lay the file out as format 1 did: a 4096-byte header
+        patch.setattr(matrix_store, 'HEADER_SIZE', 4096)
+        DistanceMatrixStore.create(path, np.arange(n_grid) * 3, [1, 2], expected_distances(grid, grid[:2]))
+    with open(path, 'rb') as f:
+        assert matrix_store._PREAMBLE.unpack(f.read(matrix_store._PREAMBLE.size))[1] == 1
+    
+    store = DistanceMatrixStore.open(path, writable=True)
+    np.testing.assert_array_equal(store.grid_ids, np.arange(n_grid) * 3)
+    
+    # Appending rewrites the file in the current format without losing data
+    store = store.append_port(3, expected_distances(grid, grid[2:3])[:, 0])
+    reopened = DistanceMatrixStore.open(path)
+    assert reopened.header['grid_ids_offset'] == matrix_store.HEADER_SIZE
+    np.testing.assert_array_equal(reopened.grid_ids, np.arange(n_grid) * 3)
+    np.testing.assert_allclose(reopened.matrix, expected_distances(grid, grid[:3]), rtol=1e-6)
+
+def test_unknown_format_is_rejected(tmp_path):
+    path = tmp_path / 'bad.bin'
+    path.write_bytes(matrix_store._PREAMBLE.pack(matrix_store.MAGIC, 99, 0, 2) + b'{}')
+    
+    with pytest.raises(ValueError, match='format version 99'):
+        DistanceMatrixStore.open(str(path))
+    assert matrix_store.open_distance_matrix(str(path)) is None
+
+def test_diff_ports_classifies_changes(tmp_path, points, ports):
+    store = build_store(tmp_path / 'm.bin', points, ports, inactive=[3])
+    current = [
+        {**ports[0], 'lat': ports[0]['lat'] + 0.1},
+        {**ports[1], 'active': False},
+        ports[2],
+        {'id': 4, 'lat': -31.4, 'lon': -64.2, 'active': True},
+    ]
+    
+    changes = diff_ports(store, current)
+    
+    assert changes == {'added': [4], 'moved': [1], 'deactivated': [2], 'reactivated': [3], 'unchanged': []}
+
+def test_ports_without_snapshots_are_routed_once(tmp_path, points, ports):
+    path = tmp_path / 'm.bin'
+    store = build_store(path, points, ports, inactive=[3])
+    # A store written before port snapshots were kept, with stale distances
+    metadata = {key: value for key, value in store.metadata.items() if key != 'ports'}
+    DistanceMatrixStore.create(str(path), store.grid_ids, store.port_ids, np.zeros(store.matrix.shape),
+                               metadata=metadata)
+    current = [ports[0], ports[1], {**ports[2], 'active': False}]
+    router = RecordingRouter()
+    
+    summary = refresh_distance_matrix(str(path), current, points, router)
+    
+    assert summary['moved'] == [1, 2] and summary['unchanged'] == [3]
+    refreshed = DistanceMatrixStore.open(str(path))
+    expected = expected_distances(points, [[-34.6, -58.4], [-38.0, -57.5]])
+    np.testing.assert_allclose(refreshed.matrix[:, :2], expected, rtol=1e-6)
+    assert (refreshed.column(3) == 0).all()
+    assert sorted(refreshed.metadata['ports']) == ['1', '2']
+    assert diff_ports(refreshed, current)['unchanged'] == [1, 2, 3]
+    assert diff_ports(refreshed, ports)['moved'] == [3]
+
+def test_refresh_routes_only_new_and_moved_ports(tmp_path, points, ports):
+    path = tmp_path / 'm.bin'
+    build_store(path, points, ports)
+    router = RecordingRouter()
+    current = [{**ports[0], 'lon': -58.0}, ports[1], {**ports[2], 'active': False},
+               {'id': 4, 'lat': -31.4, 'lon': -64.2, 'active': True}]
+    
+    summary = refresh_distance_matrix(str(path), current, points, router)
+    
+    store = DistanceMatrixStore.open(str(path))
+    assert summary['routed_ports'] == 2 and store.version == 2
+    np.testing.assert_array_equal(store.port_ids, [1, 2, 3, 4])
+    assert store.inactive_port_ids == {3}
+    np.testing.assert_array_equal(router.routed[0], [[-31.4, -64.2], [-34.6, -58.0]])
+    expected = expected_distances(points, [[-34.6, -58.0], [-38.0, -57.5], [-32.9, -60.6], [-31.4, -64.2]])
+    np.testing.assert_allclose(store.matrix, expected, rtol=1e-6)
+
+def test_refresh_unmasks_reactivated_port_that_moved(tmp_path, points, ports):
+    path = tmp_path / 'm.bin'
+    build_store(path, points, ports, inactive=[2])
+    router = RecordingRouter()
+    current = [ports[0], {**ports[1], 'lat': -38.5}, ports[2]]
+    
+    summary = refresh_distance_matrix(str(path), current, points, router)
+    
+    store = DistanceMatrixStore.open(str(path))
+    assert summary['moved'] == [2]
+    assert store.inactive_port_ids == set()
+    assert store.active_mask.all()
+    np.testing.assert_allclose(store.column(2), expected_distances(points, [[-38.5, -57.5]])[:, 0], rtol=1e-6)
+
+def test_refresh_dry_run_and_no_changes_leave_file(tmp_path, points, ports):
+    path = tmp_path / 'm.bin'
+    build_store(path, points, ports)
+    router = RecordingRouter()
+    
+    assert refresh_distance_matrix(str(path), ports, points, router)['matrix_version'] == 1
+    summary = refresh_distance_matrix(str(path), [{**ports[0], 'lat': -30.0}] + ports[1:], points, router, dry_run=True)
+    
+    assert summary['moved'] == [1]
+    assert router.routed == []
+    assert DistanceMatrixStore.open(str(path)).version == 1
+
+def test_rebuild_keeps_version_increasing(tmp_path, points):
+    path = str(tmp_path / 'm.bin')
+    matrix = expected_distances(points, points[:2])
+    store = DistanceMatrixStore.create(path, np.arange(len(points)), [1, 2], matrix)
+    
+    rebuilt = DistanceMatrixStore.create(path, np.arange(len(points)), [1, 2], matrix)
+    
+    assert (store.version, rebuilt.version) == (1, 2)
+    assert store.is_stale() and not rebuilt.is_stale()
+    assert DistanceMatrixStore.create(path, np.arange(len(points)), [1], matrix[:, :1], matrix_version=7).version == 7
+
+def test_stale_check_is_throttled(tmp_path, points, monkeypatch):
+    path = str(tmp_path / 'm.bin')
+    DistanceMatrixStore.create(path, np.arange(len(points)), [1, 2], expected_distances(points, points[:2]))
+    reader = DistanceMatrixStore.open(path)
+    reads = []
+    read_header = matrix_store._read_header
+    monkeypatch.setattr(matrix_store, '_read_header', lambda p: reads.append(p) or read_header(p))
+    
+    # Unchanged file: a stat, no header read
+    assert not reader.is_stale()
+    assert reads == []
+    
+    DistanceMatrixStore.open(path, writable=True).append_port(3, np.zeros(len(points)))
+    reads.clear()
+    assert not reader.is_stale(min_interval=3600)
+    assert reader.is_stale()
+    assert len(reads) == 1
+
+def test_refresh_refuses_to_mix_router_backends(tmp_path, points, ports):
+    path = tmp_path / 'm.bin'
+    build_store(path, points, ports)
+    router = RecordingRouter()
+    router.backend = 'haversine'
+    current = ports + [{'id': 4, 'lat': -31.4, 'lon': -64.2, 'active': True}]
+    
+    with pytest.raises(ValueError, match='osrm distances'):
+        refresh_distance_matrix(str(path), current, points, router)
+    
+    assert router.routed == []
+    assert DistanceMatrixStore.open(str(path)).version == 1
+    router.backend = 'osrm'
+    refresh_distance_matrix(str(path), current, points, router)
+    assert DistanceMatrixStore.open(str(path)).metadata['router_backend'] == 'osrm'
\ No newline at end of file
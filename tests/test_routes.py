@@ -0,0 +1,134 @@
+"""
+Tests for the scenario endpoints, run against a small raster distance matrix
+"""
+import base64
+import gzip
+import json
+import struct
+import numpy as np
+import pytest
+from app import create_app
+from app.utils.export import RASTER_MAGIC
+from app.utils.matrix_store import DistanceMatrixStore
+
+RASTER = {'origin_lat': -40.0, 'origin_lon': -65.0, 'cell_lat': 0.1, 'cell_lon': 0.1, 'n_rows': 5, 'n_cols': 10}
+
+SCENARIO = {'fuel_price': 1.0, 'ports': [{'id': 1, 'port_charge': 1, 'sea_freight': 2},
+                                         {'id': 2, 'port_charge': 2, 'sea_freight': 1}]}
+
+def build_matrix(path, seed=0):
+    """Matrix on RASTER (grid ids are cell indices) with one unreachable grid point"""
+    rng = np.random.default_rng(seed)
+    matrix = rng.uniform(10, 500, (50, 2))
+    matrix[7] = np.nan
+    return DistanceMatrixStore.create(str(path), np.arange(50), [1, 2], matrix, metadata={'raster': RASTER})
+
+def decode_raster(data):
+    """Header and arrays of a binary raster, read the way index.html does"""
+    assert data[:4] == RASTER_MAGIC
+    length = struct.unpack('<I', data[4:8])[0]
+    header = json.loads(data[8:8 + length])
+    start = (8 + length + 7) // 8 * 8
+    arrays = {}
+    for entry in header['arrays']:
+        assert entry['offset'] % 8 == 0
+        arrays[entry['name']] = np.frombuffer(data, dtype=entry['dtype'], count=entry['length'],
+                                              offset=start + entry['offset'])
+    return header, arrays
+
+@pytest.fixture
+def app(tmp_path):
+    build_matrix(tmp_path / 'm.apdm')
+    return create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DISTANCE_MATRIX_PATH': str(tmp_path / 'm.apdm'),
+                       'JOB_WORKERS': 0, 'TESTING': True})
+
+def test_if_none_match_is_answered_without_computing(app):
+    client = app.test_client()
+    etag = client.post('/calculate', json=SCENARIO).headers['ETag']
+    cache = app.extensions['scenario_cache']
+    cache.clear()
+    
+    response = client.post('/calculate', json=SCENARIO, headers={'If-None-Match': etag})
+    
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert cache.stats()['entries'] == 0
+
+def test_rebuilt_matrix_gets_a_new_etag(app, tmp_path):
+    client = app.test_client()
+    first = client.post('/calculate', json=SCENARIO)
+    
+    build_matrix(tmp_path / 'm.apdm', seed=1)
+    app.extensions['distance_matrix']._checked_at = 0
+    response = client.post('/calculate', json=SCENARIO, headers={'If-None-Match': first.headers['ETag']})
+    
+    assert response.status_code == 200
+    assert response.headers['ETag'] != first.headers['ETag']
+    assert response.get_json()['matrix_version'] == 2
+
+def test_batch_matches_individual_calculations(app):
+    client = app.test_client()
+    scenarios = [
+        {'fuel_price': 0.2},
+        {'fuel_price': 1.0},
+        {'fuel_price': 1.0, 'ports': [{'id': 1, 'port_charge': 30, 'sea_freight': 2},
+                                      {'id': 2, 'port_charge': 2, 'sea_freight': 1}]},
+        {'fuel_price': 2.5, 'ports': [SCENARIO['ports'][0], {**SCENARIO['ports'][1], 'active': False}]},
+    ]
+    
+    batch = client.post('/calculate/batch', json={'ports': SCENARIO['ports'], 'scenarios': scenarios}).get_json()
+    
+    assert batch['port_ids'] == [1, 2]
+    for overrides, summary in zip(scenarios, batch['scenarios']):
+        single = client.post('/calculate', json={**SCENARIO, **overrides}).get_json()
+        assignments = single['assignments']
+        port_id = np.full(len(batch['grid_point_id']), -1)
+        port_id[assignments['grid_point_id']] = assignments['port_id']
+        
+        assert summary['scenario_id'] == single['scenario_id']
+        assert summary['port_id'] == port_id.tolist()
+        assert summary['port_counts'] == {str(port['id']): port['grid_points']
+                                          for port in single['ports'] if port['grid_points']}
+        assert summary['mean_cost'] == pytest.approx(np.mean(assignments['total_cost']), abs=1e-4)
+        assert summary['changed_vs_baseline'] == int((port_id != batch['scenarios'][0]['port_id']).sum())
+    assert len({tuple(summary['port_id']) for summary in batch['scenarios']}) > 2
+
+@pytest.mark.parametrize('accept_encoding', ['identity', 'gzip'])
+def test_binary_raster_matches_json_result(app, accept_encoding):
+    client = app.test_client()
+    single = client.post('/calculate', json=SCENARIO).get_json()
+    
+    response = client.post('/calculate?format=binary', json=SCENARIO, headers={'Accept-Encoding': accept_encoding})
+    
+    assert response.mimetype == 'application/octet-stream'
+    data = gzip.decompress(response.data) if accept_encoding == 'gzip' else response.data
+    header, arrays = decode_raster(data)
+    assert header['scenario_id'] == single['scenario_id']
+    assert header['raster'] == RASTER
+    assert list(arrays) == ['port_index', 'total_cost', 'gradient']
+    
+    assignments = single['assignments']
+    cells = np.array(assignments['grid_point_id'])
+    port_ids = np.array(header['port_ids'])
+    np.testing.assert_array_equal(port_ids[arrays['port_index'][cells]], assignments['port_id'])
+    np.testing.assert_allclose(arrays['total_cost'][cells], assignments['total_cost'], rtol=1e-6, atol=1e-4)
+    assert arrays['port_index'][7] == header['port_index_nodata']
+    assert np.isnan(arrays['total_cost'][7]) and np.isnan(arrays['gradient'][7])
+    
+    # The base64 form carries the same arrays
+    encoded = client.post('/calculate?format=base64&fields=port_index,gradient', json=SCENARIO).get_json()
+    assert list(encoded['arrays']) == ['port_index', 'gradient']
+    for name, entry in encoded['arrays'].items():
+        np.testing.assert_array_equal(np.frombuffer(base64.b64decode(entry['data']), dtype=entry['dtype']), arrays[name])
+@pytest.mark.parametrize('scenario_id', [None, 7, ['a'], {'id': 'a'}])
+def test_scenario_id_must_be_a_string(app, scenario_id):
+    client = app.test_client()
+    known = client.post('/calculate', json=SCENARIO).get_json()['scenario_id']
+    
+    delta = client.post('/calculate/delta', json={'scenario_id': scenario_id, 'port_id': 1, 'port_charge': 5})
+    lookup = client.post('/lookup', json={'scenario_id': scenario_id, 'lat': -39.8, 'lon': -64.7})
+    
+    assert delta.status_code == 400 and 'scenario_id' in delta.get_json()['error']
+    assert lookup.status_code == 400 and 'scenario_id' in lookup.get_json()['error']
+    assert client.post('/calculate/delta', json={'scenario_id': 'missing', 'port_id': 1}).status_code == 404
+    assert client.post('/lookup', json={'scenario_id': known, 'lat': -39.8, 'lon': -64.7}).status_code == 200
\ No newline at end of file
@@ -0,0 +1,316 @@
+"""
+Tests for the routers in app.utils.routing; the OSRM client runs against a local stub server
+"""
+import numpy as np
+import pytest
+from app.utils import routing
+from app.utils.distance_cache import DistanceCache
+from app.utils.cost import compute_cost_matrix, rank_ports
+from app.utils.routing import (
+    DIRECTION_FORWARD, DIRECTION_REVERSE, AdaptiveConcurrencyLimiter, HaversineRouter, OSRMRouter,
+    compute_pruned_distance_matrix, create_router, haversine_matrix, plan_table_requests
+)
+from .conftest import expected_distances
+
+def make_router(server, **kwargs) -> OSRMRouter:
+    """OSRMRouter for the stub server that retries without sleeping"""
+    kwargs.setdefault('backoff_factor', 0)
+    kwargs.setdefault('timeout', 5)
+    return OSRMRouter(osrm_url=server.url, **kwargs)
+
+@pytest.mark.parametrize('n_origins, n_destinations, max_table_size, max_url_length, direction', [
+    (1000, 30, 100, 8192, DIRECTION_FORWARD),
+    (1000, 30, 10, 8192, DIRECTION_REVERSE),
+    (997, 7, 100, 1000, DIRECTION_FORWARD),
+    (50, 250, 12, 2000, DIRECTION_FORWARD),
+    (3, 2, 100, 8192, DIRECTION_REVERSE),
+])
+def test_plan_respects_limits_and_covers_every_pair(n_origins, n_destinations, max_table_size,
+                                                    max_url_length, direction):
+    plan = plan_table_requests(n_origins, n_destinations, max_table_size=max_table_size,
+                               max_url_length=max_url_length, base_url_length=40, direction=direction)
+    
+    covered = np.zeros((n_origins, n_destinations), dtype=int)
+    for batch in plan.batches:
+        n_sources = batch.origin_stop - batch.origin_start
+        n_targets = batch.destination_stop - batch.destination_start
+        assert n_sources * n_targets <= max_table_size ** 2
+        assert routing._estimate_table_url_length(40, n_sources + n_targets) <= max_url_length
+        assert batch.reverse == (direction == DIRECTION_REVERSE)
+        covered[batch.origin_start:batch.origin_stop, batch.destination_start:batch.destination_stop] += 1
+    assert (covered == 1).all()
+    assert plan.expected_calls == len(plan.batches)
+
+def test_plan_sends_all_destinations_together_when_they_fit():
+    plan = plan_table_requests(5000, 30)
+    
+    assert plan.destinations_per_call == 30
+    assert all((batch.destination_start, batch.destination_stop) == (0, 30) for batch in plan.batches)
+    assert plan_table_requests(0, 30).batches == []
+
+def test_table_urls_stay_under_the_limit(osrm_server, points):
+    router = make_router(osrm_server, max_table_size=10, max_url_length=350)
+    origins, destinations = points[:50], points[50:]
+    
+    matrix = router.get_distance_matrix_array(origins, destinations)
+    
+    assert max(len(osrm_server.url + path) for path in osrm_server.table_requests) <= 350
+    assert len(osrm_server.table_requests) == router.plan_distance_matrix(50, 10).expected_calls
+    np.testing.assert_allclose(matrix, expected_distances(origins, destinations), rtol=1e-6)
+
+def test_matrix_matches_server_distances(osrm_server, points):
+    router = make_router(osrm_server, max_table_size=10)
+    origins, destinations = points[:45], points[45:]
+    
+    matrix = router.get_distance_matrix_array(origins, destinations)
+    
+    np.testing.assert_allclose(matrix, expected_distances(origins, destinations), rtol=1e-6)
+    assert router.failed_batches == []
+    assert len(osrm_server.table_requests) == router.plan_distance_matrix(45, 15).expected_calls
+
+def test_unreachable_pairs_are_nan(osrm_server, points):
+    osrm_server.unreachable_points.add(tuple(points[3]))
+    router = make_router(osrm_server)
+    
+    matrix = router.get_distance_matrix_array(points[:10], points[50:55])
+    
+    assert np.isnan(matrix[3]).all()
+    assert not np.isnan(np.delete(matrix, 3, axis=0)).any()
+    assert router.failed_batches == []
+
+def test_transient_failures_are_retried(osrm_server, points):
+    osrm_server.transient_failures = 3
+    router = make_router(osrm_server, max_retries=3, max_concurrency=1)
+    
+    matrix = router.get_distance_matrix_array(points[:20], points[50:], batch_size=10)
+    
+    np.testing.assert_allclose(matrix, expected_distances(points[:20], points[50:]), rtol=1e-6)
+    assert router.failed_batches == []
+    assert len(osrm_server.table_requests) == 2 + 3
+
+def test_each_transient_failure_lowers_the_limit(osrm_server, points, monkeypatch):
+    releases = []
+    
+    class RecordingLimiter(AdaptiveConcurrencyLimiter):
+        def release(self, overloaded=False):
+            releases.append(overloaded)
+            super().release(overloaded=overloaded)
+    
+    monkeypatch.setattr(routing, 'AdaptiveConcurrencyLimiter', RecordingLimiter)
+    osrm_server.transient_failures = 3
+    router = make_router(osrm_server, max_retries=3, max_concurrency=1)
+    
+    matrix = router.get_distance_matrix_array(points[:10], points[50:], batch_size=10)
+    
+    # Every retried 503 halves the limit before the retry, not after the batch
+    assert router.failed_batches == []
+    assert releases == [True, True, True, False]
+    np.testing.assert_allclose(matrix, expected_distances(points[:10], points[50:]), rtol=1e-6)
+
+def test_exhausted_retries_record_failed_batch(osrm_server, points):
+    osrm_server.transient_failures = 2
+    router = make_router(osrm_server, max_retries=1, max_concurrency=1)
+    
+    matrix = router.get_distance_matrix_array(points[:10], points[50:], batch_size=10)
+    
+    assert len(router.failed_batches) == 1
+    assert router.failed_batches[0]['error'] == 'HTTP 503'
+    assert np.isnan(matrix).all()
+
+def test_failed_batches_are_kept_and_retried(osrm_server, points):
+    osrm_server.failing_points.add(tuple(points[12]))
+    router = make_router(osrm_server)
+    origins, destinations = points[:30], points[50:]
+    
+    matrix = router.get_distance_matrix_array(origins, destinations, batch_size=10)
+    
+    # Permanent errors are not retried: one request per batch
+    assert len(osrm_server.table_requests) == 3
+    assert len(router.failed_batches) == 1
+    np.testing.assert_array_equal(router.failed_batches[0]['origins'], np.arange(10, 20))
+    np.testing.assert_array_equal(router.failed_batches[0]['destinations'], np.arange(10))
+    assert np.isnan(matrix[10:20]).all()
+    np.testing.assert_allclose(matrix[:10], expected_distances(origins[:10], destinations), rtol=1e-6)
+    
+    osrm_server.failing_points.clear()
+    router.retry_failed_batches(origins, destinations, matrix)
+    
+    assert router.failed_batches == []
+    assert len(osrm_server.table_requests) == 4
+    np.testing.assert_allclose(matrix, expected_distances(origins, destinations), rtol=1e-6)
+
+def test_cached_failures_index_caller_arrays(osrm_server, points, tmp_path):
+    cache = DistanceCache(path=str(tmp_path / 'cache.sqlite'), network_version='test')
+    router = make_router(osrm_server, cache=cache)
+    origins, destinations = points[:30], points[50:]
+    
+    # Cache every other origin so only the odd rows are routed
+    router.get_distance_matrix_array(origins[::2], destinations)
+    assert router.failed_batches == []
+    osrm_server.failing_points.add(tuple(origins[21]))
+    
+    matrix = router.get_distance_matrix_array(origins, destinations, batch_size=5)
+    
+    # Rows 10-14 of the routed sub-matrix are caller rows 21-29
+    assert len(router.failed_batches) == 2
+    for failure in router.failed_batches:
+        np.testing.assert_array_equal(failure['origins'], [21, 23, 25, 27, 29])
+    failed = router.failed_pairs(*matrix.shape)
+    assert failed.sum() == 5 * 10
+    assert np.isnan(matrix[failed]).all()
+    np.testing.assert_allclose(matrix[~failed], expected_distances(origins, destinations)[~failed], rtol=1e-6)
+    
+    osrm_server.failing_points.clear()
+    requests_before = len(osrm_server.table_requests)
+    router.retry_failed_batches(origins, destinations, matrix)
+    
+    assert router.failed_batches == []
+    assert len(osrm_server.table_requests) == requests_before + 2
+    np.testing.assert_allclose(matrix, expected_distances(origins, destinations), rtol=1e-6)
+    assert cache.get_matrix(origins, destinations)[1].all()
+
+def test_pruned_routing_leaves_failed_cached_pairs_unrouted(osrm_server, points, tmp_path):
+    cache = DistanceCache(path=str(tmp_path / 'cache.sqlite'), network_version='test')
+    router = make_router(osrm_server, cache=cache, max_table_size=4)
+    origins, ports = points[:40], points[40:46]
+    charges, freights = np.array([5, 3, 4, 6, 2, 7.0]), np.array([20, 25, 22, 18, 30, 15.0])
+    router.get_distance_matrix_array(origins[::2], ports)
+    osrm_server.failing_points.add(tuple(origins[13]))
+    
+    distances, routed = compute_pruned_distance_matrix(router, origins, ports, charges, freights, 1.1)
+    
+    # Every pair marked routed has its distance; failed pairs are neither routed nor cached
+    assert not routed[13].any()
+    np.testing.assert_allclose(distances[routed], expected_distances(origins, ports)[routed], rtol=1e-6)
+    assert not cache.get_matrix(origins[13:14], ports)[1].any()
+    
+    osrm_server.failing_points.clear()
+    distances, routed = compute_pruned_distance_matrix(router, origins, ports, charges, freights, 1.1,
+                                                       distance_matrix=distances, routed_mask=routed)
+    
+    full = rank_ports(compute_cost_matrix(expected_distances(origins, ports), charges, freights, 1.1))
+    pruned = rank_ports(compute_cost_matrix(distances, charges, freights, 1.1))
+    np.testing.assert_array_equal(pruned.best_idx, full.best_idx)
+    assert routed[13].any()
+
+def test_concurrency_stays_within_limit(osrm_server, points):
+    osrm_server.delay = 0.02
+    router = make_router(osrm_server, max_concurrency=3)
+    
+    router.get_distance_matrix_array(points, points[:5], batch_size=5)
+    
+    assert len(osrm_server.table_requests) == 12
+    assert 1 < osrm_server.max_in_flight <= 3
+
+def test_unreachable_server_fails_batches_and_single_routes(points):
+    router = OSRMRouter(osrm_url='http://127.0.0.1:9', max_retries=1, backoff_factor=0, timeout=1)
+    
+    matrix = router.get_distance_matrix_array(points[:4], points[50:52])
+    
+    assert np.isnan(matrix).all()
+    assert len(router.failed_batches) == 1
+    assert router.get_distance(tuple(points[0]), tuple(points[1])) is None
+    assert router.check_connection() is False
+
+def test_single_route_and_health(osrm_server, points):
+    router = make_router(osrm_server)
+    
+    assert router.check_connection() is True
+    assert router.get_distance(tuple(points[0]), tuple(points[1])) == pytest.approx(
+        expected_distances(points[:1], points[1:2])[0, 0], rel=1e-6
+    )
+
+def test_limiter_grows_after_window_and_halves_on_overload():
+    limiter = AdaptiveConcurrencyLimiter(max_limit=8, initial_limit=2)
+    
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 3
+    
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 4
+    
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+def test_limiter_respects_bounds():
+    limiter = AdaptiveConcurrencyLimiter(max_limit=2, initial_limit=5)
+    assert limiter.limit == 2
+    
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 2
+    
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    assert limiter.limit == 1
+
+def fill_cache(cache, circuity_by_lat, n_origins=40, seed=6):
+    """Cache road distances as the great-circle distance times a factor per origin latitude band"""
+    rng = np.random.default_rng(seed)
+    destinations = np.column_stack([rng.uniform(-38, -30, 5), rng.uniform(-64, -58, 5)])
+    for (lat_min, lat_max), circuity in circuity_by_lat.items():
+        origins = np.column_stack([rng.uniform(lat_min, lat_max, n_origins), rng.uniform(-63.9, -62.1, n_origins)])
+        cache.put_matrix(origins, destinations, haversine_matrix(origins, destinations) * circuity)
+
+def test_calibration_fits_regional_circuity(tmp_path):
+    cache = DistanceCache(path=str(tmp_path / 'cache.sqlite'), network_version='test')
+    fill_cache(cache, {(-35.9, -34.1): 1.5, (-33.9, -32.1): 1.2})
+    router = HaversineRouter(circuity=1.3, region_size_deg=2.0)
+    
+    summary = router.calibrate(cache, min_samples=30)
+    
+    assert summary['pairs'] > 300 and summary['regions'] == 2
+    np.testing.assert_allclose(router.circuity_factors([(-35, -63), (-33, -63), (-20, -63)]),
+                               [1.5, 1.2, router.circuity], rtol=1e-3)
+    origins = [(-35.2, -62.7), (-33.4, -63.5)]
+    np.testing.assert_allclose(router.get_distance_matrix_array(origins, [(-31, -60)]),
+                               haversine_matrix(origins, [(-31, -60)]) * [[1.5], [1.2]], rtol=1e-3)
+
+def test_calibration_without_cached_pairs_keeps_circuity(tmp_path):
+    cache = DistanceCache(path=str(tmp_path / 'cache.sqlite'), network_version='test')
+    router = HaversineRouter(circuity=1.4)
+    
+    assert router.calibrate(cache)['pairs'] == 0
+    np.testing.assert_allclose(router.circuity_factors([(-35, -63)]), [1.4])
+
+def test_create_router_selects_backend(tmp_path, monkeypatch):
+    monkeypatch.delenv('ROUTER_BACKEND', raising=False)
+    assert isinstance(create_router(), OSRMRouter)
+    assert isinstance(create_router('HAVERSINE'), HaversineRouter)
+    
+    monkeypatch.setenv('ROUTER_BACKEND', 'haversine')
+    assert isinstance(create_router(), HaversineRouter)
+    assert isinstance(create_router('osrm'), OSRMRouter)
+    with pytest.raises(ValueError):
+        create_router('graphhopper')
+
+def test_calibration_follows_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(routing, '_calibrations', {})
+    monkeypatch.setattr(routing, 'CALIBRATION_SAMPLE_SIZE', 500)
+    cache = DistanceCache(path=str(tmp_path / 'cache.sqlite'), network_version='test')
+    fill_cache(cache, {(-35.9, -34.1): 1.5}, n_origins=20)
+    
+    assert create_router('haversine', cache).circuity == pytest.approx(1.5, rel=1e-3)
+    
+    # New pairs change the sample, so the factors are fitted again
+    fill_cache(cache, {(-35.9, -34.1): 1.1}, n_origins=100, seed=7)
+    refitted = create_router('haversine', cache)
+    assert refitted.circuity == pytest.approx(1.1, rel=1e-3)
+    assert len(routing._calibrations) == 1
+    
+    # Once a full sample is cached, more pairs reuse the factors
+    fill_cache(cache, {(-35.9, -34.1): 1.9}, n_origins=60, seed=8)
+    assert create_router('haversine', cache).circuity == refitted.circuity
+    
+    cache.invalidate()
+    fill_cache(cache, {(-35.9, -34.1): 1.9}, n_origins=20, seed=9)
+    assert create_router('haversine', cache).circuity == pytest.approx(1.9, rel=1e-3)
\ No newline at end of file
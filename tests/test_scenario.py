@@ -0,0 +1,121 @@
+"""
+Tests for the top-2 port ranking and incremental scenario updates
+"""
+import numpy as np
+import pytest
+from app.utils.cost import rank_ports
+from app.utils.matrix_store import DistanceMatrixStore
+from app.utils.scenario import ScenarioCache, ScenarioError, apply_port_delta, parse_scenario, run_scenario
+
+# Fuel price at which one km of trucking costs exactly one dollar per ton
+UNIT_FUEL_PRICE = 62.5
+
+def reference_ranking(cost_matrix):
+    """Best and runner-up column by a full stable sort (ties to the lower column)"""
+    order = np.argsort(cost_matrix, axis=1, kind='stable')[:, :2]
+    costs = np.take_along_axis(cost_matrix, order, axis=1)
+    return np.where(np.isfinite(costs), order, -1), costs
+
+def assert_same_ranking(ranking, other):
+    np.testing.assert_array_equal(ranking.best_idx, other.best_idx)
+    np.testing.assert_array_equal(ranking.second_idx, other.second_idx)
+    np.testing.assert_allclose(ranking.best_cost, other.best_cost)
+    np.testing.assert_allclose(ranking.second_cost, other.second_cost)
+    np.testing.assert_allclose(ranking.gradient, other.gradient)
+    np.testing.assert_array_equal(ranking.is_boundary, other.is_boundary)
+
+@pytest.fixture
+def store(tmp_path):
+    """Integer distances, so costs at UNIT_FUEL_PRICE tie often, with some unreachable pairs"""
+    rng = np.random.default_rng(11)
+    matrix = rng.integers(20, 60, (2000, 6)).astype(np.float64)
+    matrix[rng.random(matrix.shape) < 0.05] = np.nan
+    matrix[7] = np.nan
+    return DistanceMatrixStore.create(str(tmp_path / 'm.bin'), np.arange(len(matrix)), [10, 20, 30, 40, 50, 60], matrix)
+
+def make_scenario(store, charges):
+    return parse_scenario({
+        'fuel_price': UNIT_FUEL_PRICE,
+        'ports': [{'id': port_id, 'port_charge': charge, 'sea_freight': 5}
+                  for port_id, charge in zip([10, 20, 30, 40, 50, 60], charges)],
+    }, store)
+
+@pytest.mark.parametrize('port_id', [True, False, 10.0, '10', None])
+def test_port_ids_must_be_integers(store, port_id):
+    ports = [{'id': 20, 'port_charge': 1, 'sea_freight': 5}, {'id': port_id, 'port_charge': 1, 'sea_freight': 5}]
+    
+    with pytest.raises(ScenarioError, match='integer id'):
+        parse_scenario({'fuel_price': UNIT_FUEL_PRICE, 'ports': ports}, store)
+
+@pytest.mark.parametrize('n_ports', [1, 2, 7])
+def test_rank_ports_matches_full_sort(n_ports):
+    rng = np.random.default_rng(n_ports)
+    costs = rng.integers(0, 5, (500, n_ports)).astype(np.float64)
+    costs[rng.random(costs.shape) < 0.2] = np.inf
+    
+    ranking = rank_ports(costs)
+    
+    idx, expected = reference_ranking(costs)
+    np.testing.assert_array_equal(ranking.best_idx, idx[:, 0])
+    np.testing.assert_array_equal(ranking.best_cost, expected[:, 0])
+    if n_ports > 1:
+        np.testing.assert_array_equal(ranking.second_idx, idx[:, 1])
+        np.testing.assert_array_equal(ranking.second_cost, expected[:, 1])
+    else:
+        assert (ranking.second_idx == -1).all()
+
+def test_port_delta_matches_full_recompute(store):
+    rng = np.random.default_rng(5)
+    charges = rng.integers(0, 20, 6).astype(np.float64)
+    result = run_scenario(make_scenario(store, charges), store)
+    
+    # Chained edits in both directions, reusing the carried-over margin index
+    for _ in range(40):
+        column = int(rng.integers(6))
+        charges[column] = max(0.0, charges[column] + int(rng.integers(-12, 13)))
+        updated, changed = apply_port_delta(result, store, int(result.scenario.port_ids[column]),
+                                            port_charge=charges[column])
+        
+        full = run_scenario(make_scenario(store, charges), store)
+        assert updated.key == full.key
+        assert_same_ranking(updated.ranking, full.ranking)
+        moved = (full.ranking.best_idx != result.ranking.best_idx) | (full.ranking.second_idx != result.ranking.second_idx)
+        np.testing.assert_array_equal(changed, np.flatnonzero(moved))
+        result = updated
+
+def test_unchanged_cost_keeps_ranking(store):
+    result = run_scenario(make_scenario(store, [1, 2, 3, 4, 5, 6]), store)
+    
+    updated, changed = apply_port_delta(result, store, 30, sea_freight=5)
+    
+    assert updated.key == result.key
+    assert len(changed) == 0
+    assert updated.ranking is result.ranking
+
+def test_delta_rejects_unknown_port(store):
+    result = run_scenario(make_scenario(store, [1, 2, 3, 4, 5, 6]), store)
+    
+    with pytest.raises(ScenarioError):
+        apply_port_delta(result, store, 99, port_charge=1)
+
+def test_cache_keeps_byte_total_as_results_grow(store):
+    cache = ScenarioCache(max_entries=10, max_bytes=10 ** 6)
+    results = [run_scenario(make_scenario(store, [charge, 2, 3, 4, 5, 6]), store) for charge in range(3)]
+    for result in results:
+        cache.put(result)
+    assert cache.stats()['bytes'] == sum(result.nbytes for result in results)
+    
+    results[0].body
+    cache.resize(results[0])
+    cache.put(results[1])
+    
+    assert cache.stats()['bytes'] == sum(result.nbytes for result in results)
+    # Re-putting results[1] made results[0] the least recently used
+    cache.max_bytes = results[1].nbytes + results[2].nbytes
+    cache.resize(results[1])
+    assert cache.stats()['entries'] == 2 and cache.get(results[0].key) is None
+    assert cache.stats()['bytes'] == results[1].nbytes + results[2].nbytes
+    
+    cache.clear()
+    cache.resize(results[1])
+    assert cache.stats()['bytes'] == 0
\ No newline at end of file
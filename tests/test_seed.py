@@ -0,0 +1,135 @@
+"""
+Tests for bulk loading grid points and distances
+"""
+import sqlite3
+import numpy as np
+import pytest
+from sqlalchemy import event, text
+from app import create_app, db
+from app.models import Distance, GridPoint
+from app.utils.grid import Grid
+from app.utils.matrix_store import DistanceMatrixStore
+from app.utils.seed import copy_batches, distance_batches, grid_point_batches, seed_distances, seed_grid, verify_seed
+
+RASTER = {'origin_lat': -40.0, 'origin_lon': -65.0, 'cell_lat': 0.1, 'cell_lon': 0.2, 'n_rows': 4, 'n_cols': 5}
+
+@pytest.fixture
+def app(tmp_path):
+    return create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'seed.sqlite'}",
+                       'DISTANCE_MATRIX_PATH': str(tmp_path / 'missing.apdm'),
+                       'JOB_WORKERS': 0, 'TESTING': True})
+
+@pytest.fixture
+def grid():
+    return Grid.from_ids(np.array([0, 2, 3, 7, 8, 11, 14, 19]), RASTER)
+
+@pytest.fixture
+def store(tmp_path, grid):
+    """Matrix over the grid with unroutable pairs and a port without any route"""
+    rng = np.random.default_rng(5)
+    matrix = rng.uniform(5, 800, (len(grid), 3))
+    matrix[rng.random(matrix.shape) < 0.3] = np.nan
+    matrix[:, 2] = np.nan
+    return DistanceMatrixStore.create(str(tmp_path / 'm.bin'), grid.ids, [4, 5, 6], matrix)
+
+@pytest.fixture
+def spatial_app(app):
+    """App whose SQLite connections load SpatiaLite, which the geometry columns need"""
+    if not hasattr(sqlite3.Connection, 'enable_load_extension'):
+        pytest.skip("sqlite3 is built without extension loading")
+    from geoalchemy2 import load_spatialite
+    
+    with app.app_context():
+        event.listen(db.engine, 'connect', load_spatialite)
+        try:
+            db.create_all()
+        except Exception as e:
+            pytest.skip(f"SpatiaLite is not available: {e}")
+    return app
+
+def create_plain_grid_points(connection, grid, ids=None):
+    """grid_points without the geometry column, filled from grid_point_batches"""
+    connection.exec_driver_sql("CREATE TABLE grid_points (id INTEGER PRIMARY KEY, lat FLOAT, lon FLOAT)")
+    for batch in grid_point_batches(grid, batch_rows=3, ids=ids):
+        connection.exec_driver_sql("INSERT INTO grid_points (id, lat, lon) VALUES (?, ?, ?)",
+                                   list(zip(batch['id'].tolist(), batch['lat'].tolist(), batch['lon'].tolist())))
+
+def test_grid_point_batches(grid):
+    batches = list(grid_point_batches(grid, batch_rows=3))
+    
+    assert [len(batch['id']) for batch in batches] == [3, 3, 2]
+    np.testing.assert_array_equal(np.concatenate([batch['id'] for batch in batches]), grid.ids)
+    assert batches[0]['location'][1] == f"SRID=4326;POINT({float(grid.lon[1])!r} {float(grid.lat[1])!r})"
+    
+    ids = np.arange(len(grid)) + 900
+    overridden = list(grid_point_batches(grid, batch_rows=3, ids=ids))
+    np.testing.assert_array_equal(np.concatenate([batch['id'] for batch in overridden]), ids)
+    np.testing.assert_array_equal(np.concatenate([batch['lat'] for batch in overridden]), grid.lat)
+
+def test_copy_batches_skips_unroutable_pairs(app, store):
+    with app.app_context():
+        Distance.__table__.create(bind=db.engine)
+        
+        with db.engine.begin() as connection:
+            written = copy_batches(connection, Distance.__table__, ['grid_point_id', 'port_id', 'distance_km'],
+                                   distance_batches(store, batch_rows=3))
+            rows = connection.execute(text("SELECT grid_point_id, port_id, distance_km FROM distances")).all()
+    
+    expected = {(int(grid_id), int(port_id)): store.column(int(port_id))[i]
+                for port_id in store.port_ids for i, grid_id in enumerate(store.grid_ids)
+                if not np.isnan(store.column(int(port_id))[i])}
+    assert written == len(rows) == len(expected)
+    assert {(grid_id, port_id): distance for grid_id, port_id, distance in rows} == pytest.approx(expected)
+
+def test_seeded_distances_verify(app, grid, store):
+    with app.app_context():
+        Distance.__table__.create(bind=db.engine)
+        with db.engine.begin() as connection:
+            create_plain_grid_points(connection, grid)
+        
+        summary = seed_distances(db.session, store, batch_rows=4)
+        report = verify_seed(db.session, store)
+        
+        assert summary['distances'] == sum(np.count_nonzero(~np.isnan(store.column(port_id))) for port_id in (4, 5, 6))
+        assert report['problems'] == []
+        assert report['grid_points'] == len(grid)
+        assert report['distances_per_port'] == {
+            port_id: int(np.count_nonzero(~np.isnan(store.column(port_id)))) for port_id in (4, 5)
+        }
+        
+        # Reloading one port replaces its rows instead of duplicating them
+        seed_distances(db.session, store, port_ids=[4])
+        assert verify_seed(db.session, store)['problems'] == []
+        with pytest.raises(ValueError):
+            seed_distances(db.session, store, port_ids=[99])
+
+def test_verify_reports_mismatches(app, grid, store):
+    with app.app_context():
+        Distance.__table__.create(bind=db.engine)
+        with db.engine.begin() as connection:
+            create_plain_grid_points(connection, grid.take(np.arange(len(grid)) < 6))
+            connection.exec_driver_sql(
+                "INSERT INTO distances (grid_point_id, port_id, distance_km) VALUES (999, 4, 1.0)"
+            )
+        
+        problems = verify_seed(db.session, store)['problems']
+        
+        assert any('missing grid points' in problem for problem in problems)
+        assert any('6 rows, the matrix 8' in problem for problem in problems)
+        assert any(problem.startswith('Port 5:') for problem in problems)
+
+def test_seed_grid_and_distances(spatial_app, grid, store):
+    with spatial_app.app_context():
+        assert seed_grid(db.session, grid, batch_rows=3)['grid_points'] == len(grid)
+        seed_distances(db.session, store)
+        
+        assert verify_seed(db.session, store)['problems'] == []
+        with pytest.raises(ValueError):
+            seed_grid(db.session, grid)
+        
+        ids = np.arange(len(grid)) + 900
+        seed_grid(db.session, grid, replace=True, ids=ids)
+        assert sorted(db.session.scalars(db.select(GridPoint.id))) == ids.tolist()
+        assert db.session.query(Distance).count() == 0
+        with pytest.raises(ValueError):
+            seed_grid(db.session, grid, replace=True, ids=np.zeros(len(grid)))
\ No newline at end of file
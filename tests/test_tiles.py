@@ -0,0 +1,31 @@
+"""
+Tests for the background tile prerenderer
+"""
+import threading
+from types import SimpleNamespace
+from app.utils import tiles
+from app.utils.tiles import TilePrerenderer
+
+def test_prerenderer_skips_queued_scenarios_and_stays_bounded(monkeypatch):
+    release = threading.Event()
+    rendered = []
+    
+    def prerender_tiles(result, raster, cell_rows, cache, max_zoom):
+        release.wait(5)
+        rendered.append((result.key, threading.current_thread().name))
+    
+    monkeypatch.setattr(tiles, 'prerender_tiles', prerender_tiles)
+    prerenderer = TilePrerenderer(max_queued=2)
+    
+    assert prerenderer.submit(SimpleNamespace(key='a'), {}, None, None)
+    assert not prerenderer.submit(SimpleNamespace(key='a'), {}, None, None)
+    assert prerenderer.submit(SimpleNamespace(key='b'), {}, None, None)
+    assert not prerenderer.submit(SimpleNamespace(key='c'), {}, None, None)
+    assert prerenderer.pending() == 2
+    
+    release.set()
+    prerenderer._executor.shutdown(wait=True)
+    
+    assert [key for key, _ in rendered] == ['a', 'b']
+    assert len({name for _, name in rendered}) == 1
+    assert prerenderer.pending() == 0
\ No newline at end of file